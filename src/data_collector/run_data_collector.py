@@ -38,6 +38,10 @@ import argparse
 import urllib.request
 import timeit
 import struct
+import hashlib
+import urllib.error
+import http.client
+import time
 
 #Add one directory level above to path to find imports
 full_path = os.path.abspath(sys.argv[0])
@@ -45,6 +49,16 @@ path_add = os.path.dirname(os.path.dirname(full_path))
 sys.path.append(path_add)
 
 import utils.utilities as utilities
+import utils.request_state as request_state
+import utils.profiling as profiling
+
+#Size of the chunks bulk seismogram files are downloaded in, in bytes
+DOWNLOAD_CHUNK_SIZE = 4*1024*1024
+#Seconds to wait for the server to respond before giving up on an attempt
+DOWNLOAD_TIMEOUT = 60
+#Number of times a failed download is retried, and the delay before the first retry in seconds, which doubles each time
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_RETRY_DELAY = 2.0
 
 debug = False
 
@@ -54,6 +68,10 @@ def parse_args(argv):
     parser.add_argument('-i', '--input-filename', dest='input_filename', action='store', default=None, help="Path to file containing the URLs and variation IDs.")
     parser.add_argument('-o', '--output-directory', dest='output_directory', action='store', default=".", help="Path to output directory to store files in.")
     parser.add_argument('-t', '--temp-directory', dest='temp_directory', action='store', default=".", help="Path to temporary directory to store files before extraction.")
+    parser.add_argument('-sf', '--state-filename', dest='state_filename', action='store', default=None, help="Path to state file used to record completed downloads and extractions (optional).")
+    parser.add_argument('-r', '--resume', dest='resume', action='store_true', default=False, help="Skip downloads and extractions already recorded in the state file, and continue partial downloads.")
+    parser.add_argument('-pr', '--profile', dest='profile', action='store', default=None, choices=profiling.PROFILE_MODES, help="Profile this stage's CPU time or memory allocations, and write reports to the output directory (optional).")
+    parser.add_argument('-pp', '--profile-prefix', dest='profile_prefix', action='store', default=None, help="Path and filename prefix for the profile reports (optional, default is <output directory>/csdata.data_collector).")
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
     parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help="Show version number and exit.")
     args = parser.parse_args(args=argv)
@@ -64,7 +82,19 @@ def parse_args(argv):
     if args.input_filename is None:
         print("Path to input file must be provided, aborting.", file=sys.stderr)
         sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+    if args.resume==True and args.state_filename is None:
+        print("A state file must be provided to resume, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
     args_dict['input_filename'] = args.input_filename
+    args_dict['resume'] = args.resume
+    args_dict['state'] = None
+    if args.state_filename is not None:
+        state = request_state.RequestState(args.state_filename)
+        #Don't add records to a state file which can't be read back, since the next resume would ignore them
+        if args.resume==True and not state.load():
+            print("No usable state file found at %s, starting from the beginning." % args.state_filename)
+            state.create()
+        args_dict['state'] = state
     output_directory = args.output_directory
     if output_directory is None:
         output_directory = "."
@@ -81,40 +111,132 @@ def parse_args(argv):
     if not os.path.exists(temp_directory):
         os.makedirs(temp_directory)
     args_dict['temp_directory'] = temp_directory
+    args_dict['profile'] = args.profile
+    if args.profile_prefix is None:
+        args_dict['profile_prefix'] = "%s/csdata.data_collector" % output_directory
+    else:
+        args_dict['profile_prefix'] = args.profile_prefix
     if args.debug==True:
         debug = True
     return args_dict
     
 
+#Downloads url to local_filename, via a .part file so incomplete downloads are never mistaken for complete ones.
+#If resume is set and a .part file exists, continues it with an HTTP Range request.
+#Returns (size, MD5 checksum) of the downloaded file.
+def download_file(url, local_filename, resume=False):
+    part_filename = "%s.part" % local_filename
+    md5 = hashlib.md5()
+    offset = 0
+    request = urllib.request.Request(url)
+    if resume==True and os.path.exists(part_filename):
+        offset = os.path.getsize(part_filename)
+        request.add_header('Range', 'bytes=%d-' % offset)
+    try:
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code!=416:
+            raise
+        #Range not satisfiable, so the partial file can't be trusted; start over
+        offset = 0
+        response = urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT)
+    if offset>0 and response.status==206:
+        if debug:
+            print("Continuing download of %s from byte %d." % (url, offset))
+        #Seed the checksum with the part we already have
+        with open(part_filename, 'rb') as fp_part:
+            while True:
+                chunk = fp_part.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                md5.update(chunk)
+            fp_part.close()
+        mode = 'ab'
+    else:
+        #Server sent the whole file
+        offset = 0
+        mode = 'wb'
+    size = offset
+    content_length = response.getheader('Content-Length')
+    with open(part_filename, mode) as fp_out:
+        while True:
+            chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            md5.update(chunk)
+            fp_out.write(chunk)
+            size += len(chunk)
+        fp_out.flush()
+        fp_out.close()
+    response.close()
+    #Reads don't fail if the connection is closed early, so check we got everything.  The .part file is kept to continue from.
+    if content_length is not None and size-offset!=int(content_length):
+        raise http.client.IncompleteRead(b'', int(content_length)-(size-offset))
+    os.replace(part_filename, local_filename)
+    return (size, md5.hexdigest())
+
+#Client errors other than these won't go away by retrying
+RETRY_HTTP_CODES = [408, 429]
+
+#Downloads url to local_filename, retrying failures.  A failed attempt leaves its .part file behind, so each retry
+#continues from where the last one stopped.  Aborts if the file can't be downloaded.
+def download_with_retries(url, local_filename, resume=False):
+    delay = DOWNLOAD_RETRY_DELAY
+    for attempt in range(0, DOWNLOAD_RETRIES+1):
+        try:
+            return download_file(url, local_filename, resume=(resume or attempt>0))
+        except (OSError, http.client.HTTPException) as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code<500 and e.code not in RETRY_HTTP_CODES:
+                print("Error downloading %s, aborting." % url, file=sys.stderr)
+                print(e)
+                sys.exit(utilities.ExitCodes.FILE_DOWNLOAD_ERROR)
+            if attempt==DOWNLOAD_RETRIES:
+                print("Error downloading %s after %d attempts, aborting." % (url, DOWNLOAD_RETRIES+1), file=sys.stderr)
+                print(e)
+                sys.exit(utilities.ExitCodes.FILE_DOWNLOAD_ERROR)
+            print("Error downloading %s (%s), retrying in %.0f seconds." % (url, e, delay))
+            time.sleep(delay)
+            delay *= 2
+
 def retrieve_files(args_dict):
     global debug
     input_file = args_dict['input_filename']
+    state = args_dict['state']
     local_filenames = []
     with open(input_file, 'r') as fp_in:
         data = fp_in.readlines()
         num_files = len(data)
         for i, line in enumerate(data):
-            print("Downloading file %d of %d." % (i+1, num_files))
             (url, rvs) = line.strip().split()
             #Use directory hierarchy of temp_directory/site_id/run_id
-            (protocol, blank, prefix, site_name, run_id, basename) = url.split("/")
+            #The last three parts of the URL path are the site, run, and file; the server URL may have a path of its own
+            (site_name, run_id, basename) = url.rsplit("/", 3)[1:]
             local_directory = "%s/%s/%s" % (args_dict['temp_directory'], site_name, run_id)
             if not os.path.exists(local_directory):
                 os.makedirs(local_directory)
             local_filename = "%s/%s" % (local_directory, basename)
+            if args_dict['resume']==True:
+                rv_set = set([int(rv) for rv in rvs.split(",")])
+                if rv_set.issubset(state.get_extracted_rvs(url)):
+                    #Everything we need from this file was already extracted
+                    continue
+                if state.is_file_downloaded(url, local_filename):
+                    print("File %d of %d was already downloaded." % (i+1, num_files))
+                    local_filenames.append(local_filename)
+                    continue
+            print("Downloading file %d of %d." % (i+1, num_files))
             local_filenames.append(local_filename)
             if debug:
                 print("File URL: %s" % url)
-            url_data = urllib.request.urlopen(url).read()
-            with open(local_filename, 'wb') as fp_out:
-                fp_out.write(url_data)
-                fp_out.flush()
-                fp_out.close()
+            (size, checksum) = download_with_retries(url, local_filename, resume=args_dict['resume'])
+            if state is not None:
+                state.mark_file_downloaded(url, local_filename, size, checksum)
         fp_in.close()
     return local_filenames
 
 def extract_rvs(args_dict):
     input_file = args_dict['input_filename']
+    state = args_dict['state']
     with open(input_file, 'r') as fp_in:
         data = fp_in.readlines()
         num_files = len(data)
@@ -122,10 +244,17 @@ def extract_rvs(args_dict):
             if (i%100==0):
                 print("Extracting rupture variations from file %d of %d." % ((i+1), num_files))
             (url, rvs) = line.strip().split()
-            (protocol, blank, prefix, site_name, run_id, basename) = url.split("/")
+            #The last three parts of the URL path are the site, run, and file; the server URL may have a path of its own
+            (site_name, run_id, basename) = url.rsplit("/", 3)[1:]
             rv_list = []
             for rv in rvs.split(","):
                 rv_list.append(int(rv))
+            if args_dict['resume']==True:
+                extracted_rvs = state.get_extracted_rvs(url)
+                rv_list = [rv for rv in rv_list if rv not in extracted_rvs]
+                if len(rv_list)==0:
+                    continue
+            extracted_list = []
             local_rupture_directory = "%s/%s/%s" % (args_dict['temp_directory'], site_name, run_id)
             local_rupture_filename = "%s/%s" % (local_rupture_directory, url.rsplit("/", 1)[1])
             sizeof_float = 4
@@ -135,7 +264,7 @@ def extract_rvs(args_dict):
                     #Read next header
                     header_str = fp_rup_in.read(56)
                     #If we're out of data
-                    if header_str=='':
+                    if len(header_str)<56:
                         break
                     rv = struct.unpack('i', header_str[32:36])[0]
                     nt = struct.unpack('i', header_str[40:44])[0]
@@ -152,6 +281,7 @@ def extract_rvs(args_dict):
                             fp_out.flush()
                             fp_out.close()
                         rv_list.remove(rv)
+                        extracted_list.append(rv)
                     else:
                         fp_rup_in.seek(num_components*sizeof_float*nt, 1)
                 if len(rv_list)!=0:
@@ -160,6 +290,8 @@ def extract_rvs(args_dict):
                     fp_in.close()
                     sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
                 fp_rup_in.close()
+            if state is not None:
+                state.mark_rvs_extracted(url, extracted_list)
         fp_in.close()
     print("Finished extracting rupture variations to %s." % (args_dict['output_directory']))
     
@@ -172,9 +304,14 @@ def delete_temp_files(temp_directory, local_filenames):
 
 def run_main(argv):
     args_dict = parse_args(argv)
+    profiling.run_profiled(args_dict['profile'], args_dict['profile_prefix'], collect_data, args_dict)
+
+def collect_data(args_dict):
     local_filenames = retrieve_files(args_dict)
     extract_rvs(args_dict)
     delete_temp_files(args_dict['temp_directory'], local_filenames)
+    if args_dict['state'] is not None:
+        args_dict['state'].close()
 
 if __name__=="__main__":
     run_main(sys.argv[1:])
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Joins intensity measures with their site, rupture, and IM type metadata on the client.  Only the PeakAmplitudes
+columns are queried from the database; the metadata tables are read once into dicts, from the local metadata mirror
+if it has the study, and the metadata is added to each row as the results are streamed.'''
+
+import sys
+import os
+import operator
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.utilities as utilities
+import utils.metadata_mirror as metadata_mirror
+import db_wrapper.im_cache as im_cache
+import db_wrapper.wide_layout as wide_layout
+
+JOIN_MODES = ['server', 'client']
+
+#Number of rows fetched and joined at a time
+FETCH_BATCH_SIZE = 100000
+
+#If filters on Ruptures match at most this many ruptures, they're also added to the PeakAmplitudes query, so that
+#rows for other ruptures aren't sent to the client just to be dropped
+MAX_PUSHDOWN_RUPTURES = 1000
+
+#Tables which can be joined on the client, other than PeakAmplitudes
+RUN_TABLES = set(['CyberShake_Runs', 'CyberShake_Sites', 'Studies'])
+DIMENSION_TABLES = RUN_TABLES.union(set(['IM_Types', 'Ruptures', 'Rupture_Variations']))
+
+#PeakAmplitudes fields which are always fetched, since they're the keys into the metadata tables
+FACT_KEY_FIELDS = ['Run_ID', 'Source_ID', 'Rupture_ID', 'Rup_Var_ID', 'IM_Type_ID']
+
+#The joins the Query Constructor generates between these tables, which are the ones done on the client
+KNOWN_JOINS = set()
+KNOWN_JOINS.add('CyberShake_Runs.ERF_ID=Rupture_Variations.ERF_ID')
+KNOWN_JOINS.add('CyberShake_Runs.ERF_ID=Ruptures.ERF_ID')
+KNOWN_JOINS.add('CyberShake_Runs.Run_ID=PeakAmplitudes.Run_ID')
+KNOWN_JOINS.add('CyberShake_Runs.Rup_Var_Scenario_ID=Rupture_Variations.Rup_Var_Scenario_ID')
+KNOWN_JOINS.add('CyberShake_Runs.Site_ID=CyberShake_Sites.CS_Site_ID')
+KNOWN_JOINS.add('CyberShake_Runs.Study_ID=Studies.Study_ID')
+KNOWN_JOINS.add('IM_Types.IM_Type_ID=PeakAmplitudes.IM_Type_ID')
+KNOWN_JOINS.add('Rupture_Variations.ERF_ID=Ruptures.ERF_ID')
+KNOWN_JOINS.add('Rupture_Variations.Rup_Var_ID=PeakAmplitudes.Rup_Var_ID')
+KNOWN_JOINS.add('Rupture_Variations.Rupture_ID=PeakAmplitudes.Rupture_ID')
+KNOWN_JOINS.add('Rupture_Variations.Rupture_ID=Ruptures.Rupture_ID')
+KNOWN_JOINS.add('Rupture_Variations.Source_ID=PeakAmplitudes.Source_ID')
+KNOWN_JOINS.add('Rupture_Variations.Source_ID=Ruptures.Source_ID')
+KNOWN_JOINS.add('Ruptures.Rupture_ID=PeakAmplitudes.Rupture_ID')
+KNOWN_JOINS.add('Ruptures.Source_ID=PeakAmplitudes.Source_ID')
+
+
+#Returns a join term in the form used in KNOWN_JOINS, with the PeakAmplitudes table under its usual name, or None if
+#the term isn't an equality between two fields
+def normalize_join(term, pa_table):
+    sides = term.split("=")
+    if len(sides)!=2:
+        return None
+    fields = []
+    for side in sides:
+        pieces = side.strip().split(".")
+        if len(pieces)!=2 or not pieces[0].isidentifier() or not pieces[1].isidentifier():
+            return None
+        if pieces[0]==pa_table:
+            pieces[0] = 'PeakAmplitudes'
+        fields.append(".".join(pieces))
+    #Each join is listed with the tables in a fixed order, apart from PeakAmplitudes which is always last
+    if fields[0].startswith('PeakAmplitudes.') or (not fields[1].startswith('PeakAmplitudes.') and fields[1]<fields[0]):
+        fields.reverse()
+    return "=".join(fields)
+
+#Returns None if the query can be joined on the client, or else the reason it can't
+def get_client_join_problem(input_dict):
+    if input_dict['data_product']!="Intensity Measures":
+        return "only intensity measure queries are joined on the client"
+    from_tables = [t.strip() for t in input_dict['from'].split(",")]
+    pa_table = im_cache.get_peak_amplitudes_table(from_tables)
+    if pa_table is None:
+        return "the query doesn't use PeakAmplitudes"
+    for t in from_tables:
+        if t!=pa_table and t not in DIMENSION_TABLES:
+            return "the query uses %s" % t
+    if 'CyberShake_Runs' not in from_tables and len(set(from_tables).intersection(DIMENSION_TABLES - set(['IM_Types'])))>0:
+        return "the query doesn't use CyberShake_Runs"
+    for option in ['group_by', 'limit']:
+        if option in input_dict:
+            return "queries with a %s are joined by the database" % option.replace("_", " ")
+    #The wide layout's order is the PeakAmplitudes key, which the database can read in order without a join
+    if 'sort' in input_dict and input_dict['sort']!=wide_layout.get_key_sort(pa_table):
+        return "the results are sorted"
+    for f in input_dict['select'].split(","):
+        pieces = f.strip().split(".")
+        if len(pieces)!=2 or pieces[0] not in from_tables or not pieces[1].isidentifier():
+            return "the selected field '%s' isn't a table column" % f.strip()
+    for t in im_cache.split_where(input_dict['where']):
+        if len(im_cache.get_term_tables(t))>1 and normalize_join(t, pa_table) not in KNOWN_JOINS:
+            return "the condition '%s' involves more than one table" % t
+    return None
+
+
+#Joins the results of a query on the client.  load_dimensions() reads the metadata tables, then get_fact_query()
+#returns the query to run on PeakAmplitudes, and read_cursor() joins its results and writes them to writer.
+class ClientJoin:
+
+    def __init__(self, input_dict, writer, existing_results=None):
+        self.writer = writer
+        self.existing_results = existing_results
+        self.num_rows = 0
+        self.from_tables = [t.strip() for t in input_dict['from'].split(",")]
+        self.pa_table = im_cache.get_peak_amplitudes_table(self.from_tables)
+        self.where = input_dict['where']
+        self.sort = input_dict.get('sort')
+        #Conditions on each group of tables; joins between them are implied by the dict keys
+        self.terms = dict()
+        for t in im_cache.split_where(input_dict['where']):
+            tables = im_cache.get_term_tables(t)
+            if len(tables)>1 and not tables.issubset(RUN_TABLES):
+                continue
+            if tables.issubset(RUN_TABLES) and len(tables)>0:
+                group = 'runs'
+            elif tables==set(['IM_Types']):
+                group = 'IM_Types'
+            elif tables==set(['Ruptures']):
+                group = 'Ruptures'
+            elif tables==set(['Rupture_Variations']):
+                group = 'Rupture_Variations'
+            else:
+                group = 'PeakAmplitudes'
+            self.terms.setdefault(group, []).append(t)
+        #Selected fields from each group of tables
+        self.select_fields = dict()
+        self.output_fields = []
+        for f in input_dict['select'].split(","):
+            field = f.strip()
+            table = field.split(".")[0]
+            if table==self.pa_table:
+                group = 'PeakAmplitudes'
+            elif table in RUN_TABLES:
+                group = 'runs'
+            else:
+                group = table
+            self.select_fields.setdefault(group, [])
+            if field not in self.select_fields[group]:
+                self.select_fields[group].append(field)
+            self.output_fields.append((group, field))
+        self.fact_fields = ["%s.%s" % (self.pa_table, f) for f in FACT_KEY_FIELDS]
+        for field in self.select_fields.get('PeakAmplitudes', []):
+            if field not in self.fact_fields:
+                self.fact_fields.append(field)
+        self.column_indices = utilities.get_column_indices([utilities.get_select_field_name(field) for (group, field) in self.output_fields])
+        #Filled in by load_dimensions()
+        self.runs = None
+        self.im_types = None
+        self.ruptures = None
+        self.rupture_variations = None
+        self.pushdown_ruptures = None
+
+    def __len__(self):
+        return self.num_rows
+
+    #The metadata tables can be read from the mirror if they're all in it and it has the query's study
+    def can_use_mirror(self, mirror_path):
+        if mirror_path is None:
+            return False
+        for t in self.from_tables:
+            if t!=self.pa_table and t not in metadata_mirror.MIRROR_TABLES:
+                return False
+        study_name = metadata_mirror.get_query_study(self.where)
+        if study_name is None:
+            return False
+        return study_name in metadata_mirror.get_mirrored_studies(mirror_path)
+
+    #Returns whether a group of tables needs a dict: if any of its fields are selected, or it has conditions which
+    #could remove rows
+    def is_needed(self, group):
+        return len(self.select_fields.get(group, []))>0 or len(self.terms.get(group, []))>0
+
+    #Runs a metadata query and returns a dict of the first num_keys fields of each row to the rest of the row
+    def read_dimension(self, cur, select_fields, tables, terms, num_keys):
+        if len(terms)==0:
+            terms = ['1=1']
+        query = 'select %s from %s where %s' % (",".join(select_fields), ",".join(tables), " and ".join(terms))
+        cur.execute(query)
+        dimension = dict()
+        for row in cur.fetchall():
+            if num_keys==1:
+                dimension[row[0]] = row[1:]
+            else:
+                dimension[row[:num_keys]] = row[num_keys:]
+        return dimension
+
+    #Reads the metadata tables the query uses into dicts, using the given cursor
+    def load_dimensions(self, cur):
+        erf_ids = None
+        if 'CyberShake_Runs' in self.from_tables:
+            tables = sorted(RUN_TABLES.intersection(set(self.from_tables)))
+            #Each run's entry starts with its ERF and rupture variation scenario, which key the rupture tables
+            fields = ['CyberShake_Runs.Run_ID', 'CyberShake_Runs.ERF_ID', 'CyberShake_Runs.Rup_Var_Scenario_ID'] + self.select_fields.get('runs', [])
+            self.runs = self.read_dimension(cur, fields, tables, self.terms.get('runs', []), 1)
+            erf_ids = sorted(set([r[0] for r in self.runs.values()]))
+            rv_scenario_ids = sorted(set([r[1] for r in self.runs.values()]))
+        if 'IM_Types' in self.from_tables:
+            fields = ['IM_Types.IM_Type_ID'] + self.select_fields.get('IM_Types', [])
+            self.im_types = self.read_dimension(cur, fields, ['IM_Types'], self.terms.get('IM_Types', []), 1)
+        if erf_ids is None or len(erf_ids)==0:
+            return
+        erf_term = "in (%s)" % ",".join(["%d" % e for e in erf_ids])
+        if 'Ruptures' in self.from_tables and self.is_needed('Ruptures'):
+            fields = ['Ruptures.ERF_ID', 'Ruptures.Source_ID', 'Ruptures.Rupture_ID'] + self.select_fields.get('Ruptures', [])
+            terms = ["Ruptures.ERF_ID %s" % erf_term] + self.terms.get('Ruptures', [])
+            self.ruptures = self.read_dimension(cur, fields, ['Ruptures'], terms, 3)
+            if len(self.terms.get('Ruptures', []))>0 and len(self.ruptures)<=MAX_PUSHDOWN_RUPTURES:
+                self.pushdown_ruptures = sorted(set([k[1:] for k in self.ruptures.keys()]))
+        if 'Rupture_Variations' in self.from_tables and self.is_needed('Rupture_Variations'):
+            fields = ['Rupture_Variations.ERF_ID', 'Rupture_Variations.Rup_Var_Scenario_ID', 'Rupture_Variations.Source_ID', 'Rupture_Variations.Rupture_ID', 'Rupture_Variations.Rup_Var_ID'] + self.select_fields.get('Rupture_Variations', [])
+            tables = ['Rupture_Variations']
+            terms = ["Rupture_Variations.ERF_ID %s" % erf_term, "Rupture_Variations.Rup_Var_Scenario_ID in (%s)" % ",".join(["%d" % s for s in rv_scenario_ids])] + self.terms.get('Rupture_Variations', [])
+            #Only read the rupture variations of the ruptures which pass the filters
+            if len(self.terms.get('Ruptures', []))>0:
+                tables.append('Ruptures')
+                terms.extend(['Rupture_Variations.ERF_ID=Ruptures.ERF_ID', 'Rupture_Variations.Source_ID=Ruptures.Source_ID', 'Rupture_Variations.Rupture_ID=Ruptures.Rupture_ID'] + self.terms['Ruptures'])
+            self.rupture_variations = self.read_dimension(cur, fields, tables, terms, 5)
+
+    #Returns the query on PeakAmplitudes alone, restricted to the runs and IM types which passed the filters
+    def get_fact_query(self):
+        terms = list(self.terms.get('PeakAmplitudes', []))
+        if self.runs is not None:
+            terms.append(self.get_in_term('Run_ID', sorted(self.runs.keys())))
+        if self.im_types is not None:
+            terms.append(self.get_in_term('IM_Type_ID', sorted(self.im_types.keys())))
+        if self.pushdown_ruptures is not None:
+            terms.append(self.get_rupture_term(self.pushdown_ruptures))
+        fact_dict = {'select': ",".join(self.fact_fields), 'from': self.pa_table, 'where': " and ".join(terms), 'data_product': "Intensity Measures"}
+        if self.sort is not None:
+            fact_dict['sort'] = self.sort
+        return fact_dict
+
+    def get_in_term(self, field, values):
+        if len(values)==0:
+            return "1=0"
+        return "%s.%s in (%s)" % (self.pa_table, field, ",".join(["%d" % v for v in values]))
+
+    #Returns a condition matching the (Source_ID, Rupture_ID) pairs, grouped by source
+    def get_rupture_term(self, rupture_keys):
+        if len(rupture_keys)==0:
+            return "1=0"
+        ruptures_by_source = dict()
+        for (source_id, rupture_id) in rupture_keys:
+            ruptures_by_source.setdefault(source_id, []).append(rupture_id)
+        source_terms = []
+        for source_id in sorted(ruptures_by_source.keys()):
+            source_terms.append("(%s.Source_ID=%d and %s.Rupture_ID in (%s))" % (self.pa_table, source_id, self.pa_table, ",".join(["%d" % r for r in ruptures_by_source[source_id]])))
+        return "(%s)" % " or ".join(source_terms)
+
+    #Returns an itemgetter which picks the output fields out of a fact row with the run, IM type, rupture, and
+    #rupture variation entries appended, in that order
+    def get_output_getter(self):
+        offsets = dict()
+        offsets['PeakAmplitudes'] = 0
+        offset = len(self.fact_fields)
+        #Run entries start with the ERF and rupture variation scenario
+        offsets['runs'] = offset + 2
+        if self.runs is not None:
+            offset += 2 + len(self.select_fields.get('runs', []))
+        offsets['IM_Types'] = offset
+        if self.im_types is not None:
+            offset += len(self.select_fields.get('IM_Types', []))
+        offsets['Ruptures'] = offset
+        if self.ruptures is not None:
+            offset += len(self.select_fields.get('Ruptures', []))
+        offsets['Rupture_Variations'] = offset
+        indices = []
+        for (group, field) in self.output_fields:
+            if group=='PeakAmplitudes':
+                indices.append(self.fact_fields.index(field))
+            else:
+                indices.append(offsets[group] + self.select_fields[group].index(field))
+        if len(indices)==1:
+            #itemgetter with one index returns a value rather than a tuple
+            index = indices[0]
+            return lambda row: (row[index],)
+        return operator.itemgetter(*indices)
+
+    #Adds the metadata to fact rows, dropping rows which don't match an entry in each metadata dict, as an inner
+    #join would
+    def join_rows(self, rows, getter):
+        runs = self.runs
+        im_types = self.im_types
+        ruptures = self.ruptures
+        rupture_variations = self.rupture_variations
+        joined_rows = []
+        for row in rows:
+            joined = row
+            if runs is not None:
+                run = runs.get(row[0])
+                if run is None:
+                    continue
+                joined = joined + run
+            if im_types is not None:
+                im_type = im_types.get(row[4])
+                if im_type is None:
+                    continue
+                joined = joined + im_type
+            if ruptures is not None:
+                rupture = ruptures.get((run[0], row[1], row[2]))
+                if rupture is None:
+                    continue
+                joined = joined + rupture
+            if rupture_variations is not None:
+                rupture_variation = rupture_variations.get((run[0], run[1], row[1], row[2], row[3]))
+                if rupture_variation is None:
+                    continue
+                joined = joined + rupture_variation
+            joined_rows.append(getter(joined))
+        return joined_rows
+
+    #Row handler for execute_queries: joins the rows from the cursor in batches and writes them, and returns this object
+    def read_cursor(self, cur, input_dict):
+        getter = self.get_output_getter()
+        while True:
+            rows = cur.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            rows = self.join_rows(rows, getter)
+            if self.existing_results is not None:
+                rows = self.existing_results.filter_rows(rows, self.column_indices)
+            self.writer.write_rows(rows)
+            self.num_rows += len(rows)
+        return self
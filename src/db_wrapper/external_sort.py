@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Sorts query results on the client instead of the database server, spilling sorted runs to temporary files
+so memory use is bounded, and merging them as the output is written.'''
+
+import os
+import re
+import heapq
+import pickle
+import tempfile
+
+#Number of rows to read from the cursor at a time
+FETCH_BATCH_SIZE = 100000
+
+#Maximum number of rows held in memory before a sorted run is spilled to disk
+MAX_ROWS_IN_MEMORY = 500000
+
+#Rows are written to and read from the spill files in batches of this size, to keep pickling overhead down
+SPILL_BATCH_SIZE = 10000
+
+#With the 'auto' sort mode, queries estimated to return at least this many rows are sorted on the client
+CLIENT_SORT_MIN_ROWS = 1000000
+
+#The sort field is selected last with this alias, and removed from the rows before they're written
+SORT_KEY_ALIAS = 'Client_Sort_Key'
+
+sort_pattern = re.compile(r'^order by\s+(\S+)\s+(asc|desc)$', re.IGNORECASE)
+
+#Returns (sort_field, descending) for a sort clause which can be done on the client, or None if it can't
+def parse_sort(sort_clause):
+    match = sort_pattern.match(sort_clause.strip())
+    if match is None:
+        return None
+    return (match.group(1), match.group(2).lower()=='desc')
+
+#Returns None if the query's sort can be done on the client, or else the reason it can't
+def get_client_sort_problem(input_dict):
+    if 'sort' not in input_dict:
+        return "the results aren't sorted"
+    if input_dict['data_product'] in ["Seismograms", "Hazard Curves"]:
+        return "%s results aren't written directly from the query" % input_dict['data_product'].lower()
+    for option in ['group_by', 'limit']:
+        if option in input_dict:
+            return "queries with a %s are sorted by the database" % option.replace("_", " ")
+    if parse_sort(input_dict['sort']) is None:
+        return "the sort '%s' isn't supported on the client" % input_dict['sort']
+    return None
+
+#Returns a copy of input_dict without the sort, which also selects the sort field under SORT_KEY_ALIAS
+def get_unsorted_query(input_dict):
+    (sort_field, descending) = parse_sort(input_dict['sort'])
+    unsorted_dict = dict(input_dict)
+    del unsorted_dict['sort']
+    unsorted_dict['select'] = "%s,%s as %s" % (input_dict['select'], sort_field, SORT_KEY_ALIAS)
+    return unsorted_dict
+
+#Sort key which puts NULLs first in ascending order and last in descending order, like MySQL
+def get_sort_key(value):
+    return (value is not None, value)
+
+def write_run(rows, temp_directory):
+    (fd, filename) = tempfile.mkstemp(prefix='csdata.sort.', suffix='.run', dir=temp_directory)
+    with os.fdopen(fd, 'wb') as fp_out:
+        for i in range(0, len(rows), SPILL_BATCH_SIZE):
+            pickle.dump(rows[i:i+SPILL_BATCH_SIZE], fp_out, protocol=pickle.HIGHEST_PROTOCOL)
+        fp_out.close()
+    return filename
+
+def read_run(filename):
+    with open(filename, 'rb') as fp_in:
+        while True:
+            try:
+                batch = pickle.load(fp_in)
+            except EOFError:
+                break
+            for entry in batch:
+                yield entry
+        fp_in.close()
+
+
+#Accumulates rows and returns them in sorted order.  Rows are stored as (sort key, values) tuples.
+class ExternalSorter:
+
+    def __init__(self, descending, temp_directory=None, max_rows_in_memory=MAX_ROWS_IN_MEMORY):
+        self.descending = descending
+        self.temp_directory = temp_directory
+        self.max_rows_in_memory = max_rows_in_memory
+        self.buffer = []
+        self.run_filenames = []
+        self.num_rows = 0
+
+    def __len__(self):
+        return self.num_rows
+
+    def get_num_runs(self):
+        return len(self.run_filenames)
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.buffer.append((get_sort_key(row[-1]), row[:-1]))
+            if len(self.buffer)>=self.max_rows_in_memory:
+                self.spill()
+        self.num_rows += len(rows)
+
+    def sort_buffer(self):
+        #Python's sort is stable, so rows with equal keys stay in the order they arrived
+        self.buffer.sort(key=lambda entry: entry[0], reverse=self.descending)
+
+    def spill(self):
+        self.sort_buffer()
+        self.run_filenames.append(write_run(self.buffer, self.temp_directory))
+        self.buffer = []
+
+    #Row handler for execute_queries: reads all the rows from the cursor, and returns the sorter
+    def read_cursor(self, cur, input_dict):
+        while True:
+            rows = cur.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            self.add_rows(rows)
+        return self
+
+    #Yields the rows, without the sort field, in sorted order, in lists of up to batch_size rows
+    def get_sorted_batches(self, batch_size=FETCH_BATCH_SIZE):
+        self.sort_buffer()
+        if len(self.run_filenames)==0:
+            entries = iter(self.buffer)
+        else:
+            runs = [read_run(f) for f in self.run_filenames]
+            runs.append(iter(self.buffer))
+            #Runs are merged in the order they were read, which keeps equal keys in arrival order
+            entries = heapq.merge(*runs, key=lambda entry: entry[0], reverse=self.descending)
+        batch = []
+        for (key, values) in entries:
+            batch.append(values)
+            if len(batch)>=batch_size:
+                yield batch
+                batch = []
+        if len(batch)>0:
+            yield batch
+
+    def close(self):
+        for f in self.run_filenames:
+            if os.path.exists(f):
+                os.remove(f)
+        self.run_filenames = []
+        self.buffer = []
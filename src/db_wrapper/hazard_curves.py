@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Computes hazard curves from intensity measures as the query results are read, so only the curves are written out.'''
+
+import sys
+import os
+import re
+import bisect
+import math
+
+#NumPy is used if it's available, to vectorize the calculation
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.utilities as utilities
+import db_wrapper.im_cache as im_cache
+
+#Default IM levels, 10 per decade from 0.1 to 10000, in the units of the IMs (cm/sec2 for SA, so roughly 1e-4 to 10 g)
+DEFAULT_IM_LEVELS = [round(10.0**(-1.0+i/10.0), 6) for i in range(51)]
+
+#Fields which vary within a curve.  All other selected fields identify the curve.
+RUPTURE_FIELDS = ['Source_ID', 'Rupture_ID']
+PER_ROW_FIELDS = ['Source_ID', 'Rupture_ID', 'Rup_Var_ID', 'Prob', 'IM_Value']
+
+#Fields added to the curve fields in the output
+OUTPUT_FIELDS = ['IM_Level', 'Exceedance_Probability']
+
+#Number of rows to read from the database at a time
+FETCH_BATCH_SIZE = 100000
+
+im_value_pattern = re.compile(r'^PeakAmplitudes[A-Za-z_0-9]*\.IM_Value\s*(>=|<=|>|<|=)')
+
+def get_im_levels(input_dict):
+    if 'im_levels' in input_dict:
+        return sorted([float(l) for l in input_dict['im_levels'].split(",")])
+    return DEFAULT_IM_LEVELS
+
+#Hazard curves need every rupture variation, so drop any IM value filters from the query
+def remove_im_value_filters(input_dict):
+    terms = im_cache.split_where(input_dict['where'])
+    kept_terms = [t for t in terms if im_value_pattern.match(t) is None]
+    if len(kept_terms)==len(terms):
+        return input_dict
+    print("Intensity Measure Value filters don't apply to hazard curves and will be ignored.")
+    curve_input_dict = dict(input_dict)
+    curve_input_dict['where'] = " and ".join(kept_terms)
+    return curve_input_dict
+
+#Returns the selected fields which identify a curve, without their table names
+def get_curve_fields(input_dict):
+    fields = [utilities.get_select_field_name(f) for f in input_dict['select'].split(",")]
+    return [f for f in fields if f not in PER_ROW_FIELDS]
+
+def get_output_fields(input_dict):
+    return get_curve_fields(input_dict) + OUTPUT_FIELDS
+
+
+#Accumulates, for each rupture in each curve, a histogram of how many of its rupture variations fall between each pair of IM levels
+class HazardCurveCalculator:
+
+    #column_indices maps the field names in the result rows to their positions
+    def __init__(self, curve_fields, im_levels, column_indices):
+        self.curve_fields = curve_fields
+        self.curve_field_indices = [column_indices[f] for f in curve_fields]
+        self.source_id_index = column_indices['Source_ID']
+        self.rupture_id_index = column_indices['Rupture_ID']
+        self.prob_index = column_indices['Prob']
+        self.im_value_index = column_indices['IM_Value']
+        self.im_levels = im_levels
+        self.num_bins = len(im_levels)+1
+        self.curve_keys = []
+        self.curve_index = dict()
+        self.rupture_index = dict()
+        self.rupture_curves = []
+        self.rupture_probs = []
+        if numpy is not None:
+            self.histograms = numpy.zeros((1024, self.num_bins), dtype=numpy.int64)
+        else:
+            self.histograms = []
+
+    def get_rupture(self, row):
+        curve_key = tuple([row[i] for i in self.curve_field_indices])
+        if curve_key not in self.curve_index:
+            self.curve_index[curve_key] = len(self.curve_keys)
+            self.curve_keys.append(curve_key)
+        curve = self.curve_index[curve_key]
+        rupture_key = (curve, row[self.source_id_index], row[self.rupture_id_index])
+        if rupture_key not in self.rupture_index:
+            self.rupture_index[rupture_key] = len(self.rupture_curves)
+            self.rupture_curves.append(curve)
+            self.rupture_probs.append(float(row[self.prob_index]))
+            if numpy is None:
+                self.histograms.append([0]*self.num_bins)
+        return self.rupture_index[rupture_key]
+
+    def add_rows(self, rows):
+        ruptures = [self.get_rupture(row) for row in rows]
+        values = [float(row[self.im_value_index]) for row in rows]
+        if numpy is not None:
+            if len(self.rupture_curves)>len(self.histograms):
+                grown = numpy.zeros((max(2*len(self.histograms), len(self.rupture_curves)), self.num_bins), dtype=numpy.int64)
+                grown[:len(self.histograms)] = self.histograms
+                self.histograms = grown
+            #Bin i holds values which exceed the first i levels
+            bins = numpy.searchsorted(self.im_levels, numpy.asarray(values), side='left')
+            numpy.add.at(self.histograms, (numpy.asarray(ruptures, dtype=numpy.int64), bins), 1)
+        else:
+            for (rupture, value) in zip(ruptures, values):
+                self.histograms[rupture][bisect.bisect_left(self.im_levels, value)] += 1
+
+    #Returns a list of (curve_key, probabilities) with the probability of exceeding each IM level.
+    #Each rupture exceeds a level with its probability times the fraction of its rupture variations which exceed it,
+    #and the curve is the probability that at least one rupture does.
+    def get_curves(self):
+        num_levels = len(self.im_levels)
+        if numpy is not None:
+            histograms = self.histograms[:len(self.rupture_curves)]
+            exceed_counts = numpy.cumsum(histograms[:, ::-1], axis=1)[:, ::-1][:, 1:]
+            fractions = exceed_counts/numpy.maximum(histograms.sum(axis=1), 1)[:, numpy.newaxis]
+            log_non_exceedance = numpy.log1p(-numpy.asarray(self.rupture_probs)[:, numpy.newaxis]*fractions)
+            curve_sums = numpy.zeros((len(self.curve_keys), num_levels))
+            numpy.add.at(curve_sums, numpy.asarray(self.rupture_curves, dtype=numpy.int64), log_non_exceedance)
+            curves = (-numpy.expm1(curve_sums)).tolist()
+        else:
+            curve_sums = [[0.0]*num_levels for c in self.curve_keys]
+            for (rupture, histogram) in enumerate(self.histograms):
+                total = max(sum(histogram), 1)
+                exceed_count = total
+                for i in range(num_levels):
+                    exceed_count -= histogram[i]
+                    curve_sums[self.rupture_curves[rupture]][i] += math.log1p(-self.rupture_probs[rupture]*exceed_count/total)
+            curves = [[-math.expm1(s) for s in sums] for sums in curve_sums]
+        #Sort the curves, so the output doesn't depend on the order the database returned the rows in
+        return sorted(zip(self.curve_keys, curves), key=lambda c: [(v is None, v) for v in c[0]])
+
+    #Returns the curves as result rows, with the fields from get_output_fields()
+    def get_result_rows(self):
+        result_rows = []
+        for (curve_key, probabilities) in self.get_curves():
+            for (level, probability) in zip(self.im_levels, probabilities):
+                result_rows.append(curve_key + (level, probability))
+        return result_rows
+
+
+#Reads the query results from the cursor in batches and returns the hazard curve rows
+def compute_curves(cur, input_dict):
+    calculator = HazardCurveCalculator(get_curve_fields(input_dict), get_im_levels(input_dict), utilities.get_cursor_column_indices(cur))
+    num_rows = 0
+    while True:
+        rows = cur.fetchmany(FETCH_BATCH_SIZE)
+        if len(rows)==0:
+            break
+        calculator.add_rows(rows)
+        num_rows += len(rows)
+    print("Computed %d hazard curves from %d intensity measures." % (len(calculator.curve_keys), num_rows))
+    return calculator.get_result_rows()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Optional local cache of the intensity measures for each run, stored as memory-mapped NumPy arrays.
+Requests for IMs from cached runs are evaluated locally, using the metadata mirror for the metadata tables,
+instead of joining PeakAmplitudes on the database server.'''
+
+import sys
+import os
+import re
+import json
+import pymysql
+
+#NumPy is only needed if the IM cache is used
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.utilities as utilities
+import utils.metadata_mirror as metadata_mirror
+import db_wrapper.incremental as incremental
+
+#Version 1 caches stored the IM values as 32-bit floats, so they're downloaded again
+CACHE_VERSION = 2
+
+#Number of rows to read at a time when filling the cache
+FETCH_BATCH_SIZE = 100000
+
+#Each IM is identified by (Source_ID, Rupture_ID, Rup_Var_ID, IM_Type_ID), packed 16 bits apiece into one sorted key
+KEY_SHIFTS = (48, 32, 16, 0)
+KEY_MASK = 0xFFFF
+
+#Columns of the temporary PeakAmplitudes table the cached IMs are loaded into
+PEAK_AMPLITUDES_COLUMNS = ['Run_ID', 'Source_ID', 'Rupture_ID', 'Rup_Var_ID', 'IM_Type_ID', 'IM_Value']
+
+table_pattern = re.compile(r'\b([A-Za-z_][A-Za-z_0-9]*)\.[A-Za-z_]')
+
+
+def is_available():
+    return numpy is not None
+
+def get_study_directory(cache_directory, study_name):
+    return os.path.join(cache_directory, study_name.replace(" ", "_"))
+
+def get_cache_filenames(cache_directory, study_name, run_id):
+    prefix = os.path.join(get_study_directory(cache_directory, study_name), "run%d" % run_id)
+    return ("%s.keys.npy" % prefix, "%s.values.npy" % prefix, "%s.json" % prefix)
+
+#Raises ValueError if any ID doesn't fit in its 16 bits, since it would silently collide with another IM's key
+def pack_keys(source_ids, rupture_ids, rup_var_ids, im_type_ids):
+    keys = numpy.zeros(len(source_ids), dtype=numpy.uint64)
+    for (ids, shift, name) in zip((source_ids, rupture_ids, rup_var_ids, im_type_ids), KEY_SHIFTS, ('Source_ID', 'Rupture_ID', 'Rup_Var_ID', 'IM_Type_ID')):
+        ids = numpy.asarray(ids)
+        if len(ids)>0 and (ids.min()<0 or ids.max()>KEY_MASK):
+            raise ValueError("%s values must be between 0 and %d to be stored in the IM cache, but range from %d to %d." % (name, KEY_MASK, ids.min(), ids.max()))
+        keys |= ids.astype(numpy.uint64) << numpy.uint64(shift)
+    return keys
+
+#Returns (source_ids, rupture_ids, rup_var_ids, im_type_ids) arrays
+def unpack_keys(keys):
+    return tuple([((keys >> numpy.uint64(shift)) & numpy.uint64(KEY_MASK)).astype(numpy.int64) for shift in KEY_SHIFTS])
+
+
+#All the IMs for one run, sorted by key
+class IMCube:
+
+    def __init__(self, run_id, keys, values):
+        self.run_id = run_id
+        self.keys = keys
+        self.values = values
+
+    def get_run_id(self):
+        return self.run_id
+
+    def get_num_ims(self):
+        return len(self.keys)
+
+    #Returns a boolean mask of the IMs which have one of the IM types and satisfy all the value comparisons
+    def get_mask(self, im_type_ids, value_comparisons):
+        types = (self.keys & numpy.uint64(KEY_MASK)).astype(numpy.int64)
+        mask = numpy.isin(types, numpy.asarray(sorted(im_type_ids), dtype=numpy.int64))
+        for (op, value) in value_comparisons:
+            if op=='>=':
+                mask &= self.values>=value
+            elif op=='<=':
+                mask &= self.values<=value
+            elif op=='>':
+                mask &= self.values>value
+            elif op=='<':
+                mask &= self.values<value
+            elif op=='=':
+                mask &= self.values==value
+        return mask
+
+    #Returns rows of PEAK_AMPLITUDES_COLUMNS for the IMs in the mask
+    def get_rows(self, mask):
+        (source_ids, rupture_ids, rup_var_ids, im_type_ids) = unpack_keys(self.keys[mask])
+        values = self.values[mask]
+        run_ids = [self.run_id]*len(values)
+        return zip(run_ids, source_ids.tolist(), rupture_ids.tolist(), rup_var_ids.tolist(), im_type_ids.tolist(), values.tolist())
+
+    @staticmethod
+    def load(cache_directory, study_name, run_id):
+        (keys_filename, values_filename, meta_filename) = get_cache_filenames(cache_directory, study_name, run_id)
+        #The metadata file is written last, so a cube without one is incomplete
+        if not os.path.exists(meta_filename):
+            return None
+        try:
+            with open(meta_filename, 'r') as fp_in:
+                meta = json.load(fp_in)
+                fp_in.close()
+            if meta.get('version')!=CACHE_VERSION:
+                return None
+            keys = numpy.load(keys_filename, mmap_mode='r')
+            values = numpy.load(values_filename, mmap_mode='r')
+        except Exception as e:
+            print("Unable to read IM cache for run %d, it will be downloaded again." % run_id)
+            print(e)
+            return None
+        if len(keys)!=meta['num_ims'] or len(values)!=meta['num_ims']:
+            return None
+        return IMCube(run_id, keys, values)
+
+
+#Downloads all the IMs for a run from the database and stores them in the cache.  Returns the new cube.
+def build_cube(server_conn, config_dict, peak_amplitudes_table, cache_directory, study_name, run_id):
+    print("Downloading IMs for run %d into the IM cache." % run_id)
+    if config_dict['type'].lower()=='mysql':
+        #Stream the results, since a run can have tens of millions of IMs
+        cur = server_conn.cursor(pymysql.cursors.SSCursor)
+    else:
+        cur = server_conn.cursor()
+    cur.execute('select Source_ID, Rupture_ID, Rup_Var_ID, IM_Type_ID, IM_Value from %s where Run_ID=%d' % (peak_amplitudes_table, run_id))
+    key_batches = []
+    value_batches = []
+    while True:
+        rows = cur.fetchmany(FETCH_BATCH_SIZE)
+        if len(rows)==0:
+            break
+        batch = numpy.array(rows, dtype=numpy.float64)
+        try:
+            key_batches.append(pack_keys(batch[:, 0], batch[:, 1], batch[:, 2], batch[:, 3]))
+        except ValueError as e:
+            print("Run %d can't be stored in the IM cache, aborting." % run_id, file=sys.stderr)
+            print(e, file=sys.stderr)
+            sys.exit(utilities.ExitCodes.VALUE_OUT_OF_RANGE)
+        #Keep the full double precision, so cached results match the server's
+        value_batches.append(batch[:, 4])
+    cur.close()
+    if len(key_batches)==0:
+        keys = numpy.zeros(0, dtype=numpy.uint64)
+        values = numpy.zeros(0, dtype=numpy.float64)
+    else:
+        keys = numpy.concatenate(key_batches)
+        values = numpy.concatenate(value_batches)
+        order = numpy.argsort(keys, kind='stable')
+        keys = keys[order]
+        values = values[order]
+    (keys_filename, values_filename, meta_filename) = get_cache_filenames(cache_directory, study_name, run_id)
+    try:
+        os.makedirs(os.path.dirname(keys_filename), exist_ok=True)
+        for (filename, data) in ((keys_filename, keys), (values_filename, values)):
+            #Write to a temporary file, so an interrupted download never leaves a partial array behind
+            with open("%s.part" % filename, 'wb') as fp_out:
+                numpy.save(fp_out, data)
+                fp_out.close()
+            os.replace("%s.part" % filename, filename)
+        with open(meta_filename, 'w') as fp_out:
+            json.dump({'version': CACHE_VERSION, 'study': study_name, 'run_id': run_id, 'table': peak_amplitudes_table, 'num_ims': len(keys)}, fp_out)
+            fp_out.close()
+    except Exception as e:
+        print("Error writing IM cache for run %d to %s, aborting." % (run_id, cache_directory), file=sys.stderr)
+        print(e)
+        sys.exit(utilities.ExitCodes.FILE_WRITING_ERROR)
+    return IMCube.load(cache_directory, study_name, run_id)
+
+#Splits a where string into the clauses joined by top-level 'and's
+def split_where(where_string):
+    terms = []
+    depth = 0
+    in_quote = None
+    start = 0
+    i = 0
+    while i<len(where_string):
+        c = where_string[i]
+        if in_quote is not None:
+            if c==in_quote:
+                in_quote = None
+        elif c in ('"', "'"):
+            in_quote = c
+        elif c=='(':
+            depth += 1
+        elif c==')':
+            depth -= 1
+        elif depth==0 and where_string[i:i+5].lower()==' and ':
+            terms.append(where_string[start:i].strip())
+            start = i+5
+            i += 5
+            continue
+        i += 1
+    terms.append(where_string[start:].strip())
+    return [t for t in terms if len(t)>0]
+
+#Returns the set of tables referenced by a where clause
+def get_term_tables(term):
+    tables = set(table_pattern.findall(term))
+    #The PGA/PGV filter isn't qualified with its table
+    if 'IM_Type_Measure' in term and 'IM_Types.IM_Type_Measure' not in term:
+        tables.add('IM_Types')
+    return tables
+
+#Returns the name of the PeakAmplitudes table the query uses, or None
+def get_peak_amplitudes_table(from_tables):
+    pa_tables = [t for t in from_tables if t.startswith('PeakAmplitudes')]
+    if len(pa_tables)!=1:
+        return None
+    return pa_tables[0]
+
+#Returns True if the query can be answered from the IM cache
+def can_use_cache(cache_directory, mirror_path, input_dict):
+    if cache_directory is None or not is_available():
+        return False
+    from_tables = [t.strip() for t in input_dict['from'].split(",")]
+    pa_table = get_peak_amplitudes_table(from_tables)
+    if pa_table is None or 'CyberShake_Runs' not in from_tables or 'IM_Types' not in from_tables:
+        return False
+    for t in from_tables:
+        if t!=pa_table and t not in metadata_mirror.MIRROR_TABLES:
+            return False
+    study_name = metadata_mirror.get_query_study(input_dict['where'])
+    if study_name is None:
+        return False
+    return study_name in metadata_mirror.get_mirrored_studies(mirror_path)
+
+#Loads the cached IMs for the query's runs into a temporary PeakAmplitudes table in the mirror, downloading any which
+#aren't cached yet.  Connections are opened with conn_factory.  Returns the mirror connection and the query to run on it.
+def prepare_query(cache_directory, mirror_path, config_dict, input_dict, query_string_function, conn_factory, existing_results=None):
+    from_tables = [t.strip() for t in input_dict['from'].split(",")]
+    pa_table = get_peak_amplitudes_table(from_tables)
+    study_name = metadata_mirror.get_query_study(input_dict['where'])
+    terms = split_where(input_dict['where'])
+    conn = conn_factory({'type': 'SQLite', 'db_path': mirror_path})
+    cur = conn.cursor()
+    #Find the runs, using only the clauses on the run, site, and study tables
+    run_tables = set(['CyberShake_Runs', 'CyberShake_Sites', 'Studies']).intersection(set(from_tables))
+    run_terms = [t for t in terms if get_term_tables(t).issubset(run_tables)]
+    cur.execute('select distinct CyberShake_Runs.Run_ID from %s where %s' % (",".join(sorted(run_tables)), " and ".join(run_terms)))
+    run_ids = sorted([int(r[0]) for r in cur.fetchall()])
+    #Find the IM types, using only the clauses on IM_Types
+    im_type_terms = [t for t in terms if get_term_tables(t)==set(['IM_Types'])]
+    if len(im_type_terms)==0:
+        im_type_terms = ['1=1']
+    cur.execute('select IM_Type_ID from IM_Types where %s' % (" and ".join(im_type_terms)))
+    im_type_ids = set([int(r[0]) for r in cur.fetchall()])
+    #Value range filters are evaluated with the cube mask; the query reapplies them, so anything not recognized is still filtered
+    value_pattern = re.compile(r'^%s\.IM_Value(>=|<=|>|<|=)(-?[0-9.]+(?:[eE][-+]?[0-9]+)?)$' % re.escape(pa_table))
+    value_comparisons = []
+    for t in terms:
+        match = value_pattern.match(t)
+        if match is not None:
+            value_comparisons.append((match.group(1), float(match.group(2))))
+    cur.execute('CREATE TEMPORARY TABLE %s (Run_ID INTEGER, Source_ID INTEGER, Rupture_ID INTEGER, Rup_Var_ID INTEGER, IM_Type_ID INTEGER, IM_Value REAL)' % pa_table)
+    server_conn = None
+    num_downloaded = 0
+    insert_cmd = 'INSERT INTO temp.%s VALUES (?, ?, ?, ?, ?, ?)' % pa_table
+    for run_id in run_ids:
+        cube = IMCube.load(cache_directory, study_name, run_id)
+        if cube is None:
+            if server_conn is None:
+                server_conn = conn_factory(config_dict)
+            cube = build_cube(server_conn, config_dict, pa_table, cache_directory, study_name, run_id)
+            num_downloaded += 1
+        cur.executemany(insert_cmd, cube.get_rows(cube.get_mask(im_type_ids, value_comparisons)))
+    if server_conn is not None:
+        server_conn.close()
+    print("Using IM cache for %d runs, %d of which were downloaded." % (len(run_ids), num_downloaded))
+    cur.execute('CREATE INDEX temp.%s_idx ON %s (Run_ID, Source_ID, Rupture_ID, Rup_Var_ID)' % (pa_table, pa_table))
+    extra_where = None
+    if existing_results is not None and len(existing_results.get_keys())>0:
+        extra_where = incremental.create_anti_join(conn, cur, {'type': 'SQLite'}, existing_results)
+    query = query_string_function(input_dict, extra_where=extra_where)
+    return (conn, query)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Supports incremental requests, where results which already exist in the output directory are not retrieved again.'''
+
+import sys
+import os
+import re
+import csv
+import glob
+import sqlite3
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.utilities as utilities
+import utils.compression as compression
+
+#Fields which identify a row of results, in the order they're used in the key
+#IM_Type_Value is NULL for PGA and PGV, and the component tells the RotD50 and RotD100 IMs of the same period apart.
+KEY_FIELDS = ['Run_ID', 'CS_Short_Name', 'Source_ID', 'Rupture_ID', 'Rup_Var_ID', 'IM_Type_Measure', 'IM_Type_Value', 'IM_Type_Component']
+
+#Types of the key fields, for parsing previous outputs and creating the temporary table
+KEY_FIELD_TYPES = {'Run_ID': int, 'CS_Short_Name': str, 'Source_ID': int, 'Rupture_ID': int, 'Rup_Var_ID': int, 'IM_Type_Measure': str, 'IM_Type_Value': float, 'IM_Type_Component': str}
+
+#Floating-point key fields are compared with a tolerance, since the database may store them in single precision
+FLOAT_KEY_TOLERANCE = 1e-4
+
+#Name of the temporary table used for the anti-join
+KNOWN_KEYS_TABLE = 'Known_Keys'
+
+#Extracted seismograms are named Seismogram_<site>_<run>_<src>_<rup>_<rv>.grm
+seismogram_pattern = re.compile(r'^Seismogram_(.+)_(\d+)_(\d+)_(\d+)_(\d+)\.grm$')
+
+#Results which already exist in the output directory, identified by the values of their key fields
+class ExistingResults:
+
+    def __init__(self, key_fields):
+        #key_fields is a list of table.field select fields
+        self.key_fields = key_fields
+        self.keys = set()
+
+    def get_key_fields(self):
+        return self.key_fields
+
+    def get_key_names(self):
+        return [k.split(".")[1] for k in self.key_fields]
+
+    def add_key(self, key):
+        self.keys.add(key)
+
+    def get_keys(self):
+        return self.keys
+
+    #key_indices are the positions of the key fields in the row
+    def get_row_key(self, row, key_indices):
+        return tuple([normalize_value(name, row[i]) for (name, i) in zip(self.get_key_names(), key_indices)])
+
+    #Client-side equivalent of the anti-join, for when a temporary table can't be created.
+    #column_indices maps the field names in the rows to their positions.
+    def filter_rows(self, result_set, column_indices):
+        key_indices = [column_indices[name] for name in self.get_key_names()]
+        return [row for row in result_set if self.get_row_key(row, key_indices) not in self.keys]
+
+
+def normalize_value(name, value):
+    if value is None:
+        return None
+    value_type = KEY_FIELD_TYPES[name]
+    if value_type==float:
+        #Round so that single- and double-precision values compare equal
+        return round(float(value), 4)
+    return value_type(value)
+
+#Returns the fields in the select string which identify a row, in KEY_FIELDS order
+def get_key_fields(select_string):
+    select_fields = select_string.replace("distinct", "").strip().split(",")
+    key_fields = []
+    for k in KEY_FIELDS:
+        for s in select_fields:
+            if s.strip().split(".")[1]==k:
+                key_fields.append(s.strip())
+                break
+    return key_fields
+
+def get_data_product(query_filename):
+    if not os.path.exists(query_filename):
+        return None
+    with open(query_filename, 'r') as fp_in:
+        for line in fp_in.readlines():
+            if line.startswith("data_product"):
+                fp_in.close()
+                return line.split("=", 1)[1].strip()
+        fp_in.close()
+    return None
+
+def index_seismograms(output_directory, existing_results):
+    key_names = existing_results.get_key_names()
+    file_fields = ['CS_Short_Name', 'Run_ID', 'Source_ID', 'Rupture_ID', 'Rup_Var_ID']
+    #Filenames only tell us about these fields
+    for k in key_names:
+        if k not in file_fields:
+            return 0
+    num_found = 0
+    for filename in os.listdir(output_directory):
+        match = seismogram_pattern.match(filename)
+        if match is None:
+            continue
+        values = dict(zip(file_fields, match.groups()))
+        existing_results.add_key(tuple([normalize_value(k, values[k]) for k in key_names]))
+        num_found += 1
+    return num_found
+
+def index_csv_output(filename, existing_results):
+    key_names = existing_results.get_key_names()
+    aliases = [utilities.get_field_alias(k) for k in key_names]
+    num_found = 0
+    with compression.open_text(filename, 'r', newline='') as fp_in:
+        reader = csv.reader(fp_in)
+        try:
+            header = next(reader)
+        except StopIteration:
+            return 0
+        for a in aliases:
+            if a not in header:
+                return 0
+        indices = [header.index(a) for a in aliases]
+        for row in reader:
+            if len(row)!=len(header):
+                continue
+            try:
+                key = tuple([normalize_value(key_names[i], row[idx]) if row[idx]!='None' else None for i, idx in enumerate(indices)])
+            except ValueError:
+                continue
+            existing_results.add_key(key)
+            num_found += 1
+        fp_in.close()
+    return num_found
+
+def index_sqlite_output(filename, existing_results):
+    key_names = existing_results.get_key_names()
+    conn = sqlite3.connect(filename)
+    cur = conn.cursor()
+    try:
+        cur.execute('select %s from CyberShake_Data' % ", ".join(key_names))
+    except sqlite3.Error:
+        #Not all key fields are in this output
+        conn.close()
+        return 0
+    num_found = 0
+    for row in cur:
+        existing_results.add_key(tuple([normalize_value(key_names[i], v) for i, v in enumerate(row)]))
+        num_found += 1
+    conn.close()
+    return num_found
+
+#Finds the results for this data product which already exist in output_directory.
+#Previous outputs are only used if their query file shows they were for the same data product.
+def index_output_directory(output_directory, input_dict):
+    key_fields = get_key_fields(input_dict['select'])
+    existing_results = ExistingResults(key_fields)
+    if len(key_fields)==0:
+        return existing_results
+    data_product = input_dict['data_product']
+    num_found = 0
+    if data_product=="Seismograms":
+        num_found += index_seismograms(output_directory, existing_results)
+    for filename in sorted(glob.glob(os.path.join(output_directory, "csdata.*.data.*"))):
+        query_filename = "%s.query" % filename.split(".data.")[0]
+        if get_data_product(query_filename)!=data_product:
+            continue
+        if filename.endswith(".csv"):
+            num_found += index_csv_output(filename, existing_results)
+        elif ".csv." in filename and compression.get_compression(filename) is not None:
+            problem = compression.get_compression_problem(compression.get_compression(filename))
+            if problem is not None:
+                print("Skipping existing results in %s, since %s." % (filename, problem))
+                continue
+            num_found += index_csv_output(filename, existing_results)
+        elif filename.endswith(".sqlite"):
+            num_found += index_sqlite_output(filename, existing_results)
+    print("Found %d existing results in %s." % (len(existing_results.get_keys()), output_directory))
+    return existing_results
+
+#Creates and populates a temporary table with the existing keys, using the given connection,
+#and returns a where clause which excludes them from the query results.
+def create_anti_join(conn, cur, config_dict, existing_results):
+    key_names = existing_results.get_key_names()
+    is_mysql = config_dict['type'].lower()=='mysql'
+    columns = []
+    for k in key_names:
+        if KEY_FIELD_TYPES[k]==int:
+            columns.append("%s INTEGER" % k)
+        elif KEY_FIELD_TYPES[k]==float:
+            columns.append("%s DOUBLE" % k)
+        else:
+            columns.append("%s VARCHAR(64)" % k)
+    cur.execute('DROP TABLE IF EXISTS %s' % KNOWN_KEYS_TABLE)
+    #Keys can contain NULLs, which MySQL doesn't allow in a primary key, so the table just has an index.  The keys are
+    #unique anyway, since they come from a set.
+    cur.execute('CREATE TEMPORARY TABLE %s (%s)' % (KNOWN_KEYS_TABLE, ", ".join(columns)))
+    cur.execute('CREATE INDEX %s_idx ON %s (%s)' % (KNOWN_KEYS_TABLE, KNOWN_KEYS_TABLE, ", ".join(key_names)))
+    placeholder = '%s' if is_mysql else '?'
+    insert_cmd = 'INSERT INTO %s VALUES (%s)' % (KNOWN_KEYS_TABLE, ", ".join([placeholder]*len(key_names)))
+    cur.executemany(insert_cmd, list(existing_results.get_keys()))
+    conn.commit()
+    #Match NULLs with NULLs, as filter_rows() does
+    null_safe_equals = '<=>' if is_mysql else 'IS'
+    match_clauses = []
+    for i, k in enumerate(existing_results.get_key_fields()):
+        known_field = "%s.%s" % (KNOWN_KEYS_TABLE, key_names[i])
+        if KEY_FIELD_TYPES[key_names[i]]==float:
+            match_clauses.append("((%s is null and %s is null) or abs(%s-%s)<%g)" % (known_field, k, known_field, k, FLOAT_KEY_TOLERANCE))
+        else:
+            match_clauses.append("%s %s %s" % (known_field, null_safe_equals, k))
+    return "not exists (select 1 from %s where %s)" % (KNOWN_KEYS_TABLE, " and ".join(match_clauses))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Supports paginated retrieval of large result sets, walking the results in keyset order a page at a time.'''
+
+#Fields which order the pages.  They're the primary key of PeakAmplitudes, so each key identifies one row.
+KEY_FIELDS = ['PeakAmplitudes.Run_ID', 'PeakAmplitudes.Source_ID', 'PeakAmplitudes.Rupture_ID', 'PeakAmplitudes.Rup_Var_ID', 'PeakAmplitudes.IM_Type_ID']
+
+#Key fields are selected with these aliases, and removed from the rows before they're written
+KEY_ALIAS_PREFIX = 'Page_Key_'
+
+#Page sizes adapt so that each page takes about this long to retrieve, within these bounds
+PAGE_TARGET_SECONDS = 5.0
+MIN_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 1000000
+
+#Number of times a failed page is retried, with a smaller page size each time, before giving up
+PAGE_RETRIES = 3
+
+
+#Returns None if the query can be split into pages, or else the reason it can't
+def get_pagination_problem(input_dict):
+    if input_dict['data_product']=="Hazard Curves":
+        return "hazard curves are computed from all the results at once"
+    if 'PeakAmplitudes' not in input_dict['from'].split(","):
+        return "only intensity measure queries can be split into pages"
+    for option in ['group_by', 'sort', 'limit']:
+        if option in input_dict:
+            return "queries with a %s can't be split into pages" % option.replace("_", " ")
+    return None
+
+def get_key_aliases():
+    return ["%s%d" % (KEY_ALIAS_PREFIX, i) for i in range(0, len(KEY_FIELDS))]
+
+#Returns a copy of input_dict which selects the next page_size rows after last_key, or the first rows if last_key is None.
+#extra_where, if supplied, is an additional condition on the rows.
+def get_page_query(input_dict, last_key, page_size, query_string_function, extra_where=None):
+    page_dict = dict(input_dict)
+    key_selects = ["%s as %s" % (k, a) for (k, a) in zip(KEY_FIELDS, get_key_aliases())]
+    page_dict['select'] = "%s,%s" % (input_dict['select'], ",".join(key_selects))
+    page_dict['sort'] = "order by %s" % ",".join(KEY_FIELDS)
+    page_dict['limit'] = "%d" % page_size
+    conditions = []
+    if extra_where is not None:
+        conditions.append(extra_where)
+    if last_key is not None:
+        #Row value comparison, so the database can seek directly to the start of the page using the primary key
+        conditions.append("(%s) > (%s)" % (",".join(KEY_FIELDS), ",".join(["%d" % k for k in last_key])))
+    if len(conditions)==0:
+        return query_string_function(page_dict)
+    return query_string_function(page_dict, extra_where=" and ".join(conditions))
+
+#The key fields are the last fields in each row of a page
+def get_row_key(row):
+    return tuple([int(v) for v in row[-len(KEY_FIELDS):]])
+
+def remove_row_key(row):
+    return row[:-len(KEY_FIELDS)]
+
+
+#Chooses the size of each page, based on how long the previous pages took
+class PageSizer:
+
+    def __init__(self, page_size):
+        self.page_size = max(MIN_PAGE_SIZE, min(MAX_PAGE_SIZE, page_size))
+
+    def get_page_size(self):
+        return self.page_size
+
+    #Grows or shrinks the page towards the target time, by at most a factor of 2 each page
+    def update(self, elapsed_seconds, num_rows):
+        #A short final page doesn't say much about how long a full page takes
+        if num_rows<self.page_size:
+            return
+        if elapsed_seconds<=0:
+            factor = 2.0
+        else:
+            factor = max(0.5, min(2.0, PAGE_TARGET_SECONDS/elapsed_seconds))
+        self.page_size = max(MIN_PAGE_SIZE, min(MAX_PAGE_SIZE, int(self.page_size*factor)))
+
+    #Called when a page fails, so the retry asks for less
+    def shrink(self):
+        self.page_size = max(MIN_PAGE_SIZE, self.page_size//2)
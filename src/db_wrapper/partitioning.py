@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Splits database results into one output file per site, per run, or per hash bucket, so they can be read in parallel.'''
+
+import sys
+import os
+import re
+import json
+import zlib
+import concurrent.futures
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.utilities as utilities
+import db_wrapper.incremental as incremental
+
+PARTITION_MODES = ['site', 'run', 'hash']
+
+#Field which each partition holds a single value of, for the modes which partition on a field
+PARTITION_FIELDS = dict()
+PARTITION_FIELDS['site'] = 'CS_Short_Name'
+PARTITION_FIELDS['run'] = 'Run_ID'
+
+DEFAULT_NUM_PARTITIONS = 16
+
+#Number of partitions written at the same time
+WRITE_THREADS = 4
+
+MANIFEST_VERSION = 1
+
+#Returns None if the results with these columns can be partitioned this way, or else the reason they can't
+def get_partition_problem(partition_by, column_names):
+    if partition_by in PARTITION_FIELDS and PARTITION_FIELDS[partition_by] not in column_names:
+        return "the results don't include %s" % PARTITION_FIELDS[partition_by]
+    return None
+
+#Returns the output filename without the extension for the output format
+def get_output_base(args_dict):
+    output_filename = args_dict['output_filename']
+    extension = ".%s" % args_dict['output_format'].lower()
+    if output_filename.endswith(extension):
+        return output_filename[:-len(extension)]
+    return output_filename
+
+def get_manifest_filename(args_dict):
+    return "%s.manifest.json" % get_output_base(args_dict)
+
+#Partition names become part of filenames, so only keep characters which are safe in them
+def get_partition_name(prefix, value):
+    return "%s_%s" % (prefix, re.sub(r'[^A-Za-z0-9_.-]', '_', str(value)))
+
+
+#Writes results into a separate file for each partition, with a manifest listing them.  Has the same methods as
+#ResultWriter, which writer_factory(args_dict, columns) creates for each partition.  Each batch of rows is split up
+#and the partitions are written by a pool of threads, so compression and file I/O for different partitions overlap.
+class PartitionedResultWriter:
+
+    def __init__(self, args_dict, columns, writer_factory, num_partitions=DEFAULT_NUM_PARTITIONS):
+        self.args_dict = args_dict
+        self.columns = columns
+        self.writer_factory = writer_factory
+        self.partition_by = args_dict['partition_by']
+        self.num_partitions = num_partitions
+        self.output_base = get_output_base(args_dict)
+        self.filename = get_manifest_filename(args_dict)
+        self.writers = dict()
+        self.partition_names = dict()
+        self.partition_values = dict()
+        self.executor = None
+        self.num_rows = 0
+        column_names = [utilities.get_select_field_name(c) for c in columns]
+        problem = get_partition_problem(self.partition_by, column_names)
+        if problem is not None:
+            print("Results can't be partitioned by %s, since %s, aborting." % (self.partition_by, problem), file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+        column_indices = utilities.get_column_indices(column_names)
+        if self.partition_by in PARTITION_FIELDS:
+            self.key_indices = [column_indices[PARTITION_FIELDS[self.partition_by]]]
+        else:
+            #Hash on the fields which identify a row, so the buckets are even however many sites there are
+            self.key_indices = [column_indices[k] for k in incremental.KEY_FIELDS if k in column_indices]
+            if len(self.key_indices)==0:
+                self.key_indices = list(range(0, len(columns)))
+
+    def get_filename(self):
+        return self.filename
+
+    def get_num_rows(self):
+        return self.num_rows
+
+    #Partitioned output is spread over many files, so it can only be written from the start
+    def open(self, num_rows=0, position=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=WRITE_THREADS)
+        self.num_rows = num_rows
+
+    #Returns the name of the partition a row belongs in.  Names for site and run partitions are cached, since many rows share them.
+    def get_partition(self, row):
+        if self.partition_by=='hash':
+            key = tuple([row[i] for i in self.key_indices])
+            return "part%03d" % (zlib.crc32(repr(key).encode('utf-8')) % self.num_partitions)
+        value = row[self.key_indices[0]]
+        if value not in self.partition_names:
+            partition = get_partition_name(self.partition_by, value)
+            #Different values can have the same name once unsafe characters are replaced, so later ones are numbered
+            if partition in self.partition_values:
+                i = 2
+                while "%s_%d" % (partition, i) in self.partition_values:
+                    i += 1
+                partition = "%s_%d" % (partition, i)
+            self.partition_names[value] = partition
+            self.partition_values[partition] = value
+        return self.partition_names[value]
+
+    def get_writer(self, partition):
+        if partition not in self.writers:
+            partition_args = dict(self.args_dict)
+            partition_args['output_filename'] = "%s.%s" % (self.output_base, partition)
+            writer = self.writer_factory(partition_args, self.columns)
+            writer.open()
+            self.writers[partition] = writer
+        return self.writers[partition]
+
+    def write_rows(self, rows):
+        partition_rows = dict()
+        for row in rows:
+            partition_rows.setdefault(self.get_partition(row), []).append(row)
+        writers = [self.get_writer(p) for p in partition_rows]
+        #Results are checked, so errors in the threads, including a writer exiting, are raised here
+        for result in self.executor.map(lambda w, r: w.write_rows(r), writers, partition_rows.values()):
+            pass
+        self.num_rows += len(rows)
+
+    def get_position(self):
+        return self.num_rows
+
+    def close(self):
+        if self.executor is None:
+            return
+        for result in self.executor.map(lambda w: w.close(), self.writers.values()):
+            pass
+        self.executor.shutdown()
+        self.executor = None
+        self.write_manifest()
+
+    #The manifest lists each partition's file, row count, and size, so readers can skip partitions they don't need
+    def write_manifest(self):
+        manifest = dict()
+        manifest['version'] = MANIFEST_VERSION
+        manifest['partition_by'] = self.partition_by
+        if self.partition_by in PARTITION_FIELDS:
+            manifest['partition_field'] = PARTITION_FIELDS[self.partition_by]
+        else:
+            manifest['num_partitions'] = self.num_partitions
+        manifest['output_format'] = self.args_dict['output_format'].lower()
+        manifest['columns'] = [utilities.get_field_alias(utilities.get_select_field_name(c)) for c in self.columns]
+        manifest['num_rows'] = self.num_rows
+        partitions = []
+        for partition in sorted(self.writers.keys()):
+            writer = self.writers[partition]
+            partition_entry = dict()
+            partition_entry['partition'] = partition
+            if partition in self.partition_values:
+                partition_entry['value'] = self.partition_values[partition]
+            partition_entry['filename'] = os.path.basename(writer.get_filename())
+            partition_entry['num_rows'] = writer.get_num_rows()
+            partition_entry['size'] = os.path.getsize(writer.get_filename())
+            partitions.append(partition_entry)
+        manifest['partitions'] = partitions
+        try:
+            with open(self.filename, 'w') as fp_out:
+                fp_out.write(json.dumps(manifest, indent=4))
+                fp_out.flush()
+                fp_out.close()
+        except Exception as e:
+            print("Error writing partition manifest %s, aborting." % self.filename, file=sys.stderr)
+            print(e)
+            sys.exit(utilities.ExitCodes.FILE_WRITING_ERROR)
@@ -39,6 +39,7 @@ import pymysql
 import datetime
 import sqlite3
 import timeit
+import math
 
 #Add one directory level above to path to find imports
 full_path = os.path.abspath(sys.argv[0])
@@ -48,12 +49,34 @@ sys.path.append(path_add)
 import utils.utilities as utilities
 import utils.filters as filters
 import utils.data_products as data_products
+import utils.request_state as request_state
+import db_wrapper.incremental as incremental
+import utils.metadata_mirror as metadata_mirror
+import db_wrapper.im_cache as im_cache
+import db_wrapper.hazard_curves as hazard_curves
+import db_wrapper.pagination as pagination
+import db_wrapper.external_sort as external_sort
+import utils.profiling as profiling
+import utils.replicas as replicas
+import utils.sqlite_backend as sqlite_backend
+import utils.compression as compression
+import db_wrapper.partitioning as partitioning
+import db_wrapper.wide_layout as wide_layout
+import db_wrapper.client_join as client_join
 
 #Maximum size of temporary storage, in MB
 MAX_TEMP_DATA_MB = 1000
 #Maximum size of output seismograms, in MB
 MAX_OUTPUT_DATA_MB = 1000
 
+#CSV output formats, uncompressed or compressed as it's written
+CSV_FORMATS = ['csv', 'csv.gz', 'csv.zst']
+#Number of rows formatted and written to CSV files at a time
+CSV_WRITE_BATCH_SIZE = 10000
+#Buffer size for uncompressed CSV files, in bytes
+CSV_BUFFER_SIZE = 4*1024*1024
+
+#Default servers for each study's bulk seismogram files.  These can be overridden in the config file; see get_seismogram_server().
 globus_dict = dict()
 globus_dict['Study 15.12'] = "https://g-41ed52.a78b8.36fe.data.globus.org"
 globus_dict['Study 22.12 LF'] = "https://g-8f2de8.a78b8.36fe.data.globus.org"
@@ -78,7 +101,23 @@ def parse_args(argv):
     parser.add_argument('-i', '--input-filename', dest='input_filename', action='store', default=None, help="Path to query file describing the data request.")
     parser.add_argument('-o', '--output-filename', dest='output_filename', action='store', default=None, help="Path to output file, with query results.")
     parser.add_argument('-c', "--config-filename", dest='config_filename', action='store', default=None, help="Path to database configuration file.")
-    parser.add_argument('-of', '--output-format', dest='output_format', action='store', default='csv', help='Output format for database results (either "csv" or "sqlite")')
+    parser.add_argument('-of', '--output-format', dest='output_format', action='store', default='csv', help='Output format for database results: "csv", "sqlite", or compressed CSV with "csv.gz" or "csv.zst" (default: csv).')
+    parser.add_argument('-sf', '--state-filename', dest='state_filename', action='store', default=None, help="Path to state file used to record completed queries (optional).")
+    parser.add_argument('-r', '--resume', dest='resume', action='store_true', default=False, help="Skip queries already recorded as complete in the state file.")
+    parser.add_argument('-inc', '--incremental-directory', dest='incremental_directory', action='store', default=None, help="Only retrieve results which aren't already in the outputs or seismograms in this directory (optional).")
+    parser.add_argument('-m', '--mirror-filename', dest='mirror_filename', action='store', default=metadata_mirror.get_default_mirror_path(), help="Path to local metadata mirror, used for Site Info and Event Info queries on mirrored studies (default: utils/cs_metadata.sqlite).")
+    parser.add_argument('-nm', '--no-mirror', dest='no_mirror', action='store_true', default=False, help="Always query the database in the configuration file, even if a local metadata mirror is available.")
+    parser.add_argument('-imc', '--im-cache-directory', dest='im_cache_directory', action='store', default=None, help="Directory for the local IM cache (optional).  Intensity Measure queries on mirrored studies are answered from it, downloading each run's IMs the first time it's needed.  Requires NumPy.")
+    parser.add_argument('-ps', '--page-size', dest='page_size', action='store', type=int, default=None, help="Retrieve intensity measures in pages, starting with this many rows per page and adapting to how long each page takes (optional).  Each page is written as it arrives, and with a state file an interrupted retrieval resumes from the last page.")
+    parser.add_argument('-sm', '--sort-mode', dest='sort_mode', action='store', default='auto', choices=['server', 'client', 'auto'], help="Where sorted results are sorted: by the database server, by this tool using temporary files, or chosen from the estimated number of rows (default: auto).")
+    parser.add_argument('-t', '--temp-directory', dest='temp_directory', action='store', default=None, help="Directory for temporary files used to sort results on the client (optional, default is the system temporary directory).")
+    parser.add_argument('-jm', '--join-mode', dest='join_mode', action='store', default='server', choices=client_join.JOIN_MODES, help="Where intensity measures are joined with their site, rupture, and IM type metadata: by the database server, or by this tool, which only queries PeakAmplitudes from the server (default: server).")
+    parser.add_argument('-pb', '--partition-by', dest='partition_by', action='store', default=None, choices=partitioning.PARTITION_MODES, help="Split the results into a file for each site, each run, or each of a number of hash buckets, listed in a manifest file (optional).")
+    parser.add_argument('-npt', '--num-partitions', dest='num_partitions', action='store', type=int, default=partitioning.DEFAULT_NUM_PARTITIONS, help="Number of hash buckets to split the results into, with '-pb hash' (default: %d)." % partitioning.DEFAULT_NUM_PARTITIONS)
+    parser.add_argument('-lo', '--layout', dest='layout', action='store', default='long', choices=wide_layout.LAYOUTS, help="Layout for intensity measure results: a row for each IM, or a row for each rupture variation with a column for each IM type (default: long).")
+    parser.add_argument('-ro', '--replica-offset', dest='replica_offset', action='store', type=int, default=None, help="If the config file lists several database replicas, start from the one this many places after the fastest, so shards run at the same time use different replicas (optional).")
+    parser.add_argument('-pr', '--profile', dest='profile', action='store', default=None, choices=profiling.PROFILE_MODES, help="Profile this stage's CPU time or memory allocations, and write reports next to the output file (optional).")
+    parser.add_argument('-pp', '--profile-prefix', dest='profile_prefix', action='store', default=None, help="Path and filename prefix for the profile reports (optional, default is the output filename without its extension).")
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
     parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help="Show version number and exit.")
     args = parser.parse_args(args=argv)
@@ -89,6 +128,18 @@ def parse_args(argv):
     if args.input_filename is None:
         print("Path to input file must be provided, aborting.", file=sys.stderr)
         sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+    if args.resume==True and args.state_filename is None:
+        print("A state file must be provided to resume, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+    args_dict['resume'] = args.resume
+    args_dict['state'] = None
+    if args.state_filename is not None:
+        state = request_state.RequestState(args.state_filename)
+        #Don't add records to a state file which can't be read back, since the next resume would ignore them
+        if args.resume==True and not state.load():
+            print("No usable state file found at %s, starting from the beginning." % args.state_filename)
+            state.create()
+        args_dict['state'] = state
     if args.debug==True:
         debug = True
     args_dict['input_filename'] = args.input_filename
@@ -103,6 +154,39 @@ def parse_args(argv):
     args_dict['output_filename'] = output_filename
     args_dict['config_filename'] = args.config_filename
     args_dict['output_format'] = args.output_format
+    compression_problem = compression.get_compression_problem(compression.get_compression(args.output_format))
+    if compression_problem is not None:
+        print("Output format '%s' can't be used, since %s, aborting." % (args.output_format, compression_problem), file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    args_dict['incremental_directory'] = args.incremental_directory
+    if args.page_size is not None and args.page_size<=0:
+        print("Page size must be positive, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    args_dict['page_size'] = args.page_size
+    if args.num_partitions<=0:
+        print("Number of partitions must be positive, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    args_dict['partition_by'] = args.partition_by
+    args_dict['num_partitions'] = args.num_partitions
+    args_dict['layout'] = args.layout
+    args_dict['sort_mode'] = args.sort_mode
+    args_dict['join_mode'] = args.join_mode
+    args_dict['replica_offset'] = args.replica_offset
+    args_dict['temp_directory'] = args.temp_directory
+    if args.no_mirror==True:
+        args_dict['mirror_filename'] = None
+    else:
+        args_dict['mirror_filename'] = args.mirror_filename
+    if args.im_cache_directory is not None and im_cache.is_available()==False:
+        print("The IM cache requires NumPy, which isn't installed, so it won't be used.")
+        args_dict['im_cache_directory'] = None
+    else:
+        args_dict['im_cache_directory'] = args.im_cache_directory
+    args_dict['profile'] = args.profile
+    if args.profile_prefix is None:
+        args_dict['profile_prefix'] = "%s.database_wrapper" % output_filename.rsplit(".", 1)[0]
+    else:
+        args_dict['profile_prefix'] = args.profile_prefix
     return args_dict
 
 def read_input(input_filename):
@@ -121,18 +205,60 @@ def read_input(input_filename):
         sys.exit(utilities.ExitCodes.BAD_FILE_PATH)
     return input_dict
 
-def execute_queries(config_dict, input_dict):
-    print("Executing database queries.")
-    if (debug):
-        start_time = timeit.default_timer()
+#MySQL functions used by the queries which SQLite doesn't have
+def sqlite_ln(value):
+    #MySQL returns NULL for the log of a non-positive number
+    if value is None or value<=0:
+        return None
+    return math.log(value)
+
+class SQLiteStdDevPop:
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.sum_squares = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        #Welford's algorithm, to avoid cancellation
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta/self.count
+        self.sum_squares += delta*(value - self.mean)
+
+    def finalize(self):
+        if self.count==0:
+            return None
+        return math.sqrt(self.sum_squares/self.count)
+
+def register_sqlite_functions(conn):
+    conn.create_function('ln', 1, sqlite_ln, deterministic=True)
+    conn.create_aggregate('stddev_pop', 1, SQLiteStdDevPop)
+
+#Opens a connection to a single database, raising an exception if it fails
+def open_database(config_dict):
+    if config_dict['type'].lower()=='mysql':
+        return pymysql.connect(host=config_dict["host"], user=config_dict["user"], passwd=config_dict["password"], db=config_dict['db'])
+    conn = sqlite_backend.open_sqlite(config_dict)
+    register_sqlite_functions(conn)
+    return conn
+
+#Opens a connection to the database described by config_dict, and aborts if it fails.  If the config lists several
+#replicas, the connection is to the fastest one which is up.
+def get_connection(config_dict):
     try:
-        if config_dict['type'].lower()=='mysql':
-            conn = pymysql.connect(host=config_dict["host"], user=config_dict["user"], passwd=config_dict["password"], db=config_dict['db'])
-        elif config_dict['type'].lower()=='sqlite':
-            conn = sqlite3.connect(config_dict['db_path'])
-        else:
-            print("Database type %s not recognized, aborting.", file=sys.stderr)
+        if config_dict['type'].lower() not in ['mysql', 'sqlite']:
+            print("Database type %s not recognized, aborting." % config_dict['type'], file=sys.stderr)
             sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
+        if config_dict['type'].lower()=='sqlite' and sqlite_backend.get_sqlite_mode(config_dict) not in sqlite_backend.SQLITE_MODES:
+            print("SQLite mode %s not recognized, aborting." % config_dict['sqlite_mode'], file=sys.stderr)
+            sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
+        if replicas.has_replicas(config_dict):
+            conn = replicas.get_replica_set(config_dict).connect(open_database)
+        else:
+            conn = open_database(config_dict)
     except Exception as e:
         error_str = "Error connecting to %s database" % config_dict['type']
         if config_dict['type'].lower()=='mysql':
@@ -142,22 +268,122 @@ def execute_queries(config_dict, input_dict):
         print(error_str, file=sys.stderr)
         print(e)
         sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
-    #Use DictCursor in case we're retrieving seismograms
-    cur = conn.cursor(cursor=pymysql.cursors.DictCursor)
-    query = 'select %s from %s where %s' % (input_dict['select'], input_dict['from'], input_dict['where'])
+    return conn
+
+def get_query_string(input_dict, extra_where=None):
+    where = input_dict['where']
+    if extra_where is not None:
+        where = "%s and %s" % (where, extra_where)
+    query = 'select %s from %s where %s' % (input_dict['select'], input_dict['from'], where)
+    if 'group_by' in input_dict:
+        query = "%s group by %s" % (query, input_dict['group_by'])
     if 'sort' in input_dict:
         query = "%s %s" % (query, input_dict['sort'])
+    if 'limit' in input_dict:
+        query = "%s limit %d" % (query, int(input_dict['limit']))
+    return query
+
+#Wraps a cursor so that rows matching existing results are removed as they're fetched
+class FilteredCursor:
+
+    def __init__(self, cur, existing_results):
+        self.cur = cur
+        self.existing_results = existing_results
+        self.description = cur.description
+        self.column_indices = utilities.get_cursor_column_indices(cur)
+
+    def fetchmany(self, size):
+        while True:
+            rows = self.cur.fetchmany(size)
+            if not rows:
+                return rows
+            filtered_rows = self.existing_results.filter_rows(rows, self.column_indices)
+            #An empty batch would look like the end of the results, so keep going until there's something left
+            if len(filtered_rows)>0:
+                return filtered_rows
+
+#Opens the cursor for a query on conn, and returns (cur, query, filter_existing).  query, if supplied, already excludes
+#the existing results; otherwise it's built from input_dict, excluding them with an anti-join if possible, or else
+#filter_existing is True and they have to be removed from the rows.
+def open_query_cursor(conn, config_dict, input_dict, query, existing_results, streaming):
+    #Rows are tuples in the order of the selected fields, which uses much less memory than a dict per row
+    if config_dict['type'].lower()=='sqlite':
+        cur = conn.cursor()
+    elif streaming==True:
+        #Stream the results, rather than holding them all in memory
+        cur = conn.cursor(cursor=pymysql.cursors.SSCursor)
+    else:
+        cur = conn.cursor()
+    filter_existing = False
+    #If the IM cache was used, the query already excludes the existing results
+    if query is None:
+        query = get_query_string(input_dict)
+        if existing_results is not None and len(existing_results.get_keys())>0:
+            #Use an anti-join against a temporary table of the keys we already have
+            try:
+                anti_join_clause = incremental.create_anti_join(conn, cur, config_dict, existing_results)
+                query = get_query_string(input_dict, extra_where=anti_join_clause)
+            except Exception as e:
+                print("Unable to create a temporary table of existing results, so they will be removed after the query instead.")
+                if debug==True:
+                    print(e)
+                filter_existing = True
+    return (cur, query, filter_existing)
+
+#existing_results, if supplied, are results we already have and should be excluded
+#row_handler, if supplied, is called with the cursor and input_dict to read the results in batches, and returns what it computes from them
+def execute_queries(config_dict, input_dict, existing_results=None, mirror_path=None, im_cache_directory=None, row_handler=None):
+    print("Executing database queries.")
+    if (debug):
+        start_time = timeit.default_timer()
+    query = None
+    if mirror_path is not None and im_cache.can_use_cache(im_cache_directory, mirror_path, input_dict):
+        (conn, query) = im_cache.prepare_query(im_cache_directory, mirror_path, config_dict, input_dict, get_query_string, get_connection, existing_results=existing_results)
+        config_dict = {'type': 'SQLite', 'db_path': mirror_path}
+    else:
+        if mirror_path is not None and metadata_mirror.can_use_mirror(mirror_path, input_dict):
+            print("Using local metadata mirror %s." % mirror_path)
+            config_dict = {'type': 'SQLite', 'db_path': mirror_path}
+        conn = get_connection(config_dict)
+    (cur, query, filter_existing) = open_query_cursor(conn, config_dict, input_dict, query, existing_results, row_handler is not None)
     if debug==True:
         print(query)
-    try:
-        cur.execute(query)
-    except Exception as e:
-        print("Error executing database query '%s', aborting." % query)
-        cur.close()
-        conn.close()
-        print(e)
-        sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
-    res = cur.fetchall()
+    #If the config lists several replicas and the one in use goes down, the query is run again on another.  Streamed
+    #results are only retried until the first rows have been handled.
+    attempt = 0
+    while True:
+        try:
+            cur.execute(query)
+            if row_handler is None:
+                res = cur.fetchall()
+            break
+        except Exception as e:
+            if not replicas.can_retry(config_dict, e, attempt):
+                print("Error executing database query '%s', aborting." % query)
+                cur.close()
+                conn.close()
+                print(e)
+                sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
+            attempt += 1
+            print("Error executing database query, retrying on another replica.")
+            if debug==True:
+                print(e)
+            replicas.report_failure(config_dict)
+            try:
+                conn.close()
+            except Exception:
+                pass
+            conn = get_connection(config_dict)
+            (cur, query, filter_existing) = open_query_cursor(conn, config_dict, input_dict, None, existing_results, row_handler is not None)
+    if row_handler is not None:
+        if filter_existing==True:
+            res = row_handler(FilteredCursor(cur, existing_results), input_dict)
+        else:
+            res = row_handler(cur, input_dict)
+    else:
+        if filter_existing==True:
+            res = existing_results.filter_rows(res, utilities.get_cursor_column_indices(cur))
+        profiling.checkpoint("results fetched")
     #Results length 0 isn't necessarily an error, but let the user know
     if len(res)==0:
         print("No entries found in the database which match all filters.\n")
@@ -168,48 +394,245 @@ def execute_queries(config_dict, input_dict):
         print("Database query took %f sec." % (end_time-start_time))
     return res
 
-#If data product is seismograms, write a url file and calculate data size
-def write_url_file(args_dict, input_dict, config_dict, result_set):
-    print("Calculating disk space required for seismograms.")
-    seis_dict = dict()
-    temp_disk_space_mb = 0.0
-    track_file_size = True
-    #Attempt to query # of rupture variations using built-in SQLite DB
+#Opens a connection and cursor for paginated queries, along with the condition which excludes existing results.
+#Returns (conn, cur, anti_join_clause, filter_existing).
+def open_page_connection(config_dict, existing_results):
+    conn = get_connection(config_dict)
+    cur = conn.cursor()
+    anti_join_clause = None
+    filter_existing = False
+    if existing_results is not None and len(existing_results.get_keys())>0:
+        try:
+            anti_join_clause = incremental.create_anti_join(conn, cur, config_dict, existing_results)
+        except Exception as e:
+            print("Unable to create a temporary table of existing results, so they will be removed after each page instead.")
+            if debug==True:
+                print(e)
+            filter_existing = True
+    return (conn, cur, anti_join_clause, filter_existing)
+
+#Retrieves the results a page at a time in key order, writing each page with writer as it arrives.
+#last_key, if supplied, is the key of the last row already written.  Returns the total number of rows written.
+def execute_paged_queries(config_dict, input_dict, writer, page_size, state=None, query_checksum=None, existing_results=None, last_key=None):
+    print("Executing database queries in pages.")
+    if (debug):
+        start_time = timeit.default_timer()
+    sizer = pagination.PageSizer(page_size)
+    (conn, cur, anti_join_clause, filter_existing) = open_page_connection(config_dict, existing_results)
+    while True:
+        page_size = sizer.get_page_size()
+        query = pagination.get_page_query(input_dict, last_key, page_size, get_query_string, extra_where=anti_join_clause)
+        if debug==True:
+            print(query)
+        attempt = 0
+        while True:
+            try:
+                page_start = timeit.default_timer()
+                cur.execute(query)
+                res = cur.fetchall()
+                elapsed = timeit.default_timer() - page_start
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt>pagination.PAGE_RETRIES:
+                    print("Error executing database query '%s', aborting." % query)
+                    print(e)
+                    if state is not None:
+                        print("Rerun with the same state file and -r to resume from the last page written.")
+                    sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
+                print("Error retrieving page, retrying with a smaller page size.")
+                if debug==True:
+                    print(e)
+                #If the replica went down, the page is retried on another one
+                if replicas.is_transient_error(e):
+                    replicas.report_failure(config_dict)
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                (conn, cur, anti_join_clause, filter_existing) = open_page_connection(config_dict, existing_results)
+                sizer.shrink()
+                page_size = sizer.get_page_size()
+                query = pagination.get_page_query(input_dict, last_key, page_size, get_query_string, extra_where=anti_join_clause)
+        if len(res)==0:
+            break
+        last_key = pagination.get_row_key(res[-1])
+        rows = [pagination.remove_row_key(row) for row in res]
+        if filter_existing==True:
+            rows = existing_results.filter_rows(rows, utilities.get_cursor_column_indices(cur))
+        profiling.checkpoint("page fetched")
+        writer.write_rows(rows)
+        if state is not None:
+            state.mark_page_complete(query_checksum, writer.get_filename(), last_key, writer.get_num_rows(), writer.get_position())
+        if debug==True:
+            print("Retrieved %d rows in %f sec, %d rows written so far." % (len(res), elapsed, writer.get_num_rows()))
+        sizer.update(elapsed, len(res))
+        #A short page means there aren't any more results
+        if len(res)<page_size:
+            break
+    cur.close()
+    conn.close()
+    if writer.get_num_rows()==0:
+        print("No entries found in the database which match all filters.\n")
+    if (debug):
+        end_time = timeit.default_timer()
+        print("Database queries took %f sec." % (end_time-start_time))
+    return writer.get_num_rows()
+
+#Queries PeakAmplitudes alone and joins the results with the metadata tables on the client, writing them as they
+#arrive.  Returns the writer, which has been closed.
+def execute_client_join(config_dict, input_dict, args_dict, existing_results=None):
+    writer = create_result_writer(args_dict, input_dict['select'].split(","))
+    joiner = client_join.ClientJoin(input_dict, writer, existing_results=existing_results)
+    #The metadata is small enough to read from the mirror, even though PeakAmplitudes isn't in it
+    dimension_config_dict = config_dict
+    if joiner.can_use_mirror(args_dict['mirror_filename']):
+        print("Reading metadata from local metadata mirror %s." % args_dict['mirror_filename'])
+        dimension_config_dict = {'type': 'SQLite', 'db_path': args_dict['mirror_filename']}
+    conn = get_connection(dimension_config_dict)
     try:
-        num_rvs_db_path = '%s/../utils/num_rvs.sqlite' % (os.path.dirname(os.path.abspath(__file__)))
-        if os.path.exists(num_rvs_db_path):
-            print("Using built-in database to determine data size.")
-            conn = sqlite3.connect(num_rvs_db_path)
-        else:
-            print("Using config file DB to determine data size.")
-        #Open connection to query # of rupture variations
+        cur = conn.cursor()
+        joiner.load_dimensions(cur)
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print("Error reading metadata tables for the client-side join, aborting.", file=sys.stderr)
+        print(e)
+        sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
+    profiling.checkpoint("metadata loaded")
+    writer.open()
+    execute_queries(config_dict, joiner.get_fact_query(), row_handler=joiner.read_cursor)
+    writer.close()
+    return writer
+
+#Returns the number of rows the database expects the query to return, or None if it can't be estimated
+def estimate_num_rows(config_dict, input_dict):
+    #Only MySQL's EXPLAIN includes row estimates
+    if config_dict['type'].lower()!='mysql':
+        return None
+    try:
+        config_dict = replicas.get_preferred_replica(config_dict)
+        conn = pymysql.connect(host=config_dict["host"], user=config_dict["user"], passwd=config_dict["password"], db=config_dict['db'])
+        cur = conn.cursor(cursor=pymysql.cursors.DictCursor)
+        cur.execute("explain %s" % get_query_string(input_dict))
+        plan = cur.fetchall()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        if debug==True:
+            print("Unable to estimate the number of rows.")
+            print(e)
+        return None
+    #Each table in the join is looked up once for each row from the tables before it
+    num_rows = 1.0
+    for table in plan:
+        if table.get('rows') is None:
+            continue
+        num_rows *= float(table['rows'])
+        if table.get('filtered') is not None:
+            num_rows *= float(table['filtered'])/100.0
+    return int(num_rows)
+
+#Returns True if the query's sort should be done on the client, given the sort mode
+def use_client_sort(config_dict, input_dict, args_dict):
+    if args_dict['sort_mode']=='server' or 'sort' not in input_dict:
+        return False
+    #Wide layout queries are sorted by rupture variation, which is cheap for the database since it's the key order
+    if args_dict['wide_layout'] is not None:
+        return False
+    sort_problem = external_sort.get_client_sort_problem(input_dict)
+    if sort_problem is not None:
+        if args_dict['sort_mode']=='client':
+            print("Sorting on the database server, since %s." % sort_problem)
+        return False
+    if args_dict['sort_mode']=='client':
+        return True
+    #Local databases don't need protecting from big sorts
+    if args_dict['mirror_filename'] is not None and im_cache.can_use_cache(args_dict['im_cache_directory'], args_dict['mirror_filename'], input_dict):
+        return False
+    num_rows = estimate_num_rows(config_dict, input_dict)
+    if debug==True:
+        print("Estimated number of rows: %s" % num_rows)
+    return num_rows is not None and num_rows>=external_sort.CLIENT_SORT_MIN_ROWS
+
+#Opens a cursor on the config file DB for data size queries.  Returns None if it's unavailable, since the size is only informational.
+def get_size_cursor(config_dict):
+    try:
+        config_dict = replicas.get_preferred_replica(config_dict)
         if config_dict['type'].lower()=='mysql':
             conn = pymysql.connect(host=config_dict["host"], user=config_dict["user"], passwd=config_dict["password"], db=config_dict['db'])
         elif config_dict['type'].lower()=='sqlite':
-            conn = sqlite3.connect(config_dict['db_path'])
-        cur = conn.cursor()
+            conn = sqlite_backend.open_sqlite(config_dict)
+        return conn.cursor()
     except Exception as e:
         error_str = "Error connecting to database to determine data size.  Will continue without data size information."
         print(error_str, file=sys.stderr)
         print(e)
-        track_file_size = False
+        return None
+
+#Returns the URL of the server with the study's bulk seismogram files, or None if there isn't one.  The config file can
+#set 'seismogram_server.<study name> = <url>' for a single study, or 'seismogram_server = <url>' for all of them.
+def get_seismogram_server(config_dict, study_name):
+    study_key = "seismogram_server.%s" % study_name
+    if study_key in config_dict:
+        return config_dict[study_key].rstrip("/")
+    if 'seismogram_server' in config_dict:
+        return config_dict['seismogram_server'].rstrip("/")
+    return globus_dict.get(study_name, None)
+
+#If data product is seismograms, write a url file and calculate data size
+def write_url_file(args_dict, input_dict, config_dict, result_set):
+    print("Calculating disk space required for seismograms.")
+    seis_dict = dict()
+    temp_disk_space_mb = 0.0
+    track_file_size = True
+    #Attempt to query # of rupture variations using built-in SQLite DB, falling back to the config file DB for
+    #studies which aren't in it
+    num_rvs_cur = None
+    cur = None
+    num_rvs_table = 'Rupture_Variation_Counts'
+    num_rvs_db_path = sqlite_backend.get_num_rvs_db_path()
+    if os.path.exists(num_rvs_db_path):
+        print("Using built-in database to determine data size.")
+        #The fast SQLite mode attaches the built-in database, so one connection answers both kinds of lookup
+        if sqlite_backend.is_fast_mode(config_dict):
+            cur = get_size_cursor(config_dict)
+        if cur is not None and sqlite_backend.has_num_rvs(cur.connection):
+            num_rvs_cur = cur
+            num_rvs_table = '%s.%s' % (sqlite_backend.NUM_RVS_SCHEMA, num_rvs_table)
+        else:
+            num_rvs_conn = sqlite3.connect(num_rvs_db_path)
+            num_rvs_cur = num_rvs_conn.cursor()
+    else:
+        print("Using config file DB to determine data size.")
+        cur = get_size_cursor(config_dict)
+        if cur is None:
+            track_file_size = False
+    #Positions of the fields we need in the result rows, which are in the order of the select
+    column_indices = utilities.get_column_indices([utilities.get_select_field_name(c) for c in input_dict['select'].split(",")])
+    study_name_index = column_indices['Study_Name']
+    site_name_index = column_indices['CS_Short_Name']
+    run_id_index = column_indices['Run_ID']
+    source_id_index = column_indices['Source_ID']
+    rupture_id_index = column_indices['Rupture_ID']
+    rup_var_id_index = column_indices['Rup_Var_ID']
     for row in result_set:
-        study_name = row['Study_Name']
-        if study_name not in globus_dict:
+        study_name = row[study_name_index]
+        study_prefix = get_seismogram_server(config_dict, study_name)
+        if study_prefix is None:
             print("Not sure where to download seismograms from for study %s, aborting." % study_name, file=sys.stderr)
             sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
-        study_prefix = globus_dict[study_name]
         study_suffix = ".grm"
         rv_seis_size = utilities.get_rv_seismogram_size(study_name)
         #Add the '_bb' to seismogram filenames for broadband studies
         if study_name in suffix_dict:
             study_suffix = "%s%s" % (suffix_dict[study_name], study_suffix)
         #Need site name, run ID, source_ID, rupture_ID, rup_var_ID
-        site_name = row['CS_Short_Name']
-        run_id = row['Run_ID']
-        source_id = row['Source_ID']
-        rupture_id = row['Rupture_ID']
-        rup_var_id = row['Rup_Var_ID']
+        site_name = row[site_name_index]
+        run_id = row[run_id_index]
+        source_id = row[source_id_index]
+        rupture_id = row[rupture_id_index]
+        rup_var_id = row[rup_var_id_index]
         full_url = '%s/%s/%d/Seismogram_%s_%d_%d%s' % (study_prefix, site_name, run_id, site_name, source_id, rupture_id, study_suffix)
         if full_url in seis_dict:
             seis_dict[full_url] = "%s,%d" % (seis_dict[full_url], rup_var_id)
@@ -217,14 +640,29 @@ def write_url_file(args_dict, input_dict, config_dict, result_set):
             seis_dict[full_url] = "%d" % (rup_var_id)
             #Figure out size
             if track_file_size==True:
-                num_rvs_query = 'select Studies.Study_Name, count(*) from Rupture_Variations, CyberShake_Runs, Studies ' \
-                    'where Studies.Study_ID=CyberShake_Runs.Study_ID and CyberShake_Runs.Run_ID=%d and CyberShake_Runs.ERF_ID=Rupture_Variations.ERF_ID and CyberShake_Runs.Rup_Var_Scenario_ID=Rupture_Variations.Rup_Var_Scenario_ID and Rupture_Variations.Source_ID=%d and Rupture_Variations.Rupture_ID=%d' \
-                    % (run_id, source_id, rupture_id)
-                cur.execute(num_rvs_query)
-                (study_name, num_rvs) = cur.fetchone()
+                num_rvs = None
+                if num_rvs_cur is not None:
+                    num_rvs_cur.execute('select Num_Rup_Vars from %s where Study_Name=? and Source_ID=? and Rupture_ID=?' % num_rvs_table, (study_name, source_id, rupture_id))
+                    res = num_rvs_cur.fetchone()
+                    if res is not None:
+                        num_rvs = res[0]
+                if num_rvs is None:
+                    if cur is None:
+                        cur = get_size_cursor(config_dict)
+                    if cur is None:
+                        track_file_size = False
+                        continue
+                    num_rvs_query = 'select Studies.Study_Name, count(*) from Rupture_Variations, CyberShake_Runs, Studies ' \
+                        'where Studies.Study_ID=CyberShake_Runs.Study_ID and CyberShake_Runs.Run_ID=%d and CyberShake_Runs.ERF_ID=Rupture_Variations.ERF_ID and CyberShake_Runs.Rup_Var_Scenario_ID=Rupture_Variations.Rup_Var_Scenario_ID and Rupture_Variations.Source_ID=%d and Rupture_Variations.Rupture_ID=%d' \
+                        % (run_id, source_id, rupture_id)
+                    cur.execute(num_rvs_query)
+                    num_rvs = cur.fetchone()[1]
                 temp_disk_space_mb += num_rvs*rv_seis_size/(1000000.0)
+    if num_rvs_cur is not None and num_rvs_cur is not cur:
+        num_rvs_conn.close()
+    if cur is not None:
+        cur.connection.close()
     if track_file_size==True and len(result_set)>0:
-        conn.close()
         output_disk_space_mb = rv_seis_size*len(result_set)/(1000000.0)
         print("Temporary disk space required to download seismograms: %.1f MB" % (temp_disk_space_mb))
         print("Disk space required for requested output seismograms: %.1f MB" % (output_disk_space_mb))
@@ -245,98 +683,324 @@ def write_url_file(args_dict, input_dict, config_dict, result_set):
         fp_out.flush()
         fp_out.close()         
 
-def write_results(result_set, args_dict, input_dict, config_dict):
-    #Mapping of Python types to SQLite types
-    sqlite_type_dict = dict()
-    sqlite_type_dict['str'] = 'TEXT'
-    sqlite_type_dict['int'] = 'INTEGER'
-    sqlite_type_dict['float'] = 'REAL'
-    #Write data and metadata to output file
-    try:
-        if args_dict['output_format'].lower()=='csv':
-            filename = args_dict['output_filename']
-            if filename[-3:]!='csv':
-                filename = "%s.csv" % (filename)
-            with open(filename, 'w') as fp_out:
-                #Write headers
-                columns = input_dict['select'].split(",")
-                columns_pretty = []
-                for c in columns:
-                    columns_pretty.append(utilities.get_field_alias(c.split(".")[1]))
-                fp_out.write("%s\n" % ",".join(columns_pretty))
-                #Write data
-                for row in result_set:
-                    #Quote any string datatypes
-                    line_strs = []
-                    #row.values() because we're using a DictCursor
-                    for r in row.values():
-                        if type(r)==str:
-                            line_strs.append('"%s"' % r)
-                        else:
-                            line_strs.append(str(r))
-                    fp_out.write("%s\n" % ",".join(line_strs))
-                fp_out.flush()
-                fp_out.close()
-        elif args_dict['output_format'].lower()=='sqlite':
-            print("Using sqlite format.")
-            filename = args_dict['output_filename']
-            if filename[-6:]!='sqlite':
-                filename = "%s.sqlite" % (filename)
-            conn = sqlite3.connect(filename)
-            cur = conn.cursor()
-            #Create schema
-            create_table_cmd = 'CREATE TABLE CyberShake_Data'
-            #Figure out datatype from first row of results
-            #If results is empty, just make everything TEXT
-            if len(result_set)>0:
-                row_vals = []
-                for r in result_set[1].values():
-                    row_vals.append(r)
-            create_columns = []
-            columns = input_dict['select'].split(",")
-            for i, c in enumerate(columns):
-                column_type = type(row_vals[i]).__name__
-                if column_type in sqlite_type_dict:
-                    sqlite_type = sqlite_type_dict[column_type]
-                else:
-                    sqlite_type = 'TEXT'
-                create_columns.append("%s %s" % (c.split('.')[1], sqlite_type))
-            create_table_cmd = "%s (%s)" % (create_table_cmd, ', '.join(create_columns))
-            cur.execute(create_table_cmd)
-            for row in result_set:
-                #Quote any string datatypes
-                line_strs = []
-                #row.values() because we're using a DictCursor
-                for r in row.values():
-                    if type(r)==str:
-                        line_strs.append('"%s"' % r)
-                    else:
-                        line_strs.append(str(r))
-                value_string = ", ".join(line_strs)
-                insert_cmd = 'insert into CyberShake_Data values (%s)' % value_string
-                cur.execute(insert_cmd)
-            conn.commit()
-            conn.close()
+#Output filename, with the extension for the output format added
+def get_output_filename(args_dict):
+    filename = args_dict['output_filename']
+    if args_dict['output_format'].lower()=='csv':
+        if filename[-3:]!='csv':
+            filename = "%s.csv" % (filename)
+    elif args_dict['output_format'].lower()=='sqlite':
+        if filename[-6:]!='sqlite':
+            filename = "%s.sqlite" % (filename)
+    elif args_dict['output_format'].lower() in CSV_FORMATS:
+        if not filename.endswith(args_dict['output_format'].lower()):
+            filename = "%s.%s" % (filename, args_dict['output_format'].lower())
+    return filename
+
+#Returns a %-format for CSV lines of the rows, quoting the string columns, or None if a column mixes strings with other
+#values or has a string with a quote in it
+def get_csv_line_format(rows):
+    field_formats = []
+    for column in zip(*rows):
+        column_types = set(map(type, column))
+        if column_types=={str}:
+            if '"' in "".join(column):
+                return None
+            field_formats.append('"%s"')
+        elif str in column_types:
+            return None
         else:
+            field_formats.append('%s')
+    return "%s\n" % ",".join(field_formats)
+
+#Returns tuple rows as CSV lines.  Strings are quoted, with any quotes in them doubled, and other values are written with str().
+def format_csv_rows(rows):
+    if len(rows)==0:
+        return ""
+    line_format = get_csv_line_format(rows)
+    if line_format is None:
+        return "".join(["%s\n" % ",".join([('"%s"' % v.replace('"', '""')) if type(v) is str else str(v) for v in row]) for row in rows])
+    #Formatting whole rows at once is much faster than formatting each value
+    return "".join([line_format % row for row in rows])
+
+#Writes result rows to the output file.  Rows can be written all at once, or a page at a time as they arrive.
+class ResultWriter:
+
+    def __init__(self, args_dict, columns):
+        self.output_format = args_dict['output_format'].lower()
+        self.filename = get_output_filename(args_dict)
+        self.columns = columns
+        self.fp_out = None
+        self.conn = None
+        self.table_created = False
+        self.num_rows = 0
+        if self.output_format not in CSV_FORMATS and self.output_format!='sqlite':
             print("Output format '%s' is unrecognized, aborting." % args_dict['output_format'], file=sys.stderr)
             sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
-    except Exception as e:
-        print("Error writing data to output file %s, aborting." % (args_dict['output_filename']), file=sys.stderr)
+        self.compression = compression.get_compression(self.output_format)
+
+    def get_filename(self):
+        return self.filename
+
+    def get_num_rows(self):
+        return self.num_rows
+
+    def writing_error(self, e):
+        print("Error writing data to output file %s, aborting." % (self.filename), file=sys.stderr)
         print(e)
         sys.exit(utilities.ExitCodes.FILE_WRITING_ERROR)
+
+    #position, if supplied, is from get_position() on an earlier writer for this file, and anything written after it is discarded
+    def open(self, num_rows=0, position=None):
+        try:
+            if self.output_format in CSV_FORMATS:
+                if position is None:
+                    if self.compression is None:
+                        self.fp_out = open(self.filename, 'w', buffering=CSV_BUFFER_SIZE)
+                    else:
+                        self.fp_out = compression.BackgroundCompressedFile(self.filename, self.compression)
+                    #Write headers
+                    columns_pretty = []
+                    for c in self.columns:
+                        columns_pretty.append(utilities.get_field_alias(utilities.get_select_field_name(c)))
+                    self.fp_out.write("%s\n" % ",".join(columns_pretty))
+                else:
+                    self.fp_out = open(self.filename, 'r+', buffering=CSV_BUFFER_SIZE)
+                    self.fp_out.truncate(position)
+                    self.fp_out.seek(position)
+            else:
+                print("Using sqlite format.")
+                #Partitioned output may be written from another thread, though only one at a time
+                self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+                if position is not None:
+                    self.table_created = True
+                    self.conn.execute('delete from CyberShake_Data where rowid>?', (position,))
+                    self.conn.commit()
+        except Exception as e:
+            self.writing_error(e)
+        self.num_rows = num_rows
+
+    #Figures out the column types from the first rows of results, using the first value in each column which isn't
+    #NULL, or makes everything TEXT if there aren't any
+    def create_table(self, first_rows):
+        #Mapping of Python types to SQLite types
+        sqlite_type_dict = dict()
+        sqlite_type_dict['str'] = 'TEXT'
+        sqlite_type_dict['int'] = 'INTEGER'
+        sqlite_type_dict['float'] = 'REAL'
+        create_columns = []
+        for i, c in enumerate(self.columns):
+            sqlite_type = 'TEXT'
+            for row in first_rows:
+                if row[i] is not None:
+                    column_type = type(row[i]).__name__
+                    if column_type in sqlite_type_dict:
+                        sqlite_type = sqlite_type_dict[column_type]
+                    break
+            create_columns.append("%s %s" % (utilities.get_select_field_name(c), sqlite_type))
+        self.conn.execute('CREATE TABLE CyberShake_Data (%s)' % ', '.join(create_columns))
+        self.table_created = True
+
+    def write_rows(self, rows):
+        try:
+            if self.output_format in CSV_FORMATS:
+                #Format rows in batches, so each write is large but the text for all of them isn't held at once
+                for i in range(0, len(rows), CSV_WRITE_BATCH_SIZE):
+                    self.fp_out.write(format_csv_rows(rows[i:i+CSV_WRITE_BATCH_SIZE]))
+                self.fp_out.flush()
+            else:
+                if self.table_created==False and len(rows)>0:
+                    self.create_table(rows)
+                placeholders = ", ".join(["?"]*len(self.columns))
+                self.conn.executemany('insert into CyberShake_Data values (%s)' % placeholders, rows)
+                self.conn.commit()
+        except Exception as e:
+            self.writing_error(e)
+        self.num_rows += len(rows)
+
+    #Returns how much of the output file has been written, as a byte offset for CSV files and a row count for SQLite
+    #and compressed files
+    def get_position(self):
+        if self.output_format=='csv':
+            return self.fp_out.tell()
+        return self.num_rows
+
+    def close(self):
+        try:
+            if self.fp_out is not None:
+                self.fp_out.close()
+                self.fp_out = None
+            if self.conn is not None:
+                if self.table_created==False:
+                    self.create_table([])
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
+        except Exception as e:
+            self.writing_error(e)
+
+#Returns a writer for the results, which splits them into partitions and pivots them into the wide layout if those
+#were requested
+def create_result_writer(args_dict, columns):
+    layout = args_dict['wide_layout']
+    if layout is not None:
+        columns = layout.get_columns()
+    if args_dict['partition_by'] is not None:
+        writer = partitioning.PartitionedResultWriter(args_dict, columns, ResultWriter, num_partitions=args_dict['num_partitions'])
+    else:
+        writer = ResultWriter(args_dict, columns)
+    if layout is not None:
+        return wide_layout.WideResultWriter(layout, writer)
+    return writer
+
+#Returns the WideLayout for the query, or None if the results can't be written in the wide layout
+def get_wide_layout(config_dict, input_dict, args_dict):
+    layout_problem = wide_layout.get_wide_layout_problem(input_dict)
+    if layout_problem is None and args_dict['incremental_directory'] is not None:
+        layout_problem = "incremental requests compare each IM with the existing results"
+    if layout_problem is not None:
+        print("Not using the wide layout, since %s." % layout_problem)
+        return None
+    #The IM types come from the same database as the results
+    if args_dict['mirror_filename'] is not None and (metadata_mirror.can_use_mirror(args_dict['mirror_filename'], input_dict) or im_cache.can_use_cache(args_dict['im_cache_directory'], args_dict['mirror_filename'], input_dict)):
+        config_dict = {'type': 'SQLite', 'db_path': args_dict['mirror_filename']}
+    conn = get_connection(config_dict)
+    try:
+        cur = conn.cursor()
+        im_types = wide_layout.get_im_types(cur, input_dict)
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print("Error querying IM types for the wide layout, aborting.", file=sys.stderr)
+        print(e)
+        sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
+    return wide_layout.WideLayout(input_dict, im_types)
+
+#columns, if supplied, are the fields in each result row; otherwise they're the selected fields
+def write_results(result_set, args_dict, input_dict, config_dict, columns=None):
+    if columns is None:
+        columns = input_dict['select'].split(",")
+    #Write data and metadata to output file
+    writer = create_result_writer(args_dict, columns)
+    writer.open()
+    writer.write_rows(result_set)
+    writer.close()
+    filename = writer.get_filename()
     #If we're doing seismograms, need to create URL file
     if input_dict['data_product']=="Seismograms":
         write_url_file(args_dict, input_dict, config_dict, result_set)
     print("Database results are available in %s." % filename)
- 
-        
+    return filename
 
 def run_main(argv):
     args_dict = parse_args(argv)
+    profiling.run_profiled(args_dict['profile'], args_dict['profile_prefix'], retrieve_results, args_dict)
+
+def retrieve_results(args_dict):
     config_dict = utilities.read_config(args_dict['config_filename'])
+    if args_dict['replica_offset'] is not None:
+        config_dict['replica_offset'] = args_dict['replica_offset']
     input_dict = read_input(args_dict['input_filename'])
-    result_set = execute_queries(config_dict, input_dict)
-    write_results(result_set, args_dict, input_dict, config_dict)
+    state = args_dict['state']
+    query_checksum = request_state.get_string_checksum(get_query_string(input_dict))
+    if args_dict['resume']==True and state.is_query_complete(query_checksum):
+        print("Database results for this query were already retrieved, skipping.")
+        return
+    #Results in the wide layout are retrieved with the IM type and value last, and pivoted as they're written
+    args_dict['wide_layout'] = None
+    if args_dict['layout']=='wide':
+        args_dict['wide_layout'] = get_wide_layout(config_dict, input_dict, args_dict)
+    #Paginated queries which were interrupted pick up after the last page written
+    page_problem = None
+    last_page = None
+    if args_dict['page_size'] is not None:
+        page_problem = pagination.get_pagination_problem(input_dict)
+        if page_problem is None and args_dict['mirror_filename'] is not None and im_cache.can_use_cache(args_dict['im_cache_directory'], args_dict['mirror_filename'], input_dict):
+            page_problem = "the results will come from the local IM cache"
+        if page_problem is not None:
+            print("Not retrieving results in pages, since %s." % page_problem)
+        elif args_dict['resume']==True:
+            last_page = state.get_last_page(query_checksum)
+            if last_page is not None and compression.get_compression(args_dict['output_format']) is not None:
+                print("Compressed output can't be continued partway through, so all pages will be retrieved again.")
+                last_page = None
+            elif last_page is not None and args_dict['partition_by'] is not None:
+                print("Partitioned output can't be continued partway through, so all pages will be retrieved again.")
+                last_page = None
+            elif last_page is not None and args_dict['wide_layout'] is not None:
+                print("Wide layout output can't be continued partway through, so all pages will be retrieved again.")
+                last_page = None
+    paged = args_dict['page_size'] is not None and page_problem is None
+    if args_dict['wide_layout'] is not None:
+        #Pages are already ordered by the PeakAmplitudes key
+        input_dict = args_dict['wide_layout'].get_query(input_dict, ordered=not paged)
+    join_problem = None
+    if args_dict['join_mode']=='client':
+        join_problem = client_join.get_client_join_problem(input_dict)
+        if join_problem is None and paged==True:
+            join_problem = "the results are retrieved in pages"
+        if join_problem is None and args_dict['mirror_filename'] is not None and im_cache.can_use_cache(args_dict['im_cache_directory'], args_dict['mirror_filename'], input_dict):
+            join_problem = "the results will come from the local IM cache"
+        if join_problem is not None:
+            print("Joining on the database server, since %s." % join_problem)
+    existing_results = None
+    if args_dict['incremental_directory'] is not None:
+        output_filename = get_output_filename(args_dict)
+        if args_dict['partition_by'] is not None:
+            output_filename = partitioning.get_manifest_filename(args_dict)
+        if last_page is None and os.path.exists(output_filename):
+            print("Output file %s already exists.  Incremental requests only write new results, so please use a new label or output filename." % output_filename, file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+        existing_results = incremental.index_output_directory(args_dict['incremental_directory'], input_dict)
+    if input_dict['data_product']=="Hazard Curves":
+        #Curves are computed from all the IMs, so they can't be updated incrementally
+        if existing_results is not None:
+            print("Hazard curves are always computed from all the intensity measures, so the existing results will be ignored.")
+        result_set = execute_queries(config_dict, hazard_curves.remove_im_value_filters(input_dict), mirror_path=args_dict['mirror_filename'], im_cache_directory=args_dict['im_cache_directory'], row_handler=hazard_curves.compute_curves)
+        filename = write_results(result_set, args_dict, input_dict, config_dict, columns=hazard_curves.get_output_fields(input_dict))
+        num_rows = len(result_set)
+    elif use_client_sort(config_dict, input_dict, args_dict):
+        print("Sorting results on the client.")
+        (sort_field, descending) = external_sort.parse_sort(input_dict['sort'])
+        sorter = external_sort.ExternalSorter(descending, temp_directory=args_dict['temp_directory'])
+        execute_queries(config_dict, external_sort.get_unsorted_query(input_dict), existing_results=existing_results, mirror_path=args_dict['mirror_filename'], im_cache_directory=args_dict['im_cache_directory'], row_handler=sorter.read_cursor)
+        if debug==True:
+            print("Sorted %d rows using %d temporary files." % (len(sorter), sorter.get_num_runs()))
+        writer = create_result_writer(args_dict, input_dict['select'].split(","))
+        writer.open()
+        for batch in sorter.get_sorted_batches():
+            writer.write_rows(batch)
+        writer.close()
+        sorter.close()
+        num_rows = writer.get_num_rows()
+        filename = writer.get_filename()
+        print("Database results are available in %s." % filename)
+    elif paged==True:
+        writer = create_result_writer(args_dict, input_dict['select'].split(","))
+        last_key = None
+        if last_page is None:
+            writer.open()
+        else:
+            print("Resuming after %d rows already retrieved." % last_page['num_rows'])
+            writer.open(num_rows=last_page['num_rows'], position=last_page['position'])
+            last_key = last_page['last_key']
+        num_rows = execute_paged_queries(config_dict, input_dict, writer, args_dict['page_size'], state=state, query_checksum=query_checksum, existing_results=existing_results, last_key=last_key)
+        writer.close()
+        filename = writer.get_filename()
+        print("Database results are available in %s." % filename)
+    elif args_dict['join_mode']=='client' and join_problem is None:
+        print("Joining metadata on the client.")
+        writer = execute_client_join(config_dict, input_dict, args_dict, existing_results=existing_results)
+        num_rows = writer.get_num_rows()
+        filename = writer.get_filename()
+        print("Database results are available in %s." % filename)
+    else:
+        result_set = execute_queries(config_dict, input_dict, existing_results=existing_results, mirror_path=args_dict['mirror_filename'], im_cache_directory=args_dict['im_cache_directory'])
+        filename = write_results(result_set, args_dict, input_dict, config_dict)
+        num_rows = len(result_set)
+    if state is not None:
+        state.mark_query_complete(query_checksum, filename, num_rows)
+        state.close()
 
 if __name__=="__main__":
     run_main(sys.argv[1:])
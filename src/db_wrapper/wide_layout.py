@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Writes intensity measures in a wide layout, with one row per rupture variation and one column per IM type,
+pivoting the rows as they arrive in key order.'''
+
+import sys
+import os
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.utilities as utilities
+import db_wrapper.im_cache as im_cache
+
+LAYOUTS = ['long', 'wide']
+
+#Fields which identify a rupture variation in PeakAmplitudes; each wide row is one of these
+RUPTURE_VARIATION_FIELDS = ['Run_ID', 'Source_ID', 'Rupture_ID', 'Rup_Var_ID']
+
+#Returns None if the query's results can be written in the wide layout, or else the reason they can't
+def get_wide_layout_problem(input_dict):
+    if input_dict['data_product']!="Intensity Measures":
+        return "only intensity measures can be written in the wide layout"
+    from_tables = [t.strip() for t in input_dict['from'].split(",")]
+    if im_cache.get_peak_amplitudes_table(from_tables) is None or 'IM_Types' not in from_tables:
+        return "the query doesn't select intensity measures by IM type"
+    for option in ['group_by', 'sort', 'limit']:
+        if option in input_dict:
+            return "results with a %s can't be pivoted as they arrive" % option.replace("_", " ")
+    return None
+
+#Returns the sort which orders the rows by rupture variation, then IM type, which is the PeakAmplitudes key order
+def get_key_sort(pa_table):
+    key_fields = ["%s.%s" % (pa_table, f) for f in RUPTURE_VARIATION_FIELDS + ['IM_Type_ID']]
+    return "order by %s" % ",".join(key_fields)
+
+#Returns the column name for an IM type, e.g. SA_3s_RotD50 or SA_7p5s_RotD50.  Periods use 'p' for the decimal
+#point, so the names are also valid SQLite column names.
+def get_im_type_column(measure, value, component):
+    pieces = [measure.replace(" ", "_")]
+    if value is not None:
+        pieces.append("%ss" % ("%g" % float(value)).replace(".", "p"))
+    if component is not None and len(component)>0:
+        pieces.append(component)
+    return "_".join(pieces)
+
+#Returns a list of (IM_Type_ID, column name) for the IM types the query can return, found with the query's clauses
+#which only involve IM_Types, using the given cursor.  If several IM types have the same column name, each of them
+#gets its IM_Type_ID appended, e.g. SA_2s_RotD50_ID1, so no column is overwritten by another.
+def get_im_types(cur, input_dict):
+    im_type_terms = [t for t in im_cache.split_where(input_dict['where']) if im_cache.get_term_tables(t)==set(['IM_Types'])]
+    if len(im_type_terms)==0:
+        im_type_terms = ['1=1']
+    cur.execute('select IM_Type_ID, IM_Type_Measure, IM_Type_Value, IM_Type_Component from IM_Types where %s order by IM_Type_Measure, IM_Type_Component, IM_Type_Value, IM_Type_ID' % (" and ".join(im_type_terms)))
+    im_types = [(int(r[0]), get_im_type_column(r[1], r[2], r[3])) for r in cur.fetchall()]
+    columns = [column for (im_type_id, column) in im_types]
+    return [(im_type_id, column if columns.count(column)==1 else "%s_ID%d" % (column, im_type_id)) for (im_type_id, column) in im_types]
+
+
+#Describes how a query's results are pivoted.  The rows are selected with the IM type ID and value last, ordered by
+#the PeakAmplitudes key, so all the IMs for a rupture variation arrive together.
+class WideLayout:
+
+    def __init__(self, input_dict, im_types):
+        self.im_types = im_types
+        from_tables = [t.strip() for t in input_dict['from'].split(",")]
+        self.pa_table = im_cache.get_peak_amplitudes_table(from_tables)
+        #Every selected field which isn't about the IM type or value is the same for all the IMs of a rupture variation
+        self.group_fields = []
+        for f in input_dict['select'].split(","):
+            field = f.strip()
+            if field.startswith("IM_Types.") or field=="%s.IM_Value" % self.pa_table:
+                continue
+            self.group_fields.append(field)
+        #Rows are grouped by the group fields, so they have to include the rupture variation
+        group_names = [utilities.get_select_field_name(f) for f in self.group_fields]
+        for f in RUPTURE_VARIATION_FIELDS:
+            if f not in group_names:
+                self.group_fields.append("%s.%s" % (self.pa_table, f))
+
+    #Returns a copy of input_dict which selects the group fields, then the IM type and value.  Unless ordered is False,
+    #for paged queries which are already ordered by the PeakAmplitudes key, the rows are sorted by rupture variation.
+    def get_query(self, input_dict, ordered=True):
+        wide_dict = dict(input_dict)
+        wide_dict['select'] = "%s,%s.IM_Type_ID,%s.IM_Value" % (",".join(self.group_fields), self.pa_table, self.pa_table)
+        if ordered==True:
+            wide_dict['sort'] = get_key_sort(self.pa_table)
+        return wide_dict
+
+    #Output columns: the group fields, then a column for each IM type
+    def get_columns(self):
+        return self.group_fields + [column for (im_type_id, column) in self.im_types]
+
+
+#Wraps a ResultWriter, pivoting the rows written to it.  Rows must come from the query from WideLayout.get_query(),
+#and the last rupture variation is held back until the next rows or close(), since more of its IMs may follow.
+class WideResultWriter:
+
+    def __init__(self, layout, writer):
+        self.writer = writer
+        self.num_group_fields = len(layout.group_fields)
+        self.num_im_types = len(layout.im_types)
+        self.im_type_positions = dict([(im_type_id, i) for i, (im_type_id, column) in enumerate(layout.im_types)])
+        self.current_group = None
+        self.current_values = None
+
+    def get_filename(self):
+        return self.writer.get_filename()
+
+    def get_num_rows(self):
+        return self.writer.get_num_rows()
+
+    def get_position(self):
+        return self.writer.get_position()
+
+    def open(self, num_rows=0, position=None):
+        self.writer.open(num_rows=num_rows, position=position)
+
+    def write_rows(self, rows):
+        n = self.num_group_fields
+        wide_rows = []
+        for row in rows:
+            group = row[:n]
+            if group!=self.current_group:
+                if self.current_group is not None:
+                    wide_rows.append(self.current_group + tuple(self.current_values))
+                self.current_group = group
+                self.current_values = [None]*self.num_im_types
+            self.current_values[self.im_type_positions[int(row[n])]] = row[n+1]
+        self.writer.write_rows(wide_rows)
+
+    def close(self):
+        if self.current_group is not None:
+            self.writer.write_rows([self.current_group + tuple(self.current_values)])
+            self.current_group = None
+        self.writer.close()
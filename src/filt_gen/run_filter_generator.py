@@ -46,10 +46,13 @@ path_add = os.path.dirname(os.path.dirname(full_path))
 sys.path.append(path_add)
 
 import filt_gen.user_prompts as user_prompts
+import filt_gen.size_preview as size_preview
 import utils.utilities as utilities
 import utils.filters as filters
 import utils.data_products as data_products
 import utils.models as models
+import utils.metadata_mirror as metadata_mirror
+import utils.profiling as profiling
 
 model_list = None
 dp_list = None
@@ -61,6 +64,12 @@ def parse_args(argv):
 	parser.add_argument('-pl', '--products-list', dest='print_products', action='store_true', default=False, help="Print information about available data products and exit.")
 	parser.add_argument('-o', '--output-filename', dest='output_filename', action='store', default=None, help="Path to JSON file describing the data request.")
 	parser.add_argument('-e', '--input-event-filename', dest='input_event_filename', action='store', default=None, help="(Optional) path to CSV file containing src id, rup id, rup var id values.  This will bypass the event filters.")
+	parser.add_argument('-s', '--input-site-filename', dest='input_site_filename', action='store', default=None, help="(Optional) path to file containing site names, one per line.  This will bypass the site name filter.")
+	parser.add_argument('-c', '--config-filename', dest='config_filename', action='store', default=None, help="Path to database configuration file, used to estimate the size of the request if the study isn't in the local metadata mirror (default: db_wrapper/moment.cfg).")
+	parser.add_argument('-m', '--mirror-filename', dest='mirror_filename', action='store', default=metadata_mirror.get_default_mirror_path(), help="Path to local metadata mirror, used to estimate the size of the request (default: utils/cs_metadata.sqlite).")
+	parser.add_argument('-np', '--no-preview', dest='no_preview', action='store_true', default=False, help="Don't estimate the size of the request as filters are added.")
+	parser.add_argument('-pr', '--profile', dest='profile', action='store', default=None, choices=profiling.PROFILE_MODES, help="Profile this stage's CPU time or memory allocations, and write reports next to the output file (optional).  The size estimates are computed in the background and aren't included in CPU profiles.")
+	parser.add_argument('-pp', '--profile-prefix', dest='profile_prefix', action='store', default=None, help="Path and filename prefix for the profile reports (optional, default is the output filename without its extension).")
 	parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
 	parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help="Show version number and exit.")
 	args = parser.parse_args(args=argv)
@@ -85,6 +94,8 @@ def parse_args(argv):
 		sys.exit(utilities.ExitCodes.NO_ERROR)
 	if args.input_event_filename is not None:
 		args_dict['input_event_filename'] = args.input_event_filename
+	if args.input_site_filename is not None:
+		args_dict['input_site_filename'] = args.input_site_filename
 	if args.output_filename is not None:
 		output_filename = args.output_filename
 		#Add json extension
@@ -94,6 +105,17 @@ def parse_args(argv):
 		dt_tuple = datetime.datetime.now().timetuple()
 		output_filename = "csdata.%02d%02d%02d_%02d%02d%04d.json" % (dt_tuple.tm_hour, dt_tuple.tm_min, dt_tuple.tm_sec, dt_tuple.tm_mon, dt_tuple.tm_mday, dt_tuple.tm_year)
 	args_dict['output_filename'] = output_filename
+	args_dict['preview'] = not args.no_preview
+	args_dict['mirror_filename'] = args.mirror_filename
+	if args.config_filename is None:
+		args_dict['config_filename'] = '%s/db_wrapper/moment.cfg' % (os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	else:
+		args_dict['config_filename'] = args.config_filename
+	args_dict['profile'] = args.profile
+	if args.profile_prefix is None:
+		args_dict['profile_prefix'] = "%s.filter_generator" % output_filename.rsplit(".", 1)[0]
+	else:
+		args_dict['profile_prefix'] = args.profile_prefix
 	return args_dict
 
 
@@ -117,9 +139,13 @@ def prompt_user(args_dict):
 		input_event_filename = args_dict['input_event_filename']
 	else:
 		input_event_filename = None
-	return user_prompts.get_user_input(model_list, filter_list, input_event_filename=input_event_filename)
+	input_site_filename = args_dict.get('input_site_filename', None)
+	preview = None
+	if args_dict['preview']==True:
+		preview = size_preview.SizePreview(mirror_path=args_dict['mirror_filename'], config_filename=args_dict['config_filename'])
+	return user_prompts.get_user_input(model_list, filter_list, input_event_filename=input_event_filename, input_site_filename=input_site_filename, size_preview=preview)
 
-def write_filter_file(selected_model, selected_dp, selected_filters, event_list, output_filename):
+def write_filter_file(selected_model, selected_dp, selected_filters, event_list, output_filename, site_list=None):
 	if output_filename is None:
 		#Don't write a file
 		return
@@ -131,6 +157,8 @@ def write_filter_file(selected_model, selected_dp, selected_filters, event_list,
 	request_dict['filters'] = selected_filters
 	if event_list is not None:
 		request_dict['event_list'] = event_list
+	if site_list is not None:
+		request_dict['site_list'] = site_list
 
 	json_obj = json.dumps(request_dict, cls=utilities.CSJSONEncoder, indent=4)
 
@@ -141,9 +169,12 @@ def write_filter_file(selected_model, selected_dp, selected_filters, event_list,
 
 def run_main(argv):
 	args_dict = parse_args(argv)
+	profiling.run_profiled(args_dict['profile'], args_dict['profile_prefix'], generate_request, args_dict)
+
+def generate_request(args_dict):
 	load_data()
-	(selected_model, selected_dp, selected_filters, event_list) = prompt_user(args_dict)
-	write_filter_file(selected_model, selected_dp, selected_filters, event_list, args_dict['output_filename'])
+	(selected_model, selected_dp, selected_filters, event_list, site_list) = prompt_user(args_dict)
+	write_filter_file(selected_model, selected_dp, selected_filters, event_list, args_dict['output_filename'], site_list=site_list)
 	print("\nYour data request was written to %s." % args_dict['output_filename'])
 
 if __name__=="__main__":
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Estimates the size of a data request while the user is choosing filters, using cheap COUNT queries run in a background thread.'''
+
+import sys
+import os
+import re
+import copy
+import time
+import sqlite3
+import threading
+
+#pymysql is only needed to estimate sizes on the database server
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import query_build.query_constructor as query_constructor
+import utils.filters as filters
+import utils.metadata_mirror as metadata_mirror
+import utils.utilities as utilities
+import utils.replicas as replicas
+import utils.sqlite_backend as sqlite_backend
+
+#The seismogram size limits are enforced by the Database Wrapper
+try:
+    import db_wrapper.run_database_wrapper as run_database_wrapper
+except ImportError:
+    run_database_wrapper = None
+
+#Estimates which take longer than this are abandoned, in seconds
+PROBE_TIMEOUT_SECONDS = 30
+#Approximate size of one field in the output, in bytes
+BYTES_PER_FIELD = 12
+#Number of levels in a hazard curve, if the request doesn't list them
+DEFAULT_NUM_IM_LEVELS = 51
+
+#PeakAmplitudes has a row per IM, so it's too big to count.  Its size is worked out from the rupture variations of
+#each run, using the site ruptures, and the number of IM types instead.
+PEAK_AMPLITUDES_SUBSTITUTIONS = [('PeakAmplitudes.Run_ID', 'CyberShake_Runs.Run_ID'), ('PeakAmplitudes.Source_ID', 'Rupture_Variations.Source_ID'),
+    ('PeakAmplitudes.Rupture_ID', 'Rupture_Variations.Rupture_ID'), ('PeakAmplitudes.Rup_Var_ID', 'Rupture_Variations.Rup_Var_ID')]
+SITE_RUPTURE_JOINS = ["CyberShake_Site_Ruptures.CS_Site_ID=CyberShake_Runs.Site_ID", "CyberShake_Site_Ruptures.ERF_ID=Rupture_Variations.ERF_ID",
+    "CyberShake_Site_Ruptures.Source_ID=Rupture_Variations.Source_ID", "CyberShake_Site_Ruptures.Rupture_ID=Rupture_Variations.Rupture_ID"]
+
+table_pattern = re.compile(r'([A-Za-z_][A-Za-z_0-9]*)\.[A-Za-z_]')
+
+#Returns the set of tables referenced by a where clause
+def get_clause_tables(clause):
+    tables = set(table_pattern.findall(clause))
+    #The PGA/PGV filter isn't qualified with its table
+    if 'IM_Type_Measure' in clause and 'IM_Types.IM_Type_Measure' not in clause:
+        tables.add('IM_Types')
+    return tables
+
+#Joins which compare a field with itself are left over after the PeakAmplitudes fields are substituted
+def is_identity_clause(clause):
+    sides = clause.split("=")
+    return len(sides)==2 and sides[0].strip()==sides[1].strip()
+
+def get_where_suffix(query):
+    if len(query.where_clauses)==0:
+        return ""
+    return " where %s" % query.get_where_string()
+
+#Returns a query over the rupture variations of each run the request covers, in place of PeakAmplitudes, along with the
+#IM_Types clauses and whether there were IM value filters which the estimate can't account for
+def get_rupture_variation_query(query):
+    rv_query = query_constructor.Query()
+    rv_query.add_from([t for t in query.from_tables if t not in ['PeakAmplitudes', 'IM_Types']])
+    rv_query.add_from(["CyberShake_Runs", "CyberShake_Site_Ruptures", "Rupture_Variations"])
+    im_type_clauses = []
+    upper_bound = False
+    for clause in query.where_clauses:
+        for (old_field, new_field) in PEAK_AMPLITUDES_SUBSTITUTIONS:
+            clause = clause.replace(old_field, new_field)
+        tables = get_clause_tables(clause)
+        if 'PeakAmplitudes' in tables:
+            #Anything other than the IM_Types join filters on the IM values
+            if 'IM_Types' not in tables:
+                upper_bound = True
+        elif 'IM_Types' in tables:
+            im_type_clauses.append(clause)
+        elif not is_identity_clause(clause):
+            rv_query.add_where([clause])
+    rv_query.add_where(SITE_RUPTURE_JOINS)
+    rv_query.connect_tables()
+    return (rv_query, im_type_clauses, upper_bound)
+
+#Works out the COUNT queries for a request.  This is done in the calling thread, since the filters may change once it returns.
+#Returns a dictionary describing the request and its count queries, or None if the size can't be estimated.  The sites for
+#geographic filters are looked up on copies, so the selected filters are left as they were.
+def get_probe(model, dp, selected_filters, event_list, site_list=None, mirror_path=None):
+    probe_filters = []
+    for f in selected_filters:
+        if isinstance(f, filters.GeoFilter) and f.get_site_ids() is None:
+            candidates = metadata_mirror.find_sites_in_box(mirror_path, model.get_name(), f.get_bounding_box())
+            if candidates is None:
+                return None
+            f = copy.copy(f)
+            f.set_site_ids(sorted([site_id for (site_id, lat, lon) in candidates if f.contains_point(lat, lon)]))
+            if len(f.get_site_ids())==0:
+                return None
+        probe_filters.append(f)
+    request_options = dict()
+    if site_list is not None:
+        request_options['site_list'] = site_list
+    query = query_constructor.construct_queries(model, dp, probe_filters, event_list, request_options=request_options)
+    probe = dict()
+    probe['study_name'] = model.get_name()
+    probe['data_product'] = dp.get_name()
+    probe['num_fields'] = len(query.select_fields) + len(query.get_aggregate_fields())
+    probe['num_im_levels'] = DEFAULT_NUM_IM_LEVELS
+    if dp.get_im_levels() is not None:
+        probe['num_im_levels'] = len(dp.get_im_levels())
+    probe['upper_bound'] = False
+    count_queries = dict()
+    if 'PeakAmplitudes' in query.from_tables:
+        (frame_query, im_type_clauses, probe['upper_bound']) = get_rupture_variation_query(query)
+        im_type_where = ""
+        if len(im_type_clauses)>0:
+            im_type_where = " where %s" % " and ".join(sorted(im_type_clauses))
+        count_queries['im_types'] = "select count(*) from IM_Types%s" % im_type_where
+        count_queries['rupture_variations'] = "select count(*) from %s%s" % (frame_query.get_from_string(), get_where_suffix(frame_query))
+    else:
+        frame_query = query
+        if query.get_distinct()==True or query.get_group_by_string()!="":
+            group_by_string = ""
+            if query.get_group_by_string()!="":
+                group_by_string = " group by %s" % query.get_group_by_string()
+            distinct_string = ""
+            if query.get_distinct()==True:
+                distinct_string = "distinct "
+            count_queries['rows'] = "select count(*) from (select %s%s from %s%s%s) as Preview_Rows" % (distinct_string, query.get_select_string(), query.get_from_string(), get_where_suffix(query), group_by_string)
+        else:
+            count_queries['rows'] = "select count(*) from %s%s" % (query.get_from_string(), get_where_suffix(query))
+    #Seismograms are downloaded a rupture at a time, and IM statistics are computed for each rupture
+    if probe['data_product'] in ['Seismograms', 'IM Statistics']:
+        count_queries['ruptures'] = "select count(*) from (select distinct CyberShake_Runs.Run_ID, Rupture_Variations.Source_ID, Rupture_Variations.Rupture_ID from %s%s) as Preview_Ruptures" % (frame_query.get_from_string(), get_where_suffix(frame_query))
+    if probe['data_product']=='Seismograms' and 'rupture_variations' not in count_queries:
+        count_queries['rupture_variations'] = count_queries['rows']
+    if probe['data_product']=='Hazard Curves':
+        count_queries['runs'] = "select count(distinct CyberShake_Runs.Run_ID) from %s%s" % (frame_query.get_from_string(), get_where_suffix(frame_query))
+    probe['count_queries'] = count_queries
+    tables = set(frame_query.from_tables)
+    if 'im_types' in count_queries:
+        tables.add('IM_Types')
+    probe['tables'] = tables
+    return probe
+
+#Returns (rows, output MB, temporary MB) for the counts, with temporary MB None unless the request is for seismograms
+def get_sizes(probe, counts):
+    temp_mb = None
+    if probe['data_product']=='Seismograms':
+        rows = counts['rupture_variations']
+        rv_seis_size = utilities.get_rv_seismogram_size(probe['study_name'])
+        output_mb = rows*rv_seis_size/1000000.0
+        #Each rupture's file holds all its rupture variations
+        rvs_per_rupture = get_rupture_variations_per_rupture(probe['study_name'])
+        if rvs_per_rupture is None:
+            temp_mb = output_mb
+        else:
+            temp_mb = max(output_mb, counts['ruptures']*rvs_per_rupture*rv_seis_size/1000000.0)
+        return (rows, output_mb, temp_mb)
+    if probe['data_product']=='Intensity Measures':
+        rows = counts['rupture_variations']*counts['im_types']
+    elif probe['data_product']=='IM Statistics':
+        rows = counts['ruptures']*counts['im_types']
+    elif probe['data_product']=='Hazard Curves':
+        rows = counts['runs']*counts['im_types']*probe['num_im_levels']
+    else:
+        rows = counts['rows']
+    output_mb = rows*probe['num_fields']*BYTES_PER_FIELD/1000000.0
+    return (rows, output_mb, temp_mb)
+
+#Average number of rupture variations per rupture for the study, from the built-in statistics, or None
+def get_rupture_variations_per_rupture(study_name):
+    num_rvs_db_path = '%s/../utils/num_rvs.sqlite' % (os.path.dirname(os.path.abspath(__file__)))
+    if not os.path.exists(num_rvs_db_path):
+        return None
+    conn = sqlite3.connect(num_rvs_db_path)
+    cur = conn.cursor()
+    cur.execute('select Num_Ruptures, Num_Rup_Vars from Study_Metadata where Study_Name=?', (study_name,))
+    res = cur.fetchone()
+    conn.close()
+    if res is None or res[0] is None or res[1] is None or res[0]==0:
+        return None
+    return float(res[1])/res[0]
+
+def get_estimate_message(probe, counts):
+    (rows, output_mb, temp_mb) = get_sizes(probe, counts)
+    prefix = "Estimated size"
+    if probe['upper_bound']==True:
+        #IM value filters aren't applied to the estimate
+        prefix = "Estimated size, before IM value filters"
+    if temp_mb is None:
+        return "%s: %d rows, %.1f MB output." % (prefix, rows, output_mb)
+    message = "%s: %d seismograms, %.1f MB temporary space and %.1f MB output." % (prefix, rows, temp_mb, output_mb)
+    if run_database_wrapper is not None:
+        if temp_mb>run_database_wrapper.MAX_TEMP_DATA_MB or output_mb>run_database_wrapper.MAX_OUTPUT_DATA_MB:
+            message = "%s\nThis is more than the %d MB temporary and %d MB output limits, so the download won't proceed; try adding more filters." % \
+                (message, run_database_wrapper.MAX_TEMP_DATA_MB, run_database_wrapper.MAX_OUTPUT_DATA_MB)
+    return message
+
+
+#Runs size estimates in the background, so the prompts don't wait on the database.  Estimates are run against the local
+#metadata mirror if it has the study, or else the database in the config file.  Only the latest estimate is reported.
+class SizePreview:
+
+    def __init__(self, mirror_path=None, config_filename=None):
+        self.mirror_path = mirror_path
+        self.config_dict = None
+        if config_filename is not None and os.path.exists(config_filename):
+            self.config_dict = utilities.read_config(config_filename)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.thread = None
+        self.message = None
+
+    #Starts estimating the size of the request, replacing any estimate which is still running
+    def start(self, model, dp, selected_filters, event_list, site_list=None):
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.message = None
+        probe = get_probe(model, dp, selected_filters, event_list, site_list=site_list, mirror_path=self.mirror_path)
+        if probe is None:
+            self.thread = None
+            return
+        self.thread = threading.Thread(target=self.run_probe, args=(generation, probe), daemon=True)
+        self.thread.start()
+
+    def open_connection(self, probe):
+        if probe['study_name'] in metadata_mirror.get_mirrored_studies(self.mirror_path) and probe['tables'].issubset(metadata_mirror.MIRROR_TABLES):
+            return sqlite3.connect(self.mirror_path)
+        if self.config_dict is None:
+            return None
+        if self.config_dict['type'].lower()=='mysql':
+            if pymysql is None:
+                return None
+            config_dict = replicas.get_preferred_replica(self.config_dict)
+            return pymysql.connect(host=config_dict["host"], user=config_dict["user"], passwd=config_dict["password"], db=config_dict['db'],
+                connect_timeout=PROBE_TIMEOUT_SECONDS, read_timeout=PROBE_TIMEOUT_SECONDS)
+        elif self.config_dict['type'].lower()=='sqlite':
+            return sqlite_backend.open_sqlite(replicas.get_preferred_replica(self.config_dict))
+        return None
+
+    def run_probe(self, generation, probe):
+        conn = None
+        try:
+            conn = self.open_connection(probe)
+            if conn is None:
+                return
+            if isinstance(conn, sqlite3.Connection):
+                #Interrupt SQLite queries which run past the timeout
+                deadline = time.time() + PROBE_TIMEOUT_SECONDS
+                conn.set_progress_handler(lambda: time.time()>deadline, 100000)
+            cur = conn.cursor()
+            counts = dict()
+            for name in probe['count_queries']:
+                with self.lock:
+                    if generation!=self.generation:
+                        #A newer estimate has been started
+                        return
+                cur.execute(probe['count_queries'][name])
+                counts[name] = int(cur.fetchone()[0])
+            message = get_estimate_message(probe, counts)
+        except Exception:
+            message = "Unable to estimate the size of this request."
+        finally:
+            if conn is not None:
+                conn.close()
+        with self.lock:
+            if generation==self.generation:
+                self.message = message
+
+    #Returns the latest estimate's message the first time it's asked for once it's finished, and None otherwise.  This
+    #doesn't wait for the estimate, so the prompts never block on the database.
+    def get_message(self):
+        with self.lock:
+            message = self.message
+            self.message = None
+        return message
@@ -87,7 +87,17 @@ def choose_data_product(dp_list):
     return selected_dp
 
 
+#Geographic filters always take a list of coordinates
+def choose_geo_filter_value(filter):
+    while True:
+        values = input("What %s do you want to use? Specify as %s: " % (filter.get_shape(), filter.get_value_format()))
+        if filter.set_values([v.strip() for v in values.split(",")])==0:
+            break
+    return filter
+
 def choose_filter_value(filter):
+    if isinstance(filter, filters.GeoFilter):
+        return choose_geo_filter_value(filter)
     while True:
         print("\nHow do you want to specify value(s) for the %s filter?" % (filter.get_name()))
         print("%d) Specify single value." % filters.FilterParams.SINGLE_VALUE)
@@ -158,10 +168,8 @@ def choose_filter_value(filter):
                 except ValueError:
                     #Check and see if the filter is Intensity Measure Value and we're trying to use PGA or PGV.
                     if filter.get_name()=="Intensity Measure Period" and (p.strip()=="PGA" or p.strip()=="PGV"):
-                        #We don't support mixing PGA/PGV with other IMs, but explain this.
-                        print("Currently we don't support combining %s with other intensity measures.  Please submit separate data requests instead." % p.strip())
-                        good_input = False
-                        break #pieces loop
+                        #These can be combined with periods, and are retrieved in the same query
+                        value_obj = p.strip()
                     else:
                         print("%s filter requires values of type %s." % (filter.get_name(), filter.get_type().__name__))
                         good_input = False
@@ -210,7 +218,16 @@ def choose_filter_value(filter):
     return filter
 
 
-def choose_filters(filter_list, selected_dp, selected_model):
+#Prints the latest size estimate from size_preview, if there is one
+def print_size_estimate(size_preview):
+    if size_preview is None:
+        return
+    message = size_preview.get_message()
+    if message is not None:
+        print("\n%s" % message)
+
+#If size_preview is supplied, the size of the request is estimated in the background after each filter is added
+def choose_filters(filter_list, selected_dp, selected_model, size_preview=None, event_list=None, site_list=None):
     selected_filters = []
     remaining_filter_list = []
     filter_dps = selected_dp.get_relevant_filters()
@@ -220,7 +237,10 @@ def choose_filters(filter_list, selected_dp, selected_model):
             f.set_values_list(selected_model.get_periods())
         if f.get_data_product() in filter_dps:
             remaining_filter_list.append(f)
+    if size_preview is not None:
+        size_preview.start(selected_model, selected_dp, selected_filters, event_list, site_list=site_list)
     while True:
+        print_size_estimate(size_preview)
         print("\nThese are the available filters you can use to get a subset of CyberShake data.  You may add multiple filters:")
         for i,f in enumerate(remaining_filter_list):
             print("\t%d) %s" % ((i+1), f.get_name()))
@@ -247,7 +267,11 @@ def choose_filters(filter_list, selected_dp, selected_model):
                 s = choose_filter_value(s)
                 selected_filters.append(s)
                 remaining_filter_list.remove(s)
+            if size_preview is not None:
+                size_preview.start(selected_model, selected_dp, selected_filters, event_list, site_list=site_list)
             continue
+    #In case the latest estimate wasn't ready before the last prompt
+    print_size_estimate(size_preview)
     return selected_filters
 
 def choose_sort_order(sort_item):
@@ -278,19 +302,47 @@ def choose_sort(selected_filters):
     #Not sorting today
     if do_sort==False:
         return
+    #Geographic filters match a shape rather than a field, so there's nothing to sort on
+    sortable_filters = [f for f in selected_filters if not isinstance(f, filters.GeoFilter)]
+    if len(sortable_filters)==0:
+        print("None of the selected filters can be sorted on, so results won't be sorted.")
+        return
     while True:
         print("You can sort on one of the following criteria:")
-        for i,f in enumerate(selected_filters):
+        for i,f in enumerate(sortable_filters):
             print("\t%d) %s" % ((i+1), f.get_name()))
         sort_choice = input("What would you like to sort on? ")
-        sort_choice_int = validate_input(sort_choice, len(selected_filters))
+        sort_choice_int = validate_input(sort_choice, len(sortable_filters))
         if (sort_choice_int>0):
-            sort_item = selected_filters[sort_choice_int-1]
+            sort_item = sortable_filters[sort_choice_int-1]
             choose_sort_order(sort_item)
             break
 
 
-def get_user_input(model_list, filter_list, input_event_filename=None):
+#Reads a site list file, with one site name per line.  Blank lines and lines starting with '#' are skipped, and
+#only the first column of a CSV file is used.
+def read_site_list(input_site_filename):
+    site_list = []
+    try:
+        with open(input_site_filename, 'r', encoding='utf-8-sig') as fp_in:
+            data = fp_in.readlines()
+            fp_in.close()
+    except Exception as e:
+        print("Error reading from input file %s, aborting." % input_site_filename, file=sys.stderr)
+        print(e)
+        sys.exit(utilities.ExitCodes.BAD_FILE_PATH)
+    for line in data:
+        site_name = line.split(",")[0].strip()
+        if len(site_name)==0 or site_name[0]=='#':
+            continue
+        if site_name not in site_list:
+            site_list.append(site_name)
+    if len(site_list)==0:
+        print("The site list file %s doesn't contain any sites, aborting." % input_site_filename, file=sys.stderr)
+        sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
+    return site_list
+
+def get_user_input(model_list, filter_list, input_event_filename=None, input_site_filename=None, size_preview=None):
     print("Welcome to the CyberShake Data Access tool.\n")
     #Model
     selected_model = choose_model(model_list)
@@ -326,7 +378,12 @@ def get_user_input(model_list, filter_list, input_event_filename=None):
             if not f.get_data_product()==filters.FilterDataProducts.EVENTS:
                 edited_filter_list.append(f)
         filter_list = edited_filter_list    
-    selected_filters = choose_filters(filter_list, selected_dp, selected_model)
+    site_list = None
+    if input_site_filename is not None:
+        site_list = read_site_list(input_site_filename)
+        #Remove the site name filter from filter_list for asking
+        filter_list = [f for f in filter_list if f.get_name()!="Site Name"]
+    selected_filters = choose_filters(filter_list, selected_dp, selected_model, size_preview=size_preview, event_list=event_list, site_list=site_list)
     #Optional sort
     if len(selected_filters)>0:
         choose_sort(selected_filters)
@@ -350,6 +407,9 @@ def get_user_input(model_list, filter_list, input_event_filename=None):
         print("\nEvents specified in file:")
         for e in event_list:
             print("\tSrc %d, Rup %d, RV %d" % (e[0], e[1], e[2]))
-    return (selected_model, selected_dp, selected_filters, event_list)
+    if site_list is not None:
+        print("\nSites specified in file:")
+        print("\t%s" % ", ".join(site_list))
+    return (selected_model, selected_dp, selected_filters, event_list, site_list)
     
 
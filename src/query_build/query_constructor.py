@@ -43,6 +43,12 @@ sys.path.append(path_add)
 import utils.filters as filters
 import utils.data_products as data_products
 import utils.models as models
+import utils.utilities as utilities
+
+#Sampling hashes (Source_ID, Rupture_ID, Rup_Var_ID) into this many buckets.  The multipliers spread out consecutive IDs,
+#and are small enough that the hash fits in a 64-bit integer.
+SAMPLE_BUCKETS = 100000
+SAMPLE_HASH = "((%s.Source_ID*100003 + %s.Rupture_ID*1009 + %s.Rup_Var_ID)*40503) %% %d"
 
 class Query:
     field_order = ['Study_Name',
@@ -80,6 +86,9 @@ class Query:
         self.where_clauses = set()
         self.sort = ""
         self.distinct = False
+        #List of (expression, alias) for aggregate select fields.  If there are any, the query is grouped by all the other select fields.
+        self.aggregate_fields = []
+        self.limit = None
 
     def add_select(self, select_fields):
         for s in select_fields:
@@ -89,6 +98,12 @@ class Query:
         for s in select_fields:
             self.select_fields.remove(s)
 
+    def add_aggregate(self, expression, alias):
+        self.aggregate_fields.append((expression, alias))
+
+    def get_aggregate_fields(self):
+        return self.aggregate_fields
+
     def add_from(self, from_fields):
         for f in from_fields:
             self.from_tables.add(f)
@@ -109,7 +124,15 @@ class Query:
         return self.sort
 
     def get_select_string(self):
-        #Use the sorted version
+        #Use the sorted version, followed by any aggregates in the order they were added
+        select_fields = self.sort_select()
+        for (expression, alias) in self.aggregate_fields:
+            select_fields.append("%s as %s" % (expression, alias))
+        return ",".join(select_fields)
+
+    def get_group_by_string(self):
+        if len(self.aggregate_fields)==0:
+            return ""
         return ",".join(self.sort_select())
     
     def get_from_string(self):
@@ -121,7 +144,16 @@ class Query:
         return " and ".join(sorted(list(self.where_clauses)))
 
     def get_query_string(self):
-        return "select %s from %s where %s" % (self.get_select_string(), self.get_from_string(), self.get_where_string())
+        query_string = "select %s from %s where %s" % (self.get_select_string(), self.get_from_string(), self.get_where_string())
+        if self.get_group_by_string()!="":
+            query_string = "%s group by %s" % (query_string, self.get_group_by_string())
+        return query_string
+
+    def set_limit(self, limit):
+        self.limit = limit
+
+    def get_limit(self):
+        return self.limit
 
     def set_distinct(self, distinct):
         self.distinct = distinct
@@ -136,6 +168,7 @@ class Query:
             new_field = field.replace(old_name, new_name)
             new_select_fields.add(new_field)
         self.select_fields = new_select_fields
+        self.aggregate_fields = [(expression.replace(old_name, new_name), alias) for (expression, alias) in self.aggregate_fields]
         if old_name in self.from_tables:
             self.from_tables.remove(old_name)
             self.from_tables.add(new_name)
@@ -241,7 +274,58 @@ class Query:
         return added_tables
 
 
-def construct_queries(model, dp, filter_list, event_list):
+#Intensity measures which are identified by IM_Type_Measure rather than a period
+IM_MEASURES = ['PGA', 'PGV']
+
+#Returns the values of the Intensity Measure Period filter which are IM_MEASURES
+def get_im_measures(filter_list):
+    for f in filter_list:
+        if f.get_name()!="Intensity Measure Period":
+            continue
+        if f.get_filter_params()==filters.FilterParams.SINGLE_VALUE:
+            values = [f.get_value()]
+        elif f.get_filter_params()==filters.FilterParams.MULTIPLE_VALUES:
+            values = f.get_values()
+        else:
+            values = []
+        return [v for v in values if v in IM_MEASURES]
+    return []
+
+#Returns the table in the query which has one row per rupture variation, for sampling
+def get_rupture_variation_table(query):
+    for t in ["PeakAmplitudes", "Rupture_Variations"]:
+        if t in query.from_tables:
+            return t
+    return None
+
+#Returns a site name as a quoted SQL string.  Quotes are doubled, which both MySQL and SQLite accept.
+def quote_site_name(site_name):
+    return "'%s'" % site_name.replace("'", "''")
+
+#Restricts the query to the sites in the site list.  If their runs were looked up, filters on CyberShake_Runs.Run_ID, so
+#the database can join PeakAmplitudes through its Run_ID index and the IM cache can find the runs; otherwise filters on
+#the site names.
+def add_site_list(query, request_options):
+    if request_options.get('site_run_ids') is None:
+        query.add_from(["CyberShake_Sites"])
+        query.add_where(["CyberShake_Sites.CS_Short_Name in (%s)" % ",".join([quote_site_name(s) for s in request_options['site_list']])])
+        return
+    run_ids = ",".join(["%d" % r for r in request_options['site_run_ids']])
+    if "PeakAmplitudes" in query.from_tables or "CyberShake_Runs" in query.from_tables:
+        query.add_from(["CyberShake_Runs"])
+        query.add_where(["CyberShake_Runs.Run_ID in (%s)" % run_ids])
+        return
+    #Site metadata doesn't involve runs
+    query.add_from(["CyberShake_Sites"])
+    query.add_where(["CyberShake_Sites.CS_Site_ID in (%s)" % ",".join(["%d" % s for s in request_options['site_ids']])])
+
+#request_options, if supplied, can contain:
+#  limit: maximum number of rows to return
+#  top_k: (count, filter, ascending), to return the first count rows sorted by the filter's field
+#  sample_fraction: fraction of the rupture variations to return, chosen by a deterministic hash
+#  site_list: list of site names to restrict the results to
+#  site_ids, site_run_ids: the CS_Site_IDs and Run_IDs of the sites in site_list, if they were looked up
+def construct_queries(model, dp, filter_list, event_list, request_options=None):
     query = Query()
     #Add model
     (from_tables, where_clauses) = model.get_query()
@@ -253,18 +337,36 @@ def construct_queries(model, dp, filter_list, event_list):
     query.add_from(from_tables)
     if dp.get_distinct()==True:
         query.set_distinct(True)
+    for (expression, alias) in dp.get_aggregate_query():
+        query.add_aggregate(expression, alias)
     #Add metadata tables
     (metadata_select, metadata_from) = dp.get_metadata_query()
     query.add_select(metadata_select)
     query.add_from(metadata_from)
+    im_measures = get_im_measures(filter_list)
+    #IM statistics are of the RotD50 IMs even without an IM filter, unless PGA or PGV are included
+    if dp.get_name()=="IM Statistics" and len(im_measures)==0:
+        query.add_from(["IM_Types"])
+        query.add_where(["IM_Types.IM_Type_Component='RotD50'"])
     for f in filter_list:
-        #If we're filtering on IMs, restrict to RotD50, unless it's PGA or PGV
+        #If we're filtering on IMs, restrict to RotD50, unless PGA or PGV are included
         if f.get_data_product()==filters.FilterDataProducts.IMS:
             query.add_from(["IM_Types"])
-            query.add_where(["IM_Types.IM_Type_Component='RotD50'"])
+            if len(im_measures)==0:
+                query.add_where(["IM_Types.IM_Type_Component='RotD50'"])
         (where_fields, from_tables) = f.get_query()
         #print("Filter %s adds from tables %s and where fields %s." % (f.get_name(), from_tables, where_fields))
         query.add_from(from_tables)
+        if isinstance(f, filters.GeoFilter):
+            #The sites inside the shape were found before the query was built, so the database doesn't evaluate the geometry
+            if f.get_site_ids() is None:
+                print("The sites for the %s filter haven't been looked up, aborting." % f.get_name(), file=sys.stderr)
+                sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+            if f.get_sort()!=0:
+                print("Results can't be sorted by the %s filter, since it matches a shape rather than a field, aborting." % f.get_name(), file=sys.stderr)
+                sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+            query.add_where(["%s in (%s)" % (where_fields[0], ",".join(["%d" % s for s in f.get_site_ids()]))])
+            continue
         fp = f.get_filter_params()
         quote = ""
         if not f.is_numeric():
@@ -282,6 +384,18 @@ def construct_queries(model, dp, filter_list, event_list):
                     query.add_where(["IM_Type_Measure='%s'" % f.get_value()])
                 else:
                     query.add_where(["%s=%s%s%s" % (where_fields[0], quote, f.get_value(), quote)])
+        elif fp==filters.FilterParams.MULTIPLE_VALUES and f.get_name()=="Intensity Measure Period" and len(im_measures)>0:
+            #PGA and PGV are matched on IM_Type_Measure, and the periods on RotD50 spectral values, so all of them are
+            #retrieved in a single pass.  IM_Type_Measure is selected to tell them apart.
+            periods = [v for v in f.get_values() if v not in IM_MEASURES]
+            measure_clause = "IM_Types.IM_Type_Measure in (%s)" % ",".join(["'%s'" % m for m in im_measures])
+            if len(periods)==0:
+                query.remove_select(['IM_Types.IM_Type_Value','IM_Types.IM_Type_Component'])
+                query.add_where([measure_clause])
+            else:
+                period_clause = " or ".join(["%s=%s" % (where_fields[0], v) for v in periods])
+                query.add_where(["((IM_Types.IM_Type_Component='RotD50' and (%s)) or %s)" % (period_clause, measure_clause)])
+            query.add_select(['IM_Types.IM_Type_Measure'])
         elif fp==filters.FilterParams.MULTIPLE_VALUES:
             where_clauses = []
             for v in f.get_values():
@@ -296,13 +410,17 @@ def construct_queries(model, dp, filter_list, event_list):
             where_clause = "%s>=%s%s%s and %s<=%s%s%s" % (where_fields[0], quote, min, quote, where_fields[0], quote, max, quote)
             query.add_where([where_clause])
         #Check sort
+        sort_field = f.where_fields[0]
+        if sort_field in dp.get_aggregate_sort_fields():
+            #The field is aggregated, so sort on its aggregate instead
+            sort_field = dp.get_aggregate_sort_fields()[sort_field]
         if f.get_sort()<0:
             #Sort in reverse
-            sort_clause = 'order by %s desc' % (f.where_fields[0])
+            sort_clause = 'order by %s desc' % (sort_field)
             query.set_sort(sort_clause)
         elif f.get_sort()>0:
             #Sort in ascending
-            sort_clause = 'order by %s asc' % (f.where_fields[0])
+            sort_clause = 'order by %s asc' % (sort_field)
             query.set_sort(sort_clause)
     #If specific events are specified, add these
     if event_list is not None:
@@ -313,6 +431,31 @@ def construct_queries(model, dp, filter_list, event_list):
             where_clause = '(Rupture_Variations.Source_ID=%d and Rupture_Variations.Rupture_ID=%d and Rupture_Variations.Rup_Var_ID=%d)' % (e[0], e[1], e[2])
             where_clauses.append(where_clause)
         query.add_where(['(%s)' % (" OR ".join(where_clauses))])
+    if request_options is not None:
+        if 'site_list' in request_options:
+            add_site_list(query, request_options)
+        if 'top_k' in request_options:
+            (count, sort_filter, ascending) = request_options['top_k']
+            (where_fields, from_tables) = sort_filter.get_query()
+            query.add_from(from_tables)
+            sort_field = where_fields[0]
+            if sort_field in dp.get_aggregate_sort_fields():
+                sort_field = dp.get_aggregate_sort_fields()[sort_field]
+            if ascending==True:
+                query.set_sort('order by %s asc' % sort_field)
+            else:
+                query.set_sort('order by %s desc' % sort_field)
+            query.set_limit(count)
+        if 'limit' in request_options:
+            if query.get_limit() is None or request_options['limit']<query.get_limit():
+                query.set_limit(request_options['limit'])
+        if 'sample_fraction' in request_options:
+            rv_table = get_rupture_variation_table(query)
+            if rv_table is None:
+                print("The %s data product doesn't have rupture variations, so it can't be sampled.  Aborting." % dp.get_name(), file=sys.stderr)
+                sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+            threshold = int(round(request_options['sample_fraction']*SAMPLE_BUCKETS))
+            query.add_where(["%s<%d" % (SAMPLE_HASH % (rv_table, rv_table, rv_table, SAMPLE_BUCKETS), threshold)])
     #Need to join any unconnected tables
     query.connect_tables()
     return query
\ No newline at end of file
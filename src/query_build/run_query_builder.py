@@ -48,6 +48,8 @@ import utils.utilities as utilities
 import utils.filters as filters
 import utils.data_products as data_products
 import utils.models as models
+import utils.metadata_mirror as metadata_mirror
+import utils.profiling as profiling
 
 model_list = None
 dp_list = None
@@ -57,6 +59,10 @@ def parse_args(argv):
     parser = argparse.ArgumentParser(prog='Query Builder', description='Takes CyberShake data request and constructs database queries required to fulfill it.')
     parser.add_argument('-i', '--input-filename', dest='input_filename', action='store', default=None, help="Path to JSON file describing the data request.")
     parser.add_argument('-o', '--output-filename', dest='output_filename', action='store', default=None, help="Path to output file containing queries.")
+    parser.add_argument('-m', '--mirror-filename', dest='mirror_filename', action='store', default=metadata_mirror.get_default_mirror_path(), help="Path to local metadata mirror, used to look up the runs for a site list (default: utils/cs_metadata.sqlite).")
+    parser.add_argument('-nm', '--no-mirror', dest='no_mirror', action='store_true', default=False, help="Don't look up site list runs in the local metadata mirror, and filter on the site names instead.")
+    parser.add_argument('-pr', '--profile', dest='profile', action='store', default=None, choices=profiling.PROFILE_MODES, help="Profile this stage's CPU time or memory allocations, and write reports next to the output file (optional).")
+    parser.add_argument('-pp', '--profile-prefix', dest='profile_prefix', action='store', default=None, help="Path and filename prefix for the profile reports (optional, default is the output filename without its extension).")
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
     parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help="Show version number and exit.")
     args = parser.parse_args(args=argv)
@@ -72,7 +78,13 @@ def parse_args(argv):
         output_filename = "csdata.%02d%02d%02d_%02d%02d%04d.query" % (dt_tuple.tm_hour, dt_tuple.tm_min, dt_tuple.tm_sec, dt_tuple.tm_mon, dt_tuple.tm_mday, dt_tuple.tm_year)
     else:
         output_filename = args.output_filename
-    return (input_filename, output_filename)
+    mirror_filename = args.mirror_filename
+    if args.no_mirror==True:
+        mirror_filename = None
+    profile_prefix = args.profile_prefix
+    if profile_prefix is None:
+        profile_prefix = "%s.query_builder" % output_filename.rsplit(".", 1)[0]
+    return (input_filename, output_filename, mirror_filename, args.profile, profile_prefix)
 	
 def load_data():
     global model_list, dp_list, filter_list
@@ -108,6 +120,8 @@ def parse_json(input_filename):
           if d.get_name()==dp_name:
                 dp_selected = d
                 break
+    if dp_selected is not None and 'im_levels' in json_dict['products']:
+        dp_selected.set_im_levels([float(l) for l in json_dict['products']['im_levels']])
     filters_selected = []
     for filt in json_dict['filters']:
           name = filt['name']
@@ -132,7 +146,9 @@ def parse_json(input_filename):
                         if len(values)<2:
                             print("filter_params for the filter %s specifies %s, so there should be more than 1 values in the 'values' field in the input file %s.  Aborting." % (f.get_name(), filters.FilterParams.get_text(params), input_filename))
                             sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
-                        selected_filt.set_values(values)
+                        if selected_filt.set_values(values)!=0:
+                            print("Invalid values for the filter %s in the input file %s.  Aborting." % (f.get_name(), input_filename))
+                            sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
                     elif params==filters.FilterParams.VALUE_RANGE:
                         if len(values)!=2:
                             print("filter_params for the filter %s specifies %s, so there should be exactly 2 values in the 'values' field in the input file %s.  Aborting." % (f.get_name(), filters.FilterParams.get_text(params), input_filename))
@@ -148,9 +164,93 @@ def parse_json(input_filename):
     if dp_selected is None:
           print("Couldn't find a valid data product in JSON file %s, aborting." % input_filename)
           sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
-    return (model_selected, dp_selected, filters_selected, event_list)
+    request_options = parse_request_options(json_dict, dp_selected, input_filename)
+    return (model_selected, dp_selected, filters_selected, event_list, request_options)
+
+#Reads the top-level options in the request, which limit or sample the rows returned or give a list of sites
+def parse_request_options(json_dict, dp_selected, input_filename):
+    request_options = dict()
+    try:
+        #Hazard curves are computed from every IM for the site, so limiting or sorting the rows would give wrong curves
+        if dp_selected.get_name()=="Hazard Curves":
+            for option in ['limit', 'top_k']:
+                if option in json_dict:
+                    raise ValueError("%s can't be used with the Hazard Curves data product" % option)
+        if 'limit' in json_dict:
+            request_options['limit'] = int(json_dict['limit'])
+            if request_options['limit']<=0:
+                raise ValueError("limit must be positive")
+        if 'top_k' in json_dict:
+            top_k = json_dict['top_k']
+            count = int(top_k['count'])
+            if count<=0:
+                raise ValueError("top_k count must be positive")
+            sort_filter = None
+            for f in filter_list:
+                if f.get_name()==top_k['filter']:
+                    sort_filter = f
+            if sort_filter is None:
+                raise ValueError("top_k filter %s isn't a known filter" % top_k['filter'])
+            if isinstance(sort_filter, filters.GeoFilter):
+                raise ValueError("top_k can't sort by the %s filter, since it matches a shape rather than a field" % top_k['filter'])
+            order = top_k.get('order', 'desc').lower()
+            if order not in ['asc', 'desc']:
+                raise ValueError("top_k order must be 'asc' or 'desc'")
+            request_options['top_k'] = (count, sort_filter, order=='asc')
+        if 'sample_fraction' in json_dict:
+            request_options['sample_fraction'] = float(json_dict['sample_fraction'])
+            if request_options['sample_fraction']<=0.0 or request_options['sample_fraction']>1.0:
+                raise ValueError("sample_fraction must be greater than 0 and at most 1")
+        if 'site_list' in json_dict:
+            request_options['site_list'] = [str(s).strip() for s in json_dict['site_list']]
+            if len(request_options['site_list'])==0:
+                raise ValueError("site_list must contain at least one site")
+            #MySQL treats backslashes in strings as escapes and SQLite doesn't, so they can't be quoted the same way for both
+            for s in request_options['site_list']:
+                if "\\" in s:
+                    raise ValueError("site name %s in site_list can't contain a backslash" % s)
+    except (ValueError, KeyError, TypeError) as e:
+        print("Error parsing request options in JSON file %s, aborting." % input_filename)
+        print(e)
+        sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
+    return request_options
 
-def write_queries(query, input_filename, output_filename, dp_name):
+#Looks up the run and site IDs for the site list in the metadata mirror, if it contains the study
+def resolve_site_list(model, request_options, mirror_filename):
+    if 'site_list' not in request_options or mirror_filename is None:
+        return
+    resolved = metadata_mirror.resolve_sites(mirror_filename, model.get_name(), request_options['site_list'])
+    if resolved is None:
+        return
+    (site_ids, run_ids) = resolved
+    missing_sites = [s for s in request_options['site_list'] if s not in site_ids]
+    if len(missing_sites)>0:
+        print("The following sites have no runs in %s and will be ignored: %s" % (model.get_name(), ", ".join(missing_sites)))
+    if len(run_ids)==0:
+        print("None of the sites in the site list have runs in %s, aborting." % model.get_name(), file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    request_options['site_ids'] = sorted(site_ids.values())
+    request_options['site_run_ids'] = run_ids
+
+#Finds the sites inside each geographic site filter, using the spatial index in the metadata mirror
+def resolve_geo_filters(model, filters_selected, mirror_filename):
+    for f in filters_selected:
+        if not isinstance(f, filters.GeoFilter):
+            continue
+        candidates = None
+        if mirror_filename is not None:
+            candidates = metadata_mirror.find_sites_in_box(mirror_filename, model.get_name(), f.get_bounding_box())
+        if candidates is None:
+            print("The %s filter needs %s in the local metadata mirror; build it with utils/construct_rvs_db.py -m.  Aborting." % (f.get_name(), model.get_name()), file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+        site_ids = sorted([site_id for (site_id, lat, lon) in candidates if f.contains_point(lat, lon)])
+        if len(site_ids)==0:
+            print("No sites in %s match the %s filter, aborting." % (model.get_name(), f.get_name()), file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+        print("%d sites match the %s filter." % (len(site_ids), f.get_name()))
+        f.set_site_ids(site_ids)
+
+def write_queries(query, input_filename, output_filename, dp_name, im_levels=None):
     with open(output_filename, 'w') as fp_out:
         distinct_string = ""
         if query.get_distinct()==True:
@@ -158,23 +258,34 @@ def write_queries(query, input_filename, output_filename, dp_name):
         fp_out.write("select = %s %s\n" % (distinct_string, query.get_select_string()))
         fp_out.write("from = %s\n" % query.get_from_string())
         fp_out.write("where = %s\n" % query.get_where_string())
+        if (query.get_group_by_string()!=""):
+            fp_out.write("group_by = %s\n" % query.get_group_by_string())
         if (query.get_sort()!=""):
             fp_out.write("sort = %s\n" % query.get_sort())
+        if (query.get_limit() is not None):
+            fp_out.write("limit = %d\n" % query.get_limit())
         fp_out.write("data_request_file = %s\n" % input_filename)
         fp_out.write("data_product = %s\n" % dp_name)
+        if im_levels is not None:
+            fp_out.write("im_levels = %s\n" % ",".join([str(l) for l in im_levels]))
         fp_out.flush()
         fp_out.close()
 
 def run_main(argv):
-    (input_filename, output_filename) = parse_args(argv)
+    (input_filename, output_filename, mirror_filename, profile, profile_prefix) = parse_args(argv)
+    profiling.run_profiled(profile, profile_prefix, build_queries, input_filename, output_filename, mirror_filename)
+
+def build_queries(input_filename, output_filename, mirror_filename):
     load_data()
-    (model_selected, dp_selected, filters_selected, event_list) = parse_json(input_filename)
-    query = query_constructor.construct_queries(model_selected, dp_selected, filters_selected, event_list)
+    (model_selected, dp_selected, filters_selected, event_list, request_options) = parse_json(input_filename)
+    resolve_site_list(model_selected, request_options, mirror_filename)
+    resolve_geo_filters(model_selected, filters_selected, mirror_filename)
+    query = query_constructor.construct_queries(model_selected, dp_selected, filters_selected, event_list, request_options=request_options)
     #See if we need to use different table names, based on the study
     if model_selected.has_custom_table_name():
         for old_name in model_selected.custom_table_dict:
             query.change_table_name(old_name, model_selected.custom_table_dict[old_name])
-    write_queries(query, input_filename, output_filename, dp_selected.get_name())
+    write_queries(query, input_filename, output_filename, dp_selected.get_name(), im_levels=dp_selected.get_im_levels())
     print("\nYour database queries were written to %s." % output_filename)
 
 if __name__=="__main__":
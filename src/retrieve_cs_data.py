@@ -45,8 +45,14 @@ sys.path.append(path_add)
 import filt_gen.run_filter_generator
 import query_build.run_query_builder
 import db_wrapper.run_database_wrapper
+import db_wrapper.client_join as client_join
+import db_wrapper.partitioning as partitioning
+import db_wrapper.wide_layout as wide_layout
 import data_collector.run_data_collector
+import shard_tool.run_shard_tool
 import utils.utilities as utilities
+import utils.request_state as request_state
+import utils.profiling as profiling
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(prog='CyberShake Data Access Tool', description='Performs CyberShake data retrieval.')
@@ -55,10 +61,23 @@ def parse_args(argv):
     parser.add_argument('-pl', '--products-list', dest='print_products', action='store_true', default=False, help="Print information about available data products and exit.")
     parser.add_argument('-c', "--config-filename", dest='config_filename', action='store', default=None, help="Path to database configuration file (optional, default: moment.cfg)")
     parser.add_argument('-o', '--output-directory', dest='output_directory', action='store', default=".", help="Path to output directory to store files in (optional, default is current working directory).")
-    parser.add_argument('-t', '--temp-directory', dest='temp_directory', action='store', default=".", help="Path to temporary directory to store files before extraction (optional, default is current working directory).")
+    parser.add_argument('-t', '--temp-directory', dest='temp_directory', action='store', default=".", help="Path to temporary directory to store files before extraction, and results being sorted on the client (optional, default is current working directory).")
     parser.add_argument('-i', '--input-filename', dest='input_filename', action='store', default=None, help="Path to JSON file describing desired data products and filters to apply, in format outputted by Filter Generator step.  If supplied, Filter Generator is bypassed.  (optional)")
     parser.add_argument('-e', '--input-event-filename', dest='input_event_filename', action='store', default=None, help="(Optional) path to CSV file containing src id, rup id, rup var id values.  This will bypass the event filters.")
-    parser.add_argument('-of', '--output-format', dest='output_format', action='store', default='csv', help='Output format for database results (either "csv" or "sqlite")')
+    parser.add_argument('-s', '--input-site-filename', dest='input_site_filename', action='store', default=None, help="(Optional) path to file containing site names, one per line.  This will bypass the site name filter.")
+    parser.add_argument('-of', '--output-format', dest='output_format', action='store', default='csv', help='Output format for database results: "csv", "sqlite", or compressed CSV with "csv.gz" or "csv.zst" (default: csv).')
+    parser.add_argument('-jm', '--join-mode', dest='join_mode', action='store', default='server', choices=client_join.JOIN_MODES, help="Where intensity measures are joined with their site, rupture, and IM type metadata: by the database server, or by this tool, which only queries PeakAmplitudes from the server (default: server).")
+    parser.add_argument('-ro', '--replica-offset', dest='replica_offset', action='store', type=int, default=None, help="If the config file lists several database replicas, start from the one this many places after the fastest, so shards run at the same time use different replicas (optional).")
+    parser.add_argument('-pb', '--partition-by', dest='partition_by', action='store', default=None, choices=partitioning.PARTITION_MODES, help="Split the database results into a file for each site, each run, or each of a number of hash buckets, listed in csdata.<label>.data.manifest.json (optional).")
+    parser.add_argument('-npt', '--num-partitions', dest='num_partitions', action='store', type=int, default=None, help="Number of hash buckets to split the results into, with '-pb hash' (optional, default: 16).")
+    parser.add_argument('-lo', '--layout', dest='layout', action='store', default='long', choices=wide_layout.LAYOUTS, help="Layout for intensity measure results: a row for each IM, or a row for each rupture variation with a column for each IM type (default: long).")
+    parser.add_argument('-r', '--resume', dest='resume', action='store_true', default=False, help="Resume an interrupted request with the same label, skipping work recorded as complete in csdata.<label>.state.")
+    parser.add_argument('-inc', '--incremental', dest='incremental', action='store_true', default=False, help="Only retrieve results and seismograms which aren't already in the output directory.")
+    parser.add_argument('-imc', '--im-cache-directory', dest='im_cache_directory', action='store', default=None, help="Directory for the local IM cache, used to answer Intensity Measure requests for studies in the local metadata mirror (optional, requires NumPy).")
+    parser.add_argument('-ps', '--page-size', dest='page_size', action='store', type=int, default=None, help="Retrieve intensity measures from the database in pages, starting with this many rows per page (optional).  With -r, an interrupted retrieval resumes from the last page written.")
+    parser.add_argument('-sm', '--sort-mode', dest='sort_mode', action='store', default='auto', choices=['server', 'client', 'auto'], help="Where sorted results are sorted: by the database server, by this tool using the temporary directory, or chosen from the estimated number of rows (default: auto).")
+    parser.add_argument('--shard', dest='num_shards', action='store', type=int, default=None, help="Split the request into this many independent shard request files, then exit.  Use shard_tool/run_shard_tool.py merge to combine the shard results.")
+    parser.add_argument('-pr', '--profile', dest='profile', action='store', default=None, choices=profiling.PROFILE_MODES, help="Profile each stage's CPU time or memory allocations, writing reports to csdata.<label>.<stage>.* in the output directory (optional).")
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
     parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help="Show version number and exit.")
     args_dict = dict()
@@ -91,8 +110,30 @@ def parse_args(argv):
     args_dict['debug'] = args.debug
     args_dict['output_format'] = args.output_format
     args_dict['input_event_filename'] = args.input_event_filename
+    args_dict['input_site_filename'] = args.input_site_filename
+    if args.resume==True and args.request_label is None:
+        print("A request label must be provided with -l to resume a request, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+    args_dict['resume'] = args.resume
+    args_dict['incremental'] = args.incremental
+    args_dict['num_shards'] = args.num_shards
+    args_dict['im_cache_directory'] = args.im_cache_directory
+    args_dict['page_size'] = args.page_size
+    args_dict['sort_mode'] = args.sort_mode
+    args_dict['join_mode'] = args.join_mode
+    args_dict['replica_offset'] = args.replica_offset
+    args_dict['partition_by'] = args.partition_by
+    args_dict['num_partitions'] = args.num_partitions
+    args_dict['layout'] = args.layout
+    args_dict['profile'] = args.profile
     return args_dict
 
+#Adds the arguments which turn on profiling for a stage, if it was requested
+def add_profile_args(arg_string, args_dict, stage):
+    if args_dict['profile'] is None:
+        return arg_string
+    return "%s -pr %s -pp %s" % (arg_string, args_dict['profile'], profiling.get_profile_prefix(args_dict['output_directory'], args_dict['request_label'], stage))
+
 def run_filter_generator(args_dict):
     arg_string = ""
     if args_dict['print_filters']==True:
@@ -103,7 +144,10 @@ def run_filter_generator(args_dict):
         arg_string = "%s -d" % arg_string
     if args_dict['input_event_filename'] is not None:
         arg_string = "%s -e %s" % (arg_string, args_dict['input_event_filename'])
-    arg_string = "%s -o %s/csdata.%s.json" % (arg_string, args_dict['output_directory'], args_dict['request_label'])
+    if args_dict['input_site_filename'] is not None:
+        arg_string = "%s -s %s" % (arg_string, args_dict['input_site_filename'])
+    arg_string = "%s -c %s -o %s/csdata.%s.json" % (arg_string, args_dict['config_filename'], args_dict['output_directory'], args_dict['request_label'])
+    arg_string = add_profile_args(arg_string, args_dict, request_state.Stages.FILTER_GENERATOR)
     filt_gen.run_filter_generator.run_main(arg_string.split())
 
 def run_query_builder(args_dict):
@@ -114,33 +158,98 @@ def run_query_builder(args_dict):
     if args_dict['debug']==True:
         arg_string = "%s -d" % arg_string
     arg_string = "%s -o %s/csdata.%s.query" % (arg_string, args_dict['output_directory'], args_dict['request_label'])
+    arg_string = add_profile_args(arg_string, args_dict, request_state.Stages.QUERY_BUILDER)
     query_build.run_query_builder.run_main(arg_string.split())
 
 def run_database_wrapper(args_dict):
-    arg_string = "-of %s -i %s/csdata.%s.query -o %s/csdata.%s.data -c %s" % (args_dict['output_format'], args_dict['output_directory'], args_dict['request_label'], args_dict['output_directory'], args_dict['request_label'], args_dict['config_filename'])
+    arg_string = "-of %s -i %s/csdata.%s.query -o %s/csdata.%s.data -c %s -sf %s" % (args_dict['output_format'], args_dict['output_directory'], args_dict['request_label'], args_dict['output_directory'], args_dict['request_label'], args_dict['config_filename'], args_dict['state_filename'])
+    arg_string = "%s -sm %s -t %s" % (arg_string, args_dict['sort_mode'], args_dict['temp_directory'])
+    if args_dict['resume']==True:
+        arg_string = "%s -r" % arg_string
+    if args_dict['incremental']==True:
+        arg_string = "%s -inc %s" % (arg_string, args_dict['output_directory'])
+    if args_dict['im_cache_directory'] is not None:
+        arg_string = "%s -imc %s" % (arg_string, args_dict['im_cache_directory'])
+    if args_dict['page_size'] is not None:
+        arg_string = "%s -ps %d" % (arg_string, args_dict['page_size'])
+    if args_dict['replica_offset'] is not None:
+        arg_string = "%s -ro %d" % (arg_string, args_dict['replica_offset'])
+    if args_dict['join_mode']!='server':
+        arg_string = "%s -jm %s" % (arg_string, args_dict['join_mode'])
+    if args_dict['partition_by'] is not None:
+        arg_string = "%s -pb %s" % (arg_string, args_dict['partition_by'])
+    if args_dict['num_partitions'] is not None:
+        arg_string = "%s -npt %d" % (arg_string, args_dict['num_partitions'])
+    if args_dict['layout']!='long':
+        arg_string = "%s -lo %s" % (arg_string, args_dict['layout'])
     if args_dict['debug']==True:
         arg_string = "%s -d" % arg_string
+    arg_string = add_profile_args(arg_string, args_dict, request_state.Stages.DATABASE_WRAPPER)
     db_wrapper.run_database_wrapper.run_main(arg_string.split())
 
 def run_data_collector(args_dict, url_file):
-    arg_string = "-i %s -o %s -t %s" % (url_file, args_dict['output_directory'], args_dict['temp_directory'])
+    arg_string = "-i %s -o %s -t %s -sf %s" % (url_file, args_dict['output_directory'], args_dict['temp_directory'], args_dict['state_filename'])
+    if args_dict['resume']==True:
+        arg_string = "%s -r" % arg_string
     if args_dict['debug']==True:
         arg_string = "%s -d" % arg_string
+    arg_string = add_profile_args(arg_string, args_dict, request_state.Stages.DATA_COLLECTOR)
     data_collector.run_data_collector.run_main(arg_string.split())
 
+def run_shard_planner(args_dict, json_file):
+    arg_string = "plan -i %s -n %d -l %s -o %s -c %s" % (json_file, args_dict['num_shards'], args_dict['request_label'], args_dict['output_directory'], args_dict['config_filename'])
+    if args_dict['debug']==True:
+        arg_string = "%s -d" % arg_string
+    shard_tool.run_shard_tool.run_main(arg_string.split())
+
 def run_main(argv):
     args_dict = parse_args(argv)
     if args_dict['output_directory'] is not None:
         if not os.path.exists(args_dict['output_directory']):
             os.makedirs(args_dict['output_directory'])
-    if args_dict['input_filename'] is None:
+    #Listing the filters or data products doesn't start a request, so there's no state to track
+    if args_dict['print_filters']==True or args_dict['print_products']==True:
         run_filter_generator(args_dict)
-    run_query_builder(args_dict)
+        return
+    #Track completed work, so an interrupted request can be resumed
+    args_dict['state_filename'] = request_state.get_state_filename(args_dict['output_directory'], args_dict['request_label'])
+    state = request_state.RequestState(args_dict['state_filename'])
+    if args_dict['resume']==True:
+        if not state.load():
+            print("No usable state file found at %s, starting request from the beginning." % args_dict['state_filename'])
+            args_dict['resume'] = False
+    if args_dict['resume']==False:
+        state.create()
+    json_file = '%s/csdata.%s.json' % (args_dict['output_directory'], args_dict['request_label'])
+    if args_dict['input_filename'] is None:
+        if args_dict['resume']==True and state.is_stage_complete(request_state.Stages.FILTER_GENERATOR) and os.path.exists(json_file):
+            print("Using data request from %s." % json_file)
+        else:
+            run_filter_generator(args_dict)
+            state.mark_stage_complete(request_state.Stages.FILTER_GENERATOR)
+    else:
+        json_file = args_dict['input_filename']
+    if args_dict['num_shards'] is not None:
+        run_shard_planner(args_dict, json_file)
+        state.close()
+        return
+    query_file = '%s/csdata.%s.query' % (args_dict['output_directory'], args_dict['request_label'])
+    request_checksum = request_state.get_file_checksum(json_file)
+    if args_dict['resume']==True and state.is_stage_complete(request_state.Stages.QUERY_BUILDER, request_checksum) and os.path.exists(query_file):
+        print("Using database queries from %s." % query_file)
+    else:
+        run_query_builder(args_dict)
+        state.mark_stage_complete(request_state.Stages.QUERY_BUILDER, request_checksum)
+    #The database wrapper and data collector track their own progress in the state file
+    state.close()
     run_database_wrapper(args_dict)
+    state.mark_stage_complete(request_state.Stages.DATABASE_WRAPPER)
     url_file = '%s/csdata.%s.urls' % (args_dict['output_directory'], args_dict['request_label'])
     #By checking if this file exists, we're checking both that we want seismograms and also that the storage requirements are low enough.
     if os.path.exists(url_file):
         run_data_collector(args_dict, url_file)
+        state.mark_stage_complete(request_state.Stages.DATA_COLLECTOR)
+    state.close()
     print("\nData retrieval is complete!")
 
 if __name__=='__main__':
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Shard Tool, which splits a data request into independent shard requests which can run on separate nodes, and merges the shard results afterwards.'''
+
+import sys
+import os
+import argparse
+import json
+import csv
+import heapq
+import sqlite3
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.utilities as utilities
+import utils.compression as compression
+import utils.filters as filters
+import utils.data_products as data_products
+import utils.models as models
+
+debug = False
+
+def parse_args(argv):
+    global debug
+    parser = argparse.ArgumentParser(prog='Shard Tool', description='Splits a CyberShake data request into independent shards, or merges the results of shards.')
+    subparsers = parser.add_subparsers(dest='command')
+    plan_parser = subparsers.add_parser('plan', help='Split a data request JSON file into shard request files.')
+    plan_parser.add_argument('-i', '--input-filename', dest='input_filename', action='store', default=None, help="Path to JSON file describing the data request.")
+    plan_parser.add_argument('-n', '--num-shards', dest='num_shards', action='store', type=int, default=None, help="Number of shards to split the request into.")
+    plan_parser.add_argument('-l', '--request-label', dest='request_label', action='store', default=None, help="Label of the request; shards are labeled <label>.shard<N>.")
+    plan_parser.add_argument('-o', '--output-directory', dest='output_directory', action='store', default=".", help="Directory to write the shard request files and plan to.")
+    plan_parser.add_argument('-c', "--config-filename", dest='config_filename', action='store', default=None, help="Path to database configuration file, used to weight sites by their number of rupture variations (optional).")
+    plan_parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
+    merge_parser = subparsers.add_parser('merge', help='Merge the results of all shards in a plan.')
+    merge_parser.add_argument('-p', '--plan-filename', dest='plan_filename', action='store', default=None, help="Path to the csdata.<label>.shards plan file written by the plan command.")
+    merge_parser.add_argument('-s', '--shard-directory', dest='shard_directory', action='store', default=None, help="Directory containing the shard results (optional, default is the directory of the plan file).")
+    merge_parser.add_argument('-o', '--output-directory', dest='output_directory', action='store', default=None, help="Directory to write the merged results to (optional, default is the directory of the plan file).")
+    merge_parser.add_argument('-c', "--config-filename", dest='config_filename', action='store', default=None, help="Path to the database configuration file the shards were retrieved with, used to order strings the way the database does (optional, default is db_wrapper/moment.cfg).")
+    merge_parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
+    parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help="Show version number and exit.")
+    args = parser.parse_args(args=argv)
+    if args.version==True:
+        print("Version: %s" % utilities.get_version())
+        sys.exit(utilities.ExitCodes.NO_ERROR)
+    if args.command is None:
+        print("Either the plan or merge command must be provided, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+    if args.debug==True:
+        debug = True
+    args_dict = dict()
+    args_dict['command'] = args.command
+    if args.command=='plan':
+        if args.input_filename is None or args.num_shards is None or args.request_label is None:
+            print("The input file, number of shards, and request label must be provided, aborting.", file=sys.stderr)
+            sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+        if args.num_shards<1:
+            print("The number of shards must be at least 1, aborting.", file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+        args_dict['input_filename'] = args.input_filename
+        args_dict['num_shards'] = args.num_shards
+        args_dict['request_label'] = args.request_label
+        args_dict['output_directory'] = args.output_directory
+        args_dict['config_filename'] = args.config_filename
+    elif args.command=='merge':
+        if args.plan_filename is None:
+            print("Path to plan file must be provided, aborting.", file=sys.stderr)
+            sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+        args_dict['plan_filename'] = args.plan_filename
+        plan_directory = os.path.dirname(os.path.abspath(args.plan_filename))
+        args_dict['shard_directory'] = args.shard_directory if args.shard_directory is not None else plan_directory
+        args_dict['output_directory'] = args.output_directory if args.output_directory is not None else plan_directory
+        args_dict['config_filename'] = args.config_filename
+    return args_dict
+
+def get_plan_filename(output_directory, request_label):
+    return "%s/csdata.%s.shards" % (output_directory, request_label)
+
+def get_shard_label(request_label, shard_index):
+    return "%s.shard%d" % (request_label, shard_index)
+
+def read_request(input_filename):
+    try:
+        with open(input_filename, 'r') as fp_in:
+            request_dict = json.load(fp_in)
+            fp_in.close()
+    except Exception as e:
+        print("Error parsing JSON file %s, aborting." % input_filename, file=sys.stderr)
+        print(e)
+        sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
+    return request_dict
+
+def find_model(model_name):
+    model_list = models.create_models(data_products.create_data_products())
+    for m in model_list:
+        if m.get_name()==model_name:
+            return m
+    print("Model %s in the data request isn't a supported model, aborting." % model_name, file=sys.stderr)
+    sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
+
+#Returns a dict of (source ID, rupture ID) -> number of rupture variations, from the built-in SQLite DB
+def get_rv_counts(model):
+    rv_counts = dict()
+    num_rvs_db_path = '%s/../utils/num_rvs.sqlite' % (os.path.dirname(os.path.abspath(__file__)))
+    if not os.path.exists(num_rvs_db_path):
+        return rv_counts
+    conn = sqlite3.connect(num_rvs_db_path)
+    cur = conn.cursor()
+    cur.execute('select Source_ID, Rupture_ID, Num_Rup_Vars from Rupture_Variation_Counts where Study_Name=?', (model.get_name(),))
+    for (source_id, rupture_id, num_rvs) in cur.fetchall():
+        rv_counts[(source_id, rupture_id)] = num_rvs
+    conn.close()
+    return rv_counts
+
+#Returns a dict of site name -> number of rupture variations for the site, so shards can be balanced.
+#If site_names is None, all the sites in the study are included.
+def get_site_weights(model, site_names, config_filename):
+    #Imported here so that planning by event doesn't need a database driver
+    import db_wrapper.run_database_wrapper as run_database_wrapper
+    if config_filename is None:
+        config_filename = run_database_wrapper.get_default_config()
+    config_dict = utilities.read_config(config_filename)
+    rv_counts = get_rv_counts(model)
+    if len(rv_counts)==0:
+        print("No rupture variation counts are available for %s, so sites will be weighted by their number of ruptures." % model.get_name())
+    query = 'select CyberShake_Sites.CS_Short_Name, CyberShake_Site_Ruptures.Source_ID, CyberShake_Site_Ruptures.Rupture_ID ' \
+        'from CyberShake_Sites, CyberShake_Site_Ruptures, CyberShake_Runs, Studies ' \
+        'where Studies.Study_Name="%s" and CyberShake_Runs.Study_ID=Studies.Study_ID and CyberShake_Runs.Site_ID=CyberShake_Sites.CS_Site_ID ' \
+        'and CyberShake_Site_Ruptures.CS_Site_ID=CyberShake_Sites.CS_Site_ID and CyberShake_Site_Ruptures.ERF_ID=CyberShake_Runs.ERF_ID' % model.get_name()
+    if site_names is not None:
+        query = "%s and CyberShake_Sites.CS_Short_Name in (%s)" % (query, ",".join(["'%s'" % s for s in site_names]))
+    if debug:
+        print(query)
+    conn = run_database_wrapper.get_connection(config_dict)
+    cur = conn.cursor()
+    try:
+        cur.execute(query)
+    except Exception as e:
+        print("Error executing database query '%s', aborting." % query, file=sys.stderr)
+        print(e)
+        sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
+    site_weights = dict()
+    if site_names is not None:
+        for s in site_names:
+            site_weights[s] = 0
+    for (site_name, source_id, rupture_id) in cur.fetchall():
+        site_weights[site_name] = site_weights.get(site_name, 0) + rv_counts.get((source_id, rupture_id), 1)
+    cur.close()
+    conn.close()
+    return site_weights
+
+#Assigns each item to a shard, largest first, always choosing the least-loaded shard.
+#Ties are broken by item and shard order, so the same inputs always produce the same plan.
+def balance(weights, num_shards):
+    shard_heap = [(0, i) for i in range(0, num_shards)]
+    shards = [[] for i in range(0, num_shards)]
+    for (item, weight) in sorted(weights.items(), key=lambda x: (-x[1], x[0])):
+        (load, index) = heapq.heappop(shard_heap)
+        shards[index].append(item)
+        heapq.heappush(shard_heap, (load+weight, index))
+    shard_weights = [sum([weights[item] for item in s]) for s in shards]
+    return [(sorted(shards[i]), shard_weights[i]) for i in range(0, num_shards) if len(shards[i])>0]
+
+def get_site_filter(request_dict):
+    for filt in request_dict['filters']:
+        if filt['name']=='Site Name':
+            return filt
+    return None
+
+#Splits the request by event list, keeping all rupture variations of a rupture in the same shard
+#so each bulk seismogram file is only downloaded once.
+def plan_by_event(request_dict, num_shards):
+    rupture_weights = dict()
+    rupture_events = dict()
+    for e in request_dict['event_list']:
+        key = (e[0], e[1])
+        rupture_weights[key] = rupture_weights.get(key, 0) + 1
+        rupture_events.setdefault(key, []).append(e)
+    shard_requests = []
+    for (ruptures, weight) in balance(rupture_weights, num_shards):
+        shard_request = dict(request_dict)
+        shard_request['event_list'] = []
+        for r in ruptures:
+            shard_request['event_list'].extend(rupture_events[r])
+        shard_requests.append((shard_request, weight, "%d ruptures" % len(ruptures)))
+    return shard_requests
+
+def plan_by_site(request_dict, num_shards, model, config_filename):
+    site_filter = get_site_filter(request_dict)
+    site_names = None
+    if site_filter is not None:
+        if site_filter['filter_params']==filters.FilterParams.VALUE_RANGE:
+            print("Can't shard a request with a range of site names, aborting.", file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+        site_names = site_filter['values']
+    if 'site_list' in request_dict:
+        if site_names is None:
+            site_names = request_dict['site_list']
+        else:
+            site_names = [s for s in site_names if s in request_dict['site_list']]
+    site_weights = get_site_weights(model, site_names, config_filename)
+    if len(site_weights)==0:
+        print("No sites found for %s, aborting." % model.get_name(), file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    shard_requests = []
+    for (sites, weight) in balance(site_weights, num_shards):
+        shard_request = dict(request_dict)
+        if 'site_list' in request_dict and site_filter is None:
+            #Split up the site list instead of adding a site filter
+            shard_request['site_list'] = sites
+            shard_requests.append((shard_request, weight, "%d sites" % len(sites)))
+            continue
+        if 'site_list' in request_dict:
+            del shard_request['site_list']
+        shard_filters = [f for f in request_dict['filters'] if f['name']!='Site Name']
+        new_site_filter = dict()
+        new_site_filter['name'] = 'Site Name'
+        if len(sites)==1:
+            new_site_filter['filter_params'] = filters.FilterParams.SINGLE_VALUE
+        else:
+            new_site_filter['filter_params'] = filters.FilterParams.MULTIPLE_VALUES
+        new_site_filter['values'] = sites
+        #Keep any sort on site name
+        if site_filter is not None and 'sort' in site_filter:
+            new_site_filter['sort'] = site_filter['sort']
+        shard_filters.append(new_site_filter)
+        shard_request['filters'] = shard_filters
+        shard_requests.append((shard_request, weight, "%d sites" % len(sites)))
+    return shard_requests
+
+def plan_shards(args_dict):
+    request_dict = read_request(args_dict['input_filename'])
+    model = find_model(request_dict['model']['name'])
+    num_shards = args_dict['num_shards']
+    #Each shard would apply the limit separately, so the merged results wouldn't be the requested rows
+    for option in ['limit', 'top_k']:
+        if option in request_dict:
+            print("Requests with a %s can't be split into shards, aborting." % option, file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    if 'event_list' in request_dict:
+        partition = 'event'
+        shard_requests = plan_by_event(request_dict, num_shards)
+    else:
+        partition = 'site'
+        shard_requests = plan_by_site(request_dict, num_shards, model, args_dict['config_filename'])
+    if len(shard_requests)<num_shards:
+        print("The request can only be split into %d shards." % len(shard_requests))
+    plan_dict = dict()
+    plan_dict['request_label'] = args_dict['request_label']
+    #Relative to the plan file, so the plan can be moved along with the request
+    plan_dict['request_filename'] = os.path.relpath(os.path.abspath(args_dict['input_filename']), os.path.abspath(args_dict['output_directory']))
+    plan_dict['data_product'] = request_dict['products']['name']
+    plan_dict['partition'] = partition
+    plan_dict['shards'] = []
+    print("Writing %d shard requests:" % len(shard_requests))
+    for i, (shard_request, weight, description) in enumerate(shard_requests):
+        shard_label = get_shard_label(args_dict['request_label'], i)
+        shard_filename = "%s/csdata.%s.json" % (args_dict['output_directory'], shard_label)
+        with open(shard_filename, 'w') as fp_out:
+            fp_out.write(json.dumps(shard_request, indent=4))
+            fp_out.flush()
+            fp_out.close()
+        shard_dict = dict()
+        shard_dict['label'] = shard_label
+        shard_dict['request_filename'] = os.path.basename(shard_filename)
+        shard_dict['weight'] = weight
+        #Shards start from different database replicas, if the config file lists several
+        shard_dict['replica_offset'] = i
+        plan_dict['shards'].append(shard_dict)
+        print("\t%s: %s, %d rupture variations" % (shard_filename, description, weight))
+    plan_filename = get_plan_filename(args_dict['output_directory'], args_dict['request_label'])
+    with open(plan_filename, 'w') as fp_out:
+        fp_out.write(json.dumps(plan_dict, indent=4))
+        fp_out.flush()
+        fp_out.close()
+    print("\nRun each shard with 'retrieve_cs_data.py -i <shard request file> -l <shard label> -ro <shard number>', then merge the results with")
+    print("'run_shard_tool.py merge -p %s'." % plan_filename)
+    return plan_filename
+
+#Returns (column alias, ascending) for the sort in the request, or None if it isn't sorted.  As in the Query Constructor,
+#the last filter with a sort is the one used, and aggregated fields are sorted on their aggregate.
+def get_sort_column(request_filename, data_product_name):
+    request_dict = read_request(request_filename)
+    sort_column = None
+    for filt in request_dict['filters']:
+        if filt.get('sort', 0)!=0:
+            for f in filters.create_filters():
+                if f.get_name()==filt['name']:
+                    (where_fields, from_tables) = f.get_query()
+                    sort_column = (utilities.get_field_alias(where_fields[0].split(".")[1]), filt['sort']>0)
+                    for dp in data_products.create_data_products():
+                        if dp.get_name()==data_product_name and where_fields[0] in dp.get_aggregate_sort_fields():
+                            sort_column = (dp.get_aggregate_sort_fields()[where_fields[0]], filt['sort']>0)
+    return sort_column
+
+#Returns the type of the database the shards were retrieved from, which determines how strings are ordered
+def get_database_type(config_filename):
+    if config_filename is None:
+        config_filename = "%s/../db_wrapper/moment.cfg" % (os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return utilities.read_config(config_filename)['type'].lower()
+    except Exception as e:
+        print("Error reading config file %s, aborting." % config_filename, file=sys.stderr)
+        print(e)
+        sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
+
+#Returns a function giving the sort key of a CSV value, matching the database's ordering so the merged results are in
+#the same order a single query would have returned.  NULLs, written as None, sort before everything else, numeric
+#columns sort numerically, and strings sort by the database's collation: MySQL's default collations ignore case and
+#trailing spaces, while SQLite compares the bytes.
+def get_sort_key_function(database_type):
+    def get_sort_key(value):
+        if value=='None':
+            return (0, 0.0, "")
+        try:
+            return (1, float(value), "")
+        except ValueError:
+            if database_type=='mysql':
+                return (2, 0.0, value.rstrip(' ').casefold())
+            return (2, 0.0, value)
+    return get_sort_key
+
+#Generator of (fields, text) for each record in an open CSV file.  Quoted fields can contain newlines, so a record may
+#span several lines; text is the record exactly as it appears in the file.
+def read_csv_records(fp_in):
+    record_lines = []
+    def read_lines():
+        for line in fp_in:
+            record_lines.append(line)
+            yield line
+    for fields in csv.reader(read_lines()):
+        #The reader only reads as many lines as it needs for each record
+        text = "".join(record_lines)
+        del record_lines[:]
+        yield (fields, text)
+
+#Generator of (sort key, text) for each record of a CSV file, skipping the header
+def read_sorted_csv(filename, column_index, get_sort_key):
+    with compression.open_text(filename, 'r', newline='') as fp_in:
+        records = read_csv_records(fp_in)
+        next(records, None)
+        for (fields, text) in records:
+            yield (get_sort_key(fields[column_index]), text)
+        fp_in.close()
+
+def merge_csv(shard_filenames, output_filename, sort_column, database_type):
+    headers = []
+    for f in shard_filenames:
+        with compression.open_text(f, 'r', newline='') as fp_in:
+            headers.append(next(read_csv_records(fp_in), ([], "")))
+            fp_in.close()
+    if len(set([h[1] for h in headers]))>1:
+        print("Shard results have different columns, so they can't be merged, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
+    (header_fields, header) = headers[0]
+    column_index = None
+    if sort_column is not None:
+        if sort_column[0] in header_fields:
+            column_index = header_fields.index(sort_column[0])
+        else:
+            print("Results are sorted on %s, which isn't in the output, so shard results will be concatenated in shard order." % sort_column[0])
+    num_rows = 0
+    with compression.open_text(output_filename, 'w', newline='') as fp_out:
+        fp_out.write(header)
+        if column_index is None:
+            for f in shard_filenames:
+                with compression.open_text(f, 'r', newline='') as fp_in:
+                    records = read_csv_records(fp_in)
+                    next(records, None)
+                    for (fields, text) in records:
+                        fp_out.write(text)
+                        num_rows += 1
+                    fp_in.close()
+        else:
+            #k-way merge of the already-sorted shard results.  heapq.merge is stable, so ties keep shard order.
+            streams = [read_sorted_csv(f, column_index, get_sort_key_function(database_type)) for f in shard_filenames]
+            for (key, text) in heapq.merge(*streams, key=lambda x: x[0], reverse=not sort_column[1]):
+                fp_out.write(text)
+                num_rows += 1
+        fp_out.flush()
+        fp_out.close()
+    return num_rows
+
+def merge_sqlite(shard_filenames, output_filename):
+    if os.path.exists(output_filename):
+        os.remove(output_filename)
+    conn = sqlite3.connect(output_filename)
+    cur = conn.cursor()
+    num_rows = 0
+    for i, f in enumerate(shard_filenames):
+        cur.execute("ATTACH DATABASE ? AS shard", (f,))
+        if i==0:
+            #Copy the schema from the first shard
+            cur.execute("select sql from shard.sqlite_master where type='table' and name='CyberShake_Data'")
+            cur.execute(cur.fetchone()[0])
+        cur.execute("INSERT INTO CyberShake_Data SELECT * FROM shard.CyberShake_Data")
+        num_rows += cur.rowcount
+        conn.commit()
+        cur.execute("DETACH DATABASE shard")
+    conn.close()
+    return num_rows
+
+#Combines the URL files, merging the rupture variations for bulk files which appear in multiple shards.
+#Output is sorted by URL and rupture variation, so it doesn't depend on shard order.
+def merge_urls(shard_filenames, output_filename):
+    url_dict = dict()
+    for f in shard_filenames:
+        with open(f, 'r') as fp_in:
+            for line in fp_in:
+                (url, rvs) = line.strip().split()
+                url_dict.setdefault(url, set()).update([int(rv) for rv in rvs.split(",")])
+            fp_in.close()
+    with open(output_filename, 'w') as fp_out:
+        for url in sorted(url_dict.keys()):
+            fp_out.write("%s %s\n" % (url, ",".join([str(rv) for rv in sorted(url_dict[url])])))
+        fp_out.flush()
+        fp_out.close()
+    return len(url_dict)
+
+#Returns the sort column for merging the shards' results.  The request filename in the plan is relative to the plan file.
+def get_merge_sort_column(plan_filename, plan_dict):
+    request_filename = os.path.join(os.path.dirname(os.path.abspath(plan_filename)), plan_dict['request_filename'])
+    if not os.path.exists(request_filename):
+        print("Request file %s isn't available, so shard results will be concatenated in shard order." % request_filename)
+        return None
+    return get_sort_column(request_filename, plan_dict['data_product'])
+
+def merge_shards(args_dict):
+    plan_dict = read_request(args_dict['plan_filename'])
+    request_label = plan_dict['request_label']
+    shard_directory = args_dict['shard_directory']
+    output_directory = args_dict['output_directory']
+    shard_labels = [shard['label'] for shard in plan_dict['shards']]
+    merged_any = False
+    for extension in ['csv', 'csv.gz', 'csv.zst', 'sqlite']:
+        shard_filenames = ["%s/csdata.%s.data.%s" % (shard_directory, label, extension) for label in shard_labels]
+        existing = [f for f in shard_filenames if os.path.exists(f)]
+        if len(existing)==0:
+            continue
+        if len(existing)<len(shard_filenames):
+            missing = [f for f in shard_filenames if not os.path.exists(f)]
+            print("Results are missing for %d shards (%s), aborting." % (len(missing), ", ".join(missing)), file=sys.stderr)
+            sys.exit(utilities.ExitCodes.BAD_FILE_PATH)
+        output_filename = "%s/csdata.%s.data.%s" % (output_directory, request_label, extension)
+        if extension.startswith('csv'):
+            problem = compression.get_compression_problem(compression.get_compression(extension))
+            if problem is not None:
+                print("Shard results in %s format can't be merged, since %s, aborting." % (extension, problem), file=sys.stderr)
+                sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+            num_rows = merge_csv(shard_filenames, output_filename, get_merge_sort_column(args_dict['plan_filename'], plan_dict), get_database_type(args_dict['config_filename']))
+        else:
+            num_rows = merge_sqlite(shard_filenames, output_filename)
+        print("Merged %d rows from %d shards into %s." % (num_rows, len(shard_filenames), output_filename))
+        merged_any = True
+    if not merged_any:
+        print("No shard results were found in %s, aborting." % shard_directory, file=sys.stderr)
+        sys.exit(utilities.ExitCodes.BAD_FILE_PATH)
+    url_filenames = ["%s/csdata.%s.urls" % (shard_directory, label) for label in shard_labels]
+    url_filenames = [f for f in url_filenames if os.path.exists(f)]
+    if len(url_filenames)>0:
+        output_filename = "%s/csdata.%s.urls" % (output_directory, request_label)
+        num_urls = merge_urls(url_filenames, output_filename)
+        print("Merged %d seismogram URLs into %s." % (num_urls, output_filename))
+
+def run_main(argv):
+    args_dict = parse_args(argv)
+    if args_dict['command']=='plan':
+        plan_shards(args_dict)
+    elif args_dict['command']=='merge':
+        merge_shards(args_dict)
+
+if __name__=="__main__":
+    run_main(sys.argv[1:])
+    sys.exit(0)
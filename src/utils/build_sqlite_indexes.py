@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Utility to prepare a local SQLite copy of the CyberShake database for the fast SQLite mode.  It creates the covering
+indexes the generated queries need, then runs ANALYZE so the query planner knows how selective they are.  Since the
+fast mode opens the database read-only, rerun this with --analyze-only after changing the data to refresh the statistics.'''
+
+import sys
+import os
+import sqlite3
+import argparse
+import time
+import utilities
+import replicas
+import sqlite_backend
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='Build SQLite Indexes', description='Creates covering indexes and query planner statistics in a SQLite CyberShake database.')
+    parser.add_argument('-c', '--config-file', dest='config_file', action='store', default=None, help='Path to config file for the SQLite DB (required).  If it lists several db_path replicas, each is indexed.')
+    parser.add_argument('-a', '--analyze-only', dest='analyze_only', action='store_true', default=False, help="Only refresh the query planner statistics, without creating indexes.")
+    args = parser.parse_args()
+    if args.config_file is None:
+        print("A config file is required, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+    args_dict = dict()
+    args_dict['config_file'] = args.config_file
+    args_dict['analyze_only'] = args.analyze_only
+    return args_dict
+
+def get_connection(config_dict):
+    db_path = config_dict['db_path']
+    #Don't create an empty database if the path is wrong
+    if not os.path.exists(db_path):
+        print("SQLite database %s doesn't exist, aborting." % db_path, file=sys.stderr)
+        sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
+    try:
+        conn = sqlite3.connect(db_path)
+        sqlite_backend.tune_connection(conn, config_dict)
+    except Exception as e:
+        print("Error connecting to SQLite database %s, aborting." % db_path, file=sys.stderr)
+        print(e)
+        sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
+    return conn
+
+#Creates any covering indexes which are missing.  Each is committed as it's made, so an interrupted run keeps them.
+def create_indexes(conn):
+    existing_indexes = set([r[0] for r in conn.execute("select name from sqlite_master where type='index'").fetchall()])
+    covering_indexes = sqlite_backend.get_covering_indexes(conn)
+    for table in sorted(covering_indexes):
+        for columns in covering_indexes[table]:
+            index_name = sqlite_backend.get_index_name(table, columns)
+            if index_name in existing_indexes:
+                continue
+            print("Creating index %s on %s (%s)." % (index_name, table, ", ".join(columns)))
+            start_time = time.time()
+            conn.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (index_name, table, ", ".join(columns)))
+            conn.commit()
+            print("Created index %s in %.1f sec." % (index_name, time.time()-start_time))
+
+def analyze(conn):
+    print("Updating query planner statistics.")
+    start_time = time.time()
+    conn.execute('ANALYZE')
+    conn.commit()
+    print("Updated statistics in %.1f sec." % (time.time()-start_time))
+
+def run_main():
+    args_dict = parse_args()
+    config_dict = utilities.read_config(args_dict['config_file'])
+    if config_dict['type'].lower()!='sqlite':
+        print("Config file %s isn't for a SQLite database, aborting." % args_dict['config_file'], file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    for replica_dict in replicas.get_replicas(config_dict):
+        print("Preparing SQLite database %s." % replica_dict['db_path'])
+        conn = get_connection(replica_dict)
+        if args_dict['analyze_only']==False:
+            create_indexes(conn)
+        analyze(conn)
+        conn.close()
+
+if __name__=="__main__":
+    run_main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Reads and writes compressed CSV output files, compressing in a background thread while results are being formatted.'''
+
+import sys
+import os
+import io
+import gzip
+import queue
+import threading
+
+#zstandard is optional, and only needed for .zst output
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+#Compression levels, chosen for speed since outputs are written while the database is being read
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+#Maximum number of chunks waiting to be compressed, so a slow disk doesn't let memory grow without limit
+MAX_QUEUED_CHUNKS = 8
+
+#Extensions of compressed output files, as they appear after .csv
+COMPRESSED_EXTENSIONS = ['gz', 'zst']
+
+#Returns the compression extension of a filename or output format, or None if it isn't compressed
+def get_compression(filename):
+    extension = filename.rsplit(".", 1)[-1].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return extension
+    return None
+
+#Returns None if the compression can be used, or else the reason it can't
+def get_compression_problem(compression):
+    if compression=='zst' and zstandard is None:
+        return "zstd compression requires the zstandard package, which isn't installed"
+    return None
+
+def open_binary(filename, mode, compression):
+    if compression=='gz':
+        if 'w' in mode:
+            return gzip.open(filename, mode, compresslevel=GZIP_LEVEL)
+        return gzip.open(filename, mode)
+    if 'w' in mode:
+        return zstandard.open(filename, mode, cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL))
+    return zstandard.open(filename, mode)
+
+#Opens a file as text, decompressing or compressing it based on its extension.  mode is 'r' or 'w'.
+def open_text(filename, mode, newline=None):
+    compression = get_compression(filename)
+    if compression is None:
+        return open(filename, mode, newline=newline)
+    return io.TextIOWrapper(open_binary(filename, "%sb" % mode, compression), encoding='utf-8', newline=newline)
+
+#Text file which is compressed as it's written.  Each write() hands its text to a background thread, which does the
+#compression; zlib and zstd release the GIL while compressing, so it overlaps with formatting the next chunk.
+class BackgroundCompressedFile:
+
+    def __init__(self, filename, compression):
+        self.filename = filename
+        self.fp_out = open_binary(filename, 'wb', compression)
+        self.chunks = queue.Queue(maxsize=MAX_QUEUED_CHUNKS)
+        self.error = None
+        self.thread = threading.Thread(target=self.compress_chunks, daemon=True)
+        self.thread.start()
+
+    def compress_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            #Keep draining the queue after an error, so write() never blocks on a full queue
+            if self.error is not None:
+                continue
+            try:
+                self.fp_out.write(chunk)
+            except Exception as e:
+                self.error = e
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, text):
+        self.check_error()
+        self.chunks.put(text.encode('utf-8'))
+
+    #Data is flushed when the file is closed; flushing the compressor early would only make the output larger
+    def flush(self):
+        self.check_error()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.chunks.put(None)
+        self.thread.join()
+        self.thread = None
+        self.fp_out.close()
+        self.check_error()
@@ -33,37 +33,60 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 '''Utility to construct a SQLite database which tracks the number of rupture variations per rupture for a given study.
-This should be much faster than hitting the database over the network when we want to estimate data sizes.'''
+This should be much faster than hitting the database over the network when we want to estimate data sizes.
+Rerunning it for a study refreshes that study's counts, leaving the other studies in the DB alone.
+With --mirror, it instead constructs a local mirror of the metadata tables for the given studies, which the
+Database Wrapper uses to answer Site Info and Event Info queries without going over the network.'''
 
 import sys
 import os
 import pymysql
 import sqlite3
 import argparse
+import datetime
+import decimal
 import utilities
+import metadata_mirror
+import replicas
+import sqlite_backend
+
+#Number of rows to copy at a time when building the mirror
+MIRROR_BATCH_SIZE = 50000
 
 def parse_args():
     parser = argparse.ArgumentParser(prog='Construct RV DB', description='Builds a SQLite DB for quick retrieval of the # of rupture variations per rupture.')
     parser.add_argument('-c', '--config-file', dest='config_file', action='store', default='focal.cfg', help='Path to config file with connection information to DB.')
     parser.add_argument('-s', '--study-names', dest='study_names', action='store', default=None, help='Comma-separated list of study names for which to populate the DB (required).')
-    parser.add_argument('-o', '--output-filename', dest='output_filename', action='store', default='num_rvs.sqlite', help="Path to output SQLite file.")
+    parser.add_argument('-o', '--output-filename', dest='output_filename', action='store', default=None, help="Path to output SQLite file (default: num_rvs.sqlite, or cs_metadata.sqlite with --mirror).")
+    parser.add_argument('-m', '--mirror', dest='mirror', action='store_true', default=False, help="Build a local mirror of the metadata tables for the studies, instead of the rupture variation counts.")
+    parser.add_argument('-u', '--upgrade', dest='upgrade', action='store_true', default=False, help="Convert an existing rupture variation count DB to the current format, without querying the database.")
     args = parser.parse_args()
     args_dict = dict()
-    if args.study_names is None:
+    if args.study_names is None and not (args.upgrade==True and args.mirror==False):
         print("At least one study name is required, aborting.", file=sys.stderr)
         sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
-    args_dict['study_names'] = args.study_names
+    if args.upgrade==True and args.mirror==False:
+        args_dict['study_names'] = None
+    else:
+        args_dict['study_names'] = args.study_names
     args_dict['config_file'] = args.config_file
-    args_dict['output_filename'] = args.output_filename
+    args_dict['mirror'] = args.mirror
+    if args.output_filename is not None:
+        args_dict['output_filename'] = args.output_filename
+    elif args.mirror==True:
+        args_dict['output_filename'] = 'cs_metadata.sqlite'
+    else:
+        args_dict['output_filename'] = 'num_rvs.sqlite'
     return args_dict
 
 
-def generate_db(args_dict, config_dict):
+def get_source_connection(config_dict):
+    config_dict = replicas.get_preferred_replica(config_dict)
     try:
         if config_dict['type'].lower()=='mysql':
             from_conn = pymysql.connect(host=config_dict["host"], user=config_dict["user"], passwd=config_dict["password"], db=config_dict['db'])
         elif config_dict['type'].lower()=='sqlite':
-            from_conn = sqlite3.connect(config_dict['db_path'])
+            from_conn = sqlite_backend.open_sqlite(config_dict)
         else:
             print("Database type %s not recognized, aborting.", file=sys.stderr)
             sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
@@ -76,13 +99,60 @@ def generate_db(args_dict, config_dict):
         print(error_str, file=sys.stderr)
         print(e)
         sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
-    from_cur = from_conn.cursor()
+    return from_conn
+
+#Table schemas for the rupture variation count DB.  Lookups are always by (study, source, rupture), so the counts
+#are stored clustered on that key.
+COUNTS_TABLE = 'Rupture_Variation_Counts'
+COUNTS_SCHEMA = 'CREATE TABLE IF NOT EXISTS %s (Study_Name TEXT NOT NULL, Source_ID INTEGER NOT NULL, Rupture_ID INTEGER NOT NULL, ' \
+    'Num_Rup_Vars INTEGER NOT NULL, PRIMARY KEY (Study_Name, Source_ID, Rupture_ID)) WITHOUT ROWID' % COUNTS_TABLE
+STUDY_TABLE = 'Study_Metadata'
+STUDY_SCHEMA = 'CREATE TABLE IF NOT EXISTS %s (Study_Name TEXT PRIMARY KEY, ERF_ID INTEGER, Rup_Var_Scenario_ID INTEGER, ' \
+    'Num_Ruptures INTEGER, Num_Rup_Vars INTEGER, Last_Updated TEXT)' % STUDY_TABLE
+
+#Creates the schema in the output DB, converting a counts table from an older version of this tool if needed
+def create_schema(to_conn):
+    to_cur = to_conn.cursor()
+    to_cur.execute("select sql from sqlite_master where type='table' and name=?", (COUNTS_TABLE,))
+    res = to_cur.fetchone()
+    if res is not None and 'WITHOUT ROWID' not in res[0].upper():
+        print("Converting %s to the indexed format." % COUNTS_TABLE)
+        to_cur.execute('ALTER TABLE %s RENAME TO Old_%s' % (COUNTS_TABLE, COUNTS_TABLE))
+        to_cur.execute(COUNTS_SCHEMA)
+        to_cur.execute('INSERT OR REPLACE INTO %s SELECT Study_Name, Source_ID, Rupture_ID, Num_Rup_Vars FROM Old_%s' % (COUNTS_TABLE, COUNTS_TABLE))
+        to_cur.execute('DROP TABLE Old_%s' % COUNTS_TABLE)
+    else:
+        to_cur.execute(COUNTS_SCHEMA)
+    to_cur.execute(STUDY_SCHEMA)
+    #Studies converted from an older DB have counts but no metadata, so fill in what we can
+    to_cur.execute('INSERT INTO %s (Study_Name, Num_Ruptures, Num_Rup_Vars, Last_Updated) ' \
+        'SELECT Study_Name, count(*), sum(Num_Rup_Vars), NULL FROM %s WHERE Study_Name NOT IN (SELECT Study_Name FROM %s) GROUP BY Study_Name' \
+        % (STUDY_TABLE, COUNTS_TABLE, STUDY_TABLE))
+    to_conn.commit()
+    to_cur.close()
+
+#Compacts the DB and updates the query planner statistics
+def optimize_db(to_conn):
+    print("Optimizing SQLite db.")
+    to_conn.execute('ANALYZE')
+    to_conn.commit()
+    to_conn.execute('VACUUM')
+
+def generate_db(args_dict, config_dict):
     try:
         to_conn = sqlite3.connect(args_dict['output_filename'])
     except Exception as e:
-        print("Error connecting to SQLite database %s, aborting." % (config_dict['db_path']), file=sys.stderr)
+        print("Error connecting to SQLite database %s, aborting." % (args_dict['output_filename']), file=sys.stderr)
         print(e)
         sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
+    create_schema(to_conn)
+    if args_dict['study_names'] is None:
+        #Only upgrading an existing DB
+        optimize_db(to_conn)
+        to_conn.close()
+        return
+    from_conn = get_source_connection(config_dict)
+    from_cur = from_conn.cursor()
     to_cur = to_conn.cursor()
     studies = args_dict['study_names'].split(",")
     print(studies)
@@ -94,7 +164,11 @@ def generate_db(args_dict, config_dict):
             'order by CyberShake_Runs.Run_ID asc limit 1' % (s)
         print(query)
         from_cur.execute(query)
-        (erf_id, rup_var_scenario_id) = from_cur.fetchone()
+        res = from_cur.fetchone()
+        if res is None:
+            print("Study %s has no runs in the database, aborting." % s, file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+        (erf_id, rup_var_scenario_id) = (int(res[0]), int(res[1]))
         query = 'select Ruptures.Source_ID, Ruptures.Rupture_ID, count(Rupture_Variations.Rup_Var_ID) ' \
             'from Ruptures, Rupture_Variations ' \
             'where Rupture_Variations.ERF_ID=Ruptures.ERF_ID and Ruptures.Source_ID=Rupture_Variations.Source_ID and Ruptures.Rupture_ID=Rupture_Variations.Rupture_ID and ' \
@@ -102,24 +176,127 @@ def generate_db(args_dict, config_dict):
             'group by Rupture_Variations.Source_ID, Rupture_Variations.Rupture_ID' % (erf_id, rup_var_scenario_id)
         print(query)
         from_cur.execute(query)
-        res = from_cur.fetchall()
-        #Construct schema in target DB, if it doesn't exist
-        create_table_cmd = 'CREATE TABLE IF NOT EXISTS Rupture_Variation_Counts ' \
-            '(Study_Name TEXT, Source_ID INTEGER, Rupture_ID INTEGER, Num_Rup_Vars INTEGER)'
-        to_cur.execute(create_table_cmd)
-        print("Inserting values into SQLite db.")
-        for r in res:
-            insert_cmd = 'INSERT INTO Rupture_Variation_Counts VALUES ("%s", %d, %d, %d)' % (s, int(r[0]), int(r[1]), int(r[2]))
-            to_cur.execute(insert_cmd)
+        rows = [(s, int(r[0]), int(r[1]), int(r[2])) for r in from_cur.fetchall()]
+        print("Inserting %d values into SQLite db." % len(rows))
+        #Replace this study's counts in a single transaction, leaving the other studies alone
+        with to_conn:
+            to_cur.execute('DELETE FROM %s WHERE Study_Name=?' % COUNTS_TABLE, (s,))
+            to_cur.executemany('INSERT INTO %s VALUES (?, ?, ?, ?)' % COUNTS_TABLE, rows)
+            to_cur.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)' % STUDY_TABLE, (s, erf_id, rup_var_scenario_id, len(rows),
+                sum([r[3] for r in rows]), datetime.datetime.now().isoformat(timespec='seconds')))
+    from_conn.close()
+    optimize_db(to_conn)
+    to_conn.close()
+
+#Returns the SQLite type to use for a column, based on a value from it
+def get_sqlite_type(value):
+    if isinstance(value, int):
+        return 'INTEGER'
+    elif isinstance(value, (float, decimal.Decimal)):
+        return 'REAL'
+    return 'TEXT'
+
+#Creates a table in the mirror, using the types of the values in first_row if there is one
+def create_mirror_table(to_cur, table, columns, first_row):
+    if first_row is None:
+        create_columns = list(columns)
+    else:
+        create_columns = ["%s %s" % (c, get_sqlite_type(first_row[i])) for i, c in enumerate(columns)]
+    primary_key = metadata_mirror.MIRROR_PRIMARY_KEYS[table]
+    if set(primary_key).issubset(set(columns)):
+        create_columns.append("PRIMARY KEY (%s)" % ", ".join(primary_key))
+    to_cur.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, ", ".join(create_columns)))
+
+#Copies the results of query into table in the mirror, creating the table if needed.  Returns the number of rows copied.
+def copy_table(from_conn, config_dict, to_cur, table, query):
+    print(query)
+    if config_dict['type'].lower()=='mysql':
+        #Stream the results, since some of these tables are large
+        from_cur = from_conn.cursor(pymysql.cursors.SSCursor)
+    else:
+        from_cur = from_conn.cursor()
+    from_cur.execute(query)
+    columns = [d[0] for d in from_cur.description]
+    num_rows = 0
+    insert_cmd = None
+    while True:
+        rows = from_cur.fetchmany(MIRROR_BATCH_SIZE)
+        if len(rows)==0:
+            break
+        #SQLite can't store Decimals
+        rows = [tuple([float(v) if isinstance(v, decimal.Decimal) else v for v in r]) for r in rows]
+        if insert_cmd is None:
+            create_mirror_table(to_cur, table, columns, rows[0])
+            insert_cmd = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (table, ", ".join(columns), ", ".join(["?"]*len(columns)))
+        to_cur.executemany(insert_cmd, rows)
+        num_rows += len(rows)
+    if insert_cmd is None:
+        #Still create the table, so queries against it return no results rather than failing
+        create_mirror_table(to_cur, table, columns, None)
+    from_cur.close()
+    return num_rows
+
+#Builds (or refreshes) a local mirror of the metadata tables for each study
+def generate_mirror(args_dict, config_dict):
+    from_conn = get_source_connection(config_dict)
+    from_cur = from_conn.cursor()
+    to_conn = sqlite3.connect(args_dict['output_filename'])
+    to_cur = to_conn.cursor()
+    to_cur.execute('CREATE TABLE IF NOT EXISTS %s (Study_Name TEXT PRIMARY KEY, Mirror_Time TEXT)' % metadata_mirror.MIRROR_STUDIES_TABLE)
+    #IM types are shared by all studies
+    copy_table(from_conn, config_dict, to_cur, 'IM_Types', 'select * from IM_Types')
+    studies = args_dict['study_names'].split(",")
+    for s in studies:
+        print("Mirroring metadata for %s." % s)
+        from_cur.execute('select Study_ID from Studies where Study_Name="%s"' % s)
+        res = from_cur.fetchone()
+        if res is None:
+            print("Study %s isn't in the database, aborting." % s, file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+        study_id = int(res[0])
+        #Don't leave rows from a previous snapshot of this study behind
+        to_cur.execute("select name from sqlite_master where type='table' and name='CyberShake_Runs'")
+        if to_cur.fetchone() is not None:
+            to_cur.execute('DELETE FROM CyberShake_Runs WHERE Study_ID=?', (study_id,))
+        copy_table(from_conn, config_dict, to_cur, 'Studies', 'select * from Studies where Study_ID=%d' % study_id)
+        copy_table(from_conn, config_dict, to_cur, 'CyberShake_Runs', 'select * from CyberShake_Runs where Study_ID=%d' % study_id)
+        copy_table(from_conn, config_dict, to_cur, 'CyberShake_Sites', 'select distinct CyberShake_Sites.* from CyberShake_Sites, CyberShake_Runs ' \
+            'where CyberShake_Runs.Study_ID=%d and CyberShake_Runs.Site_ID=CyberShake_Sites.CS_Site_ID' % study_id)
+        from_cur.execute('select distinct ERF_ID, Rup_Var_Scenario_ID from CyberShake_Runs where Study_ID=%d' % study_id)
+        erf_scenarios = [(int(r[0]), int(r[1])) for r in from_cur.fetchall()]
+        from_cur.execute('select distinct Site_ID from CyberShake_Runs where Study_ID=%d' % study_id)
+        site_ids = ",".join([str(int(r[0])) for r in from_cur.fetchall()])
+        for erf_id in sorted(set([e[0] for e in erf_scenarios])):
+            copy_table(from_conn, config_dict, to_cur, 'Ruptures', 'select * from Ruptures where ERF_ID=%d' % erf_id)
+            copy_table(from_conn, config_dict, to_cur, 'CyberShake_Site_Ruptures', 'select * from CyberShake_Site_Ruptures where ERF_ID=%d and CS_Site_ID in (%s)' % (erf_id, site_ids))
+        for (erf_id, rup_var_scenario_id) in erf_scenarios:
+            copy_table(from_conn, config_dict, to_cur, 'Rupture_Variations', 'select * from Rupture_Variations where ERF_ID=%d and Rup_Var_Scenario_ID=%d' % (erf_id, rup_var_scenario_id))
+        to_cur.execute('INSERT OR REPLACE INTO %s VALUES (?, ?)' % metadata_mirror.MIRROR_STUDIES_TABLE, (s, datetime.datetime.now().isoformat(timespec='seconds')))
+        #Commit after each study, so a failure doesn't lose the studies already mirrored
         to_conn.commit()
+    print("Creating indexes.")
+    for table in metadata_mirror.MIRROR_INDEXES:
+        for columns in metadata_mirror.MIRROR_INDEXES[table]:
+            to_cur.execute('CREATE INDEX IF NOT EXISTS %s_%s_idx ON %s (%s)' % (table, "_".join(columns), table, ", ".join(columns)))
+    to_conn.commit()
+    if not metadata_mirror.build_site_index(to_conn):
+        print("This SQLite doesn't support R*Tree indexes, so geographic site filters will scan the site table.")
+    to_cur.execute('ANALYZE')
+    to_conn.commit()
     to_conn.close()
     from_conn.close()
 
 def run_main():
     print(sys.argv)
     args_dict = parse_args()
-    config_dict = utilities.read_config(args_dict['config_file'])
-    generate_db(args_dict, config_dict)
+    config_dict = None
+    #Upgrading an existing DB doesn't need a database connection
+    if args_dict['study_names'] is not None:
+        config_dict = utilities.read_config(args_dict['config_file'])
+    if args_dict['mirror']==True:
+        generate_mirror(args_dict, config_dict)
+    else:
+        generate_db(args_dict, config_dict)
 
 if __name__=="__main__":
     run_main()
\ No newline at end of file
@@ -58,6 +58,11 @@ class DataProducts:
         self.help_string = help_string
         self.distinct = distinct
         self.sort = 0
+        #IM levels for data products computed on the client, like hazard curves
+        self.im_levels = None
+        #Aggregates computed by the database, as (expression, alias), and the alias to sort on in place of each aggregated field
+        self.aggregate_fields = []
+        self.aggregate_sort_fields = dict()
 
     def get_name(self):
         return self.name
@@ -68,6 +73,8 @@ class DataProducts:
     def get_dict_representation(self):
         obj_dict = dict()
         obj_dict['name'] = self.name
+        if self.im_levels is not None:
+            obj_dict['im_levels'] = self.im_levels
         return obj_dict
 
     def get_help_string(self):
@@ -98,6 +105,22 @@ class DataProducts:
     def get_distinct(self):
         return self.distinct
 
+    def set_aggregate_query(self, aggregates=None, sort_fields=None):
+        self.aggregate_fields.extend(aggregates)
+        self.aggregate_sort_fields.update(sort_fields)
+
+    def get_aggregate_query(self):
+        return self.aggregate_fields
+
+    def get_aggregate_sort_fields(self):
+        return self.aggregate_sort_fields
+
+    def set_im_levels(self, im_levels):
+        self.im_levels = im_levels
+
+    def get_im_levels(self):
+        return self.im_levels
+
 def create_data_products():
     dp_list = []
     #Sites
@@ -115,6 +138,16 @@ def create_data_products():
     dp_intensity_measures.set_query(fields=["PeakAmplitudes.IM_Value"], tables=["PeakAmplitudes"])
     dp_intensity_measures.set_metadata_query(fields=["CyberShake_Sites.CS_Short_Name", "PeakAmplitudes.Run_ID", "PeakAmplitudes.Source_ID", "PeakAmplitudes.Rupture_ID", "PeakAmplitudes.Rup_Var_ID", "Ruptures.Mag", "Ruptures.Prob", "Ruptures.Source_Name", "IM_Types.IM_Type_Value", "IM_Types.IM_Type_Component", "IM_Types.Units", "Rupture_Variations.Hypocenter_Lat", "Rupture_Variations.Hypocenter_Lon", "Rupture_Variations.Hypocenter_Depth"], tables=["CyberShake_Sites", "PeakAmplitudes", "Ruptures", "IM_Types", "Rupture_Variations"])
     dp_list.append(dp_intensity_measures)
+    #Hazard curves, computed from the IMs by the Database Wrapper
+    dp_hazard_curves = DataProducts('Hazard Curves', requires_file=False, relevant_filters=[filters.FilterDataProducts.SITES, filters.FilterDataProducts.EVENTS, filters.FilterDataProducts.IMS], help_string="Annual probability of exceeding each IM level, for each site and period.")
+    dp_hazard_curves.set_query(fields=["PeakAmplitudes.IM_Value"], tables=["PeakAmplitudes"])
+    dp_hazard_curves.set_metadata_query(fields=["CyberShake_Sites.CS_Short_Name", "PeakAmplitudes.Run_ID", "PeakAmplitudes.Source_ID", "PeakAmplitudes.Rupture_ID", "Ruptures.Prob", "IM_Types.IM_Type_Value", "IM_Types.IM_Type_Component", "IM_Types.Units"], tables=["CyberShake_Sites", "PeakAmplitudes", "Ruptures", "IM_Types"])
+    dp_list.append(dp_hazard_curves)
+    #IM statistics for each rupture, computed by the database
+    dp_im_statistics = DataProducts('IM Statistics', requires_file=False, relevant_filters=[filters.FilterDataProducts.SITES, filters.FilterDataProducts.EVENTS, filters.FilterDataProducts.IMS], help_string="Count, minimum, maximum, mean, and log-mean and log-standard deviation of the RotD50 intensity measures for each rupture.")
+    dp_im_statistics.set_metadata_query(fields=["CyberShake_Sites.CS_Short_Name", "PeakAmplitudes.Run_ID", "PeakAmplitudes.Source_ID", "PeakAmplitudes.Rupture_ID", "Ruptures.Mag", "Ruptures.Prob", "Ruptures.Source_Name", "IM_Types.IM_Type_Value", "IM_Types.IM_Type_Component", "IM_Types.Units"], tables=["CyberShake_Sites", "PeakAmplitudes", "Ruptures", "IM_Types"])
+    dp_im_statistics.set_aggregate_query(aggregates=[("count(PeakAmplitudes.IM_Value)", "Num_Rup_Vars"), ("min(PeakAmplitudes.IM_Value)", "Min_IM_Value"), ("max(PeakAmplitudes.IM_Value)", "Max_IM_Value"), ("avg(PeakAmplitudes.IM_Value)", "Mean_IM_Value"), ("avg(ln(PeakAmplitudes.IM_Value))", "Mean_Ln_IM_Value"), ("stddev_pop(ln(PeakAmplitudes.IM_Value))", "Std_Ln_IM_Value")], sort_fields={"PeakAmplitudes.IM_Value": "Mean_IM_Value"})
+    dp_list.append(dp_im_statistics)
     #Events
     dp_events = DataProducts('Event Info', requires_file=False, relevant_filters=[filters.FilterDataProducts.SITES, filters.FilterDataProducts.EVENTS], help_string="Metadata about individual events.", distinct=True)
     dp_events.set_metadata_query(fields=["Ruptures.Source_ID", "Ruptures.Rupture_ID", "Ruptures.Source_Name", "Ruptures.Mag", "Ruptures.Prob", "Ruptures.Start_Lat", "Ruptures.Start_Lon", "Ruptures.End_Lat", "Ruptures.End_Lon", "Rupture_Variations.Rup_Var_ID", "Rupture_Variations.Hypocenter_Lat", "Rupture_Variations.Hypocenter_Lon", "Rupture_Variations.Hypocenter_Depth"], tables=["Ruptures", "Rupture_Variations", "CyberShake_Site_Ruptures"])
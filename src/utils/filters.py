@@ -37,6 +37,7 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import sys
 import os
 import json
+import math
 
 from enum import IntEnum
 
@@ -277,6 +278,121 @@ class RangeFilter(Filter):
 		return super().set_value_range(min, max)
 
 
+#Shapes which a geographic site filter can describe
+class GeoShapes:
+	RADIUS = "radius"
+	BOUNDING_BOX = "bounding box"
+	POLYGON = "polygon"
+
+EARTH_RADIUS_KM = 6371.0
+
+#Class for a filter which selects sites by location.  The values are latitudes and longitudes (plus a radius for
+#RADIUS filters).  Sites are found in the local metadata mirror before the query is built, so the filter is applied
+#to the database as a list of site IDs.
+class GeoFilter(Filter):
+
+	def __init__(self, name, shape, data_product=None, help_string=""):
+		super().__init__(name, filt_type=float, data_product=data_product, help_string=help_string)
+		self.shape = shape
+		self.site_ids = None
+
+	def get_shape(self):
+		return self.shape
+
+	#Description of the values, for prompts and error messages
+	def get_value_format(self):
+		if self.shape==GeoShapes.RADIUS:
+			return "lat, lon, radius in km"
+		elif self.shape==GeoShapes.BOUNDING_BOX:
+			return "min lat, min lon, max lat, max lon"
+		else:
+			return "lat1, lon1, lat2, lon2, lat3, lon3, ... for at least 3 vertices"
+
+	def set_value(self, value):
+		print("The %s filter needs several values, specified as %s." % (self.name, self.get_value_format()))
+		return -1
+
+	def set_value_range(self, min, max):
+		return self.set_value(min)
+
+	def set_values(self, values):
+		try:
+			values = [float(v) for v in values]
+		except (ValueError, TypeError):
+			print("The %s filter values must be numbers, specified as %s." % (self.name, self.get_value_format()))
+			return -1
+		if self.shape==GeoShapes.RADIUS:
+			good_values = (len(values)==3 and values[2]>0.0)
+			points = [(values[0], values[1])] if len(values)==3 else []
+		elif self.shape==GeoShapes.BOUNDING_BOX:
+			good_values = (len(values)==4 and values[0]<=values[2] and values[1]<=values[3])
+			points = [(values[0], values[1]), (values[2], values[3])] if len(values)==4 else []
+		else:
+			good_values = (len(values)>=6 and len(values)%2==0)
+			points = [(values[i], values[i+1]) for i in range(0, len(values)-1, 2)]
+		if not good_values:
+			print("The %s filter values must be specified as %s." % (self.name, self.get_value_format()))
+			return -1
+		for (lat, lon) in points:
+			if lat<-90.0 or lat>90.0 or lon<-180.0 or lon>180.0:
+				print("The %s filter can only take latitudes [-90, 90] and longitudes [-180, 180]." % self.name)
+				return utilities.ExitCodes.VALUE_OUT_OF_RANGE
+		self.site_ids = None
+		return super().set_values(values)
+
+	#Returns (min lat, min lon, max lat, max lon) of a box which contains the shape
+	def get_bounding_box(self):
+		if self.shape==GeoShapes.RADIUS:
+			(lat, lon, radius) = self.values
+			dlat = math.degrees(radius/EARTH_RADIUS_KM)
+			cos_lat = math.cos(math.radians(min(90.0, abs(lat)+dlat)))
+			if cos_lat<1e-6:
+				#Near the poles, every longitude may be in range
+				dlon = 180.0
+			else:
+				dlon = min(180.0, dlat/cos_lat)
+			return (lat-dlat, lon-dlon, lat+dlat, lon+dlon)
+		elif self.shape==GeoShapes.BOUNDING_BOX:
+			return tuple(self.values)
+		else:
+			lats = self.values[0::2]
+			lons = self.values[1::2]
+			return (min(lats), min(lons), max(lats), max(lons))
+
+	#Returns True if the point is inside the shape
+	def contains_point(self, lat, lon):
+		if self.shape==GeoShapes.RADIUS:
+			(center_lat, center_lon, radius) = self.values
+			#Haversine distance
+			dlat = math.radians(lat-center_lat)
+			dlon = math.radians(lon-center_lon)
+			a = math.sin(dlat/2.0)**2 + math.cos(math.radians(center_lat))*math.cos(math.radians(lat))*math.sin(dlon/2.0)**2
+			return 2.0*EARTH_RADIUS_KM*math.asin(min(1.0, math.sqrt(a)))<=radius
+		elif self.shape==GeoShapes.BOUNDING_BOX:
+			(min_lat, min_lon, max_lat, max_lon) = self.values
+			return min_lat<=lat<=max_lat and min_lon<=lon<=max_lon
+		else:
+			#Ray casting, counting how many polygon edges a ray from the point crosses
+			lats = self.values[0::2]
+			lons = self.values[1::2]
+			inside = False
+			j = len(lats)-1
+			for i in range(0, len(lats)):
+				if (lats[i]>lat)!=(lats[j]>lat):
+					crossing_lon = lons[i] + (lat-lats[i])*(lons[j]-lons[i])/(lats[j]-lats[i])
+					if lon<crossing_lon:
+						inside = not inside
+				j = i
+			return inside
+
+	#Site IDs which are inside the shape, found before the query is built
+	def set_site_ids(self, site_ids):
+		self.site_ids = site_ids
+
+	def get_site_ids(self):
+		return self.site_ids
+
+
 def create_filters():
 	filters = []
 	#IM type
@@ -300,6 +416,16 @@ def create_filters():
 	#sites_filter.set_values_list(["USC", "PAS", "WNGC", "STNI"])
 	sites_filter.set_query(fields=["CyberShake_Sites.CS_Short_Name"], tables=['CyberShake_Sites'])
 	filters.append(sites_filter)
+	#Site location
+	site_radius_filter = GeoFilter('Site Radius', GeoShapes.RADIUS, data_product=FilterDataProducts.SITES, help_string="Sites within a distance of a point, specified as lat, lon, radius in km.")
+	site_radius_filter.set_query(fields=["CyberShake_Sites.CS_Site_ID"], tables=['CyberShake_Sites'])
+	filters.append(site_radius_filter)
+	site_box_filter = GeoFilter('Site Bounding Box', GeoShapes.BOUNDING_BOX, data_product=FilterDataProducts.SITES, help_string="Sites inside a latitude and longitude box, specified as min lat, min lon, max lat, max lon.")
+	site_box_filter.set_query(fields=["CyberShake_Sites.CS_Site_ID"], tables=['CyberShake_Sites'])
+	filters.append(site_box_filter)
+	site_polygon_filter = GeoFilter('Site Polygon', GeoShapes.POLYGON, data_product=FilterDataProducts.SITES, help_string="Sites inside a polygon, specified as lat, lon pairs for each vertex.")
+	site_polygon_filter.set_query(fields=["CyberShake_Sites.CS_Site_ID"], tables=['CyberShake_Sites'])
+	filters.append(site_polygon_filter)
 	#Site-Rupture dist
 	site_rup_dist_filter = RangeFilter('Site-Rupture Distance', filt_type=float, data_product=FilterDataProducts.EVENTS, help_string="Site-rupture distance, which is determined by calculating the distance between the site and each point on the rupture surface and taking the minimum.", units="km")
 	site_rup_dist_filter.set_range(min=0.0, max=200.0)
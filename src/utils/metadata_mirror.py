@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Describes the local SQLite mirror of the CyberShake metadata tables, and decides when a query can be answered from it.'''
+
+import sys
+import os
+import re
+import sqlite3
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+#Tables which are copied into the mirror, with the columns which uniquely identify a row
+MIRROR_PRIMARY_KEYS = dict()
+MIRROR_PRIMARY_KEYS['Studies'] = ['Study_ID']
+MIRROR_PRIMARY_KEYS['CyberShake_Runs'] = ['Run_ID']
+MIRROR_PRIMARY_KEYS['CyberShake_Sites'] = ['CS_Site_ID']
+MIRROR_PRIMARY_KEYS['Ruptures'] = ['ERF_ID', 'Source_ID', 'Rupture_ID']
+MIRROR_PRIMARY_KEYS['Rupture_Variations'] = ['ERF_ID', 'Rup_Var_Scenario_ID', 'Source_ID', 'Rupture_ID', 'Rup_Var_ID']
+MIRROR_PRIMARY_KEYS['CyberShake_Site_Ruptures'] = ['CS_Site_ID', 'ERF_ID', 'Source_ID', 'Rupture_ID']
+MIRROR_PRIMARY_KEYS['IM_Types'] = ['IM_Type_ID']
+
+MIRROR_TABLES = set(MIRROR_PRIMARY_KEYS.keys())
+
+#Secondary indexes, matching the joins and filters the Query Constructor generates
+MIRROR_INDEXES = dict()
+MIRROR_INDEXES['Studies'] = [['Study_Name']]
+MIRROR_INDEXES['CyberShake_Runs'] = [['Study_ID', 'Site_ID'], ['Site_ID']]
+MIRROR_INDEXES['CyberShake_Sites'] = [['CS_Short_Name']]
+MIRROR_INDEXES['Ruptures'] = [['ERF_ID', 'Mag']]
+MIRROR_INDEXES['Rupture_Variations'] = [['Source_ID', 'Rupture_ID', 'Rup_Var_ID']]
+MIRROR_INDEXES['CyberShake_Site_Ruptures'] = [['ERF_ID', 'Source_ID', 'Rupture_ID'], ['CS_Site_ID', 'Site_Rupture_Dist']]
+
+#Table in the mirror which records which studies it contains
+MIRROR_STUDIES_TABLE = 'Mirror_Studies'
+
+#R*Tree spatial index of site locations, used by the geographic site filters
+SITE_INDEX_TABLE = 'Site_Locations'
+SITE_INDEX_PADDING = 0.001
+
+study_pattern = re.compile(r'Studies\.Study_Name="([^"]+)"')
+
+def get_default_mirror_path():
+    return "%s/cs_metadata.sqlite" % (os.path.dirname(os.path.abspath(__file__)))
+
+#Returns the set of study names in the mirror, or an empty set if the mirror isn't usable
+def get_mirrored_studies(mirror_path):
+    if mirror_path is None or not os.path.exists(mirror_path):
+        return set()
+    try:
+        conn = sqlite3.connect(mirror_path)
+        cur = conn.cursor()
+        cur.execute('select Study_Name from %s' % MIRROR_STUDIES_TABLE)
+        studies = set([r[0] for r in cur.fetchall()])
+        conn.close()
+    except sqlite3.Error:
+        return set()
+    return studies
+
+#Returns the study name the query is restricted to, or None
+def get_query_study(where_string):
+    match = study_pattern.search(where_string)
+    if match is None:
+        return None
+    return match.group(1)
+
+#A query can be run against the mirror if it only uses mirrored tables and its study has been mirrored
+def can_use_mirror(mirror_path, input_dict):
+    from_tables = [t.strip() for t in input_dict['from'].split(",")]
+    for t in from_tables:
+        if t not in MIRROR_TABLES:
+            return False
+    study_name = get_query_study(input_dict['where'])
+    if study_name is None:
+        return False
+    return study_name in get_mirrored_studies(mirror_path)
+
+#Looks up the sites for a study in the mirror.  Returns (site_ids, run_ids), where site_ids maps each site name
+#which was found to its CS_Site_ID and run_ids is the sorted list of the study's runs for those sites, or None
+#if the study isn't in the mirror.
+def resolve_sites(mirror_path, study_name, site_names):
+    if study_name not in get_mirrored_studies(mirror_path):
+        return None
+    conn = sqlite3.connect(mirror_path)
+    cur = conn.cursor()
+    #Join against a temporary table of the names, rather than building a long IN-list
+    cur.execute('CREATE TEMPORARY TABLE Requested_Sites (CS_Short_Name TEXT PRIMARY KEY)')
+    cur.executemany('INSERT OR IGNORE INTO temp.Requested_Sites VALUES (?)', [(s,) for s in site_names])
+    cur.execute('select CyberShake_Sites.CS_Short_Name, CyberShake_Sites.CS_Site_ID, CyberShake_Runs.Run_ID ' \
+        'from Requested_Sites, CyberShake_Sites, CyberShake_Runs, Studies ' \
+        'where Requested_Sites.CS_Short_Name=CyberShake_Sites.CS_Short_Name and CyberShake_Runs.Site_ID=CyberShake_Sites.CS_Site_ID ' \
+        'and CyberShake_Runs.Study_ID=Studies.Study_ID and Studies.Study_Name=?', (study_name,))
+    site_ids = dict()
+    run_ids = set()
+    for (site_name, site_id, run_id) in cur.fetchall():
+        site_ids[site_name] = int(site_id)
+        run_ids.add(int(run_id))
+    conn.close()
+    return (site_ids, sorted(run_ids))
+
+#(Re)builds the spatial index of the mirrored sites.  Returns False if this SQLite doesn't support R*Trees.
+def build_site_index(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute('DROP TABLE IF EXISTS %s' % SITE_INDEX_TABLE)
+        cur.execute('CREATE VIRTUAL TABLE %s USING rtree(CS_Site_ID, Min_Lat, Max_Lat, Min_Lon, Max_Lon)' % SITE_INDEX_TABLE)
+    except sqlite3.OperationalError:
+        return False
+    cur.execute('INSERT INTO %s SELECT CS_Site_ID, CS_Site_Lat, CS_Site_Lat, CS_Site_Lon, CS_Site_Lon FROM CyberShake_Sites' % SITE_INDEX_TABLE)
+    conn.commit()
+    return True
+
+#Returns [(CS_Site_ID, lat, lon)] for the study's sites inside the box, or None if the study isn't in the mirror
+def find_sites_in_box(mirror_path, study_name, bounding_box):
+    if study_name not in get_mirrored_studies(mirror_path):
+        return None
+    #R*Tree coordinates are stored in single precision, so pad the box slightly; callers check the exact shape
+    (min_lat, min_lon, max_lat, max_lon) = bounding_box
+    (min_lat, min_lon, max_lat, max_lon) = (min_lat-SITE_INDEX_PADDING, min_lon-SITE_INDEX_PADDING, max_lat+SITE_INDEX_PADDING, max_lon+SITE_INDEX_PADDING)
+    conn = sqlite3.connect(mirror_path)
+    cur = conn.cursor()
+    cur.execute("select name from sqlite_master where name=?", (SITE_INDEX_TABLE,))
+    if cur.fetchone() is not None:
+        #Only the sites the R*Tree finds in the box are joined against the runs
+        box_query = 'select CyberShake_Sites.CS_Site_ID, CyberShake_Sites.CS_Site_Lat, CyberShake_Sites.CS_Site_Lon from %s, CyberShake_Sites ' \
+            'where %s.Min_Lat>=? and %s.Max_Lat<=? and %s.Min_Lon>=? and %s.Max_Lon<=? and CyberShake_Sites.CS_Site_ID=%s.CS_Site_ID' \
+            % (SITE_INDEX_TABLE, SITE_INDEX_TABLE, SITE_INDEX_TABLE, SITE_INDEX_TABLE, SITE_INDEX_TABLE, SITE_INDEX_TABLE)
+    else:
+        #Mirrors built before the index was added
+        box_query = 'select CyberShake_Sites.CS_Site_ID, CyberShake_Sites.CS_Site_Lat, CyberShake_Sites.CS_Site_Lon from CyberShake_Sites ' \
+            'where CyberShake_Sites.CS_Site_Lat>=? and CyberShake_Sites.CS_Site_Lat<=? and CyberShake_Sites.CS_Site_Lon>=? and CyberShake_Sites.CS_Site_Lon<=?'
+    cur.execute('select distinct Box_Sites.* from (%s) as Box_Sites, CyberShake_Runs, Studies ' \
+        'where CyberShake_Runs.Site_ID=Box_Sites.CS_Site_ID and CyberShake_Runs.Study_ID=Studies.Study_ID and Studies.Study_Name=?' % box_query, \
+        (min_lat, max_lat, min_lon, max_lon, study_name))
+    sites = [(int(r[0]), float(r[1]), float(r[2])) for r in cur.fetchall()]
+    conn.close()
+    return sites
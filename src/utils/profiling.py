@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Profiles a pipeline stage, writing CPU or memory reports so slow requests can be diagnosed without adding prints.'''
+
+import sys
+import os
+import re
+import cProfile
+import pstats
+import tracemalloc
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+PROFILE_MODES = ['cpu', 'mem']
+
+#Number of functions or source lines listed in the text reports
+REPORT_TOP_N = 40
+#Number of frames recorded for each allocation
+TRACEMALLOC_FRAMES = 25
+#Call paths deeper than this, or with less time than this in seconds, are left out of the collapsed stacks
+COLLAPSED_MAX_DEPTH = 100
+COLLAPSED_MIN_TIME = 1e-6
+
+#Builtin methods which read or write files, as they're named by cProfile
+FILE_IO_PATTERN = re.compile(r"^<(method '(write|writelines|flush|read|readline|readlines|seek|truncate|close)' of '_io\.|built-in method (_?io\.)?open>)")
+
+#Where a request's time goes, as the functions which do each activity.  A function is a (file basename, function name)
+#pair; builtins have no file.  Activities can overlap, e.g. SQLite builds rows while they're fetched, and pymysql's
+#buffered cursors do it during execute().
+ACTIVITIES = []
+ACTIVITIES.append(("Query construction", [('query_constructor.py', 'construct_queries')]))
+ACTIVITIES.append(("Query execution", [(None, "<method 'execute' of 'sqlite3.Cursor' objects>"), ('cursors.py', 'execute')]))
+ACTIVITIES.append(("Row fetching", [(None, "<method 'fetchall' of 'sqlite3.Cursor' objects>"), (None, "<method 'fetchmany' of 'sqlite3.Cursor' objects>"), ('cursors.py', 'fetchall'), ('cursors.py', 'fetchmany')]))
+ACTIVITIES.append(("Row materialization", [('connections.py', '_read_row_from_packet'), ('cursors.py', '_conv_row')]))
+ACTIVITIES.append(("Client-side joins", [('client_join.py', 'join_rows'), ('client_join.py', 'load_dimensions')]))
+ACTIVITIES.append(("Result formatting", [('run_database_wrapper.py', 'write_rows'), ('run_database_wrapper.py', 'write_url_file')]))
+ACTIVITIES.append(("Seismogram downloads", [('run_data_collector.py', 'download_file')]))
+ACTIVITIES.append(("Seismogram extraction", [('run_data_collector.py', 'extract_rvs')]))
+
+#The profile of the stage which is currently running, so code can mark points worth a memory snapshot
+active_profiler = None
+
+#Returns the prefix for a stage's reports, e.g. <output directory>/csdata.<label>.database_wrapper
+def get_profile_prefix(output_directory, request_label, stage):
+    return "%s/csdata.%s.%s" % (output_directory, request_label, stage)
+
+def is_file_io(func):
+    return func[0]=='~' and FILE_IO_PATTERN.match(func[2]) is not None
+
+def matches_function(func, function_spec):
+    (basename, name) = function_spec
+    if basename is None:
+        return func[0]=='~' and func[2]==name
+    return os.path.basename(func[0])==basename and func[2]==name
+
+#Returns a label for a function in a pstats key, as basename:line:function
+def get_function_label(func):
+    if func[0]=='~':
+        label = func[2]
+    else:
+        label = "%s:%d:%s" % (os.path.basename(func[0]), func[1], func[2])
+    #Semicolons separate frames in the collapsed stack format
+    return label.replace(";", ",")
+
+#Returns a list of (activity, seconds), from the cumulative time of each activity's functions.
+#File I/O is split out of the activities which do it, so formatting and writing are reported separately.
+def get_activity_times(stats):
+    activity_times = []
+    file_io_time = 0.0
+    for func in stats:
+        if is_file_io(func):
+            file_io_time += stats[func][3]
+    for (activity, function_specs) in ACTIVITIES:
+        total = 0.0
+        for func in stats:
+            if not any(matches_function(func, f) for f in function_specs):
+                continue
+            total += stats[func][3]
+        #Take off the file I/O called directly from the activity
+        for func in stats:
+            if not is_file_io(func):
+                continue
+            for (caller, edge) in stats[func][4].items():
+                if any(matches_function(caller, f) for f in function_specs):
+                    total -= edge[3]
+        if total>0:
+            activity_times.append((activity, total))
+    if file_io_time>0:
+        activity_times.append(("File I/O", file_io_time))
+    return activity_times
+
+#Returns a dict of collapsed call stacks to microseconds of self time, walking the call graph down from the functions
+#with no recorded caller.  cProfile only keeps caller/callee pairs, so a function's time is split between the paths
+#leading to it in proportion to the time each caller spent in it.
+def get_collapsed_stacks(stats):
+    children = dict()
+    for func in stats:
+        for (caller, edge) in stats[func][4].items():
+            children.setdefault(caller, []).append((func, edge[3]))
+    collapsed = dict()
+    #Each entry is (function, share of its time on this path, labels of the path, functions on the path)
+    to_visit = [(func, 1.0, [get_function_label(func)], set([func])) for func in stats if len(stats[func][4])==0]
+    while len(to_visit)>0:
+        (func, share, path, on_path) = to_visit.pop()
+        (cc, nc, tt, ct, callers) = stats[func]
+        self_time = int(round(tt*share*1e6))
+        if self_time>0:
+            stack = ";".join(path)
+            collapsed[stack] = collapsed.get(stack, 0) + self_time
+        if len(path)>=COLLAPSED_MAX_DEPTH:
+            continue
+        for (child, edge_time) in children.get(func, []):
+            #Recursive calls are already counted in the outer call
+            if child in on_path:
+                continue
+            child_time = stats[child][3]
+            if child_time<=0:
+                continue
+            child_share = share*edge_time/child_time
+            if child_share*child_time<COLLAPSED_MIN_TIME:
+                continue
+            to_visit.append((child, child_share, path + [get_function_label(child)], on_path | set([child])))
+    return collapsed
+
+def write_collapsed_stacks(filename, collapsed):
+    with open(filename, 'w') as fp_out:
+        for stack in sorted(collapsed.keys()):
+            fp_out.write("%s %d\n" % (stack, collapsed[stack]))
+        fp_out.flush()
+        fp_out.close()
+
+#Returns the label for a traceback frame from tracemalloc
+def get_frame_label(frame):
+    return ("%s:%d" % (os.path.basename(frame.filename), frame.lineno)).replace(";", ",")
+
+
+#Profiles a single stage, either its CPU time with cProfile or its allocations with tracemalloc.
+#Reports are written to files starting with output_prefix when stop() is called.
+class StageProfiler:
+
+    def __init__(self, mode, output_prefix):
+        if mode not in PROFILE_MODES:
+            raise ValueError("Profile mode %s is unrecognized, must be one of %s." % (mode, ", ".join(PROFILE_MODES)))
+        self.mode = mode
+        self.output_prefix = output_prefix
+        self.profiler = None
+        self.snapshot = None
+        self.snapshot_label = None
+        self.snapshot_size = 0
+        self.started_tracemalloc = False
+
+    def get_filenames(self):
+        if self.mode=='cpu':
+            return ["%s.prof" % self.output_prefix, "%s.cpu.txt" % self.output_prefix, "%s.cpu.collapsed" % self.output_prefix]
+        return ["%s.mem.txt" % self.output_prefix, "%s.mem.collapsed" % self.output_prefix]
+
+    def start(self):
+        global active_profiler
+        output_directory = os.path.dirname(self.output_prefix)
+        if output_directory!="" and not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        if self.mode=='cpu':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self.started_tracemalloc = True
+            tracemalloc.reset_peak()
+        active_profiler = self
+
+    #Memory which is freed before the stage ends wouldn't show up in a snapshot taken at the end, so stages call this
+    #where they hold the most, and the snapshot with the most memory in use is the one reported.
+    def checkpoint(self, label):
+        if self.mode!='mem':
+            return
+        current = tracemalloc.get_traced_memory()[0]
+        if self.snapshot is not None and current<=self.snapshot_size:
+            return
+        self.snapshot = tracemalloc.take_snapshot()
+        self.snapshot_label = label
+        self.snapshot_size = current
+
+    def stop(self):
+        global active_profiler
+        active_profiler = None
+        try:
+            if self.mode=='cpu':
+                self.profiler.disable()
+                self.write_cpu_reports()
+            else:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.checkpoint("end of stage")
+                if self.started_tracemalloc==True:
+                    tracemalloc.stop()
+                self.write_memory_reports(peak)
+        except Exception as e:
+            #A failed report shouldn't fail the request
+            print("Error writing profile reports to %s, continuing." % self.output_prefix, file=sys.stderr)
+            print(e)
+            return
+        print("Profile reports were written to %s." % ", ".join(self.get_filenames()))
+
+    def write_cpu_reports(self):
+        (prof_filename, text_filename, collapsed_filename) = self.get_filenames()
+        self.profiler.dump_stats(prof_filename)
+        with open(text_filename, 'w') as fp_out:
+            stats = pstats.Stats(self.profiler, stream=fp_out)
+            fp_out.write("Time by activity (seconds):\n")
+            for (activity, seconds) in get_activity_times(stats.stats):
+                fp_out.write("\t%s: %f\n" % (activity, seconds))
+            fp_out.write("\n")
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_TOP_N)
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(REPORT_TOP_N)
+            fp_out.flush()
+            fp_out.close()
+        write_collapsed_stacks(collapsed_filename, get_collapsed_stacks(stats.stats))
+
+    def write_memory_reports(self, peak):
+        (text_filename, collapsed_filename) = self.get_filenames()
+        snapshot = self.snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>"), tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>")])
+        with open(text_filename, 'w') as fp_out:
+            fp_out.write("Peak traced memory: %.1f MB\n" % (peak/(1024.0*1024.0)))
+            fp_out.write("Largest snapshot: %.1f MB in use, at %s\n\n" % (self.snapshot_size/(1024.0*1024.0), self.snapshot_label))
+            fp_out.write("Top %d allocation sites in the snapshot:\n" % REPORT_TOP_N)
+            for stat in snapshot.statistics('lineno')[:REPORT_TOP_N]:
+                frame = stat.traceback[0]
+                fp_out.write("\t%s:%d: %.1f KB in %d blocks\n" % (frame.filename, frame.lineno, stat.size/1024.0, stat.count))
+            fp_out.flush()
+            fp_out.close()
+        collapsed = dict()
+        for stat in snapshot.statistics('traceback'):
+            #Frames run from the oldest call to the allocation
+            stack = ";".join([get_frame_label(frame) for frame in stat.traceback])
+            collapsed[stack] = collapsed.get(stack, 0) + stat.size
+        write_collapsed_stacks(collapsed_filename, collapsed)
+
+
+#Marks a point where the running stage holds a lot of memory, if it's being profiled
+def checkpoint(label):
+    if active_profiler is not None:
+        active_profiler.checkpoint(label)
+
+#Calls function with args, profiling it if mode is set, and returns what it returns.
+#Reports are written even if the function exits early.
+def run_profiled(mode, output_prefix, function, *args):
+    if mode is None:
+        return function(*args)
+    profiler = StageProfiler(mode, output_prefix)
+    profiler.start()
+    try:
+        return function(*args)
+    finally:
+        profiler.stop()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Chooses between replicas of the CyberShake database.  A config file lists replicas as comma-separated hosts (or
+SQLite db_paths); the connect latency of each is probed the first time one is needed, connections go to the fastest
+replica which is up, and a replica which fails is skipped in favor of the next one.'''
+
+import sys
+import os
+import time
+import sqlite3
+import threading
+import concurrent.futures
+
+#pymysql is only needed for MySQL replicas
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.sqlite_backend as sqlite_backend
+
+#Replicas which don't answer the probe within this many seconds are treated as down
+PROBE_TIMEOUT_SECONDS = 5
+
+#MySQL errors which mean the server or connection went away, rather than a problem with the query: can't connect,
+#server has gone away, lost connection, too many connections, server shutdown, and connection killed
+TRANSIENT_MYSQL_ERRORS = set([1040, 1053, 1927, 2002, 2003, 2006, 2013])
+
+#SQLite errors which mean the database file couldn't be read
+TRANSIENT_SQLITE_MESSAGES = ['unable to open database file', 'disk i/o error', 'database is locked']
+
+#Replica sets which have been probed, by config, so each process only probes once
+replica_sets = dict()
+replica_sets_lock = threading.Lock()
+
+
+#The config key listing the replicas, depending on the database type
+def get_replica_key(config_dict):
+    if config_dict['type'].lower()=='sqlite':
+        return 'db_path'
+    return 'host'
+
+#Returns a config dict for each replica in the config, in the order they're listed
+def get_replicas(config_dict):
+    key = get_replica_key(config_dict)
+    replicas = []
+    for value in config_dict[key].split(","):
+        replica_dict = dict(config_dict)
+        replica_dict[key] = value.strip()
+        replicas.append(replica_dict)
+    return replicas
+
+def has_replicas(config_dict):
+    return len(get_replicas(config_dict))>1
+
+def get_replica_name(replica_dict):
+    return replica_dict[get_replica_key(replica_dict)]
+
+#Opens a connection to a single replica, raising an exception if it fails
+def open_replica(replica_dict):
+    if replica_dict['type'].lower()=='mysql':
+        return pymysql.connect(host=replica_dict["host"], user=replica_dict["user"], passwd=replica_dict["password"], db=replica_dict['db'], connect_timeout=PROBE_TIMEOUT_SECONDS)
+    return sqlite_backend.open_sqlite(replica_dict)
+
+#Returns True if the exception means the replica failed, so the query may work on another one
+def is_transient_error(e):
+    if pymysql is not None and isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
+        return len(e.args)==0 or e.args[0] in TRANSIENT_MYSQL_ERRORS
+    if isinstance(e, sqlite3.OperationalError):
+        message = str(e).lower()
+        return any(m in message for m in TRANSIENT_SQLITE_MESSAGES)
+    return False
+
+#Returns the seconds taken to connect to the replica and run a trivial query, or None if it's down
+def probe_latency(replica_set, replica_dict):
+    start_time = time.time()
+    try:
+        conn = replica_set.open(replica_dict, open_replica)
+        cur = conn.cursor()
+        cur.execute('select 1')
+        cur.fetchall()
+        cur.close()
+        conn.close()
+    except Exception:
+        return None
+    return time.time() - start_time
+
+
+#The replicas for one config.  Replicas are ordered by their probed latency, and the order is rotated by the
+#config's replica_offset, so shards running at the same time can be spread over the replicas.  The set only tracks
+#the replicas' health; each caller passes its own function for opening connections.
+class ReplicaSet:
+
+    def __init__(self, config_dict):
+        self.replicas = get_replicas(config_dict)
+        self.offset = int(config_dict.get('replica_offset', 0))
+        self.latencies = None
+        self.failed = set()
+        self.active = None
+        self.lock = threading.Lock()
+
+    #Connecting to a missing SQLite file would create an empty database, rather than fail over to another replica
+    def open(self, replica_dict, connect_function):
+        if replica_dict['type'].lower()=='sqlite' and not os.path.exists(replica_dict['db_path']):
+            raise sqlite3.OperationalError("unable to open database file %s" % replica_dict['db_path'])
+        return connect_function(replica_dict)
+
+    #Probes all the replicas at once, so a replica which is down only costs one timeout
+    def probe(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.replicas)) as executor:
+            latencies = list(executor.map(lambda r: probe_latency(self, r), self.replicas))
+        self.latencies = dict()
+        for (replica_dict, latency) in zip(self.replicas, latencies):
+            self.latencies[get_replica_name(replica_dict)] = latency
+            if latency is None:
+                print("Database replica %s is unreachable." % get_replica_name(replica_dict))
+
+    #Replicas which answered the probe and haven't failed since, fastest first and rotated by the offset, followed
+    #by the rest in the order they're listed, as a last resort
+    def get_ordered_replicas(self):
+        if self.latencies is None:
+            self.probe()
+        healthy = [r for r in self.replicas if self.latencies[get_replica_name(r)] is not None and get_replica_name(r) not in self.failed]
+        healthy.sort(key=lambda r: self.latencies[get_replica_name(r)])
+        if len(healthy)>0:
+            shift = self.offset % len(healthy)
+            healthy = healthy[shift:] + healthy[:shift]
+        return healthy + [r for r in self.replicas if r not in healthy]
+
+    #Connects to the best replica which is up, using connect_function to open a connection to one replica.  Raises the
+    #last connection error if none of them are.
+    def connect(self, connect_function=open_replica):
+        with self.lock:
+            ordered_replicas = self.get_ordered_replicas()
+        last_error = None
+        for replica_dict in ordered_replicas:
+            name = get_replica_name(replica_dict)
+            try:
+                conn = self.open(replica_dict, connect_function)
+            except Exception as e:
+                print("Unable to connect to database replica %s, trying the next one." % name)
+                last_error = e
+                with self.lock:
+                    self.failed.add(name)
+                continue
+            with self.lock:
+                if self.active is None or get_replica_name(self.active)!=name:
+                    latency = self.latencies[name]
+                    if latency is None:
+                        print("Using database replica %s." % name)
+                    else:
+                        print("Using database replica %s (%.0f ms to connect)." % (name, 1000.0*latency))
+                self.active = replica_dict
+            return conn
+        raise last_error
+
+    #Marks the replica in use as failed, so the next connection goes to another one
+    def report_failure(self):
+        with self.lock:
+            if self.active is not None:
+                self.failed.add(get_replica_name(self.active))
+                self.active = None
+
+    def get_num_replicas(self):
+        return len(self.replicas)
+
+    #Returns a config dict for the replica connections would go to, without connecting
+    def get_preferred_replica(self):
+        with self.lock:
+            if self.active is not None:
+                return self.active
+            return self.get_ordered_replicas()[0]
+
+
+def get_config_key(config_dict):
+    return tuple(sorted(config_dict.items()))
+
+#Returns the ReplicaSet for the config, creating it the first time
+def get_replica_set(config_dict):
+    with replica_sets_lock:
+        key = get_config_key(config_dict)
+        if key not in replica_sets:
+            replica_sets[key] = ReplicaSet(config_dict)
+        return replica_sets[key]
+
+#Returns the config dict for the replica to use, for code which connects to the database itself.  Configs with only
+#one replica are returned unchanged.
+def get_preferred_replica(config_dict):
+    if not has_replicas(config_dict):
+        return config_dict
+    return get_replica_set(config_dict).get_preferred_replica()
+
+def report_failure(config_dict):
+    if has_replicas(config_dict):
+        get_replica_set(config_dict).report_failure()
+
+#Returns True if a query which failed with this exception should be tried again on another replica, given how many
+#times it's been retried already
+def can_retry(config_dict, e, attempt):
+    if not has_replicas(config_dict) or not is_transient_error(e):
+        return False
+    return attempt<get_replica_set(config_dict).get_num_replicas()-1
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Tracks the progress of a data request, so that an interrupted retrieval can be resumed without redoing completed work.'''
+
+import sys
+import os
+import json
+import hashlib
+import datetime
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.utilities as utilities
+
+STATE_VERSION = 1
+
+#Names of the pipeline stages, in the order they are run
+class Stages:
+
+    FILTER_GENERATOR = "filter_generator"
+    QUERY_BUILDER = "query_builder"
+    DATABASE_WRAPPER = "database_wrapper"
+    DATA_COLLECTOR = "data_collector"
+
+
+def get_state_filename(output_directory, request_label):
+    return "%s/csdata.%s.state" % (output_directory, request_label)
+
+#Returns the hex MD5 checksum of a file, reading it in chunks
+def get_file_checksum(filename, chunk_size=4*1024*1024):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fp_in:
+        while True:
+            chunk = fp_in.read(chunk_size)
+            if not chunk:
+                break
+            md5.update(chunk)
+        fp_in.close()
+    return md5.hexdigest()
+
+#Returns the hex MD5 checksum of a string, used to identify queries
+def get_string_checksum(value):
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+#Manifest of completed work for a single request label, stored in csdata.<label>.state.
+#The file is an append-only log with one JSON record per line, so recording progress is cheap even for
+#requests with thousands of files, and a run which is killed mid-write only loses its last record.
+class RequestState:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp_out = None
+        self.loaded = False
+        self.reset()
+
+    def reset(self):
+        self.stages = dict()
+        self.queries = dict()
+        self.pages = dict()
+        self.downloads = dict()
+        self.extracted = dict()
+
+    def get_filename(self):
+        return self.filename
+
+    def apply_record(self, record):
+        record_type = record['type']
+        if record_type=='stage':
+            self.stages[record['stage']] = record
+        elif record_type=='query':
+            self.queries.setdefault(record['query'], dict())[record['shard']] = record
+        elif record_type=='page':
+            self.pages[record['query']] = record
+        elif record_type=='download':
+            self.downloads[record['url']] = record
+        elif record_type=='extracted':
+            self.extracted.setdefault(record['url'], set()).update(record['rvs'])
+
+    #Reads in an existing state file.  Returns False if there isn't a usable one.
+    def load(self):
+        self.reset()
+        self.loaded = False
+        if not os.path.exists(self.filename):
+            return False
+        try:
+            with open(self.filename, 'r') as fp_in:
+                data = fp_in.readlines()
+                fp_in.close()
+        except Exception as e:
+            print("Error reading state file %s, aborting." % self.filename, file=sys.stderr)
+            print(e)
+            sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
+        for i, line in enumerate(data):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                #The last record may have been cut off if the previous run was killed
+                if i==len(data)-1:
+                    break
+                print("Error parsing line %d of state file %s, aborting." % (i+1, self.filename), file=sys.stderr)
+                sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
+            if i==0:
+                if record.get('type')!='version' or record.get('version')!=STATE_VERSION:
+                    print("State file %s was written by a different version of the tool and will be ignored." % self.filename)
+                    return False
+                continue
+            self.apply_record(record)
+        self.loaded = True
+        return True
+
+    #Returns True if the file starts with the version record this version of the tool writes
+    def has_current_version(self):
+        try:
+            with open(self.filename, 'r') as fp_in:
+                record = json.loads(fp_in.readline())
+                fp_in.close()
+        except (OSError, ValueError):
+            return False
+        return isinstance(record, dict) and record.get('type')=='version' and record.get('version')==STATE_VERSION
+
+    #Opens an existing state file to add records to.  If the last record was cut off, it's removed first, so the
+    #next record starts on its own line.
+    def open_for_append(self):
+        with open(self.filename, 'rb+') as fp_in:
+            fp_in.seek(0, os.SEEK_END)
+            size = fp_in.tell()
+            end = size
+            #Records are short, so the last newline is near the end of the file
+            while end>0:
+                start = max(0, end-4096)
+                fp_in.seek(start)
+                chunk = fp_in.read(end-start)
+                newline = chunk.rfind(b'\n')
+                if newline>=0:
+                    end = start+newline+1
+                    break
+                end = start
+            if end<size:
+                fp_in.truncate(end)
+            fp_in.close()
+        #Not even the version record was written
+        if end==0:
+            self.create()
+            return
+        self.fp_out = open(self.filename, 'a')
+
+    #Starts a new, empty state file
+    def create(self):
+        self.close()
+        self.reset()
+        self.fp_out = open(self.filename, 'w')
+        self.loaded = True
+        self.write_record({'type': 'version', 'version': STATE_VERSION})
+
+    def write_record(self, record):
+        if self.fp_out is None:
+            if not os.path.exists(self.filename):
+                self.create()
+            elif not self.loaded and not self.has_current_version():
+                #Records appended to a file from another version of the tool would never be read back
+                print("State file %s was written by a different version of the tool, starting a new one." % self.filename)
+                self.create()
+            else:
+                self.open_for_append()
+        try:
+            self.fp_out.write("%s\n" % json.dumps(record, sort_keys=True))
+            self.fp_out.flush()
+        except Exception as e:
+            print("Error writing state file %s, aborting." % self.filename, file=sys.stderr)
+            print(e)
+            sys.exit(utilities.ExitCodes.FILE_WRITING_ERROR)
+        self.apply_record(record)
+
+    def close(self):
+        if self.fp_out is not None:
+            self.fp_out.close()
+            self.fp_out = None
+
+    #Stages are recorded along with a checksum of their input, so that changing the request invalidates them
+    def mark_stage_complete(self, stage, input_checksum=None):
+        self.write_record({'type': 'stage', 'stage': stage, 'input_checksum': input_checksum, 'completed': datetime.datetime.now().isoformat(timespec='seconds')})
+
+    def is_stage_complete(self, stage, input_checksum=None):
+        if stage not in self.stages:
+            return False
+        if input_checksum is not None and self.stages[stage]['input_checksum']!=input_checksum:
+            return False
+        return True
+
+    #Queries are keyed by a checksum of the query text; shard identifies part of a query, if it was split up
+    def mark_query_complete(self, query_checksum, output_filename, num_rows, shard="all"):
+        self.write_record({'type': 'query', 'query': query_checksum, 'shard': str(shard), 'output_filename': output_filename, 'num_rows': num_rows})
+
+    def is_query_complete(self, query_checksum, shard="all"):
+        if query_checksum not in self.queries or str(shard) not in self.queries[query_checksum]:
+            return False
+        return os.path.exists(self.queries[query_checksum][str(shard)]['output_filename'])
+
+    #Paginated queries record the key of the last row of each page written, and how far into the output file it ends
+    def mark_page_complete(self, query_checksum, output_filename, last_key, num_rows, position):
+        self.write_record({'type': 'page', 'query': query_checksum, 'output_filename': output_filename, 'last_key': list(last_key), 'num_rows': num_rows, 'position': position})
+
+    #Returns the record of the last page written for the query, or None if there isn't a usable one
+    def get_last_page(self, query_checksum):
+        if query_checksum not in self.pages:
+            return None
+        if not os.path.exists(self.pages[query_checksum]['output_filename']):
+            return None
+        return self.pages[query_checksum]
+
+    def mark_file_downloaded(self, url, local_filename, size, checksum):
+        self.write_record({'type': 'download', 'url': url, 'local_filename': local_filename, 'size': size, 'checksum': checksum})
+
+    #A download only counts if the local file still matches the recorded size and checksum
+    def is_file_downloaded(self, url, local_filename):
+        if url not in self.downloads:
+            return False
+        download_record = self.downloads[url]
+        if download_record['local_filename']!=local_filename or not os.path.exists(local_filename):
+            return False
+        if os.path.getsize(local_filename)!=download_record['size']:
+            return False
+        return get_file_checksum(local_filename)==download_record['checksum']
+
+    def mark_rvs_extracted(self, url, rv_list):
+        self.write_record({'type': 'extracted', 'url': url, 'rvs': sorted(rv_list)})
+
+    def get_extracted_rvs(self, url):
+        return self.extracted.get(url, set())
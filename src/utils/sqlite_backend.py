@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Opens local SQLite copies of the CyberShake database.  In the fast mode, set with 'sqlite_mode = fast' in the
+config file, the database is opened read-only and immutable, so SQLite skips locking and change detection, with a
+large memory map and page cache, and the built-in rupture variation count DB attached.  The covering indexes the
+generated queries need are created by build_sqlite_indexes.py.'''
+
+import sys
+import os
+import sqlite3
+import threading
+import urllib.parse
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utils.metadata_mirror as metadata_mirror
+
+SQLITE_MODES = ['default', 'fast']
+
+#Defaults for the fast mode, which the config file can override with 'mmap_size_mb' and 'cache_size_mb'.
+#SQLite caps the memory map at the largest size it was compiled to support.
+DEFAULT_MMAP_SIZE_MB = 65536
+DEFAULT_CACHE_SIZE_MB = 2048
+
+#Name the built-in rupture variation count DB is attached under
+NUM_RVS_SCHEMA = 'num_rvs'
+
+#Covering indexes for the joins and filters the Query Constructor generates.  PeakAmplitudes is matched by prefix,
+#since some studies have their own table.  With IM_Value in the index, IM queries for a run never read the table itself.
+PEAK_AMPLITUDES_PREFIX = 'PeakAmplitudes'
+COVERING_INDEXES = dict(metadata_mirror.MIRROR_INDEXES)
+COVERING_INDEXES[PEAK_AMPLITUDES_PREFIX] = [['Run_ID', 'IM_Type_ID', 'Source_ID', 'Rupture_ID', 'Rup_Var_ID', 'IM_Value']]
+
+#Databases we've already warned are missing statistics, so the warning is printed once per process
+unanalyzed_paths = set()
+unanalyzed_paths_lock = threading.Lock()
+
+
+def get_sqlite_mode(config_dict):
+    return config_dict.get('sqlite_mode', 'default').strip().lower()
+
+def is_fast_mode(config_dict):
+    return config_dict['type'].lower()=='sqlite' and get_sqlite_mode(config_dict)=='fast'
+
+def get_num_rvs_db_path():
+    return '%s/num_rvs.sqlite' % (os.path.dirname(os.path.abspath(__file__)))
+
+#Returns the URI which opens the file read-only.  Immutable files are never checked for changes by other processes.
+def get_read_only_uri(db_path, immutable=True):
+    uri = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(db_path))
+    if immutable==True:
+        uri = '%s&immutable=1' % uri
+    return uri
+
+#Sets the memory map and page cache sizes, and lets SQLite use helper threads for sorting
+def tune_connection(conn, config_dict):
+    mmap_size_mb = int(config_dict.get('mmap_size_mb', DEFAULT_MMAP_SIZE_MB))
+    cache_size_mb = int(config_dict.get('cache_size_mb', DEFAULT_CACHE_SIZE_MB))
+    conn.execute('PRAGMA mmap_size=%d' % (mmap_size_mb*1024*1024))
+    #Negative cache sizes are in KiB, rather than pages
+    conn.execute('PRAGMA cache_size=%d' % (-cache_size_mb*1024))
+    conn.execute('PRAGMA threads=%d' % (os.cpu_count() or 1))
+
+#Attaches the built-in rupture variation count DB, if it's there.  Returns True if it's attached.
+def attach_num_rvs(conn):
+    num_rvs_db_path = get_num_rvs_db_path()
+    if not os.path.exists(num_rvs_db_path):
+        return False
+    conn.execute('ATTACH DATABASE ? AS %s' % NUM_RVS_SCHEMA, (get_read_only_uri(num_rvs_db_path),))
+    return True
+
+def has_num_rvs(conn):
+    return any(r[1]==NUM_RVS_SCHEMA for r in conn.execute('PRAGMA database_list').fetchall())
+
+#The query planner only knows how selective the indexes are once ANALYZE has been run
+def is_analyzed(conn):
+    res = conn.execute("select name from sqlite_master where type='table' and name='sqlite_stat1'").fetchone()
+    return res is not None
+
+def warn_if_unanalyzed(conn, db_path):
+    with unanalyzed_paths_lock:
+        if db_path in unanalyzed_paths:
+            return
+        unanalyzed_paths.add(db_path)
+    if not is_analyzed(conn):
+        print("SQLite database %s has no query planner statistics; run utils/build_sqlite_indexes.py on it to create them." % db_path)
+
+#Opens the SQLite database in the config, in the config's mode, raising an exception if it fails
+def open_sqlite(config_dict):
+    db_path = config_dict['db_path']
+    if not is_fast_mode(config_dict):
+        return sqlite3.connect(db_path)
+    conn = sqlite3.connect(get_read_only_uri(db_path), uri=True)
+    tune_connection(conn, config_dict)
+    attach_num_rvs(conn)
+    warn_if_unanalyzed(conn, db_path)
+    return conn
+
+#Returns the tables in the database which have covering indexes, with the indexes for each
+def get_covering_indexes(conn):
+    tables = [r[0] for r in conn.execute("select name from sqlite_master where type='table'").fetchall()]
+    indexes = dict()
+    for table in tables:
+        if table in COVERING_INDEXES:
+            indexes[table] = COVERING_INDEXES[table]
+        elif table.startswith(PEAK_AMPLITUDES_PREFIX):
+            indexes[table] = COVERING_INDEXES[PEAK_AMPLITUDES_PREFIX]
+    return indexes
+
+def get_index_name(table, columns):
+    return '%s_%s_idx' % (table, "_".join(columns))
@@ -96,6 +96,25 @@ def get_field_alias(field):
 	else:
 		return field
 
+#Returns the output column name for a select field, which is its alias if it has one
+def get_select_field_name(select_field):
+	if " as " in select_field:
+		return select_field.rsplit(" as ", 1)[1].strip()
+	return select_field.strip().split(".")[-1]
+
+#Result rows are tuples; this returns a dict of each column name to its position in them.
+#If two columns have the same name, the first one is used.
+def get_column_indices(column_names):
+	column_indices = dict()
+	for i, name in enumerate(column_names):
+		if name not in column_indices:
+			column_indices[name] = i
+	return column_indices
+
+#Returns the column indices for the rows a cursor returns
+def get_cursor_column_indices(cursor):
+	return get_column_indices([d[0] for d in cursor.description])
+
 def get_rv_seismogram_size(study_name):
 	components = 2
 	sizeof_float = 4
@@ -117,7 +136,10 @@ def read_config(config_file):
     with open(config_file, "r") as fp_in:
         data = fp_in.readlines()
         for line in data:
-            (key, value) = line.split("=")
+            if len(line.strip())==0:
+                continue
+            #Values may be URLs, which can contain '='
+            (key, value) = line.split("=", 1)
             config_dict[key.strip()] = value.strip()
         fp_in.close()
     return config_dict
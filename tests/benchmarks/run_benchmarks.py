@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Times the Query Builder, Database Wrapper, its output writers, and the Data Collector against synthetic CyberShake
+databases at several scales, and stores the timings as JSON so later runs can be compared against them.'''
+
+import sys
+import os
+import io
+import argparse
+import json
+import time
+import shutil
+import datetime
+import platform
+import sqlite3
+import contextlib
+import functools
+
+#Add src and tests/tools directories to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
+sys.path.append("%s/src" % path_add)
+sys.path.append("%s/tests/tools" % path_add)
+
+import utils.utilities as utilities
+import query_build.run_query_builder as run_query_builder
+import db_wrapper.run_database_wrapper as run_database_wrapper
+import data_collector.run_data_collector as run_data_collector
+import synthetic_db
+import grm_server
+
+#Arguments to the synthetic database generator for each scale
+SCALES = dict()
+SCALES['small'] = ['-ns', '4', '-nsrc', '10', '-nr', '4', '-nrv', '5']
+SCALES['medium'] = ['-ns', '20', '-nsrc', '40', '-nr', '5', '-nrv', '10']
+SCALES['large'] = ['-ns', '50', '-nsrc', '100', '-nr', '5', '-nrv', '20']
+DEFAULT_SCALES = 'small,medium'
+
+#Requests in the inputs directory which are timed, by the name in benchmark.<name>.json
+REQUESTS = ['ims', 'seismograms', 'hazard_curves', 'im_statistics', 'event_info']
+
+#Rows per page for the paginated retrieval benchmark
+PAGE_SIZE = 10000
+#Timesteps in the synthetic seismograms, kept small so the bulk files don't dominate the disk space used
+NUM_TIMESTEPS = 1000
+
+#A stage is a regression if it's this much slower than the baseline, unless both timings are too short to compare
+REGRESSION_TOLERANCE = 0.25
+MIN_COMPARE_SECONDS = 0.05
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='Benchmarks', description='Times the data access tools against synthetic CyberShake databases.')
+    parser.add_argument('-s', '--scales', dest='scales', action='store', default=DEFAULT_SCALES, help="Comma-separated list of scales to run, from %s (default: %s)." % (", ".join(SCALES.keys()), DEFAULT_SCALES))
+    parser.add_argument('-o', '--output-filename', dest='output_filename', action='store', default=None, help="Path to JSON file to write the results to (default: benchmark.<date>.json).")
+    parser.add_argument('-b', '--baseline-filename', dest='baseline_filename', action='store', default=None, help="Path to JSON results from an earlier run to compare against (optional).")
+    parser.add_argument('-n', '--num-repeats', dest='num_repeats', action='store', type=int, default=3, help="Number of times to run each stage; the fastest time is kept (default: 3).")
+    parser.add_argument('-w', '--work-directory', dest='work_directory', action='store', default='tmpdir', help="Directory for the synthetic databases and outputs, which is removed afterwards (default: tmpdir).")
+    parser.add_argument('-k', '--keep', dest='keep', action='store_true', default=False, help="Don't remove the work directory when done.")
+    parser.add_argument('-l', '--latency', dest='latency', action='store', type=float, default=0.0, help="Delay the seismogram server adds to each response, in seconds (default: 0).")
+    parser.add_argument('-bw', '--bandwidth', dest='bandwidth', action='store', type=float, default=None, help="Rate the seismogram server sends each file at, in bytes per second (default: no limit).")
+    parser.add_argument('-fr', '--failure-rate', dest='failure_rate', action='store', type=float, default=0.0, help="Fraction of seismogram downloads which are cut off partway through (default: 0).")
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help="Show the output of the tools.")
+    args = parser.parse_args(args=argv)
+    args_dict = dict()
+    args_dict['scales'] = [s.strip() for s in args.scales.split(",")]
+    for s in args_dict['scales']:
+        if s not in SCALES:
+            print("Scale %s not recognized, aborting." % s, file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    if args.num_repeats<1:
+        print("The number of repeats must be at least 1, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    if args.output_filename is None:
+        dt_tuple = datetime.datetime.now().timetuple()
+        args_dict['output_filename'] = "benchmark.%04d%02d%02d_%02d%02d%02d.json" % (dt_tuple.tm_year, dt_tuple.tm_mon, dt_tuple.tm_mday, dt_tuple.tm_hour, dt_tuple.tm_min, dt_tuple.tm_sec)
+    else:
+        args_dict['output_filename'] = args.output_filename
+    args_dict['baseline_filename'] = args.baseline_filename
+    args_dict['num_repeats'] = args.num_repeats
+    args_dict['work_directory'] = args.work_directory
+    args_dict['keep'] = args.keep
+    args_dict['debug'] = args.debug
+    args_dict['server_args'] = {'latency': args.latency, 'bandwidth': args.bandwidth, 'failure_rate': args.failure_rate, 'failure_mode': grm_server.FailureModes.TRUNCATE}
+    return args_dict
+
+#Runs function(argv) num_repeats times, returning the fastest time in seconds, or None if it failed
+def time_stage(function, argv, num_repeats, debug, before=None):
+    best = None
+    for i in range(0, num_repeats):
+        if before is not None:
+            before()
+        output = io.StringIO()
+        start = time.perf_counter()
+        try:
+            if debug==True:
+                function(argv)
+            else:
+                with contextlib.redirect_stdout(output):
+                    function(argv)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                print("%s failed with exit code %s." % (" ".join(argv), e.code), file=sys.stderr)
+                return None
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed<best:
+            best = elapsed
+    return best
+
+def count_rows(filename):
+    if filename.endswith(".sqlite"):
+        conn = sqlite3.connect(filename)
+        num_rows = conn.execute('select count(*) from CyberShake_Data').fetchone()[0]
+        conn.close()
+        return num_rows
+    with open(filename, 'r') as fp_in:
+        #Don't count the header
+        num_rows = sum(1 for line in fp_in) - 1
+        fp_in.close()
+    return num_rows
+
+def get_stage_result(seconds, filename=None):
+    result = {'seconds': seconds}
+    if seconds is not None and filename is not None and os.path.exists(filename):
+        result['rows'] = count_rows(filename)
+        result['bytes'] = os.path.getsize(filename)
+    return result
+
+def remove_file(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+def run_scale(scale, args_dict, input_directory):
+    scale_directory = os.path.join(args_dict['work_directory'], scale)
+    if os.path.exists(scale_directory):
+        shutil.rmtree(scale_directory)
+    os.makedirs(scale_directory)
+    db_filename = os.path.join(scale_directory, "synthetic.sqlite")
+    config_filename = os.path.join(scale_directory, "synthetic.cfg")
+    grm_directory = os.path.join(scale_directory, "grm")
+    print("Generating %s synthetic database." % scale)
+    generator_argv = SCALES[scale] + ['-o', db_filename, '-c', config_filename, '-g', grm_directory, '-nt', str(NUM_TIMESTEPS)]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        counts = synthetic_db.run_main(generator_argv)
+    scale_results = {'generator_arguments': SCALES[scale], 'counts': counts, 'generate_seconds': time.perf_counter()-start, 'stages': dict()}
+    #The seismogram URLs point at a local server with the bulk files
+    server = grm_server.GrmServer(grm_directory, **args_dict['server_args'])
+    server.start()
+    with open(config_filename, 'a') as fp_out:
+        fp_out.write("seismogram_server = %s\n" % server.get_url())
+        fp_out.close()
+    try:
+        run_requests(scale_directory, config_filename, input_directory, args_dict, scale_results['stages'])
+    finally:
+        server.close()
+    return scale_results
+
+def run_requests(scale_directory, config_filename, input_directory, args_dict, stages):
+    num_repeats = args_dict['num_repeats']
+    debug = args_dict['debug']
+    for request in REQUESTS:
+        print("Timing %s request." % request)
+        input_filename = os.path.join(input_directory, "benchmark.%s.json" % request)
+        query_filename = os.path.join(scale_directory, "%s.query" % request)
+        seconds = time_stage(run_query_builder.run_main, ['-i', input_filename, '-o', query_filename, '-nm'], num_repeats, debug)
+        stages["query_builder.%s" % request] = get_stage_result(seconds)
+        if seconds is None:
+            continue
+        output_filename = os.path.join(scale_directory, "%s.data" % request)
+        wrapper_argv = ['-i', query_filename, '-o', output_filename, '-c', config_filename, '-nm', '-sm', 'server']
+        seconds = time_stage(run_database_wrapper.run_main, wrapper_argv + ['-of', 'csv'], num_repeats, debug, before=functools.partial(remove_file, "%s.csv" % output_filename))
+        stages["database_wrapper.%s.csv" % request] = get_stage_result(seconds, "%s.csv" % output_filename)
+        if request=='ims':
+            seconds = time_stage(run_database_wrapper.run_main, wrapper_argv + ['-of', 'sqlite'], num_repeats, debug, before=functools.partial(remove_file, "%s.sqlite" % output_filename))
+            stages["database_wrapper.%s.sqlite" % request] = get_stage_result(seconds, "%s.sqlite" % output_filename)
+            paged_filename = os.path.join(scale_directory, "%s.paged.data" % request)
+            seconds = time_stage(run_database_wrapper.run_main, ['-i', query_filename, '-o', paged_filename, '-c', config_filename, '-nm', '-ps', str(PAGE_SIZE), '-of', 'csv'],
+                num_repeats, debug, before=functools.partial(remove_file, "%s.csv" % paged_filename))
+            stages["database_wrapper.%s.paged" % request] = get_stage_result(seconds, "%s.csv" % paged_filename)
+        if request=='seismograms' and stages["database_wrapper.%s.csv" % request]['seconds'] is not None:
+            url_filename = "%s.urls" % output_filename.rsplit(".", 1)[0]
+            collector_directory = os.path.join(scale_directory, "collected")
+            temp_directory = os.path.join(scale_directory, "collector_temp")
+            seconds = time_stage(run_data_collector.run_main, ['-i', url_filename, '-o', collector_directory, '-t', temp_directory], num_repeats, debug)
+            result = get_stage_result(seconds)
+            if seconds is not None:
+                result['files'] = len(os.listdir(collector_directory))
+            stages["data_collector.%s" % request] = result
+
+#Prints how each stage compares to the baseline.  Returns the number of regressions.
+def compare_results(results, baseline):
+    num_regressions = 0
+    print("\n%-10s %-40s %10s %10s %8s" % ("Scale", "Stage", "Baseline", "Current", "Change"))
+    for scale in results['scales']:
+        if scale not in baseline.get('scales', dict()):
+            continue
+        baseline_stages = baseline['scales'][scale]['stages']
+        for stage in sorted(results['scales'][scale]['stages'].keys()):
+            if stage not in baseline_stages:
+                continue
+            current = results['scales'][scale]['stages'][stage]['seconds']
+            previous = baseline_stages[stage]['seconds']
+            if current is None or previous is None:
+                print("%-10s %-40s %10s %10s" % (scale, stage, previous, current))
+                continue
+            change = (current-previous)/previous
+            flag = ""
+            if change>REGRESSION_TOLERANCE and max(current, previous)>=MIN_COMPARE_SECONDS:
+                flag = " REGRESSION"
+                num_regressions += 1
+            print("%-10s %-40s %10.3f %10.3f %+7.0f%%%s" % (scale, stage, previous, current, 100.0*change, flag))
+    return num_regressions
+
+def run_main(argv):
+    args_dict = parse_args(argv)
+    input_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inputs")
+    results = dict()
+    results['version'] = utilities.get_version()
+    results['created'] = datetime.datetime.now().isoformat(timespec='seconds')
+    results['python_version'] = platform.python_version()
+    results['sqlite_version'] = sqlite3.sqlite_version
+    results['platform'] = platform.platform()
+    results['num_repeats'] = args_dict['num_repeats']
+    results['server'] = args_dict['server_args']
+    results['scales'] = dict()
+    if not os.path.exists(args_dict['work_directory']):
+        os.makedirs(args_dict['work_directory'])
+    try:
+        for scale in args_dict['scales']:
+            results['scales'][scale] = run_scale(scale, args_dict, input_directory)
+    finally:
+        if args_dict['keep']==False:
+            shutil.rmtree(args_dict['work_directory'])
+    with open(args_dict['output_filename'], 'w') as fp_out:
+        fp_out.write(json.dumps(results, indent=4, sort_keys=True))
+        fp_out.write("\n")
+        fp_out.flush()
+        fp_out.close()
+    print("\n%-10s %-40s %10s %10s" % ("Scale", "Stage", "Seconds", "Rows"))
+    for scale in results['scales']:
+        for stage in sorted(results['scales'][scale]['stages'].keys()):
+            result = results['scales'][scale]['stages'][stage]
+            seconds = "failed"
+            if result['seconds'] is not None:
+                seconds = "%.3f" % result['seconds']
+            print("%-10s %-40s %10s %10s" % (scale, stage, seconds, result.get('rows', "")))
+    print("\nBenchmark results were written to %s." % args_dict['output_filename'])
+    if args_dict['baseline_filename'] is not None:
+        with open(args_dict['baseline_filename'], 'r') as fp_in:
+            baseline = json.load(fp_in)
+            fp_in.close()
+        num_regressions = compare_results(results, baseline)
+        if num_regressions>0:
+            print("\n%d stages were more than %d%% slower than the baseline." % (num_regressions, int(100*REGRESSION_TOLERANCE)))
+        return num_regressions
+    return 0
+
+if __name__=="__main__":
+    sys.exit(run_main(sys.argv[1:])>0)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Serves bulk seismogram files over HTTP in place of the Globus seismogram servers, for tests and benchmarks of the Data
+Collector.  Responses can be slowed down, capped in bandwidth, or made to fail, and Range requests are supported.'''
+
+import sys
+import os
+import argparse
+import time
+import random
+import threading
+import urllib.parse
+import http.server
+
+#Add src directory to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
+sys.path.append("%s/src" % path_add)
+
+import utils.utilities as utilities
+
+#Ways an injected failure can happen: an error status, or a connection which closes partway through the file
+class FailureModes:
+
+    ERROR = "error"
+    TRUNCATE = "truncate"
+
+
+#Size of the writes used to send files, in bytes.  With a bandwidth cap, writes are also limited to a tenth of a second's worth.
+SEND_CHUNK_SIZE = 64*1024
+
+#HTTP status for injected errors
+FAILURE_STATUS = 503
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='GRM Server', description='Serves bulk seismogram files over HTTP, with configurable latency, bandwidth and failures.')
+    parser.add_argument('-i', '--input-directory', dest='input_directory', action='store', default=None, help="Directory to serve files from, with the files in <site>/<run ID>/ subdirectories (required).")
+    parser.add_argument('-p', '--port', dest='port', action='store', type=int, default=8000, help="Port to listen on (default: 8000).")
+    parser.add_argument('-l', '--latency', dest='latency', action='store', type=float, default=0.0, help="Delay before each response, in seconds (default: 0).")
+    parser.add_argument('-bw', '--bandwidth', dest='bandwidth', action='store', type=float, default=None, help="Maximum rate each response is sent at, in bytes per second (default: no limit).")
+    parser.add_argument('-fr', '--failure-rate', dest='failure_rate', action='store', type=float, default=0.0, help="Fraction of requests which fail (default: 0).")
+    parser.add_argument('-ff', '--fail-first', dest='fail_first', action='store', type=int, default=0, help="Number of requests for each file which fail before it's served (default: 0).")
+    parser.add_argument('-fm', '--failure-mode', dest='failure_mode', action='store', default=FailureModes.ERROR, choices=[FailureModes.ERROR, FailureModes.TRUNCATE], help="How requests fail: with an error status, or by closing the connection halfway through the file (default: error).")
+    parser.add_argument('-r', '--random-seed', dest='random_seed', action='store', type=int, default=1, help="Seed for choosing which requests fail (default: 1).")
+    args = parser.parse_args(args=argv)
+    if args.input_directory is None:
+        print("Path to input directory must be provided, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+    if not os.path.isdir(args.input_directory):
+        print("Input directory %s doesn't exist, aborting." % args.input_directory, file=sys.stderr)
+        sys.exit(utilities.ExitCodes.BAD_FILE_PATH)
+    if args.failure_rate<0.0 or args.failure_rate>1.0:
+        print("The failure rate must be between 0 and 1, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    if args.bandwidth is not None and args.bandwidth<=0.0:
+        print("The bandwidth must be greater than 0, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    args_dict = dict()
+    args_dict['input_directory'] = args.input_directory
+    args_dict['port'] = args.port
+    args_dict['latency'] = args.latency
+    args_dict['bandwidth'] = args.bandwidth
+    args_dict['failure_rate'] = args.failure_rate
+    args_dict['fail_first'] = args.fail_first
+    args_dict['failure_mode'] = args.failure_mode
+    args_dict['random_seed'] = args.random_seed
+    return args_dict
+
+#Parses a Range header for a file of the given size.  Returns (start, end) with end inclusive, None if the whole file
+#should be sent, or False if the range can't be satisfied.  Only single ranges are supported.
+def parse_range(range_header, size):
+    if range_header is None or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    (start_string, end_string) = range_header[len("bytes="):].split("-", 1)
+    try:
+        if start_string.strip()=="":
+            #Suffix range, for the last N bytes
+            start = max(0, size-int(end_string))
+            end = size-1
+        else:
+            start = int(start_string)
+            end = size-1
+            if end_string.strip()!="":
+                end = min(int(end_string), size-1)
+    except ValueError:
+        return None
+    if start>=size or start>end:
+        return False
+    return (start, end)
+
+
+class GrmRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    #Returns the local path for the request, or None if it's outside the served directory
+    def get_local_path(self):
+        url_path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+        local_path = os.path.normpath(os.path.join(self.server.directory, url_path.lstrip("/")))
+        if not local_path.startswith(self.server.directory + os.sep):
+            return None
+        return local_path
+
+    def do_GET(self):
+        if self.server.latency>0.0:
+            time.sleep(self.server.latency)
+        local_path = self.get_local_path()
+        if local_path is None or not os.path.isfile(local_path):
+            self.server.record_request(self.path, self.headers.get('Range'), 404)
+            self.send_error(404)
+            return
+        fail = self.server.should_fail(local_path)
+        if fail==True and self.server.failure_mode==FailureModes.ERROR:
+            self.server.record_request(self.path, self.headers.get('Range'), FAILURE_STATUS)
+            self.send_error(FAILURE_STATUS)
+            return
+        size = os.path.getsize(local_path)
+        byte_range = parse_range(self.headers.get('Range'), size)
+        if byte_range==False:
+            self.server.record_request(self.path, self.headers.get('Range'), 416)
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if byte_range is None:
+            (start, end) = (0, size-1)
+            self.send_response(200)
+            status = 200
+        else:
+            (start, end) = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            status = 206
+        length = end-start+1
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self.server.record_request(self.path, self.headers.get('Range'), status)
+        if fail==True:
+            #Send half the data, then drop the connection
+            length = length//2
+            self.close_connection = True
+        self.send_file(local_path, start, length)
+
+    def send_file(self, local_path, start, length):
+        chunk_size = SEND_CHUNK_SIZE
+        if self.server.bandwidth is not None:
+            chunk_size = max(1, min(chunk_size, int(self.server.bandwidth/10.0)))
+        send_start = time.time()
+        sent = 0
+        with open(local_path, 'rb') as fp_in:
+            fp_in.seek(start)
+            while sent<length:
+                chunk = fp_in.read(min(chunk_size, length-sent))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    break
+                sent += len(chunk)
+                if self.server.bandwidth is not None:
+                    #Sleep until the bytes sent so far would have taken this long at the capped rate
+                    delay = sent/self.server.bandwidth - (time.time()-send_start)
+                    if delay>0.0:
+                        time.sleep(delay)
+            fp_in.close()
+
+
+#Serves the files in directory on a background thread.  Use port 0 to pick any free port.
+class GrmServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, directory, port=0, latency=0.0, bandwidth=None, failure_rate=0.0, fail_first=0, failure_mode=FailureModes.ERROR, random_seed=1):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), GrmRequestHandler)
+        self.directory = os.path.abspath(directory)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.fail_first = fail_first
+        self.failure_mode = failure_mode
+        self.rng = random.Random(random_seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.failures = dict()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+    def get_url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    #Decides whether a request for the file should fail
+    def should_fail(self, local_path):
+        with self.lock:
+            num_failures = self.failures.get(local_path, 0)
+            if num_failures<self.fail_first or (self.failure_rate>0.0 and self.rng.random()<self.failure_rate):
+                self.failures[local_path] = num_failures+1
+                return True
+            return False
+
+    def record_request(self, path, range_header, status):
+        with self.lock:
+            self.requests.append((path, range_header, status))
+
+    #Returns the list of (path, Range header, status) for the requests served so far
+    def get_requests(self):
+        with self.lock:
+            return list(self.requests)
+
+
+def run_main(argv):
+    args_dict = parse_args(argv)
+    server = GrmServer(args_dict['input_directory'], port=args_dict['port'], latency=args_dict['latency'], bandwidth=args_dict['bandwidth'],
+        failure_rate=args_dict['failure_rate'], fail_first=args_dict['fail_first'], failure_mode=args_dict['failure_mode'], random_seed=args_dict['random_seed'])
+    print("Serving %s at %s; use 'seismogram_server = %s' in the config file.  Press Ctrl-C to stop." % (args_dict['input_directory'], server.get_url(), server.get_url()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__=="__main__":
+    run_main(sys.argv[1:])
+    sys.exit(0)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+'''Builds a synthetic CyberShake database in SQLite, with the same schema as the CyberShake database, and optionally
+the matching bulk seismogram files, at a configurable scale.  Used for benchmarks and tests which can't use the live server.'''
+
+import sys
+import os
+import argparse
+import random
+import math
+import struct
+import sqlite3
+
+#Add src directory to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
+sys.path.append("%s/src" % path_add)
+
+import utils.utilities as utilities
+import utils.data_products as data_products
+import utils.models as models
+
+#Table definitions, matching the columns of the CyberShake database which the tools use
+SCHEMA = dict()
+SCHEMA['Studies'] = 'CREATE TABLE Studies (Study_ID INTEGER PRIMARY KEY, Study_Name TEXT NOT NULL, Study_Description TEXT)'
+SCHEMA['CyberShake_Sites'] = 'CREATE TABLE CyberShake_Sites (CS_Site_ID INTEGER PRIMARY KEY, CS_Site_Name TEXT, CS_Short_Name TEXT NOT NULL, ' \
+    'CS_Site_Lat REAL NOT NULL, CS_Site_Lon REAL NOT NULL, CS_Site_Type_ID INTEGER)'
+SCHEMA['CyberShake_Runs'] = 'CREATE TABLE CyberShake_Runs (Run_ID INTEGER PRIMARY KEY, Site_ID INTEGER NOT NULL, Study_ID INTEGER NOT NULL, ' \
+    'ERF_ID INTEGER NOT NULL, Rup_Var_Scenario_ID INTEGER NOT NULL, SGT_Variation_ID INTEGER, Velocity_Model_ID INTEGER, Status TEXT, ' \
+    'Target_Vs30 REAL, Model_Vs30 REAL, Z1_0 REAL, Z2_5 REAL)'
+SCHEMA['Ruptures'] = 'CREATE TABLE Ruptures (ERF_ID INTEGER NOT NULL, Source_ID INTEGER NOT NULL, Rupture_ID INTEGER NOT NULL, Source_Name TEXT, ' \
+    'Mag REAL, Prob REAL, Start_Lat REAL, Start_Lon REAL, End_Lat REAL, End_Lon REAL, PRIMARY KEY (ERF_ID, Source_ID, Rupture_ID))'
+SCHEMA['Rupture_Variations'] = 'CREATE TABLE Rupture_Variations (ERF_ID INTEGER NOT NULL, Rup_Var_Scenario_ID INTEGER NOT NULL, Source_ID INTEGER NOT NULL, ' \
+    'Rupture_ID INTEGER NOT NULL, Rup_Var_ID INTEGER NOT NULL, Rup_Var_LFN TEXT, Hypocenter_Lat REAL, Hypocenter_Lon REAL, Hypocenter_Depth REAL, ' \
+    'PRIMARY KEY (ERF_ID, Rup_Var_Scenario_ID, Source_ID, Rupture_ID, Rup_Var_ID))'
+SCHEMA['CyberShake_Site_Ruptures'] = 'CREATE TABLE CyberShake_Site_Ruptures (CS_Site_ID INTEGER NOT NULL, ERF_ID INTEGER NOT NULL, Source_ID INTEGER NOT NULL, ' \
+    'Rupture_ID INTEGER NOT NULL, Site_Rupture_Dist REAL, PRIMARY KEY (CS_Site_ID, ERF_ID, Source_ID, Rupture_ID))'
+SCHEMA['IM_Types'] = 'CREATE TABLE IM_Types (IM_Type_ID INTEGER PRIMARY KEY, IM_Type_Measure TEXT, IM_Type_Value REAL, IM_Type_Component TEXT, Units TEXT)'
+PEAK_AMPLITUDES_SCHEMA = 'CREATE TABLE %s (Run_ID INTEGER NOT NULL, Source_ID INTEGER NOT NULL, Rupture_ID INTEGER NOT NULL, Rup_Var_ID INTEGER NOT NULL, ' \
+    'IM_Type_ID INTEGER NOT NULL, IM_Value REAL, PRIMARY KEY (Run_ID, Source_ID, Rupture_ID, Rup_Var_ID, IM_Type_ID))'
+
+#Secondary indexes on the server
+INDEXES = ['CREATE INDEX Studies_Study_Name_idx ON Studies (Study_Name)',
+    'CREATE INDEX CyberShake_Sites_CS_Short_Name_idx ON CyberShake_Sites (CS_Short_Name)',
+    'CREATE INDEX CyberShake_Runs_Study_ID_Site_ID_idx ON CyberShake_Runs (Study_ID, Site_ID)',
+    'CREATE INDEX Ruptures_ERF_ID_Mag_idx ON Ruptures (ERF_ID, Mag)',
+    'CREATE INDEX CyberShake_Site_Ruptures_ERF_ID_Source_ID_Rupture_ID_idx ON CyberShake_Site_Ruptures (ERF_ID, Source_ID, Rupture_ID)']
+
+#IDs used for the synthetic study.  Source IDs start above the real ones, so the built-in rupture variation counts don't match them.
+STUDY_ID = 1
+ERF_ID = 36
+RUP_VAR_SCENARIO_ID = 8
+FIRST_RUN_ID = 1000
+SOURCE_ID_OFFSET = 1000
+
+SOURCE_NAMES = ['Elsinore', 'San Andreas', 'San Jacinto', 'Newport-Inglewood', 'Puente Hills', 'Sierra Madre', 'Whittier', 'Palos Verdes']
+
+#Sites are laid out on a grid starting here, with this spacing in degrees
+SITE_GRID_ORIGIN = (33.5, -119.0)
+SITE_GRID_SPACING = 0.05
+SITE_GRID_COLUMNS = 20
+
+#Seismogram header: version, site name, padding, source ID, rupture ID, rup var ID, dt, nt, components, max frequencies
+SEISMOGRAM_HEADER_FORMAT = '8s8s8siiifiiff'
+SEISMOGRAM_DT = 0.05
+SEISMOGRAM_COMPONENTS = 2
+
+#Number of PeakAmplitudes rows inserted at a time
+INSERT_BATCH_SIZE = 100000
+
+#Broadband studies add this to their seismogram filenames
+SEISMOGRAM_SUFFIXES = {'Study 15.12': '_bb', 'Study 22.12 BB': '_bb'}
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='Synthetic DB', description='Builds a synthetic CyberShake database in SQLite, and optionally matching bulk seismogram files.')
+    parser.add_argument('-o', '--output-filename', dest='output_filename', action='store', default=None, help="Path to output SQLite file (required).")
+    parser.add_argument('-c', '--config-filename', dest='config_filename', action='store', default=None, help="Path to write a database configuration file for the output file to (default: output filename with a .cfg extension).")
+    parser.add_argument('-m', '--model', dest='model', action='store', default='Study 22.12 LF', help="Name of the model to generate data for (default: Study 22.12 LF).")
+    parser.add_argument('-ns', '--num-sites', dest='num_sites', action='store', type=int, default=10, help="Number of sites, each with one run (default: 10).")
+    parser.add_argument('-nsrc', '--num-sources', dest='num_sources', action='store', type=int, default=20, help="Number of sources (default: 20).")
+    parser.add_argument('-nr', '--ruptures-per-source', dest='ruptures_per_source', action='store', type=int, default=5, help="Number of ruptures for each source (default: 5).")
+    parser.add_argument('-nrv', '--rvs-per-rupture', dest='rvs_per_rupture', action='store', type=int, default=10, help="Number of rupture variations for each rupture (default: 10).")
+    parser.add_argument('-ni', '--num-im-types', dest='num_im_types', action='store', type=int, default=None, help="Number of IM types stored for each rupture variation (default: all of the model's periods).")
+    parser.add_argument('-sr', '--site-rupture-fraction', dest='site_rupture_fraction', action='store', type=float, default=1.0, help="Fraction of the ruptures within range of each site (default: 1.0).")
+    parser.add_argument('-g', '--grm-directory', dest='grm_directory', action='store', default=None, help="Directory to write bulk seismogram files to, in <site>/<run ID>/ subdirectories (optional).")
+    parser.add_argument('-gs', '--grm-sites', dest='grm_sites', action='store', type=int, default=1, help="Number of sites to write bulk seismogram files for (default: 1).")
+    parser.add_argument('-nt', '--num-timesteps', dest='num_timesteps', action='store', type=int, default=None, help="Number of timesteps in each seismogram (default: the model's).")
+    parser.add_argument('-r', '--random-seed', dest='random_seed', action='store', type=int, default=1, help="Seed for the random values, so the same arguments give the same database (default: 1).")
+    args = parser.parse_args(args=argv)
+    if args.output_filename is None:
+        print("Path to output file must be provided, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+    for (name, value) in [('sites', args.num_sites), ('sources', args.num_sources), ('ruptures per source', args.ruptures_per_source), ('rupture variations per rupture', args.rvs_per_rupture)]:
+        if value<1:
+            print("The number of %s must be at least 1, aborting." % name, file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    if args.site_rupture_fraction<=0.0 or args.site_rupture_fraction>1.0:
+        print("The site rupture fraction must be greater than 0 and at most 1, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    args_dict = dict()
+    args_dict['output_filename'] = args.output_filename
+    if args.config_filename is None:
+        args_dict['config_filename'] = "%s.cfg" % args.output_filename.rsplit(".", 1)[0]
+    else:
+        args_dict['config_filename'] = args.config_filename
+    model = None
+    for m in models.create_models(data_products.create_data_products()):
+        if m.get_name()==args.model:
+            model = m
+    if model is None:
+        print("Model %s not recognized, aborting." % args.model, file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    args_dict['model'] = model
+    args_dict['num_sites'] = args.num_sites
+    args_dict['num_sources'] = args.num_sources
+    args_dict['ruptures_per_source'] = args.ruptures_per_source
+    args_dict['rvs_per_rupture'] = args.rvs_per_rupture
+    args_dict['num_im_types'] = args.num_im_types
+    args_dict['site_rupture_fraction'] = args.site_rupture_fraction
+    args_dict['grm_directory'] = args.grm_directory
+    args_dict['grm_sites'] = args.grm_sites
+    if args.num_timesteps is None:
+        args_dict['num_timesteps'] = (utilities.get_rv_seismogram_size(model.get_name())-struct.calcsize(SEISMOGRAM_HEADER_FORMAT))//(SEISMOGRAM_COMPONENTS*4)
+    else:
+        args_dict['num_timesteps'] = args.num_timesteps
+    args_dict['random_seed'] = args.random_seed
+    return args_dict
+
+def get_site_name(site_index):
+    return "S%04d" % (site_index+1)
+
+#Returns the list of (IM_Type_ID, measure, value, component, units) for the model's periods.  The RotD50 types come
+#first, since those are the ones the tools retrieve, followed by the RotD100 ones.
+def get_im_types(model):
+    im_types = []
+    for component in ['RotD50', 'RotD100']:
+        for p in model.get_periods():
+            if p=='PGA':
+                im_types.append(('PGA', None, component, 'cm per sec squared'))
+            elif p=='PGV':
+                im_types.append(('PGV', None, component, 'cm per sec'))
+            else:
+                im_types.append(('SA', float(p), component, 'cm per sec squared'))
+    return [tuple([i+1]+list(t)) for i, t in enumerate(im_types)]
+
+def create_schema(conn, peak_amplitudes_table):
+    cur = conn.cursor()
+    for table in SCHEMA:
+        cur.execute('DROP TABLE IF EXISTS %s' % table)
+        cur.execute(SCHEMA[table])
+    cur.execute('DROP TABLE IF EXISTS %s' % peak_amplitudes_table)
+    cur.execute(PEAK_AMPLITUDES_SCHEMA % peak_amplitudes_table)
+    conn.commit()
+
+#Returns the [(source ID, rupture ID)] of the ruptures, after inserting them and their rupture variations
+def populate_ruptures(cur, args_dict, rng):
+    ruptures = []
+    rupture_rows = []
+    rv_rows = []
+    for s in range(0, args_dict['num_sources']):
+        source_id = SOURCE_ID_OFFSET + s
+        source_name = "%s %d" % (SOURCE_NAMES[s % len(SOURCE_NAMES)], s)
+        (start_lat, start_lon) = (SITE_GRID_ORIGIN[0] + rng.uniform(-1.0, 2.0), SITE_GRID_ORIGIN[1] + rng.uniform(-1.0, 2.0))
+        for r in range(0, args_dict['ruptures_per_source']):
+            mag = round(6.0 + 0.1*r + rng.uniform(0.0, 0.05), 2)
+            (end_lat, end_lon) = (start_lat + 0.2*(r+1), start_lon + 0.1*(r+1))
+            rupture_rows.append((ERF_ID, source_id, r, source_name, mag, 10.0**(-4.0-0.5*r), start_lat, start_lon, end_lat, end_lon))
+            ruptures.append((source_id, r))
+            for rv in range(0, args_dict['rvs_per_rupture']):
+                fraction = (rv+0.5)/args_dict['rvs_per_rupture']
+                rv_rows.append((ERF_ID, RUP_VAR_SCENARIO_ID, source_id, r, rv, "e%d_rv%d_%d_%d.txt" % (ERF_ID, RUP_VAR_SCENARIO_ID, source_id, r),
+                    start_lat + fraction*(end_lat-start_lat), start_lon + fraction*(end_lon-start_lon), rng.uniform(5.0, 15.0)))
+    cur.executemany('INSERT INTO Ruptures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rupture_rows)
+    cur.executemany('INSERT INTO Rupture_Variations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rv_rows)
+    return ruptures
+
+#Returns [(site name, run ID, [(source ID, rupture ID)])] for the runs, after inserting the sites, runs and site ruptures
+def populate_sites(cur, args_dict, ruptures, rng):
+    runs = []
+    for i in range(0, args_dict['num_sites']):
+        site_id = i+1
+        run_id = FIRST_RUN_ID + i
+        site_name = get_site_name(i)
+        lat = SITE_GRID_ORIGIN[0] + SITE_GRID_SPACING*(i // SITE_GRID_COLUMNS)
+        lon = SITE_GRID_ORIGIN[1] + SITE_GRID_SPACING*(i % SITE_GRID_COLUMNS)
+        cur.execute('INSERT INTO CyberShake_Sites VALUES (?, ?, ?, ?, ?, ?)', (site_id, "Synthetic site %d" % site_id, site_name, lat, lon, 1))
+        vs30 = rng.uniform(200.0, 800.0)
+        cur.execute('INSERT INTO CyberShake_Runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (run_id, site_id, STUDY_ID, ERF_ID, RUP_VAR_SCENARIO_ID, 1, 1, 'Verified',
+            round(vs30, 1), round(vs30*rng.uniform(0.9, 1.1), 1), round(rng.uniform(100.0, 800.0), 1), round(rng.uniform(0.5, 5.0), 2)))
+        #The first rupture is always in range, so every run has results
+        site_ruptures = [rup for j, rup in enumerate(ruptures) if j==0 or rng.random()<args_dict['site_rupture_fraction']]
+        cur.executemany('INSERT INTO CyberShake_Site_Ruptures VALUES (?, ?, ?, ?, ?)', [(site_id, ERF_ID, source_id, rupture_id, round(rng.uniform(1.0, 200.0), 2)) for (source_id, rupture_id) in site_ruptures])
+        runs.append((site_name, run_id, site_ruptures))
+    return runs
+
+#Yields the PeakAmplitudes rows for the runs
+def get_peak_amplitudes(runs, im_type_ids, rvs_per_rupture, rng):
+    for (site_name, run_id, site_ruptures) in runs:
+        for (source_id, rupture_id) in site_ruptures:
+            for rv in range(0, rvs_per_rupture):
+                for im_type_id in im_type_ids:
+                    yield (run_id, source_id, rupture_id, rv, im_type_id, round(math.exp(rng.gauss(2.0, 1.0)), 4))
+
+def populate_peak_amplitudes(conn, peak_amplitudes_table, runs, im_type_ids, rvs_per_rupture, rng):
+    cur = conn.cursor()
+    insert_cmd = 'INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?)' % peak_amplitudes_table
+    num_rows = 0
+    batch = []
+    for row in get_peak_amplitudes(runs, im_type_ids, rvs_per_rupture, rng):
+        batch.append(row)
+        if len(batch)>=INSERT_BATCH_SIZE:
+            cur.executemany(insert_cmd, batch)
+            num_rows += len(batch)
+            batch = []
+    cur.executemany(insert_cmd, batch)
+    num_rows += len(batch)
+    conn.commit()
+    return num_rows
+
+#Writes a bulk seismogram file for each rupture of the first grm_sites runs, with every rupture variation in it.
+#All the seismograms share the same waveform; only the headers differ.
+def write_bulk_files(args_dict, runs):
+    model_name = args_dict['model'].get_name()
+    nt = args_dict['num_timesteps']
+    waveform = struct.pack('%df' % (SEISMOGRAM_COMPONENTS*nt), *[math.sin(0.01*i) for i in range(0, SEISMOGRAM_COMPONENTS*nt)])
+    version = model_name.split()[1].encode('utf-8')
+    suffix = SEISMOGRAM_SUFFIXES.get(model_name, "")
+    num_files = 0
+    for (site_name, run_id, site_ruptures) in runs[:args_dict['grm_sites']]:
+        run_directory = os.path.join(args_dict['grm_directory'], site_name, str(run_id))
+        if not os.path.exists(run_directory):
+            os.makedirs(run_directory)
+        for (source_id, rupture_id) in site_ruptures:
+            filename = os.path.join(run_directory, "Seismogram_%s_%d_%d%s.grm" % (site_name, source_id, rupture_id, suffix))
+            with open(filename, 'wb') as fp_out:
+                for rv in range(0, args_dict['rvs_per_rupture']):
+                    fp_out.write(struct.pack(SEISMOGRAM_HEADER_FORMAT, version, site_name.encode('utf-8'), b'', source_id, rupture_id, rv, SEISMOGRAM_DT, nt, SEISMOGRAM_COMPONENTS, 1.0, -1.0))
+                    fp_out.write(waveform)
+                fp_out.flush()
+                fp_out.close()
+            num_files += 1
+    return num_files
+
+def write_config(config_filename, db_filename):
+    with open(config_filename, 'w') as fp_out:
+        fp_out.write("type = SQLite\n")
+        fp_out.write("db_path = %s\n" % os.path.abspath(db_filename))
+        fp_out.flush()
+        fp_out.close()
+
+#Builds the database described by args_dict.  Returns a dictionary with the number of rows in the main tables.
+def generate_db(args_dict):
+    rng = random.Random(args_dict['random_seed'])
+    model = args_dict['model']
+    peak_amplitudes_table = model.custom_table_dict.get('PeakAmplitudes', 'PeakAmplitudes')
+    if os.path.exists(args_dict['output_filename']):
+        os.remove(args_dict['output_filename'])
+    conn = sqlite3.connect(args_dict['output_filename'])
+    #The file is rebuilt from scratch if anything goes wrong, so skip the journal
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    create_schema(conn, peak_amplitudes_table)
+    cur = conn.cursor()
+    cur.execute('INSERT INTO Studies VALUES (?, ?, ?)', (STUDY_ID, model.get_name(), "Synthetic data for %s" % model.get_name()))
+    im_types = get_im_types(model)
+    cur.executemany('INSERT INTO IM_Types VALUES (?, ?, ?, ?, ?)', im_types)
+    ruptures = populate_ruptures(cur, args_dict, rng)
+    runs = populate_sites(cur, args_dict, ruptures, rng)
+    conn.commit()
+    num_im_types = args_dict['num_im_types']
+    if num_im_types is None:
+        num_im_types = len(model.get_periods())
+    im_type_ids = [t[0] for t in im_types[:num_im_types]]
+    counts = dict()
+    counts['sites'] = len(runs)
+    counts['ruptures'] = len(ruptures)
+    counts['rupture_variations'] = len(ruptures)*args_dict['rvs_per_rupture']
+    counts['site_ruptures'] = sum([len(r[2]) for r in runs])
+    counts['peak_amplitudes'] = populate_peak_amplitudes(conn, peak_amplitudes_table, runs, im_type_ids, args_dict['rvs_per_rupture'], rng)
+    for index_cmd in INDEXES:
+        cur.execute(index_cmd)
+    cur.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+    write_config(args_dict['config_filename'], args_dict['output_filename'])
+    counts['bulk_files'] = 0
+    if args_dict['grm_directory'] is not None:
+        counts['bulk_files'] = write_bulk_files(args_dict, runs)
+    return counts
+
+def run_main(argv):
+    args_dict = parse_args(argv)
+    counts = generate_db(args_dict)
+    print("Wrote %d sites, %d ruptures, %d rupture variations and %d PeakAmplitudes rows to %s." % (counts['sites'], counts['ruptures'], counts['rupture_variations'], counts['peak_amplitudes'], args_dict['output_filename']))
+    if args_dict['grm_directory'] is not None:
+        print("Wrote %d bulk seismogram files to %s." % (counts['bulk_files'], args_dict['grm_directory']))
+    print("Database configuration file is %s." % args_dict['config_filename'])
+    return counts
+
+if __name__=="__main__":
+    run_main(sys.argv[1:])
+    sys.exit(0)
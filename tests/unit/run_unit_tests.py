@@ -39,11 +39,19 @@ import unittest
 from test_query_builder import TestQueryBuilder
 from test_database_wrapper import TestDatabaseWrapper
 from test_data_collector import TestDataCollector
+from test_shard_tool import TestShardTool
+from test_request_state import TestRequestState
+from test_construct_rvs_db import TestConstructRVsDB
+from test_size_preview import TestSizePreview
 
 test_suite = unittest.TestSuite()
 test_suite.addTest(unittest.makeSuite(TestQueryBuilder))
 test_suite.addTest(unittest.makeSuite(TestDatabaseWrapper))
 test_suite.addTest(unittest.makeSuite(TestDataCollector))
+test_suite.addTest(unittest.makeSuite(TestShardTool))
+test_suite.addTest(unittest.makeSuite(TestRequestState))
+test_suite.addTest(unittest.makeSuite(TestConstructRVsDB))
+test_suite.addTest(unittest.makeSuite(TestSizePreview))
 
 print("Running unit tests...")
 rc = unittest.TextTestRunner(verbosity=2).run(test_suite)
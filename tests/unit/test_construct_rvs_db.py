@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+import os
+import sys
+import unittest
+import shutil
+import sqlite3
+
+#Add src directory to find imports 
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
+sys.path.append("%s/src" % path_add)
+sys.path.append("%s/src/utils" % path_add)
+sys.path.append("%s/tests/tools" % path_add)
+
+import utils.construct_rvs_db as construct_rvs_db
+import utils.metadata_mirror as metadata_mirror
+import utils.utilities as utilities
+import synthetic_db
+
+class TestConstructRVsDB(unittest.TestCase):
+    '''Unit tests for the rupture variation count DB and metadata mirror builder'''
+
+    synthetic_db_file = 'tmpdir/unittest.synthetic.sqlite'
+    synthetic_config_file = 'tmpdir/unittest.synthetic.cfg'
+    study_name = 'Study 22.12 LF'
+
+    @classmethod
+    def setUpClass(self):
+        if not os.path.exists('tmpdir'):
+            os.mkdir('tmpdir')
+        synthetic_db.run_main(['-o', self.synthetic_db_file, '-ns', '3', '-nsrc', '4', '-nr', '2', '-nrv', '5', '-ni', '2'])
+
+    @classmethod
+    def tearDownClass(self):
+        if os.path.exists('tmpdir'):
+            shutil.rmtree('tmpdir')
+
+    def count_rows(self, filename, table):
+        conn = sqlite3.connect(filename)
+        num_rows = conn.execute('select count(*) from %s' % table).fetchone()[0]
+        conn.close()
+        return num_rows
+
+    def testMirror(self):
+        mirror_file = 'tmpdir/unittest.cs_metadata.sqlite'
+        args_dict = {'study_names': self.study_name, 'output_filename': mirror_file, 'mirror': True}
+        config_dict = utilities.read_config(self.synthetic_config_file)
+        construct_rvs_db.generate_mirror(args_dict, config_dict)
+        #Rebuilding the mirror for the same study refreshes it, rather than adding rows
+        construct_rvs_db.generate_mirror(args_dict, config_dict)
+        self.assertEqual(set([self.study_name]), metadata_mirror.get_mirrored_studies(mirror_file), "Mirror doesn't list the mirrored study.")
+        for table in sorted(metadata_mirror.MIRROR_TABLES):
+            self.assertEqual(self.count_rows(self.synthetic_db_file, table), self.count_rows(mirror_file, table), "Mirror table %s has a different number of rows from the database." % table)
+        (site_ids, run_ids) = metadata_mirror.resolve_sites(mirror_file, self.study_name, ['S0001', 'S0003', 'NOTASITE'])
+        self.assertEqual({'S0001': 1, 'S0003': 3}, site_ids, "Sites were not looked up correctly in the mirror.")
+        self.assertEqual([synthetic_db.FIRST_RUN_ID, synthetic_db.FIRST_RUN_ID+2], run_ids, "Runs were not looked up correctly in the mirror.")
+        #The synthetic sites are in a row, 0.05 degrees apart, so the box only holds the first two
+        (lat, lon) = synthetic_db.SITE_GRID_ORIGIN
+        sites = metadata_mirror.find_sites_in_box(mirror_file, self.study_name, (lat-0.01, lon-0.01, lat+0.01, lon+0.06))
+        self.assertEqual([1, 2], sorted([s[0] for s in sites]), "Sites in the bounding box were not found correctly.")
+        conn = sqlite3.connect(mirror_file)
+        has_site_index = conn.execute("select name from sqlite_master where name=?", (metadata_mirror.SITE_INDEX_TABLE,)).fetchone() is not None
+        conn.close()
+        if has_site_index:
+            self.assertEqual(3, self.count_rows(mirror_file, metadata_mirror.SITE_INDEX_TABLE), "Spatial index doesn't have every site.")
+        self.assertIsNone(metadata_mirror.resolve_sites(mirror_file, 'Study 15.4', ['S0001']), "Sites were looked up for a study which isn't mirrored.")
+
+    def testCountsUpgrade(self):
+        counts_file = 'tmpdir/unittest.num_rvs.sqlite'
+        #Counts DBs from older versions of the tool have a plain table, without any study metadata
+        conn = sqlite3.connect(counts_file)
+        conn.execute('CREATE TABLE %s (Study_Name TEXT, Source_ID INTEGER, Rupture_ID INTEGER, Num_Rup_Vars INTEGER)' % construct_rvs_db.COUNTS_TABLE)
+        conn.executemany('INSERT INTO %s VALUES (?, ?, ?, ?)' % construct_rvs_db.COUNTS_TABLE, [('Study 15.4', 1, 0, 30), ('Study 15.4', 1, 1, 40), ('Study 15.4', 2, 0, 50)])
+        conn.commit()
+        conn.close()
+        construct_rvs_db.generate_db({'study_names': None, 'output_filename': counts_file, 'mirror': False}, None)
+        conn = sqlite3.connect(counts_file)
+        table_sql = conn.execute("select sql from sqlite_master where type='table' and name=?", (construct_rvs_db.COUNTS_TABLE,)).fetchone()[0]
+        self.assertIn('WITHOUT ROWID', table_sql.upper(), "Counts table was not converted to the indexed format.")
+        self.assertEqual([(1, 0, 30), (1, 1, 40), (2, 0, 50)], conn.execute('select Source_ID, Rupture_ID, Num_Rup_Vars from %s where Study_Name=? order by Source_ID, Rupture_ID' % construct_rvs_db.COUNTS_TABLE, ('Study 15.4',)).fetchall(), "Counts were not kept when the table was converted.")
+        self.assertEqual((3, 120), conn.execute('select Num_Ruptures, Num_Rup_Vars from %s where Study_Name=?' % construct_rvs_db.STUDY_TABLE, ('Study 15.4',)).fetchone(), "Study metadata was not filled in for the converted study.")
+        conn.close()
+        #Adding a study from the database leaves the converted study alone, and refreshing it replaces its counts
+        config_dict = utilities.read_config(self.synthetic_config_file)
+        for i in range(0, 2):
+            construct_rvs_db.generate_db({'study_names': self.study_name, 'output_filename': counts_file, 'mirror': False}, config_dict)
+        conn = sqlite3.connect(counts_file)
+        #4 sources with 2 ruptures each, and 5 rupture variations per rupture
+        num_ruptures = 4*2
+        self.assertEqual((num_ruptures, num_ruptures*5), conn.execute('select count(*), sum(Num_Rup_Vars) from %s where Study_Name=?' % construct_rvs_db.COUNTS_TABLE, (self.study_name,)).fetchone(), "Counts for the synthetic study are incorrect.")
+        self.assertEqual((num_ruptures, num_ruptures*5), conn.execute('select Num_Ruptures, Num_Rup_Vars from %s where Study_Name=?' % construct_rvs_db.STUDY_TABLE, (self.study_name,)).fetchone(), "Study metadata for the synthetic study is incorrect.")
+        self.assertEqual(3, conn.execute('select count(*) from %s where Study_Name=?' % construct_rvs_db.COUNTS_TABLE, ('Study 15.4',)).fetchone()[0], "Counts for another study were changed.")
+        conn.close()
+
+if __name__=='__main__':
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(TestConstructRVsDB)
+    rc = unittest.TextTestRunner(verbosity=2).run(test_suite)
+    sys.exit(not rc.wasSuccessful())
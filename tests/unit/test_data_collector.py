@@ -37,13 +37,17 @@ import sys
 import unittest
 import shutil
 import filecmp
+import struct
 
 #Add src directory to find imports 
 full_path = os.path.abspath(sys.argv[0])
 path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
 sys.path.append("%s/src" % path_add)
+sys.path.append("%s/tests/tools" % path_add)
 
 import data_collector.run_data_collector as run_data_collector
+import utils.utilities as utilities
+import grm_server
 
 class TestDataCollector(unittest.TestCase):
     '''Unit tests for data collector'''
@@ -79,6 +83,69 @@ class TestDataCollector(unittest.TestCase):
             test_file = os.path.join(output_dir, f)
             self.assertTrue(filecmp.cmp(ref_file, test_file), 'Reference file %s does not match test file %s.' % (ref_file, test_file))
         
+    #Builds bulk files from the reference seismograms, with an extra rupture variation ahead of each one, serves them
+    #from a local server, and writes a URL file for them
+    def setUpServer(self, label, **server_args):
+        reference_output_dir = 'outputs'
+        served_dir = os.path.join('tmpdir', label, 'served')
+        url_filename = os.path.join('tmpdir', label, 'unittest.%s.urls' % label)
+        rv_list = []
+        for f in ['Seismogram_USC_9306_12_0_144.grm', 'Seismogram_USC_9306_124_262_50.grm']:
+            (site_name, run_id, source_id, rupture_id, rv) = f.split(".")[0].split("_")[1:]
+            with open(os.path.join(reference_output_dir, f), 'rb') as fp_in:
+                seismogram = fp_in.read()
+                fp_in.close()
+            other_seismogram = seismogram[:32] + struct.pack('i', int(rv)+1) + seismogram[36:]
+            bulk_dir = os.path.join(served_dir, site_name, run_id)
+            if not os.path.exists(bulk_dir):
+                os.makedirs(bulk_dir)
+            with open(os.path.join(bulk_dir, 'Seismogram_%s_%s_%s.grm' % (site_name, source_id, rupture_id)), 'wb') as fp_out:
+                fp_out.write(other_seismogram)
+                fp_out.write(seismogram)
+                fp_out.close()
+            rv_list.append((f, '%s/%s/Seismogram_%s_%s_%s.grm %s' % (site_name, run_id, site_name, source_id, rupture_id, rv)))
+        server = grm_server.GrmServer(served_dir, **server_args)
+        server.start()
+        with open(url_filename, 'w') as fp_out:
+            for (f, url) in rv_list:
+                fp_out.write("%s/%s\n" % (server.get_url(), url))
+            fp_out.close()
+        return (server, url_filename, [f for (f, url) in rv_list])
+
+    def testDataSeismogramsRetry(self):
+        #Each file's first download is cut off halfway, so it has to be continued with a Range request
+        (server, input_file, reference_output_files) = self.setUpServer('retry', fail_first=1, failure_mode=grm_server.FailureModes.TRUNCATE)
+        output_dir = 'tmpdir/retry/test_output'
+        retry_delay = run_data_collector.DOWNLOAD_RETRY_DELAY
+        run_data_collector.DOWNLOAD_RETRY_DELAY = 0.0
+        try:
+            run_data_collector.run_main(['-i', input_file, '-o', output_dir, '-t', 'tmpdir/retry/temp'])
+        finally:
+            run_data_collector.DOWNLOAD_RETRY_DELAY = retry_delay
+            server.close()
+        for f in reference_output_files:
+            ref_file = os.path.join('outputs', f)
+            test_file = os.path.join(output_dir, f)
+            if not os.path.exists(test_file):
+                self.fail('Seismogram file %s was not created.' % f)
+            self.assertTrue(filecmp.cmp(ref_file, test_file), 'Reference file %s does not match test file %s.' % (ref_file, test_file))
+        range_requests = [r for r in server.get_requests() if r[2]==206]
+        self.assertEqual(len(range_requests), len(reference_output_files), 'Expected each interrupted download to be continued with a Range request.')
+
+    def testDataSeismogramsDownloadFailure(self):
+        #The server fails more times than the collector retries
+        (server, input_file, reference_output_files) = self.setUpServer('failure', fail_first=run_data_collector.DOWNLOAD_RETRIES+1)
+        retry_delay = run_data_collector.DOWNLOAD_RETRY_DELAY
+        run_data_collector.DOWNLOAD_RETRY_DELAY = 0.0
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                run_data_collector.run_main(['-i', input_file, '-o', 'tmpdir/failure/test_output', '-t', 'tmpdir/failure/temp'])
+        finally:
+            run_data_collector.DOWNLOAD_RETRY_DELAY = retry_delay
+            server.close()
+        self.assertEqual(cm.exception.code, utilities.ExitCodes.FILE_DOWNLOAD_ERROR)
+        self.assertEqual(len(server.get_requests()), run_data_collector.DOWNLOAD_RETRIES+1)
+
 if __name__=='__main__':
     test_suite = unittest.TestLoader().loadTestsFromTestCase(TestDataCollector)
     rc = unittest.TextTestRunner(verbosity=2).run(test_suite)
@@ -37,17 +37,61 @@ import sys
 import unittest
 import shutil
 import filecmp
+import gzip
+import json
+import sqlite3
+import csv
+import math
 
 #Add src directory to find imports 
 full_path = os.path.abspath(sys.argv[0])
 path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
 sys.path.append("%s/src" % path_add)
+sys.path.append("%s/src/utils" % path_add)
+sys.path.append("%s/tests/tools" % path_add)
 
 import db_wrapper.run_database_wrapper as run_database_wrapper
+import query_build.run_query_builder as run_query_builder
+import synthetic_db
+import db_wrapper.wide_layout as wide_layout
+import db_wrapper.partitioning as partitioning
+import db_wrapper.pagination as pagination
+import db_wrapper.external_sort as external_sort
+import db_wrapper.hazard_curves as hazard_curves
+import utils.replicas as replicas
+import utils.sqlite_backend as sqlite_backend
+import utils.construct_rvs_db as construct_rvs_db
+import utils.utilities as utilities
+import db_wrapper.im_cache as im_cache
 
 class TestDatabaseWrapper(unittest.TestCase):
     '''Unit tests for database wrapper'''
-    
+
+    synthetic_db_file = 'tmpdir/unittest.synthetic.sqlite'
+    synthetic_config_file = 'tmpdir/unittest.synthetic.cfg'
+    synthetic_requests = ['IMs', 'multi_period', 'hazard_curves', 'im_statistics']
+
+    def read_lines(self, filename):
+        with open(filename, 'r') as fp_in:
+            lines = fp_in.readlines()
+            fp_in.close()
+        return lines
+
+    def read_csv(self, filename):
+        with open(filename, 'r', newline='') as fp_in:
+            rows = list(csv.DictReader(fp_in))
+            fp_in.close()
+        return rows
+
+    #Returns {(Source_ID, Rupture_ID): (Rupture_Probability, [IM values])} for the 2 sec RotD50 IMs in the multi-period results
+    def get_rupture_ims(self):
+        ruptures = dict()
+        for row in self.read_csv('tmpdir/unittest.synthetic.multi_period.csv'):
+            if row['Period']=='2.0' and row['Component']=='RotD50':
+                rupture = ruptures.setdefault((int(row['Source_ID']), int(row['Rupture_ID'])), (float(row['Rupture_Probability']), []))
+                rupture[1].append(float(row['IM_Value']))
+        return ruptures
+
     @classmethod
     def setUpClass(self):
         if not os.path.exists("tmpdir"):
@@ -61,7 +105,13 @@ class TestDatabaseWrapper(unittest.TestCase):
         shutil.copy('inputs/unittest.Seis.query', 'tmpdir')
         shutil.copy('inputs/unittest.Seis.csv', 'tmpdir')
         shutil.copy('inputs/unittest.Seis.urls', 'tmpdir')
-        
+        #Tests which don't need the live server use a small synthetic database, with both components of each IM type
+        synthetic_db.run_main(['-o', self.synthetic_db_file, '-ns', '3', '-nsrc', '4', '-nr', '2', '-nrv', '5', '-ni', '14'])
+        for name in self.synthetic_requests:
+            shutil.copy('inputs/unittest.synthetic.%s.json' % name, 'tmpdir')
+            run_query_builder.run_main(['-i', 'tmpdir/unittest.synthetic.%s.json' % name, '-o', 'tmpdir/unittest.synthetic.%s.query' % name, '-nm'])
+            run_database_wrapper.run_main(['-i', 'tmpdir/unittest.synthetic.%s.query' % name, '-o', 'tmpdir/unittest.synthetic.%s.csv' % name, '-c', self.synthetic_config_file])
+
 
     @classmethod
     def tearDownClass(self):
@@ -101,6 +151,476 @@ class TestDatabaseWrapper(unittest.TestCase):
         self.assertTrue(filecmp.cmp(reference_output_file, test_output_file), "Test query file %s does not match reference file %s." % (test_output_file, reference_output_file))
 
 
+    def testDBIMsCompressed(self):
+        input_file = 'tmpdir/unittest.synthetic.IMs.query'
+        reference_output_file = 'tmpdir/unittest.synthetic.IMs.csv'
+        test_output_file = 'tmpdir/unittest.synthetic.IMs.output.csv.gz'
+        argv = ['-i', input_file, '-o', test_output_file, '-c', self.synthetic_config_file, '-of', 'csv.gz']
+        run_database_wrapper.run_main(argv)
+        if not os.path.exists(test_output_file):
+            self.fail("Output file %s was not created." % test_output_file)
+        #Decompressed output should match the uncompressed reference
+        with gzip.open(test_output_file, 'rb') as fp_in:
+            test_data = fp_in.read()
+            fp_in.close()
+        with open(reference_output_file, 'rb') as fp_in:
+            reference_data = fp_in.read()
+            fp_in.close()
+        self.assertEqual(reference_data, test_data, "Decompressed output file %s does not match reference file %s." % (test_output_file, reference_output_file))
+
+
+    def testDBIMsPartitioned(self):
+        input_file = 'tmpdir/unittest.synthetic.IMs.query'
+        reference_output_file = 'tmpdir/unittest.synthetic.IMs.csv'
+        test_output_file = 'tmpdir/unittest.synthetic.IMs.partitioned'
+        argv = ['-i', input_file, '-o', test_output_file, '-c', self.synthetic_config_file, '-pb', 'hash', '-npt', '4']
+        run_database_wrapper.run_main(argv)
+        manifest_file = 'tmpdir/unittest.synthetic.IMs.partitioned.manifest.json'
+        if not os.path.exists(manifest_file):
+            self.fail("Manifest file %s was not created." % manifest_file)
+        with open(manifest_file, 'r') as fp_in:
+            manifest = json.load(fp_in)
+            fp_in.close()
+        with open(reference_output_file, 'r') as fp_in:
+            reference_lines = fp_in.readlines()
+            fp_in.close()
+        #Together, the partitions should have the same rows as the reference, each with the same header
+        test_lines = []
+        for partition in manifest['partitions']:
+            with open('tmpdir/%s' % partition['filename'], 'r') as fp_in:
+                partition_lines = fp_in.readlines()
+                fp_in.close()
+            self.assertEqual(reference_lines[0], partition_lines[0], "Partition %s has a different header from reference file %s." % (partition['filename'], reference_output_file))
+            self.assertEqual(partition['num_rows'], len(partition_lines)-1, "Manifest row count for partition %s is incorrect." % partition['filename'])
+            test_lines.extend(partition_lines[1:])
+        self.assertEqual(len(reference_lines)-1, manifest['num_rows'], "Manifest total row count is incorrect.")
+        self.assertEqual(sorted(reference_lines[1:]), sorted(test_lines), "Partitioned output does not match reference file %s." % reference_output_file)
+
+
+    def testDBIMsClientJoin(self):
+        input_file = 'tmpdir/unittest.synthetic.IMs.query'
+        reference_output_file = 'tmpdir/unittest.synthetic.IMs.csv'
+        test_output_file = 'tmpdir/unittest.synthetic.IMs.client_join.csv'
+        argv = ['-i', input_file, '-o', test_output_file, '-c', self.synthetic_config_file, '-jm', 'client']
+        run_database_wrapper.run_main(argv)
+        if not os.path.exists(test_output_file):
+            self.fail("Output file %s was not created." % test_output_file)
+        #Rows may come back in a different order without the server join, but should otherwise be identical
+        with open(reference_output_file, 'r') as fp_in:
+            reference_lines = fp_in.readlines()
+            fp_in.close()
+        with open(test_output_file, 'r') as fp_in:
+            test_lines = fp_in.readlines()
+            fp_in.close()
+        self.assertEqual(reference_lines[0], test_lines[0], "Client-side join header does not match reference file %s." % reference_output_file)
+        self.assertEqual(sorted(reference_lines[1:]), sorted(test_lines[1:]), "Client-side join output does not match reference file %s." % reference_output_file)
+
+
+    def testDBIMsWide(self):
+        input_file = 'tmpdir/unittest.synthetic.IMs.query'
+        reference_output_file = 'tmpdir/unittest.synthetic.IMs.csv'
+        test_output_file = 'tmpdir/unittest.synthetic.IMs.wide.csv'
+        argv = ['-i', input_file, '-o', test_output_file, '-c', self.synthetic_config_file, '-lo', 'wide']
+        run_database_wrapper.run_main(argv)
+        #The IM type fields and units are replaced by a column for the one period requested
+        with open(reference_output_file, 'r') as fp_in:
+            reference_lines = fp_in.readlines()
+            fp_in.close()
+        reference_columns = reference_lines[0].strip().split(",")
+        im_value_index = reference_columns.index('IM_Value')
+        group_indices = [i for (i, c) in enumerate(reference_columns) if c not in ['Period', 'Component', 'IM_Value', 'Units']]
+        expected_lines = []
+        for line in reference_lines[1:]:
+            pieces = line.strip().split(",")
+            expected_lines.append("%s\n" % ",".join([pieces[i] for i in group_indices] + [pieces[im_value_index]]))
+        with open(test_output_file, 'r') as fp_in:
+            test_lines = fp_in.readlines()
+            fp_in.close()
+        expected_header = "%s\n" % ",".join([reference_columns[i] for i in group_indices] + ['SA_2s_RotD50'])
+        self.assertEqual(expected_header, test_lines[0], "Wide layout header is incorrect.")
+        self.assertEqual(sorted(expected_lines), sorted(test_lines[1:]), "Wide layout output does not match reference file %s." % reference_output_file)
+
+
+    def testPartitionNames(self):
+        #Both site names become site_LA_1 in a filename, so they need separate partitions
+        args_dict = {'output_filename': 'tmpdir/unittest.partition_names', 'output_format': 'csv', 'partition_by': 'site'}
+        writer = partitioning.PartitionedResultWriter(args_dict, ['CyberShake_Sites.CS_Short_Name', 'PeakAmplitudes.IM_Value'], run_database_wrapper.ResultWriter)
+        writer.open()
+        writer.write_rows([('LA 1', 0.5), ('LA/1', 0.25), ('LA 1', 0.125), ('LA_1_2', 0.0625)])
+        writer.close()
+        with open(writer.get_filename(), 'r') as fp_in:
+            manifest = json.load(fp_in)
+            fp_in.close()
+        partitions = dict([(p['value'], p) for p in manifest['partitions']])
+        self.assertEqual(set(['LA 1', 'LA/1', 'LA_1_2']), set(partitions.keys()), "Manifest doesn't list a partition for each site.")
+        self.assertEqual(3, len(set([p['filename'] for p in manifest['partitions']])), "Sites with the same sanitized name share a partition file.")
+        self.assertEqual(2, partitions['LA 1']['num_rows'], "Partition row count is incorrect.")
+        self.assertEqual(1, partitions['LA/1']['num_rows'], "Partition row count is incorrect.")
+        self.assertEqual(['"LA/1",0.25\n'], self.read_lines('tmpdir/%s' % partitions['LA/1']['filename'])[1:], "Partition has rows from another site.")
+
+
+    def testWideColumnNames(self):
+        conn = sqlite3.connect(':memory:')
+        cur = conn.cursor()
+        cur.execute('CREATE TABLE IM_Types (IM_Type_ID INTEGER, IM_Type_Measure TEXT, IM_Type_Value REAL, IM_Type_Component TEXT)')
+        #IM types 1 and 3 both become SA_2s_RotD50
+        cur.executemany('INSERT INTO IM_Types VALUES (?, ?, ?, ?)', [(1, 'SA', 2.0, 'RotD50'), (2, 'SA', 3.0, 'RotD50'), (3, 'SA', 2.0, 'RotD50'), (4, 'SA', 2.0, 'RotD100')])
+        im_types = wide_layout.get_im_types(cur, {'where': 'IM_Types.IM_Type_ID>0'})
+        conn.close()
+        self.assertEqual([(4, 'SA_2s_RotD100'), (1, 'SA_2s_RotD50_ID1'), (3, 'SA_2s_RotD50_ID3'), (2, 'SA_3s_RotD50')], im_types, "IM types with the same column name were not given distinct columns.")
+
+
+    def testWidePivot(self):
+        class ListWriter:
+            def __init__(self):
+                self.rows = []
+            def write_rows(self, rows):
+                self.rows.extend(rows)
+            def close(self):
+                pass
+        input_dict = {'data_product': 'Intensity Measures', 'from': 'IM_Types,PeakAmplitudes', 'select': 'PeakAmplitudes.Run_ID,PeakAmplitudes.Source_ID,PeakAmplitudes.Rupture_ID,PeakAmplitudes.Rup_Var_ID,IM_Types.IM_Type_Value,PeakAmplitudes.IM_Value'}
+        layout = wide_layout.WideLayout(input_dict, [(1, 'SA_2s_RotD50'), (5, 'SA_7p5s_RotD50')])
+        self.assertEqual(['PeakAmplitudes.Run_ID', 'PeakAmplitudes.Source_ID', 'PeakAmplitudes.Rupture_ID', 'PeakAmplitudes.Rup_Var_ID', 'SA_2s_RotD50', 'SA_7p5s_RotD50'], layout.get_columns(), "Wide layout columns are incorrect.")
+        list_writer = ListWriter()
+        writer = wide_layout.WideResultWriter(layout, list_writer)
+        #Rupture variations can be split across writes, and may be missing IMs
+        writer.write_rows([(1, 2, 3, 0, 1, 0.5), (1, 2, 3, 0, 5, 0.25), (1, 2, 3, 1, 1, 0.75)])
+        writer.write_rows([(1, 2, 3, 1, 5, 0.125), (1, 2, 3, 2, 5, 0.0625)])
+        writer.close()
+        self.assertEqual([(1, 2, 3, 0, 0.5, 0.25), (1, 2, 3, 1, 0.75, 0.125), (1, 2, 3, 2, None, 0.0625)], list_writer.rows, "Rows were not pivoted correctly.")
+        self.assertEqual('SA_7p5s_RotD50', wide_layout.get_im_type_column('SA', 7.5, 'RotD50'), "IM type column name is incorrect.")
+        self.assertEqual('PGV_RotD50', wide_layout.get_im_type_column('PGV', None, 'RotD50'), "IM type column name is incorrect.")
+
+
+    def testIncrementalIMs(self):
+        query_file = 'tmpdir/unittest.synthetic.multi_period.query'
+        reference_lines = self.read_lines('tmpdir/unittest.synthetic.multi_period.csv')
+        columns = reference_lines[0].strip().split(",")
+        component_index = columns.index('Component')
+        #The existing results have every IM for the first half of the rupture variations, and only the RotD50 IMs for
+        #the rest, so PGV (with a NULL period) is in both, and only its component tells the missing rows apart
+        half = (len(reference_lines)-1)//2
+        existing_lines = reference_lines[1:half+1] + [l for l in reference_lines[half+1:] if l.split(",")[component_index]!='"RotD100"']
+        expected_lines = sorted(set(reference_lines[1:]) - set(existing_lines))
+        self.assertTrue(len(expected_lines)>0 and len(expected_lines)<half, "Synthetic database doesn't have the expected IM types.")
+        incremental_directory = 'tmpdir/unittest_incremental'
+        os.mkdir(incremental_directory)
+        shutil.copy(query_file, '%s/csdata.existing.query' % incremental_directory)
+        with open('%s/csdata.existing.data.csv' % incremental_directory, 'w') as fp_out:
+            fp_out.write(reference_lines[0])
+            fp_out.writelines(existing_lines)
+            fp_out.close()
+        #The server anti-join, the paged anti-join and the client-side join filter should all agree
+        for (label, extra_args) in [('anti_join', []), ('paged', ['-ps', '50']), ('client_join', ['-jm', 'client'])]:
+            test_output_file = 'tmpdir/unittest.incremental.%s.csv' % label
+            argv = ['-i', query_file, '-o', test_output_file, '-c', self.synthetic_config_file, '-inc', incremental_directory] + extra_args
+            run_database_wrapper.run_main(argv)
+            test_lines = self.read_lines(test_output_file)
+            self.assertEqual(reference_lines[0], test_lines[0], "Incremental output header with %s does not match reference." % label)
+            self.assertEqual(expected_lines, sorted(test_lines[1:]), "Incremental output with %s does not contain exactly the missing results." % label)
+
+
+    def testIMCache(self):
+        query_file = 'tmpdir/unittest.synthetic.multi_period.query'
+        reference_output_file = 'tmpdir/unittest.synthetic.multi_period.csv'
+        mirror_file = 'tmpdir/unittest.imc.mirror.sqlite'
+        cache_directory = 'tmpdir/unittest_im_cache'
+        construct_rvs_db.generate_mirror({'study_names': 'Study 22.12 LF', 'output_filename': mirror_file, 'mirror': True}, utilities.read_config(self.synthetic_config_file))
+        #The first request downloads the run into the cache, and the second is answered from the cache files
+        for label in ['download', 'cached']:
+            test_output_file = 'tmpdir/unittest.imc.%s.csv' % label
+            argv = ['-i', query_file, '-o', test_output_file, '-c', self.synthetic_config_file, '-m', mirror_file, '-imc', cache_directory]
+            run_database_wrapper.run_main(argv)
+            self.assertTrue(filecmp.cmp(reference_output_file, test_output_file, shallow=False), "IM cache output file %s does not match direct output file %s." % (test_output_file, reference_output_file))
+        self.assertTrue(os.path.exists(im_cache.get_cache_filenames(cache_directory, 'Study 22.12 LF', 1000)[2]), "Run was not stored in the IM cache.")
+        #IDs which don't fit in a key are rejected, rather than colliding with another IM
+        with self.assertRaises(ValueError):
+            im_cache.pack_keys([1, 70000], [0, 0], [0, 0], [1, 1])
+
+
+    def testIMCacheSiteList(self):
+        request_file = 'tmpdir/unittest.imc_site_list.json'
+        query_file = 'tmpdir/unittest.imc_site_list.query'
+        test_output_file = 'tmpdir/unittest.imc_site_list.csv'
+        mirror_file = 'tmpdir/unittest.imc_site_list.mirror.sqlite'
+        cache_directory = 'tmpdir/unittest_im_cache_site_list'
+        construct_rvs_db.generate_mirror({'study_names': 'Study 22.12 LF', 'output_filename': mirror_file, 'mirror': True}, utilities.read_config(self.synthetic_config_file))
+        with open('inputs/unittest.synthetic.multi_period.json', 'r') as fp_in:
+            request = json.load(fp_in)
+            fp_in.close()
+        #Replace the site name filter with a site list
+        request['filters'] = [f for f in request['filters'] if f['name']!='Site Name']
+        request['site_list'] = ["S0002"]
+        with open(request_file, 'w') as fp_out:
+            json.dump(request, fp_out)
+            fp_out.close()
+        run_query_builder.run_main(['-i', request_file, '-o', query_file, '-m', mirror_file])
+        run_database_wrapper.run_main(['-i', query_file, '-o', test_output_file, '-c', self.synthetic_config_file, '-m', mirror_file, '-imc', cache_directory])
+        #Only the site list's run is downloaded into the cache
+        cached_runs = [r for r in range(1000, 1003) if os.path.exists(im_cache.get_cache_filenames(cache_directory, 'Study 22.12 LF', r)[2])]
+        self.assertEqual([1001], cached_runs, "IM cache didn't build exactly the cube for the site list's run.")
+        rows = self.read_csv(test_output_file)
+        self.assertTrue(len(rows)>0, "Site list request through the IM cache returned no results.")
+        self.assertEqual(set(['S0002']), set([r['Site_Name'] for r in rows]), "Site list request through the IM cache returned other sites.")
+
+
+    def testPageSizer(self):
+        sizer = pagination.PageSizer(10)
+        self.assertEqual(pagination.MIN_PAGE_SIZE, sizer.get_page_size(), "Page size wasn't raised to the minimum.")
+        sizer = pagination.PageSizer(100000)
+        #Fast pages grow, and slow pages shrink, by at most a factor of 2
+        sizer.update(pagination.PAGE_TARGET_SECONDS/4.0, 100000)
+        self.assertEqual(200000, sizer.get_page_size(), "Fast page didn't double the page size.")
+        sizer.update(pagination.PAGE_TARGET_SECONDS/1.25, 200000)
+        self.assertEqual(250000, sizer.get_page_size(), "Page size didn't move towards the target time.")
+        sizer.update(pagination.PAGE_TARGET_SECONDS*10.0, 250000)
+        self.assertEqual(125000, sizer.get_page_size(), "Slow page didn't halve the page size.")
+        #A short final page, or one which took no measurable time, doesn't slow the next page down
+        sizer.update(pagination.PAGE_TARGET_SECONDS*10.0, 1000)
+        self.assertEqual(125000, sizer.get_page_size(), "Short page changed the page size.")
+        sizer.update(0.0, 125000)
+        self.assertEqual(250000, sizer.get_page_size(), "Instant page didn't double the page size.")
+        for i in range(0, 5):
+            sizer.update(0.0, sizer.get_page_size())
+        self.assertEqual(pagination.MAX_PAGE_SIZE, sizer.get_page_size(), "Page size grew past the maximum.")
+        #Failed pages are retried with half as many rows, down to the minimum
+        sizer.shrink()
+        self.assertEqual(pagination.MAX_PAGE_SIZE//2, sizer.get_page_size(), "Failed page didn't halve the page size.")
+        for i in range(0, 20):
+            sizer.shrink()
+        self.assertEqual(pagination.MIN_PAGE_SIZE, sizer.get_page_size(), "Page size shrank past the minimum.")
+
+
+    def testPagedResume(self):
+        query_file = 'tmpdir/unittest.synthetic.multi_period.query'
+        reference_output_file = 'tmpdir/unittest.synthetic.multi_period.csv'
+        test_output_file = 'tmpdir/unittest.paged.csv'
+        state_file = 'tmpdir/unittest.paged.state'
+        argv = ['-i', query_file, '-o', test_output_file, '-c', self.synthetic_config_file, '-ps', '50', '-sf', state_file]
+        #Allow small pages, so the synthetic results take several pages
+        min_page_size = pagination.MIN_PAGE_SIZE
+        pagination.MIN_PAGE_SIZE = 50
+        try:
+            run_database_wrapper.run_main(argv)
+            self.assertTrue(filecmp.cmp(reference_output_file, test_output_file, shallow=False), "Paged output file %s does not match reference file %s." % (test_output_file, reference_output_file))
+            state_lines = self.read_lines(state_file)
+            page_records = [json.loads(l) for l in state_lines if json.loads(l)['type']=='page']
+            self.assertTrue(len(page_records)>1, "Results weren't retrieved in several pages.")
+            self.assertEqual(50, page_records[0]['num_rows'], "First page has the wrong number of rows.")
+            #Interrupt the retrieval partway through writing the second page: the state file only has the first page,
+            #and the output file ends with part of a row
+            first_page_index = [i for (i, l) in enumerate(state_lines) if json.loads(l)['type']=='page'][0]
+            with open(state_file, 'w') as fp_out:
+                fp_out.writelines(state_lines[:first_page_index+1])
+                fp_out.close()
+            with open(test_output_file, 'r+b') as fp_out:
+                fp_out.seek(page_records[0]['position'])
+                partial_line = fp_out.readline()
+                fp_out.seek(page_records[0]['position'] + len(partial_line)//2)
+                fp_out.truncate()
+                fp_out.close()
+            run_database_wrapper.run_main(argv + ['-r'])
+        finally:
+            pagination.MIN_PAGE_SIZE = min_page_size
+        self.assertTrue(filecmp.cmp(reference_output_file, test_output_file, shallow=False), "Resumed paged output file %s does not match reference file %s." % (test_output_file, reference_output_file))
+
+
+    def testExternalSort(self):
+        temp_directory = 'tmpdir/unittest_sort'
+        os.mkdir(temp_directory)
+        #Rows are (arrival order, sort field), with repeated keys and NULLs spread over several runs
+        keys = [5, 3, None, 8, 3, 1, 5, None, 9, 0, 3, 7, 2, 5, 6, 4, 1, 8, None, 3, 2, 7]
+        rows = [(i, k) for (i, k) in enumerate(keys)]
+        for descending in [False, True]:
+            sorter = external_sort.ExternalSorter(descending, temp_directory=temp_directory, max_rows_in_memory=4)
+            #Rows arrive in batches which don't line up with the runs
+            for i in range(0, len(rows), 3):
+                sorter.add_rows(rows[i:i+3])
+            self.assertEqual(len(rows), len(sorter), "Sorter row count is incorrect.")
+            self.assertEqual(len(rows)//4, sorter.get_num_runs(), "Rows weren't spilled into several runs.")
+            self.assertEqual(sorter.get_num_runs(), len(os.listdir(temp_directory)), "Runs weren't written to the temporary directory.")
+            sorted_rows = []
+            for batch in sorter.get_sorted_batches(batch_size=5):
+                self.assertTrue(len(batch)<=5, "Sorted batch is larger than the batch size.")
+                sorted_rows.extend(batch)
+            sorter.close()
+            self.assertEqual([], os.listdir(temp_directory), "Run files weren't removed.")
+            #NULLs sort first in ascending order and last in descending order, and equal keys stay in arrival order
+            expected_rows = [(i,) for (i, k) in sorted(rows, key=lambda r: (r[1] is not None, r[1]), reverse=descending)]
+            self.assertEqual(expected_rows, sorted_rows, "Rows weren't merged in sorted order with descending=%s." % descending)
+        #Sorting on the client and on the server gives the same results
+        query_file = 'tmpdir/unittest.sorted.query'
+        with open(query_file, 'w') as fp_out:
+            fp_out.writelines(self.read_lines('tmpdir/unittest.synthetic.multi_period.query'))
+            fp_out.write("sort = order by Ruptures.Mag desc\n")
+            fp_out.close()
+        outputs = dict()
+        for sort_mode in ['server', 'client']:
+            test_output_file = 'tmpdir/unittest.sorted.%s.csv' % sort_mode
+            run_database_wrapper.run_main(['-i', query_file, '-o', test_output_file, '-c', self.synthetic_config_file, '-sm', sort_mode, '-t', temp_directory])
+            outputs[sort_mode] = self.read_lines(test_output_file)
+        magnitude_index = outputs['client'][0].strip().split(",").index('Magnitude')
+        magnitudes = [float(l.split(",")[magnitude_index]) for l in outputs['client'][1:]]
+        self.assertEqual(sorted(magnitudes, reverse=True), magnitudes, "Client-sorted results aren't in descending order.")
+        self.assertEqual(outputs['server'][0], outputs['client'][0], "Client-sorted header doesn't match the server-sorted one.")
+        self.assertEqual(sorted(outputs['server'][1:]), sorted(outputs['client'][1:]), "Client-sorted results don't match the server-sorted ones.")
+
+
+    def testHazardCurveValues(self):
+        ruptures = self.get_rupture_ims()
+        self.assertEqual(8, len(ruptures), "Synthetic database doesn't have the expected ruptures.")
+        #A level is exceeded by a rupture with its probability times the fraction of its rupture variations above the level,
+        #and the curve is the probability that any rupture exceeds it
+        curve_rows = self.read_csv('tmpdir/unittest.synthetic.hazard_curves.csv')
+        self.assertEqual([1.0, 5.0, 10.0, 50.0], [float(r['IM_Level']) for r in curve_rows], "Hazard curve levels are incorrect.")
+        for row in curve_rows:
+            level = float(row['IM_Level'])
+            non_exceedance = 1.0
+            for (prob, values) in ruptures.values():
+                non_exceedance *= 1.0 - prob*len([v for v in values if v>level])/len(values)
+            self.assertAlmostEqual(1.0-non_exceedance, float(row['Exceedance_Probability']), delta=1e-12, msg="Exceedance probability at %s is incorrect." % row['IM_Level'])
+        #The NumPy and pure Python calculations agree, including for values exactly at a level
+        rows = []
+        for ((source_id, rupture_id), (prob, values)) in sorted(ruptures.items()):
+            rows.extend([(1000, source_id, rupture_id, prob, v) for v in values])
+        rows.append((1000, 1000, 0, ruptures[(1000, 0)][0], 5.0))
+        column_indices = {'Run_ID': 0, 'Source_ID': 1, 'Rupture_ID': 2, 'Prob': 3, 'IM_Value': 4}
+        curves = []
+        numpy_module = hazard_curves.numpy
+        try:
+            for module in [numpy_module, None]:
+                hazard_curves.numpy = module
+                calculator = hazard_curves.HazardCurveCalculator(['Run_ID'], [1.0, 5.0, 10.0, 50.0], column_indices)
+                calculator.add_rows(rows[:100])
+                calculator.add_rows(rows[100:])
+                curves.append(calculator.get_curves())
+        finally:
+            hazard_curves.numpy = numpy_module
+        self.assertEqual(curves[0][0][0], curves[1][0][0], "Curve keys don't match.")
+        for (numpy_probability, python_probability) in zip(curves[0][0][1], curves[1][0][1]):
+            self.assertAlmostEqual(numpy_probability, python_probability, delta=1e-15, msg="NumPy and pure Python hazard curves differ.")
+
+
+    def testIMStatisticsValues(self):
+        ruptures = self.get_rupture_ims()
+        statistics_rows = self.read_csv('tmpdir/unittest.synthetic.im_statistics.csv')
+        self.assertEqual(len(ruptures), len(statistics_rows), "There isn't a row of statistics for each rupture.")
+        #Sorted by mean IM value, largest first
+        means = [float(r['Mean_IM_Value']) for r in statistics_rows]
+        self.assertEqual(sorted(means, reverse=True), means, "Statistics aren't sorted by mean IM value.")
+        for row in statistics_rows:
+            (prob, values) = ruptures[(int(row['Source_ID']), int(row['Rupture_ID']))]
+            ln_values = [math.log(v) for v in values]
+            mean_ln = sum(ln_values)/len(ln_values)
+            std_ln = math.sqrt(sum([(v-mean_ln)**2 for v in ln_values])/len(ln_values))
+            self.assertEqual(len(values), int(row['Num_Rup_Vars']), "Number of rupture variations is incorrect.")
+            self.assertEqual(min(values), float(row['Min_IM_Value']), "Minimum IM value is incorrect.")
+            self.assertEqual(max(values), float(row['Max_IM_Value']), "Maximum IM value is incorrect.")
+            self.assertAlmostEqual(sum(values)/len(values), float(row['Mean_IM_Value']), delta=1e-9, msg="Mean IM value is incorrect.")
+            self.assertAlmostEqual(mean_ln, float(row['Mean_Ln_IM_Value']), delta=1e-12, msg="Mean ln IM value is incorrect.")
+            self.assertAlmostEqual(std_ln, float(row['Std_Ln_IM_Value']), delta=1e-12, msg="Population standard deviation of ln IM value is incorrect.")
+        #Without an IM filter, the statistics are still only of the RotD50 IMs
+        request_file = 'tmpdir/unittest.im_statistics.all_ims.json'
+        query_file = 'tmpdir/unittest.im_statistics.all_ims.query'
+        test_output_file = 'tmpdir/unittest.im_statistics.all_ims.csv'
+        with open('inputs/unittest.synthetic.im_statistics.json', 'r') as fp_in:
+            request = json.load(fp_in)
+            fp_in.close()
+        request['filters'] = [f for f in request['filters'] if f['name']=='Site Name']
+        with open(request_file, 'w') as fp_out:
+            json.dump(request, fp_out)
+            fp_out.close()
+        run_query_builder.run_main(['-i', request_file, '-o', query_file, '-nm'])
+        run_database_wrapper.run_main(['-i', query_file, '-o', test_output_file, '-c', self.synthetic_config_file])
+        statistics_rows = self.read_csv(test_output_file)
+        self.assertTrue(len(statistics_rows)>len(ruptures), "Statistics without an IM filter don't cover every period.")
+        self.assertEqual(set(['RotD50']), set([r['Component'] for r in statistics_rows]), "Statistics without an IM filter include other components.")
+
+
+    def testReplicaFailover(self):
+        replica_filename = 'tmpdir/unittest.replica.sqlite'
+        missing_filename = 'tmpdir/unittest.missing_replica.sqlite'
+        conn = sqlite3.connect(replica_filename)
+        conn.execute('CREATE TABLE Studies (Study_ID INTEGER, Study_Name TEXT)')
+        conn.execute("INSERT INTO Studies VALUES (1, 'Study 22.12 LF')")
+        conn.commit()
+        conn.close()
+        config_dict = {'type': 'SQLite', 'db_path': "%s, %s" % (missing_filename, replica_filename)}
+        #The missing replica is skipped, rather than created as an empty database
+        conn = run_database_wrapper.get_connection(config_dict)
+        cur = conn.cursor()
+        cur.execute('select Study_Name from Studies')
+        self.assertEqual([('Study 22.12 LF',)], cur.fetchall(), "Connection was not made to the working replica.")
+        conn.close()
+        self.assertFalse(os.path.exists(missing_filename), "Missing replica %s was created." % missing_filename)
+        self.assertEqual(replica_filename, replicas.get_preferred_replica(config_dict)['db_path'], "Working replica was not preferred.")
+        #Connections opened after the module helpers have created the replica set still get the SQLite functions
+        config_dict = {'type': 'SQLite', 'db_path': "%s, %s" % (replica_filename, missing_filename)}
+        self.assertEqual(replica_filename, replicas.get_preferred_replica(config_dict)['db_path'], "Working replica was not preferred.")
+        conn = run_database_wrapper.get_connection(config_dict)
+        cur = conn.cursor()
+        cur.execute('select stddev_pop(Study_ID) from Studies')
+        self.assertEqual(0.0, cur.fetchone()[0], "SQLite functions were not registered on the replica connection.")
+        conn.close()
+
+
+    def testReplicaOrder(self):
+        replica_filenames = ['tmpdir/unittest.replica%d.sqlite' % i for i in range(0, 3)]
+        for filename in replica_filenames:
+            sqlite3.connect(filename).close()
+        config_dict = {'type': 'SQLite', 'db_path': ", ".join(replica_filenames)}
+        #Replicas are ordered by latency, with the ones which are down last, in the order they're listed
+        replica_set = replicas.ReplicaSet(config_dict)
+        replica_set.latencies = {replica_filenames[0]: 0.3, replica_filenames[1]: None, replica_filenames[2]: 0.1}
+        self.assertEqual([replica_filenames[2], replica_filenames[0], replica_filenames[1]], [r['db_path'] for r in replica_set.get_ordered_replicas()], "Replicas were not ordered by latency.")
+        #A failed replica moves to the end, and connections fail over to the next one
+        conn = replica_set.connect()
+        conn.close()
+        self.assertEqual(replica_filenames[2], replica_set.get_preferred_replica()['db_path'], "Connection was not made to the fastest replica.")
+        replica_set.report_failure()
+        self.assertEqual([replica_filenames[0], replica_filenames[1], replica_filenames[2]], [r['db_path'] for r in replica_set.get_ordered_replicas()], "Failed replica was not moved to the end.")
+        self.assertEqual(replica_filenames[0], replica_set.get_preferred_replica()['db_path'], "Connections did not fail over to the next replica.")
+        #The offset rotates the healthy replicas, wrapping around
+        latencies = {replica_filenames[0]: 0.3, replica_filenames[1]: 0.2, replica_filenames[2]: 0.1}
+        for (offset, expected_order) in [(1, [1, 0, 2]), (2, [0, 2, 1]), (4, [1, 0, 2])]:
+            offset_dict = dict(config_dict)
+            offset_dict['replica_offset'] = offset
+            replica_set = replicas.ReplicaSet(offset_dict)
+            replica_set.latencies = latencies
+            self.assertEqual([replica_filenames[i] for i in expected_order], [r['db_path'] for r in replica_set.get_ordered_replicas()], "Replicas were not rotated by offset %d." % offset)
+
+
+    def testFastSQLite(self):
+        db_filename = 'tmpdir/unittest.fast.sqlite'
+        if os.path.exists(db_filename):
+            os.remove(db_filename)
+        conn = sqlite3.connect(db_filename)
+        conn.execute('CREATE TABLE PeakAmplitudes_Study_22_12 (Run_ID INTEGER, Source_ID INTEGER, Rupture_ID INTEGER, Rup_Var_ID INTEGER, IM_Type_ID INTEGER, IM_Value REAL)')
+        conn.execute('INSERT INTO PeakAmplitudes_Study_22_12 VALUES (1, 2, 3, 4, 5, 0.25)')
+        conn.commit()
+        indexes = sqlite_backend.get_covering_indexes(conn)
+        self.assertEqual({'PeakAmplitudes_Study_22_12': [['Run_ID', 'IM_Type_ID', 'Source_ID', 'Rupture_ID', 'Rup_Var_ID', 'IM_Value']]}, indexes, "Covering indexes were not matched to the study's PeakAmplitudes table.")
+        conn.close()
+        config_dict = {'type': 'SQLite', 'db_path': db_filename, 'sqlite_mode': 'fast'}
+        conn = run_database_wrapper.get_connection(config_dict)
+        cur = conn.cursor()
+        cur.execute('select ln(IM_Value) from PeakAmplitudes_Study_22_12')
+        self.assertAlmostEqual(-1.386294, cur.fetchone()[0], 5, "Query on the fast SQLite connection returned the wrong value.")
+        self.assertEqual(os.path.exists(sqlite_backend.get_num_rvs_db_path()), sqlite_backend.has_num_rvs(conn), "Built-in rupture variation count DB was not attached.")
+        with self.assertRaises(sqlite3.OperationalError):
+            cur.execute('INSERT INTO PeakAmplitudes_Study_22_12 VALUES (1, 2, 3, 5, 5, 0.5)')
+        conn.close()
+
+
+    def testCSVQuoting(self):
+        rows = [(1, 'Fault, North', 2.5), (2, 'The "Big" One', None)]
+        expected = '1,"Fault, North",2.5\n2,"The ""Big"" One",None\n'
+        self.assertEqual(expected, run_database_wrapper.format_csv_rows(rows), "Strings with commas or quotes were not quoted correctly.")
+        #Columns with a mix of strings and other values
+        rows = [(1, 'a'), (2, None)]
+        self.assertEqual('1,"a"\n2,None\n', run_database_wrapper.format_csv_rows(rows), "Columns with strings and NULLs were not formatted correctly.")
+
+
     def testDBSeismograms(self):
         input_file = 'tmpdir/unittest.Seis.query'
         reference_output_file = 'tmpdir/unittest.Seis.csv'
@@ -37,6 +37,7 @@ import sys
 import unittest
 import filecmp
 import shutil
+import json
 
 #Add src directory to find imports 
 full_path = os.path.abspath(sys.argv[0])
@@ -44,6 +45,10 @@ path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
 sys.path.append("%s/src" % path_add)
 
 import query_build.run_query_builder as run_query_builder
+import query_build.query_constructor as query_constructor
+import utils.filters as filters
+import utils.models as models
+import utils.data_products as data_products
 
 class TestQueryBuilder(unittest.TestCase):
     '''Unit tests for query builder'''
@@ -60,6 +65,16 @@ class TestQueryBuilder(unittest.TestCase):
         shutil.copy('inputs/unittest.IMs.query', 'tmpdir')
         shutil.copy('inputs/unittest.Seis.json', 'tmpdir')
         shutil.copy('inputs/unittest.Seis.query', 'tmpdir')
+        shutil.copy('inputs/unittest.hazard_curves.json', 'tmpdir')
+        shutil.copy('inputs/unittest.hazard_curves.query', 'tmpdir')
+        shutil.copy('inputs/unittest.im_statistics.json', 'tmpdir')
+        shutil.copy('inputs/unittest.im_statistics.query', 'tmpdir')
+        shutil.copy('inputs/unittest.top_k.json', 'tmpdir')
+        shutil.copy('inputs/unittest.top_k.query', 'tmpdir')
+        shutil.copy('inputs/unittest.multi_period.json', 'tmpdir')
+        shutil.copy('inputs/unittest.multi_period.query', 'tmpdir')
+        shutil.copy('inputs/unittest.site_list.json', 'tmpdir')
+        shutil.copy('inputs/unittest.site_list.query', 'tmpdir')
 
     @classmethod
     def tearDownClass(self):
@@ -123,6 +138,155 @@ class TestQueryBuilder(unittest.TestCase):
             self.fail("Output file %s was not created." % test_output_file)
         self.assertTrue(self.compare_query_files(reference_output_file, test_output_file), "Test query file %s does not match reference file %s." % (test_output_file, reference_output_file))
 
+    def testQueryHazardCurves(self):
+        input_file = 'tmpdir/unittest.hazard_curves.json'
+        reference_output_file = 'tmpdir/unittest.hazard_curves.query'
+        test_output_file = 'tmpdir/unittest.hazard_curves.output.query'
+        argv = ['-i', input_file, '-o', test_output_file]
+        run_query_builder.run_main(argv)
+        if not os.path.exists(test_output_file):
+            self.fail("Output file %s was not created." % test_output_file)
+        self.assertTrue(self.compare_query_files(reference_output_file, test_output_file), "Test query file %s does not match reference file %s." % (test_output_file, reference_output_file))
+        #Curves need every IM, so limiting or sorting the rows is rejected
+        with open(input_file, 'r') as fp_in:
+            json_dict = json.load(fp_in)
+            fp_in.close()
+        for (option, value) in [('limit', 10), ('top_k', {'count': 10, 'filter': 'Intensity Measure Value'})]:
+            option_input_file = 'tmpdir/unittest.hazard_curves.%s.json' % option
+            option_dict = dict(json_dict)
+            option_dict[option] = value
+            with open(option_input_file, 'w') as fp_out:
+                json.dump(option_dict, fp_out)
+                fp_out.close()
+            with self.assertRaises(SystemExit):
+                run_query_builder.run_main(['-i', option_input_file, '-o', 'tmpdir/unittest.hazard_curves.%s.query' % option])
+
+    def testQueryIMStatistics(self):
+        input_file = 'tmpdir/unittest.im_statistics.json'
+        reference_output_file = 'tmpdir/unittest.im_statistics.query'
+        test_output_file = 'tmpdir/unittest.im_statistics.output.query'
+        argv = ['-i', input_file, '-o', test_output_file]
+        run_query_builder.run_main(argv)
+        if not os.path.exists(test_output_file):
+            self.fail("Output file %s was not created." % test_output_file)
+        self.assertTrue(self.compare_query_files(reference_output_file, test_output_file), "Test query file %s does not match reference file %s." % (test_output_file, reference_output_file))
+
+    def testQueryTopKSample(self):
+        input_file = 'tmpdir/unittest.top_k.json'
+        reference_output_file = 'tmpdir/unittest.top_k.query'
+        test_output_file = 'tmpdir/unittest.top_k.output.query'
+        argv = ['-i', input_file, '-o', test_output_file]
+        run_query_builder.run_main(argv)
+        if not os.path.exists(test_output_file):
+            self.fail("Output file %s was not created." % test_output_file)
+        self.assertTrue(self.compare_query_files(reference_output_file, test_output_file), "Test query file %s does not match reference file %s." % (test_output_file, reference_output_file))
+
+    def testQueryMultiPeriod(self):
+        input_file = 'tmpdir/unittest.multi_period.json'
+        reference_output_file = 'tmpdir/unittest.multi_period.query'
+        test_output_file = 'tmpdir/unittest.multi_period.output.query'
+        argv = ['-i', input_file, '-o', test_output_file]
+        run_query_builder.run_main(argv)
+        if not os.path.exists(test_output_file):
+            self.fail("Output file %s was not created." % test_output_file)
+        self.assertTrue(self.compare_query_files(reference_output_file, test_output_file), "Test query file %s does not match reference file %s." % (test_output_file, reference_output_file))
+
+    def testQuerySiteList(self):
+        input_file = 'tmpdir/unittest.site_list.json'
+        reference_output_file = 'tmpdir/unittest.site_list.query'
+        test_output_file = 'tmpdir/unittest.site_list.output.query'
+        #Without the metadata mirror, the site list is matched on site names
+        argv = ['-i', input_file, '-o', test_output_file, '-nm']
+        run_query_builder.run_main(argv)
+        if not os.path.exists(test_output_file):
+            self.fail("Output file %s was not created." % test_output_file)
+        self.assertTrue(self.compare_query_files(reference_output_file, test_output_file), "Test query file %s does not match reference file %s." % (test_output_file, reference_output_file))
+
+    def testSiteListQuoting(self):
+        query = query_constructor.Query()
+        query_constructor.add_site_list(query, {'site_list': ['USC', "O'Neill"]})
+        self.assertEqual(set(["CyberShake_Sites.CS_Short_Name in ('USC','O''Neill')"]), query.where_clauses, "Quotes in site names were not escaped.")
+        #Backslashes can't be escaped the same way for both databases, so they're rejected
+        input_file = 'tmpdir/unittest.site_list.backslash.json'
+        with open('tmpdir/unittest.site_list.json', 'r') as fp_in:
+            json_dict = json.load(fp_in)
+            fp_in.close()
+        json_dict['site_list'] = ['USC', "PAS\\') or ('1'='1"]
+        with open(input_file, 'w') as fp_out:
+            json.dump(json_dict, fp_out)
+            fp_out.close()
+        with self.assertRaises(SystemExit):
+            run_query_builder.run_main(['-i', input_file, '-o', 'tmpdir/unittest.site_list.backslash.query', '-nm'])
+
+    def testGeoFilter(self):
+        geo_filters = dict([(f.get_name(), f) for f in filters.create_filters() if isinstance(f, filters.GeoFilter)])
+        #Radius: 1 degree of latitude is about 111 km
+        radius_filter = geo_filters['Site Radius']
+        self.assertEqual(0, radius_filter.set_values(['34.0', '-118.0', '50']), "Valid radius values were rejected.")
+        self.assertTrue(radius_filter.contains_point(34.4, -118.0), "Point 44 km away is outside the radius.")
+        self.assertFalse(radius_filter.contains_point(34.5, -118.0), "Point 56 km away is inside the radius.")
+        (min_lat, min_lon, max_lat, max_lon) = radius_filter.get_bounding_box()
+        self.assertAlmostEqual(34.4497, max_lat, 3, "Radius bounding box latitude is incorrect.")
+        #Longitude degrees are shorter away from the equator, so the box is wider than it is tall
+        self.assertTrue(max_lon-(-118.0)>max_lat-34.0, "Radius bounding box isn't widened for the latitude.")
+        #0.53 degrees of longitude at this latitude is about 49 km
+        self.assertTrue(radius_filter.contains_point(34.0, -117.47), "Point 49 km east is outside the radius.")
+        self.assertTrue(min_lon<=-118.53 and max_lon>=-117.47, "Points in the radius are outside its bounding box.")
+        #Bounding box, including its edges
+        box_filter = geo_filters['Site Bounding Box']
+        self.assertEqual(0, box_filter.set_values([33.5, -119.0, 34.5, -117.0]), "Valid box values were rejected.")
+        self.assertEqual((33.5, -119.0, 34.5, -117.0), box_filter.get_bounding_box(), "Box bounding box is incorrect.")
+        self.assertTrue(box_filter.contains_point(33.5, -117.0), "Point on the box edge is outside the box.")
+        self.assertFalse(box_filter.contains_point(34.6, -118.0), "Point north of the box is inside the box.")
+        #Concave polygon, shaped like a U opening to the north
+        polygon_filter = geo_filters['Site Polygon']
+        self.assertEqual(0, polygon_filter.set_values([34, -119, 34, -117, 35, -117, 35, -117.5, 34.5, -117.5, 34.5, -118.5, 35, -118.5, 35, -119]), "Valid polygon values were rejected.")
+        self.assertEqual((34, -119, 35, -117), polygon_filter.get_bounding_box(), "Polygon bounding box is incorrect.")
+        self.assertTrue(polygon_filter.contains_point(34.25, -118.0), "Point in the base of the polygon is outside it.")
+        self.assertTrue(polygon_filter.contains_point(34.75, -118.75), "Point in the arm of the polygon is outside it.")
+        self.assertFalse(polygon_filter.contains_point(34.75, -118.0), "Point in the notch of the polygon is inside it.")
+        self.assertFalse(polygon_filter.contains_point(33.9, -118.0), "Point south of the polygon is inside it.")
+        #Invalid values are rejected, and new values clear the sites found for the old ones
+        self.assertNotEqual(0, radius_filter.set_values([34.0, -118.0]), "Radius without a distance was accepted.")
+        self.assertNotEqual(0, radius_filter.set_values([34.0, -118.0, 0.0]), "Radius of 0 was accepted.")
+        self.assertNotEqual(0, box_filter.set_values([34.5, -119.0, 33.5, -117.0]), "Box with min lat above max lat was accepted.")
+        self.assertNotEqual(0, box_filter.set_values([33.5, -190.0, 34.5, -117.0]), "Box with an invalid longitude was accepted.")
+        self.assertNotEqual(0, polygon_filter.set_values([34, -119, 34, -117]), "Polygon with 2 vertices was accepted.")
+        self.assertNotEqual(0, polygon_filter.set_values(['north', -119, 34, -117, 35, -117]), "Polygon with a non-numeric value was accepted.")
+        box_filter.set_site_ids([1, 2])
+        box_filter.set_values([33.5, -119.0, 34.0, -118.0])
+        self.assertIsNone(box_filter.get_site_ids(), "Sites for the old values were kept.")
+
+    def testGeoFilterSort(self):
+        dp_list = data_products.create_data_products()
+        model = [m for m in models.create_models(dp_list) if m.get_name()=='Study 22.12 LF'][0]
+        dp = [d for d in dp_list if d.get_name()=='Site Info'][0]
+        box_filter = [f for f in filters.create_filters() if f.get_name()=='Site Bounding Box'][0]
+        box_filter.set_values([33.5, -119.0, 34.5, -117.0])
+        box_filter.set_site_ids([3, 1])
+        query = query_constructor.construct_queries(model, dp, [box_filter], None)
+        self.assertIn("CyberShake_Sites.CS_Site_ID in (3,1)", query.where_clauses, "Sites for the geographic filter weren't added to the query.")
+        #A shape has no field to sort on, so sorting by it is rejected rather than dropped
+        box_filter.set_sort(1)
+        with self.assertRaises(SystemExit):
+            query_constructor.construct_queries(model, dp, [box_filter], None)
+
+    def testQueryProfile(self):
+        input_file = 'tmpdir/unittest.IMs.json'
+        reference_output_file = 'tmpdir/unittest.IMs.query'
+        test_output_file = 'tmpdir/unittest.IMs.profile.query'
+        #Profiling shouldn't change the queries
+        for mode in ['cpu', 'mem']:
+            argv = ['-i', input_file, '-o', test_output_file, '-pr', mode]
+            run_query_builder.run_main(argv)
+            self.assertTrue(self.compare_query_files(reference_output_file, test_output_file), "Test query file %s does not match reference file %s." % (test_output_file, reference_output_file))
+        for report_file in ['tmpdir/unittest.IMs.profile.query_builder.prof', 'tmpdir/unittest.IMs.profile.query_builder.cpu.txt', 'tmpdir/unittest.IMs.profile.query_builder.cpu.collapsed', 'tmpdir/unittest.IMs.profile.query_builder.mem.txt', 'tmpdir/unittest.IMs.profile.query_builder.mem.collapsed']:
+            if not os.path.exists(report_file):
+                self.fail("Profile report %s was not created." % report_file)
+        with open('tmpdir/unittest.IMs.profile.query_builder.cpu.txt', 'r') as fp_in:
+            self.assertTrue(fp_in.read().find("Query construction")>-1, "CPU profile report doesn't include the time spent constructing the query.")
+            fp_in.close()
+
 if __name__=='__main__':
     test_suite = unittest.TestLoader().loadTestsFromTestCase(TestQueryBuilder)
     rc = unittest.TextTestRunner(verbosity=2).run(test_suite)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+import os
+import sys
+import unittest
+import shutil
+import json
+
+#Add src directory to find imports 
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
+sys.path.append("%s/src" % path_add)
+
+import utils.request_state as request_state
+import retrieve_cs_data
+
+class TestRequestState(unittest.TestCase):
+    '''Unit tests for the request state file'''
+
+    @classmethod
+    def setUpClass(self):
+        if not os.path.exists('tmpdir'):
+            os.mkdir('tmpdir')
+
+    @classmethod
+    def tearDownClass(self):
+        if os.path.exists('tmpdir'):
+            shutil.rmtree('tmpdir')
+
+    def testLoadAndAppend(self):
+        state_file = 'tmpdir/csdata.unittest_state.state'
+        output_file = 'tmpdir/unittest_state.csv'
+        with open(output_file, 'w') as fp_out:
+            fp_out.write("Run_ID\n1\n")
+            fp_out.close()
+        state = request_state.RequestState(state_file)
+        state.create()
+        state.mark_stage_complete(request_state.Stages.QUERY_BUILDER, 'abc')
+        state.close()
+        #A second run loads the file and adds to it
+        state = request_state.RequestState(state_file)
+        self.assertTrue(state.load(), "State file %s could not be loaded." % state_file)
+        self.assertTrue(state.is_stage_complete(request_state.Stages.QUERY_BUILDER, 'abc'), "Completed stage was not read back.")
+        self.assertFalse(state.is_stage_complete(request_state.Stages.QUERY_BUILDER, 'def'), "Stage with a different input checksum was treated as complete.")
+        state.mark_query_complete('q1', output_file, 1)
+        state.close()
+        state = request_state.RequestState(state_file)
+        self.assertTrue(state.load(), "State file %s could not be loaded." % state_file)
+        self.assertTrue(state.is_stage_complete(request_state.Stages.QUERY_BUILDER, 'abc'), "Completed stage was lost when the file was appended to.")
+        self.assertTrue(state.is_query_complete('q1'), "Completed query was not read back.")
+        self.assertFalse(state.is_query_complete('q2'), "Unknown query was treated as complete.")
+
+    def testTruncatedRecord(self):
+        state_file = 'tmpdir/csdata.unittest_truncated.state'
+        state = request_state.RequestState(state_file)
+        state.create()
+        state.mark_stage_complete(request_state.Stages.FILTER_GENERATOR)
+        state.close()
+        #A run killed mid-write leaves part of a record behind
+        with open(state_file, 'a') as fp_out:
+            fp_out.write('{"type": "stage", "sta')
+            fp_out.close()
+        state = request_state.RequestState(state_file)
+        self.assertTrue(state.load(), "State file %s with a cut off last record could not be loaded." % state_file)
+        self.assertTrue(state.is_stage_complete(request_state.Stages.FILTER_GENERATOR), "Stage before the cut off record was lost.")
+        state.mark_stage_complete(request_state.Stages.QUERY_BUILDER)
+        state.close()
+        #The new record should start on its own line, so it can be read back
+        state = request_state.RequestState(state_file)
+        self.assertTrue(state.load(), "State file %s could not be loaded after appending to it." % state_file)
+        self.assertTrue(state.is_stage_complete(request_state.Stages.QUERY_BUILDER), "Record appended after a cut off record was lost.")
+
+    def testVersionMismatch(self):
+        state_file = 'tmpdir/csdata.unittest_old.state'
+        with open(state_file, 'w') as fp_out:
+            fp_out.write("%s\n" % json.dumps({'type': 'version', 'version': request_state.STATE_VERSION+1}))
+            fp_out.write("%s\n" % json.dumps({'type': 'stage', 'stage': request_state.Stages.FILTER_GENERATOR, 'input_checksum': None}))
+            fp_out.close()
+        state = request_state.RequestState(state_file)
+        self.assertFalse(state.load(), "State file %s from another version was loaded." % state_file)
+        self.assertFalse(state.is_stage_complete(request_state.Stages.FILTER_GENERATOR), "Stage from another version's state file was used.")
+        #Writing to it starts a new file, rather than adding records which would never be read back
+        state.mark_stage_complete(request_state.Stages.QUERY_BUILDER)
+        state.close()
+        state = request_state.RequestState(state_file)
+        self.assertTrue(state.load(), "Replaced state file %s could not be loaded." % state_file)
+        self.assertTrue(state.is_stage_complete(request_state.Stages.QUERY_BUILDER), "Record written after the version mismatch was lost.")
+        self.assertFalse(state.is_stage_complete(request_state.Stages.FILTER_GENERATOR), "Stage from the old state file was kept.")
+    def testListWithoutState(self):
+        #Listing the filters or data products exits without leaving a state file behind
+        for (label, option) in [('unittest_filters', '-fl'), ('unittest_products', '-pl')]:
+            with self.assertRaises(SystemExit):
+                retrieve_cs_data.run_main([option, '-o', 'tmpdir', '-l', label])
+            state_file = request_state.get_state_filename('tmpdir', label)
+            self.assertFalse(os.path.exists(state_file), "Listing with %s created state file %s." % (option, state_file))
+
+if __name__=='__main__':
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(TestRequestState)
+    rc = unittest.TextTestRunner(verbosity=2).run(test_suite)
+    sys.exit(not rc.wasSuccessful())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import sys
+import unittest
+import shutil
+import filecmp
+import json
+
+#Add src directory to find imports 
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
+sys.path.append("%s/src" % path_add)
+
+import shard_tool.run_shard_tool as run_shard_tool
+
+class TestShardTool(unittest.TestCase):
+    '''Unit tests for shard tool'''
+
+    @classmethod
+    def setUpClass(self):
+        if not os.path.exists('tmpdir'):
+            os.mkdir('tmpdir')
+        shutil.copy('inputs/unittest.shard.json', 'tmpdir')
+        shutil.copy('inputs/unittest.Seis.csv', 'tmpdir')
+        shutil.copy('inputs/unittest.Seis.urls', 'tmpdir')
+
+    @classmethod
+    def tearDownClass(self):
+        if os.path.exists('tmpdir'):
+            shutil.rmtree('tmpdir')
+
+    def testPlanByEvent(self):
+        input_file = 'tmpdir/unittest.shard.json'
+        argv = ['plan', '-i', input_file, '-n', '2', '-l', 'unittest_plan', '-o', 'tmpdir']
+        run_shard_tool.run_main(argv)
+        plan_file = 'tmpdir/csdata.unittest_plan.shards'
+        if not os.path.exists(plan_file):
+            self.fail("Plan file %s was not created." % plan_file)
+        with open(plan_file, 'r') as fp_in:
+            plan_dict = json.load(fp_in)
+            fp_in.close()
+        self.assertEqual(len(plan_dict['shards']), 2, "Plan file %s should contain 2 shards." % plan_file)
+        #The request file is found relative to the plan file, wherever the merge is run from
+        self.assertEqual(os.path.abspath(input_file), os.path.abspath(os.path.join(os.path.dirname(plan_file), plan_dict['request_filename'])), "Request file in plan file %s is incorrect." % plan_file)
+        #Every event should be in exactly one shard, and each rupture should only be in one shard
+        with open(input_file, 'r') as fp_in:
+            events = sorted([tuple(e) for e in json.load(fp_in)['event_list']])
+            fp_in.close()
+        shard_events = []
+        shard_ruptures = []
+        for shard in plan_dict['shards']:
+            with open(os.path.join('tmpdir', shard['request_filename']), 'r') as fp_in:
+                shard_event_list = [tuple(e) for e in json.load(fp_in)['event_list']]
+                fp_in.close()
+            shard_events.extend(shard_event_list)
+            shard_ruptures.append(set([(e[0], e[1]) for e in shard_event_list]))
+        self.assertEqual(events, sorted(shard_events), "Shard event lists don't match the events in %s." % input_file)
+        self.assertEqual(len(shard_ruptures[0] & shard_ruptures[1]), 0, "A rupture was split across shards.")
+
+    def testMerge(self):
+        #Split the reference results into 2 shards, then check that merging them gives back the original
+        with open('tmpdir/unittest.Seis.csv', 'r') as fp_in:
+            data = fp_in.readlines()
+            fp_in.close()
+        with open('tmpdir/unittest.Seis.urls', 'r') as fp_in:
+            urls = fp_in.readlines()
+            fp_in.close()
+        plan_dict = {'request_label': 'unittest_merge', 'request_filename': 'unittest.shard.json', 'data_product': 'Seismograms', 'partition': 'event', 'shards': []}
+        for i, (start, end) in enumerate([(1, 3), (3, len(data))]):
+            label = 'unittest_merge.shard%d' % i
+            plan_dict['shards'].append({'label': label, 'request_filename': 'csdata.%s.json' % label, 'weight': end-start})
+            with open('tmpdir/csdata.%s.data.csv' % label, 'w') as fp_out:
+                fp_out.write(data[0])
+                fp_out.writelines(data[start:end])
+                fp_out.close()
+            with open('tmpdir/csdata.%s.urls' % label, 'w') as fp_out:
+                fp_out.writelines(urls[start-1:end-1])
+                fp_out.close()
+        plan_file = 'tmpdir/csdata.unittest_merge.shards'
+        with open(plan_file, 'w') as fp_out:
+            json.dump(plan_dict, fp_out)
+            fp_out.close()
+        run_shard_tool.run_main(['merge', '-p', plan_file])
+        test_output_file = 'tmpdir/csdata.unittest_merge.data.csv'
+        if not os.path.exists(test_output_file):
+            self.fail("Output file %s was not created." % test_output_file)
+        self.assertTrue(filecmp.cmp('tmpdir/unittest.Seis.csv', test_output_file), "Merged file %s does not match reference file %s." % (test_output_file, 'tmpdir/unittest.Seis.csv'))
+        test_output_file = 'tmpdir/csdata.unittest_merge.urls'
+        if not os.path.exists(test_output_file):
+            self.fail("Output file %s was not created." % test_output_file)
+        with open(test_output_file, 'r') as fp_in:
+            merged_urls = fp_in.readlines()
+            fp_in.close()
+        self.assertEqual(sorted(urls), merged_urls, "Merged URL file %s does not contain the shard URLs." % test_output_file)
+
+    def testSortedMerge(self):
+        #The last sort in the request is the one applied, here descending on source name
+        request_dict = {'model': {'name': 'Study 22.12 LF'}, 'products': {'name': 'Event Info'}, 'filters': [
+            {'name': 'Magnitude', 'filter_params': 2, 'values': [6.0, 8.0], 'sort': 1},
+            {'name': 'Source Name', 'filter_params': 1, 'values': ['a'], 'contains': True, 'sort': -1}]}
+        os.mkdir('tmpdir/unittest_sorted_merge')
+        with open('tmpdir/unittest_sorted_merge/unittest.sorted.json', 'w') as fp_out:
+            json.dump(request_dict, fp_out)
+            fp_out.close()
+        #Each shard is sorted the way MySQL orders strings, ignoring case.  One name has a newline in it.
+        header = 'Source_ID,Source_Name,Magnitude\n'
+        shard_rows = [['1,"san Andreas",7.1\n', '2,"Elsinore\nNorth",6.5\n'], ['3,"Whittier",6.8\n', '4,"Puente Hills",7.0\n', '5,None,6.2\n']]
+        plan_dict = {'request_label': 'unittest_sorted', 'request_filename': 'unittest.sorted.json', 'data_product': 'Event Info', 'partition': 'site', 'shards': []}
+        for i, rows in enumerate(shard_rows):
+            label = 'unittest_sorted.shard%d' % i
+            plan_dict['shards'].append({'label': label, 'request_filename': 'csdata.%s.json' % label, 'weight': len(rows)})
+            with open('tmpdir/unittest_sorted_merge/csdata.%s.data.csv' % label, 'w', newline='') as fp_out:
+                fp_out.write(header)
+                fp_out.writelines(rows)
+                fp_out.close()
+        plan_file = 'tmpdir/unittest_sorted_merge/csdata.unittest_sorted.shards'
+        with open(plan_file, 'w') as fp_out:
+            json.dump(plan_dict, fp_out)
+            fp_out.close()
+        run_shard_tool.run_main(['merge', '-p', plan_file])
+        with open('tmpdir/unittest_sorted_merge/csdata.unittest_sorted.data.csv', 'r', newline='') as fp_in:
+            merged_data = fp_in.read()
+            fp_in.close()
+        expected_data = header + '3,"Whittier",6.8\n1,"san Andreas",7.1\n4,"Puente Hills",7.0\n2,"Elsinore\nNorth",6.5\n5,None,6.2\n'
+        self.assertEqual(expected_data, merged_data, "Shard results were not merged in the database's order.")
+
+if __name__=='__main__':
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(TestShardTool)
+    rc = unittest.TextTestRunner(verbosity=2).run(test_suite)
+    sys.exit(not rc.wasSuccessful())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+BSD 3-Clause License
+
+Copyright (c) 2023, University of Southern California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import sys
+import unittest
+import shutil
+import sqlite3
+
+#Add src directory to find imports 
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(os.path.dirname(full_path)))
+sys.path.append("%s/src" % path_add)
+sys.path.append("%s/src/utils" % path_add)
+sys.path.append("%s/tests/tools" % path_add)
+
+import filt_gen.size_preview as size_preview
+import utils.construct_rvs_db as construct_rvs_db
+import utils.data_products as data_products
+import utils.filters as filters
+import utils.models as models
+import utils.utilities as utilities
+import synthetic_db
+
+class TestSizePreview(unittest.TestCase):
+    '''Unit tests for the Filter Generator's request size estimates'''
+
+    synthetic_db_file = 'tmpdir/unittest.synthetic.sqlite'
+    synthetic_config_file = 'tmpdir/unittest.synthetic.cfg'
+    mirror_file = 'tmpdir/unittest.preview_mirror.sqlite'
+    study_name = 'Study 22.12 LF'
+
+    @classmethod
+    def setUpClass(self):
+        if not os.path.exists('tmpdir'):
+            os.mkdir('tmpdir')
+        #3 sites, each with 4 sources of 2 ruptures with 5 rupture variations
+        synthetic_db.run_main(['-o', self.synthetic_db_file, '-ns', '3', '-nsrc', '4', '-nr', '2', '-nrv', '5', '-ni', '14'])
+        construct_rvs_db.generate_mirror({'study_names': self.study_name, 'output_filename': self.mirror_file, 'mirror': True}, utilities.read_config(self.synthetic_config_file))
+
+    @classmethod
+    def tearDownClass(self):
+        if os.path.exists('tmpdir'):
+            shutil.rmtree('tmpdir')
+
+    def get_request(self, dp_name):
+        dp_list = data_products.create_data_products()
+        model = [m for m in models.create_models(dp_list) if m.get_name()==self.study_name][0]
+        dp = [d for d in dp_list if d.get_name()==dp_name][0]
+        filter_dict = dict([(f.get_name(), f) for f in filters.create_filters()])
+        filter_dict['Intensity Measure Period'].set_values_list(model.get_periods())
+        #The box holds the first two sites, which are 0.05 degrees apart
+        (lat, lon) = synthetic_db.SITE_GRID_ORIGIN
+        filter_dict['Site Bounding Box'].set_values([lat-0.01, lon-0.01, lat+0.01, lon+0.06])
+        return (model, dp, filter_dict)
+
+    def run_counts(self, probe):
+        conn = sqlite3.connect(self.synthetic_db_file)
+        cur = conn.cursor()
+        counts = dict()
+        for name in probe['count_queries']:
+            cur.execute(probe['count_queries'][name])
+            counts[name] = int(cur.fetchone()[0])
+        conn.close()
+        return counts
+
+    def testIMProbe(self):
+        (model, dp, filter_dict) = self.get_request('Intensity Measures')
+        box_filter = filter_dict['Site Bounding Box']
+        period_filter = filter_dict['Intensity Measure Period']
+        self.assertEqual(0, period_filter.set_value(2.0), "Period filter value was rejected.")
+        probe = size_preview.get_probe(model, dp, [box_filter, period_filter], None, mirror_path=self.mirror_file)
+        self.assertIsNotNone(probe, "No estimate was made for the request.")
+        #The sites are looked up for the estimate without changing the selected filter
+        self.assertIsNone(box_filter.get_site_ids(), "Estimate changed the sites of the selected filter.")
+        self.assertFalse(probe['upper_bound'], "Estimate without IM value filters is marked as an upper bound.")
+        self.assertEqual(set(['im_types', 'rupture_variations']), set(probe['count_queries'].keys()), "IMs are estimated with the wrong count queries.")
+        counts = self.run_counts(probe)
+        self.assertEqual({'im_types': 1, 'rupture_variations': 80}, counts, "Counts for the request are incorrect.")
+        (rows, output_mb, temp_mb) = size_preview.get_sizes(probe, counts)
+        self.assertEqual(80, rows, "Estimated number of IMs is incorrect.")
+        self.assertAlmostEqual(80*probe['num_fields']*size_preview.BYTES_PER_FIELD/1000000.0, output_mb, 9, "Estimated output size is incorrect.")
+        self.assertIsNone(temp_mb, "IM requests shouldn't need temporary space.")
+        #IM value filters aren't counted, so the estimate is an upper bound
+        value_filter = filter_dict['Intensity Measure Value']
+        value_filter.set_value_range(0.0, 5.0)
+        probe = size_preview.get_probe(model, dp, [box_filter, period_filter, value_filter], None, mirror_path=self.mirror_file)
+        self.assertTrue(probe['upper_bound'], "Estimate with IM value filters isn't marked as an upper bound.")
+        #A shape with no sites in it can't be estimated
+        box_filter.set_values([0.0, 0.0, 1.0, 1.0])
+        self.assertIsNone(size_preview.get_probe(model, dp, [box_filter, period_filter], None, mirror_path=self.mirror_file), "Request with no sites was estimated.")
+
+    def testSiteInfoPreview(self):
+        (model, dp, filter_dict) = self.get_request('Site Info')
+        box_filter = filter_dict['Site Bounding Box']
+        preview = size_preview.SizePreview(mirror_path=self.mirror_file, config_filename=self.synthetic_config_file)
+        preview.start(model, dp, [box_filter], None)
+        preview.thread.join()
+        message = preview.get_message()
+        self.assertTrue(message is not None and message.startswith("Estimated size: 2 rows"), "Site Info estimate is incorrect: %s" % message)
+        self.assertIsNone(preview.get_message(), "Estimate was reported more than once.")
+        self.assertIsNone(box_filter.get_site_ids(), "Estimate changed the sites of the selected filter.")
+
+    def testSizes(self):
+        counts = {'rows': 10, 'runs': 3, 'im_types': 4, 'ruptures': 7, 'rupture_variations': 70}
+        probe = {'study_name': self.study_name, 'num_fields': 5, 'num_im_levels': 20, 'upper_bound': False}
+        expected_rows = {'Site Info': 10, 'Hazard Curves': 3*4*20, 'IM Statistics': 7*4, 'Intensity Measures': 70*4}
+        for (dp_name, rows) in expected_rows.items():
+            probe['data_product'] = dp_name
+            self.assertEqual((rows, rows*5*size_preview.BYTES_PER_FIELD/1000000.0, None), size_preview.get_sizes(probe, counts), "Sizes for %s are incorrect." % dp_name)
+        #Seismograms need at least as much temporary space as output
+        probe['data_product'] = 'Seismograms'
+        (rows, output_mb, temp_mb) = size_preview.get_sizes(probe, counts)
+        self.assertEqual(70, rows, "Number of seismograms is incorrect.")
+        self.assertAlmostEqual(70*utilities.get_rv_seismogram_size(self.study_name)/1000000.0, output_mb, 9, "Seismogram output size is incorrect.")
+        self.assertTrue(temp_mb>=output_mb, "Seismogram temporary space is less than the output size.")
+
+
+if __name__=='__main__':
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(TestSizePreview)
+    rc = unittest.TextTestRunner(verbosity=2).run(test_suite)
+    sys.exit(not rc.wasSuccessful())